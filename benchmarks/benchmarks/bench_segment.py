@@ -5,8 +5,10 @@ import numpy as np
 from dipy.data import get_fnames
 from dipy.io.streamline import load_tractogram
 from dipy.segment.clustering import QuickBundles as QB_New
+from dipy.segment.lsh import StreamlineLSH
 from dipy.segment.mask import bounding_box
 from dipy.segment.metricspeed import Metric
+from dipy.tracking.distances import bundles_distances_mdf
 from dipy.tracking.streamline import Streamlines, set_number_of_points
 
 
@@ -92,3 +94,45 @@ class BenchQuickbundles:
             self.basic_parameters.get("threshold", 10), metric=self.custom_metric
         )
         _ = qb.cluster(self.streamlines)
+
+
+class BenchStreamlineLSH:
+    def setup(self):
+        fname = get_fnames(name="fornix")
+        fornix = load_tractogram(fname, "same", bbox_valid_check=False).streamlines
+        fornix = Streamlines(fornix)
+
+        # A grid of 10 x 10 copies of the fornix as reference and one
+        # streamline out of ten as queries.
+        self.ref = Streamlines()
+        for dx in range(0, 400, 40):
+            for dy in range(0, 400, 40):
+                shifted = fornix.copy()
+                shifted._data += np.array([dx, dy, 0], dtype=np.float32)
+                self.ref.extend(shifted)
+        self.queries = self.ref[::10]
+
+        self.k = 5
+        self.ref_resampled = set_number_of_points(self.ref, nb_points=12)
+        self.queries_resampled = set_number_of_points(self.queries, nb_points=12)
+        mdf = bundles_distances_mdf(self.queries_resampled, self.ref_resampled)
+        self.exact_knn = np.argsort(mdf, axis=1)[:, : self.k]
+
+        self.index = StreamlineLSH(self.ref, rng=np.random.default_rng(42))
+
+    def time_exact_mdf(self):
+        bundles_distances_mdf(self.queries_resampled, self.ref_resampled)
+
+    def time_lsh_build(self):
+        StreamlineLSH(self.ref, rng=np.random.default_rng(42))
+
+    def time_lsh_knn_search(self):
+        self.index.knn_search(self.queries, k=self.k)
+
+    def time_lsh_radius_search(self):
+        self.index.radius_search(self.queries, 5.0)
+
+    def track_lsh_knn_recall(self):
+        ids, _ = self.index.knn_search(self.queries, k=self.k)
+        found = [len(set(a) & set(b)) for a, b in zip(ids, self.exact_knn)]
+        return np.sum(found) / self.exact_knn.size
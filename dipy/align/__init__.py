@@ -39,12 +39,14 @@ from dipy.align._public import (
     rigid_scaling,
     streamline_registration,
     syn_registration,
+    syn_template,
     translation,
     write_mapping,
 )
 
 __all__ = [
     "syn_registration",
+    "syn_template",
     "register_dwi_to_template",
     "write_mapping",
     "read_mapping",
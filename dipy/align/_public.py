@@ -7,22 +7,30 @@ streamlines.
 """
 
 import collections.abc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 from functools import partial
 import numbers
 from pathlib import Path
 import re
+import time
 from warnings import warn
 
 import nibabel as nib
 import numpy as np
 
+from dipy.align import floating, vector_fields as vfu
 from dipy.align.imaffine import (
     AffineMap,
     AffineRegistration,
     MutualInformationMetric,
     transform_centers_of_mass,
 )
-from dipy.align.imwarp import DiffeomorphicMap, SymmetricDiffeomorphicRegistration
+from dipy.align.imwarp import (
+    DiffeomorphicMap,
+    SymmetricDiffeomorphicRegistration,
+    get_direction_and_spacings,
+)
 from dipy.align.metrics import CCMetric, EMMetric, SSDMetric
 from dipy.align.streamlinear import StreamlineLinearRegistration
 from dipy.align.transforms import (
@@ -41,9 +49,11 @@ from dipy.testing.decorators import warning_for_keywords
 from dipy.tracking.streamline import set_number_of_points
 from dipy.tracking.utils import transform_tracking_output
 from dipy.utils.logging import logger
+from dipy.utils.multiproc import determine_num_processes
 
 __all__ = [
     "syn_registration",
+    "syn_template",
     "register_dwi_to_template",
     "write_mapping",
     "read_mapping",
@@ -66,6 +76,11 @@ syn_metric_dict = {"CC": CCMetric, "EM": EMMetric, "SSD": SSDMetric}
 
 affine_metric_dict = {"MI": MutualInformationMetric}
 
+# Default scale space of the affine registrations:
+_AFFINE_LEVEL_ITERS = (1000, 500, 100)
+_AFFINE_SIGMAS = (3, 1, 0.0)
+_AFFINE_FACTORS = (4, 2, 1)
+
 
 @warning_for_keywords()
 def _handle_pipeline_inputs(
@@ -106,6 +121,7 @@ def syn_registration(
     dim=3,
     level_iters=None,
     prealign=None,
+    low_memory=False,
     **metric_kwargs,
 ):
     """Register a 2D/3D source image (moving) to a 2D/3D target image (static).
@@ -129,6 +145,11 @@ def syn_registration(
         the number of iterations at each level of the Gaussian Pyramid (the
         length of the list defines the number of pyramid levels to be
         used). Default: [10, 10, 5].
+    low_memory : bool, optional
+        If True, the displacement fields are updated in place with single
+        precision work buffers, see
+        :class:`dipy.align.imwarp.SymmetricDiffeomorphicRegistration`.
+        Default: False.
     metric_kwargs : dict, optional
         Parameters for initialization of the metric object. If not provided,
         uses the default settings of each metric.
@@ -158,7 +179,10 @@ def syn_registration(
     use_metric = syn_metric_dict[metric.upper()](dim, **metric_kwargs)
 
     sdr = SymmetricDiffeomorphicRegistration(
-        use_metric, level_iters=level_iters, step_length=step_length
+        use_metric,
+        level_iters=level_iters,
+        step_length=step_length,
+        low_memory=low_memory,
     )
 
     mapping = sdr.optimize(
@@ -342,6 +366,306 @@ def read_mapping(disp, domain_img, codomain_img, *, prealign=None):
     return mapping
 
 
+def _copy_syn_registration(sdr):
+    """Copy a SymmetricDiffeomorphicRegistration to register another image
+
+    The copy shares the static cache of `sdr` and has its own metric and work
+    buffers, so that copies can be optimized concurrently.
+    """
+    sdr = copy.copy(sdr)
+    sdr.metric = copy.deepcopy(sdr.metric)
+    sdr._work_buffers = {}
+    return sdr
+
+
+def _normalize_intensities(image):
+    """Scale an image to [0, 1] by its min and max values"""
+    imin, imax = np.min(image), np.max(image)
+    if imax == imin:
+        return np.zeros(image.shape)
+    return (np.asarray(image, dtype=np.float64) - imin) / (imax - imin)
+
+
+def _template_shape_update(average, field, template_affine, gradient_step):
+    """Move the average image along the inverse of the mean field
+
+    The subjects see the template point x at x + field(x) on average. The
+    average image is moved towards this mean shape by sampling it at the
+    inverse of x -> x + gradient_step * field(x).
+    """
+    template_world2grid = np.linalg.inv(template_affine)
+    _, spacing = get_direction_and_spacings(template_affine, 3)
+    step = np.asarray(gradient_step * field, dtype=floating)
+    update = DiffeomorphicMap(
+        dim=3,
+        disp_shape=average.shape,
+        disp_grid2world=template_affine,
+        domain_shape=average.shape,
+        domain_grid2world=template_affine,
+        codomain_shape=average.shape,
+        codomain_grid2world=template_affine,
+    )
+    update.forward = step
+    update.backward = np.asarray(
+        vfu.invert_vector_field_fixed_point_3d(
+            step, template_world2grid, spacing, 20, 1e-3
+        )
+    )
+    return update.transform_inverse(average)
+
+
+def _save_atomically(save_f, fname):
+    """Save a file with `save_f(tmp_fname)` and then rename it to `fname`
+
+    An interrupted save never leaves a partial file at `fname`.
+    """
+    fname = Path(fname)
+    tmp_fname = fname.with_name("partial_" + fname.name)
+    save_f(tmp_fname)
+    tmp_fname.replace(fname)
+
+
+@warning_for_keywords()
+def syn_template(
+    images,
+    *,
+    affines=None,
+    template=None,
+    template_affine=None,
+    n_iterations=4,
+    gradient_step=0.25,
+    metric="CC",
+    level_iters=None,
+    step_length=0.25,
+    num_threads=1,
+    checkpoint_dir=None,
+    low_memory=False,
+    **metric_kwargs,
+):
+    """Build an unbiased template from a group of 3D images with SyN.
+
+    At each iteration, all the images are registered to the current template
+    with :func:`syn_registration`, and the new template is the average of the
+    registered images (scaled to [0, 1]), moved along the inverse of the mean
+    displacement field so that it is not biased towards the shape of the
+    initial template :footcite:p:`Avants2010`.
+
+    Parameters
+    ----------
+    images : sequence of 3D arrays, nib.Nifti1Image or str
+        The images of the group, as arrays, nifti images or paths to nifti
+        files. They are read when needed, so paths keep the memory footprint
+        independent of the size of the group. They are assumed to be affinely
+        pre-aligned.
+    affines : sequence of 4x4 arrays, optional
+        The affine of each image. Required for images provided as arrays. If
+        provided together with nifti images or paths, they over-ride the
+        affines stored in the files.
+    template : 3D array, nib.Nifti1Image or str, optional
+        The initial template. By default, the average of the images
+        (scaled to [0, 1]) resampled on the grid of the first image.
+    template_affine : 4x4 array, optional
+        The affine of the initial template. Required if `template` is an
+        array. The template is built on the grid of the initial template.
+    n_iterations : int, optional
+        The number of template iterations.
+    gradient_step : float, optional
+        The fraction of the mean displacement field applied to the average
+        image at each iteration.
+    metric : string, optional
+        The metric to be optimized. One of `CC`, `EM`, `SSD`.
+    level_iters : list of int, optional
+        The number of iterations at each level of the Gaussian pyramid of
+        each registration. Default: [10, 10, 5].
+    step_length : float, optional
+        The step length of each registration.
+    num_threads : int, optional
+        Number of images registered concurrently by a pool of threads. If
+        None, all available cores are used. If < 0 the maximal number of cores
+        minus ``num_threads + 1`` is used (enter -1 to use as many cores as
+        possible). 0 raises an error. Default: 1 (sequential registration).
+    checkpoint_dir : str or Path, optional
+        Directory where the template of each iteration and the mapping of
+        each image to it are saved. Files already present are reused, so an
+        interrupted run resumes where it stopped when called again with the
+        same directory and inputs.
+    low_memory : bool, optional
+        If True, the registrations update their displacement fields in place,
+        see :class:`dipy.align.imwarp.SymmetricDiffeomorphicRegistration`.
+    metric_kwargs : dict, optional
+        Parameters for initialization of the metric object. If not provided,
+        uses the default settings of each metric.
+
+    Returns
+    -------
+    template : 3D array
+        The final template, scaled to [0, 1].
+    template_affine : 4x4 array
+        The affine of the template.
+
+    Notes
+    -----
+    The scale space of the template is computed once per iteration and shared
+    by the registrations of all the images. The results do not depend on
+    `num_threads`. When several images are registered concurrently, each
+    registration runs its OpenMP kernels on a single thread.
+
+    In `checkpoint_dir`, ``template_{it:03d}.nii.gz`` (e.g.
+    ``template_002.nii.gz``) is the template used at iteration ``it``
+    (``template_{n_iterations:03d}.nii.gz`` is the final one) and
+    ``mapping_{it:03d}_{i:05d}.nii.gz`` (e.g. ``mapping_002_00015.nii.gz``)
+    is the mapping of image ``i`` to it, written with :func:`write_mapping`.
+    It can be read with ``read_mapping(fname, image_i, template_it)``.
+    Existing files are reused as they are; use a new directory when the
+    inputs change.
+
+    References
+    ----------
+    .. footbibliography::
+
+    """
+    n_images = len(images)
+    if n_images == 0:
+        raise ValueError("At least one image is needed to build a template")
+    if affines is None:
+        affines = [None] * n_images
+    elif len(affines) != n_images:
+        raise ValueError("There should be one affine per image")
+    if n_iterations < 1:
+        raise ValueError("n_iterations should be >= 1")
+    level_iters = level_iters or [10, 10, 5]
+
+    def read_image(ii):
+        data, affine = read_img_arr_or_path(images[ii], affine=affines[ii])
+        if data.ndim != 3:
+            raise ValueError(f"Image {ii} is not a 3D image")
+        return data, affine
+
+    if checkpoint_dir is not None:
+        checkpoint_dir = Path(checkpoint_dir)
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+    def template_fname(it):
+        return checkpoint_dir / f"template_{it:03d}.nii.gz"
+
+    def mapping_fname(it, ii):
+        return checkpoint_dir / f"mapping_{it:03d}_{ii:05d}.nii.gz"
+
+    num_threads = min(determine_num_processes(num_threads), n_images)
+    # Images registered concurrently use a single thread each in the
+    # registration and warping kernels, to not oversubscribe the cores.
+    kernel_threads = 1 if num_threads > 1 else None
+
+    # Resume from the latest saved template
+    first_iteration = 0
+    if checkpoint_dir is not None:
+        for it in range(n_iterations, -1, -1):
+            if template_fname(it).exists():
+                template, template_affine = load_nifti(template_fname(it))
+                first_iteration = it
+                break
+
+    if template is None:
+        first_image, template_affine = read_image(0)
+        template_shape = first_image.shape
+        template = np.zeros(template_shape)
+        for ii in range(n_images):
+            if ii == 0:
+                data, affine = first_image, template_affine
+            else:
+                data, affine = read_image(ii)
+            affine_map = AffineMap(
+                np.eye(4),
+                domain_grid_shape=template_shape,
+                domain_grid2world=template_affine,
+                codomain_grid_shape=data.shape,
+                codomain_grid2world=affine,
+            )
+            template += _normalize_intensities(affine_map.transform(data))
+        del first_image
+        template /= n_images
+    else:
+        template, template_affine = read_img_arr_or_path(
+            template, affine=template_affine
+        )
+        if template.ndim != 3:
+            raise ValueError("The template should be a 3D image")
+    template = np.asarray(template, dtype=floating)
+    if checkpoint_dir is not None and first_iteration == 0:
+        _save_atomically(
+            partial(save_nifti, data=template, affine=template_affine),
+            template_fname(0),
+        )
+
+    use_metric = syn_metric_dict[metric.upper()](3, **metric_kwargs)
+    sdr = SymmetricDiffeomorphicRegistration(
+        use_metric,
+        level_iters=level_iters,
+        step_length=step_length,
+        num_threads=kernel_threads,
+        low_memory=low_memory,
+        cache_static=True,
+    )
+    sdr.verbosity = 0
+
+    for it in range(first_iteration, n_iterations):
+
+        def register_image(ii, it=it, template=template):
+            start = time.perf_counter()
+            data, affine = read_image(ii)
+            moving = np.asarray(data, dtype=floating)
+            fname = None if checkpoint_dir is None else mapping_fname(it, ii)
+            if fname is not None and fname.exists():
+                mapping = read_mapping(
+                    fname,
+                    nib.Nifti1Image(moving, affine),
+                    nib.Nifti1Image(template, template_affine),
+                )
+                mapping.num_threads = kernel_threads
+            else:
+                mapping = _copy_syn_registration(sdr).optimize(
+                    template,
+                    moving,
+                    static_grid2world=template_affine,
+                    moving_grid2world=affine,
+                )
+                if fname is not None:
+                    _save_atomically(partial(write_mapping, mapping), fname)
+            warped = _normalize_intensities(mapping.transform(moving))
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Registered image {ii} to the template of iteration {it} "
+                f"in {elapsed:.2f} s"
+            )
+            return warped, mapping.get_forward_field()
+
+        # The images are processed in batches and summed in order, so that
+        # the template does not depend on num_threads and at most num_threads
+        # registrations are held in memory.
+        average = np.zeros(template.shape)
+        mean_field = np.zeros(template.shape + (3,))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for batch in range(0, n_images, num_threads):
+                ids = range(batch, min(batch + num_threads, n_images))
+                for warped, field in executor.map(register_image, ids):
+                    average += warped
+                    mean_field += field
+        average /= n_images
+        mean_field /= n_images
+
+        template = _template_shape_update(
+            average, mean_field, template_affine, gradient_step
+        )
+        template = np.asarray(_normalize_intensities(template), dtype=floating)
+        if checkpoint_dir is not None:
+            _save_atomically(
+                partial(save_nifti, data=template, affine=template_affine),
+                template_fname(it + 1),
+            )
+
+    return template, template_affine
+
+
 @warning_for_keywords()
 def resample(
     moving, static, *, moving_affine=None, static_affine=None, between_affine=None
@@ -523,15 +847,15 @@ def affine_registration(
     pipeline = pipeline or ["center_of_mass", "translation", "rigid", "affine"]
     optimizer_options = optimizer_options or {"gtol": 1e-4, "ftol": 1e-3}
     if level_iters is None:
-        level_iters = [1000, 500, 100]
+        level_iters = list(_AFFINE_LEVEL_ITERS)
         logger.info(
-            "Default level_iters have been updated to [1000, 500, 100] for "
+            f"Default level_iters have been updated to {level_iters} for "
             "performance improvement. Identical results are expected. In case "
             "of any discrepancy, you can revert to the previous default by "
             "setting level_iters=[10000, 1000, 100]."
         )
-    sigmas = sigmas or [3, 1, 0.0]
-    factors = factors or [4, 2, 1]
+    sigmas = sigmas or list(_AFFINE_SIGMAS)
+    factors = factors or list(_AFFINE_FACTORS)
 
     starting_was_supplied = starting_affine is not None
     static, static_affine, moving, moving_affine, starting_affine = (
@@ -554,10 +878,37 @@ def affine_registration(
         sigmas=sigmas,
         factors=factors,
         options=optimizer_options,
+        cache_static=True,
         verbosity=0,
     )
 
-    # Convert pipeline to sanitized list of str
+    pipeline = _sanitize_pipeline(pipeline)
+    if pipeline == ["center_of_mass"] and ret_metric:
+        raise ValueError(
+            "center of mass registration cannot return any quality metric."
+        )
+
+    resampled, final_affine, xopt, fopt = _run_affine_pipeline(
+        affreg,
+        static,
+        static_affine,
+        moving,
+        moving_affine,
+        pipeline,
+        starting_affine=starting_affine,
+        starting_was_supplied=starting_was_supplied,
+        static_mask=static_mask,
+        moving_mask=moving_mask,
+    )
+
+    # Return the optimization metric only if requested
+    if ret_metric:
+        return resampled, final_affine, xopt, fopt
+    return resampled, final_affine
+
+
+def _sanitize_pipeline(pipeline):
+    """Convert an affine registration pipeline to a list of str"""
     pipeline = list(pipeline)
     for fi, func in enumerate(pipeline):
         if callable(func):
@@ -569,19 +920,37 @@ def affine_registration(
             raise ValueError(
                 f"pipeline[{fi}] must be one of {list(_METHOD_DICT)}, got {func!r}"
             )
+    return pipeline
 
-    if pipeline == ["center_of_mass"] and ret_metric:
-        raise ValueError(
-            "center of mass registration cannot return any quality metric."
-        )
 
+def _run_affine_pipeline(
+    affreg,
+    static,
+    static_affine,
+    moving,
+    moving_affine,
+    pipeline,
+    *,
+    starting_affine,
+    starting_was_supplied,
+    static_mask,
+    moving_mask,
+    num_threads=None,
+):
+    """Run the steps of a sanitized pipeline with an AffineRegistration
+
+    Returns the resampled moving image, the final affine and the optimal
+    parameters and metric value of the last optimized step (None if there
+    is none). The moving image is resampled with `num_threads` threads.
+    """
+    xopt = fopt = None
     # Go through the selected transformation:
     for func in pipeline:
         logger.info(f"➞ Running {func} step from affine registration...")
         if func == "center_of_mass":
             if starting_affine is not None and starting_was_supplied:
                 wm = "starting_affine overwritten by center_of_mass transform"
-                warn(wm, UserWarning, stacklevel=2)
+                warn(wm, UserWarning, stacklevel=3)
 
             # multiply images by masks for transform_centers_of_mass
             static_masked, moving_masked = static, moving
@@ -621,14 +990,11 @@ def affine_registration(
         domain_grid2world=static_affine,
         codomain_grid_shape=moving.shape,
         codomain_grid2world=moving_affine,
+        num_threads=num_threads,
     )
 
     resampled = affine_map.transform(moving)
-
-    # Return the optimization metric only if requested
-    if ret_metric:
-        return resampled, final_affine, xopt, fopt
-    return resampled, final_affine
+    return resampled, final_affine, xopt, fopt
 
 
 center_of_mass = partial(affine_registration, pipeline=["center_of_mass"])
@@ -668,6 +1034,19 @@ _METHOD_DICT = {  # mapping from str key -> (callable, class) tuple
 }
 
 
+def _copy_affine_registration(affreg):
+    """Copy an AffineRegistration for the registration of another volume
+
+    The copy shares the static cache of `affreg` and has its own metric and
+    optimizer options, so that copies can be optimized concurrently.
+    """
+    affreg = copy.copy(affreg)
+    affreg.metric = copy.deepcopy(affreg.metric)
+    if affreg.options is not None:
+        affreg.options = dict(affreg.options)
+    return affreg
+
+
 @warning_for_keywords()
 def register_series(
     series,
@@ -679,6 +1058,8 @@ def register_series(
     static_mask=None,
     level_iters=None,
     optimizer_options=None,
+    num_threads=1,
+    out=None,
 ):
     """Register a series to a reference image.
 
@@ -715,14 +1096,38 @@ def register_series(
         Options to be passed to the optimizer. See `scipy.optimize.minimize`
         documentation for details.
 
+    num_threads : int, optional
+        Number of volumes registered concurrently by a pool of threads. If
+        None, all available cores are used. If < 0 the maximal number of cores
+        minus ``num_threads + 1`` is used (enter -1 to use as many cores as
+        possible). 0 raises an error. Default: 1 (sequential registration).
+        Volumes registered concurrently use a single thread each in the
+        metric and transform kernels.
+
+    out : 4D array, optional
+        Preallocated array of the shape of `series` (for example a memory-mapped
+        array) in which the transformed volumes are written. By default, a new
+        float64 array is allocated.
+
     Returns
     -------
     xformed, affines : 4D array with transformed data and a (4,4,n) array
     with 4x4 matrices associated with each of the volumes of the input moving
     data that was used to transform it into register with the static data.
 
+    Notes
+    -----
+    The scale space of the reference image is computed once and shared by the
+    registrations of all the volumes. The results do not depend on
+    `num_threads`. The registration time of each volume is logged.
+
     """
-    pipeline = pipeline or ["center_of_mass", "translation", "rigid", "affine"]
+    pipeline = _sanitize_pipeline(
+        pipeline or ["center_of_mass", "translation", "rigid", "affine"]
+    )
+    optimizer_options = optimizer_options or {"gtol": 1e-4, "ftol": 1e-3}
+    if level_iters is None:
+        level_iters = list(_AFFINE_LEVEL_ITERS)
 
     series, series_affine = read_img_arr_or_path(series, affine=series_affine)
     if isinstance(ref, numbers.Number):
@@ -740,28 +1145,75 @@ def register_series(
                 " or the index of one or more volumes",
             )
 
-    xformed = np.zeros(series.shape)
-    affines = np.zeros((4, 4, series.shape[-1]))
-    for ii in range(series.shape[-1]):
-        logger.info(f"Registering volume {ii} of the series...")
+    n_volumes = series.shape[-1]
+    if out is None:
+        xformed = np.zeros(series.shape)
+    elif out.shape != series.shape:
+        raise ValueError(
+            f"out has shape {out.shape}, expected the shape of the series "
+            f"{series.shape}"
+        )
+    else:
+        xformed = out
+    affines = np.zeros((4, 4, n_volumes))
+
+    num_threads = min(determine_num_processes(num_threads), n_volumes)
+    # Volumes registered concurrently use a single thread each in the
+    # metric and transform kernels, to not oversubscribe the cores.
+    kernel_threads = 1 if num_threads > 1 else None
+
+    affreg = AffineRegistration(
+        metric=MutualInformationMetric(num_threads=kernel_threads),
+        level_iters=level_iters,
+        sigmas=list(_AFFINE_SIGMAS),
+        factors=list(_AFFINE_FACTORS),
+        options=optimizer_options,
+        cache_static=True,
+        verbosity=0,
+    )
+
+    def register_volume(ii):
+        start = time.perf_counter()
         this_moving = series[..., ii]
         if isinstance(ref_as_idx, numbers.Number) and ii == ref_as_idx:
             # This is the reference! No need to move and the xform is I(4):
             xformed[..., ii] = this_moving
             affines[..., ii] = np.eye(4)
         else:
-            transformed, reg_affine = affine_registration(
-                this_moving,
+            transformed, reg_affine, _, _ = _run_affine_pipeline(
+                _copy_affine_registration(affreg),
                 ref,
-                moving_affine=series_affine,
-                static_affine=ref_affine,
-                pipeline=pipeline,
+                ref_affine,
+                this_moving,
+                series_affine,
+                pipeline,
+                starting_affine=np.eye(4),
+                starting_was_supplied=False,
                 static_mask=static_mask,
-                level_iters=level_iters,
-                optimizer_options=optimizer_options,
+                moving_mask=None,
+                num_threads=kernel_threads,
             )
             xformed[..., ii] = transformed
             affines[..., ii] = reg_affine
+        return time.perf_counter() - start
+
+    def report(ii, elapsed, done):
+        logger.info(
+            f"Registered volume {ii} of the series in {elapsed:.2f} s "
+            f"({done}/{n_volumes})"
+        )
+
+    if num_threads <= 1:
+        for ii in range(n_volumes):
+            logger.info(f"Registering volume {ii} of the series...")
+            report(ii, register_volume(ii), ii + 1)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {
+                executor.submit(register_volume, ii): ii for ii in range(n_volumes)
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                report(futures[future], future.result(), done)
 
     return xformed, affines
 
@@ -777,6 +1229,7 @@ def register_dwi_series(
     static_mask=None,
     level_iters=None,
     optimizer_options=None,
+    num_threads=1,
 ):
     """Register a DWI series to the mean of the B0 images in that series.
 
@@ -818,6 +1271,12 @@ def register_dwi_series(
         Options to be passed to the optimizer. See `scipy.optimize.minimize`
         documentation for details.
 
+    num_threads : int, optional
+        Number of volumes registered concurrently by a pool of threads. If
+        None, all available cores are used. If < 0 the maximal number of cores
+        minus ``num_threads + 1`` is used (enter -1 to use as many cores as
+        possible). 0 raises an error. Default: 1 (sequential registration).
+
     Returns
     -------
     xform_img, affine_array: a Nifti1Image containing the registered data and
@@ -834,7 +1293,7 @@ def register_dwi_series(
     if np.sum(gtab.b0s_mask) > 1:
         # First, register the b0s into one image and average:
         logger.info(
-            "Creating Reference Image by Registering " "b0 Volumes to Each Other..."
+            "Creating Reference Image by Registering b0 Volumes to Each Other..."
         )
         b0_img = nib.Nifti1Image(data[..., gtab.b0s_mask], affine)
         trans_b0, b0_affines = register_series(
@@ -844,6 +1303,7 @@ def register_dwi_series(
             static_mask=static_mask,
             level_iters=level_iters,
             optimizer_options=optimizer_options,
+            num_threads=num_threads,
         )
         ref_data = np.mean(trans_b0, -1, keepdims=True)
     else:
@@ -863,6 +1323,7 @@ def register_dwi_series(
         static_mask=static_mask,
         level_iters=level_iters,
         optimizer_options=optimizer_options,
+        num_threads=num_threads,
     )
     # Cut out the part pertaining to that first volume:
     affines = affines[..., 1:]
@@ -15,12 +15,15 @@ It remains licensed as the rest of PyCPD (MIT license as of October 2010).
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import numbers
 from warnings import warn
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 from dipy.testing.decorators import warning_for_keywords
+from dipy.utils.multiproc import determine_num_processes
 
 
 def gaussian_kernel(X, beta, Y=None):
@@ -63,9 +66,80 @@ def initialize_sigma2(X, Y):
     """
     (N, D) = X.shape
     (M, _) = Y.shape
-    diff = X[None, :, :] - Y[:, None, :]
-    err = diff**2
-    return np.sum(err) / (D * M * N)
+    # Sum of the squared distances between all pairs of points, computed
+    # from the centered points without forming the MxN pairs.
+    center = np.mean(X, axis=0)
+    X = X - center
+    Y = Y - center
+    err = (
+        M * np.sum(X**2)
+        + N * np.sum(Y**2)
+        - 2 * np.dot(np.sum(X, axis=0), np.sum(Y, axis=0))
+    )
+    return err / (D * M * N)
+
+
+def _dense_affinities(X, TY, sigma2, c, eps):
+    """Expectation step restricted to a chunk of target points
+
+    Parameters
+    ----------
+    X: numpy array
+        nxD array of target points of the chunk.
+
+    TY: numpy array
+        MxD array of transformed source points.
+
+    sigma2: float
+        Variance of the Gaussian mixture model.
+
+    c: float
+        Contribution of the uniform distribution to the normalization.
+
+    eps: float
+        Lower bound of the sum of the affinities of a target point.
+
+    Returns
+    -------
+    P1: numpy array
+        Contribution of the chunk to P1, shape (M,).
+
+    Pt1: numpy array
+        Pt1 of the target points of the chunk, shape (n,).
+
+    PX: numpy array
+        Contribution of the chunk to PX, shape (M, D).
+    """
+    P = np.sum((X[None, :, :] - TY[:, None, :]) ** 2, axis=2)
+    P = np.exp(-P / (2 * sigma2))
+    den = np.sum(P, axis=0, keepdims=True)
+    den = np.clip(den, eps, None) + c
+    P = np.divide(P, den)
+    return np.sum(P, axis=1), np.sum(P, axis=0), np.matmul(P, X)
+
+
+def _truncated_affinities(X, TY, sigma2, c, eps, radius, tree):
+    """Expectation step of a chunk of target points with a truncated kernel
+
+    Only the pairs of points closer than `radius` are considered. They are
+    found with the k-d tree `tree` of `TY`, and the memory used is
+    proportional to their number. See :func:`_dense_affinities` for the other
+    parameters and the returned values.
+    """
+    n = len(X)
+    M = len(TY)
+    pairs = cKDTree(X).sparse_distance_matrix(tree, radius, output_type="ndarray")
+    i = pairs["i"]
+    j = pairs["j"]
+    P = np.exp(-np.sum((X[i] - TY[j]) ** 2, axis=1) / (2 * sigma2))
+    den = np.clip(np.bincount(i, weights=P, minlength=n), eps, None) + c
+    P = P / den[i]
+    P1 = np.bincount(j, weights=P, minlength=M)
+    Pt1 = np.bincount(i, weights=P, minlength=n)
+    PX = np.empty((M, X.shape[1]))
+    for d in range(X.shape[1]):
+        PX[:, d] = np.bincount(j, weights=P * X[i, d], minlength=M)
+    return P1, Pt1, PX
 
 
 @warning_for_keywords()
@@ -160,7 +234,8 @@ class DeformableRegistration:
     P: numpy array
         MxN array of probabilities.
         P[m, n] represents the probability that the m-th source point
-        corresponds to the n-th target point.
+        corresponds to the n-th target point. It is only computed when
+        neither `chunk_size` nor `cutoff` are given, and None otherwise.
 
     Pt1: numpy array
         Nx1 column array. Multiplication result between the transpose of P
@@ -185,6 +260,22 @@ class DeformableRegistration:
 
     num_eig: int
         Number of eigenvectors to use in lowrank calculation.
+
+    chunk_size: int or None
+        Number of target points whose affinities are evaluated at once in
+        the expectation step. If given, the MxN matrix P is not formed and
+        the expectation step uses O(M * chunk_size) memory.
+
+    cutoff: float or None
+        If given, the Gaussian affinities between points farther apart than
+        ``cutoff * sqrt(sigma2)`` are neglected in the expectation step.
+        The remaining pairs are found with a k-d tree, so that the memory
+        and time used are proportional to their number rather than to MxN.
+
+    num_threads: int
+        Number of chunks of target points processed concurrently by a pool
+        of threads in the expectation step. If None, all available cores
+        are used. The result does not depend on the number of threads.
     """
 
     def __init__(
@@ -200,6 +291,9 @@ class DeformableRegistration:
         max_iterations=None,
         tolerance=None,
         w=None,
+        chunk_size=None,
+        cutoff=None,
+        num_threads=1,
         **kwargs,
     ):
         if not isinstance(X, np.ndarray) or X.ndim != 2:
@@ -245,6 +339,19 @@ class DeformableRegistration:
             msg += f"for w instead got: {w}"
             raise ValueError(msg)
 
+        if chunk_size is not None and (
+            not isinstance(chunk_size, numbers.Integral) or chunk_size < 1
+        ):
+            msg = "Expected a positive integer for chunk_size "
+            msg += f"instead got: {chunk_size}"
+            raise ValueError(msg)
+
+        if cutoff is not None and (
+            not isinstance(cutoff, numbers.Number) or cutoff <= 0
+        ):
+            msg = f"Expected a positive value for cutoff instead got: {cutoff}"
+            raise ValueError(msg)
+
         self.X = X
         self.Y = Y
         self.TY = Y
@@ -257,7 +364,13 @@ class DeformableRegistration:
         self.iteration = 0
         self.diff = np.inf
         self.q = np.inf
-        self.P = np.zeros((self.M, self.N))
+        self.chunk_size = chunk_size
+        self.cutoff = cutoff
+        self.num_threads = determine_num_processes(num_threads)
+        if chunk_size is None and cutoff is None:
+            self.P = np.zeros((self.M, self.N))
+        else:
+            self.P = None
         self.Pt1 = np.zeros((self.N,))
         self.P1 = np.zeros((self.M,))
         self.PX = np.zeros((self.M, self.D))
@@ -447,6 +560,10 @@ class DeformableRegistration:
 
     def expectation(self):
         """Compute the expectation step of the EM algorithm."""
+        if self.P is None:
+            self._chunked_expectation()
+            return
+
         # (M, N)
         P = np.sum((self.X[None, :, :] - self.TY[:, None, :]) ** 2, axis=2)
         P = np.exp(-P / (2 * self.sigma2))
@@ -467,6 +584,57 @@ class DeformableRegistration:
         self.Np = np.sum(self.P1)
         self.PX = np.matmul(self.P, self.X)
 
+    def _chunked_expectation(self):
+        """Compute the expectation step by chunks of target points.
+
+        The products of P are accumulated chunk by chunk, in order, so that
+        the MxN matrix P is never formed.
+        """
+        c = (
+            (2 * np.pi * self.sigma2) ** (self.D / 2)
+            * self.w
+            / (1.0 - self.w)
+            * self.M
+            / self.N
+        )
+        eps = np.finfo(self.X.dtype).eps
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, 2**20 // max(self.M, 1))
+
+        affinities = _dense_affinities
+        args = (self.sigma2, c, eps)
+        if self.cutoff is not None:
+            radius = self.cutoff * np.sqrt(self.sigma2)
+            # The truncation only pays off once the kernel is narrower than
+            # the extent of the point clouds.
+            points = np.concatenate((self.X, self.TY))
+            if radius < np.linalg.norm(np.ptp(points, axis=0)):
+                affinities = _truncated_affinities
+                args += (radius, cKDTree(self.TY))
+
+        def _chunk(start):
+            return affinities(self.X[start : start + chunk_size], self.TY, *args)
+
+        starts = range(0, self.N, chunk_size)
+        executor = None
+        if self.num_threads > 1:
+            executor = ThreadPoolExecutor(self.num_threads)
+        run = map if executor is None else executor.map
+
+        self.P1 = np.zeros(self.M)
+        self.PX = np.zeros((self.M, self.D))
+        self.Pt1 = np.zeros(self.N)
+        try:
+            for start, (P1, Pt1, PX) in zip(starts, run(_chunk, starts)):
+                self.P1 += P1
+                self.PX += PX
+                self.Pt1[start : start + chunk_size] = Pt1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.Np = np.sum(self.P1)
+
     def maximization(self):
         """Compute the maximization step of the EM algorithm."""
         self.update_transform()
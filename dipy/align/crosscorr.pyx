@@ -5,6 +5,14 @@ from dipy.align.fused_types cimport floating
 cimport cython
 cimport numpy as cnp
 
+from cython.parallel import prange, threadid
+
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+
+DEF SLAB_SLICES = 32
+
 
 cdef inline int _int_max(int a, int b) noexcept nogil:
     r"""
@@ -125,6 +133,153 @@ cdef inline void _update_factors(double[:, :, :, :] factors,
             factors[ss, rr, cc, SIJ] += sval*mval
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _precompute_cc_factors_slab(floating[:, :, :] static,
+                                      floating[:, :, :] moving,
+                                      cnp.npy_intp radius,
+                                      cnp.npy_intp first,
+                                      cnp.npy_intp last,
+                                      double[:, :, :, :] temp,
+                                      floating[:, :, :, :] factors) noexcept nogil:
+    r"""Precomputes the CC factors of slices `first` to `last` - 1
+
+    The running sums are started `radius` slices before `first` (or at the
+    first slice of the volume), so slabs can be computed independently.
+
+    Parameters
+    ----------
+    static : array, shape (S, R, C)
+        the static volume
+    moving : array, shape (S, R, C)
+        the moving volume
+    radius : int
+        the radius of the neighborhood
+    first : int
+        first slice of the slab
+    last : int
+        last slice of the slab (exclusive)
+    temp : array, shape (2, R, C, 5)
+        buffer holding the running sums of two consecutive slices
+    factors : array, shape (S, R, C, 5)
+        the buffer to write the factors of the slab to
+    """
+    cdef:
+        cnp.npy_intp ns = static.shape[0]
+        cnp.npy_intp nr = static.shape[1]
+        cnp.npy_intp nc = static.shape[2]
+        cnp.npy_intp side = 2 * radius + 1
+        cnp.npy_intp start = _int_max(0, first - radius)
+        cnp.npy_intp firstc, lastc, firstr, lastr, firsts, lasts
+        cnp.npy_intp s, r, c, it, sides, sider, sidec
+        double cnt
+        cnp.npy_intp sss, ss, rr, cc, prev_ss, prev_rr, prev_cc
+        double Imean, Jmean, IJprods, Isq, Jsq
+
+    sss = 1
+    for s in range(start, last + radius):
+        ss = _wrap(s - radius, ns)
+        sss = 1 - sss
+        firsts = _int_max(0, ss - radius)
+        lasts = _int_min(ns - 1, ss + radius)
+        sides = (lasts - firsts + 1)
+        for r in range(nr+radius):
+            rr = _wrap(r - radius, nr)
+            firstr = _int_max(0, rr - radius)
+            lastr = _int_min(nr - 1, rr + radius)
+            sider = (lastr - firstr + 1)
+            for c in range(nc+radius):
+                cc = _wrap(c - radius, nc)
+                # New corner
+                _update_factors(temp, moving, static,
+                                sss, rr, cc, s, r, c, 0)
+
+                # Add signed sub-volumes
+                if s > start:
+                    prev_ss = 1 - sss
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += temp[prev_ss, rr, cc, it]
+                    if r > 0:
+                        prev_rr = _wrap(rr-1, nr)
+                        for it in range(5):
+                            temp[sss, rr, cc, it] -= \
+                                temp[prev_ss, prev_rr, cc, it]
+                        if c > 0:
+                            prev_cc = _wrap(cc-1, nc)
+                            for it in range(5):
+                                temp[sss, rr, cc, it] += \
+                                    temp[prev_ss, prev_rr, prev_cc, it]
+                    if c > 0:
+                        prev_cc = _wrap(cc-1, nc)
+                        for it in range(5):
+                            temp[sss, rr, cc, it] -= \
+                                temp[prev_ss, rr, prev_cc, it]
+                if r > 0:
+                    prev_rr = _wrap(rr-1, nr)
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += \
+                            temp[sss, prev_rr, cc, it]
+                    if c > 0:
+                        prev_cc = _wrap(cc-1, nc)
+                        for it in range(5):
+                            temp[sss, rr, cc, it] -= \
+                                temp[sss, prev_rr, prev_cc, it]
+                if c > 0:
+                    prev_cc = _wrap(cc-1, nc)
+                    for it in range(5):
+                        temp[sss, rr, cc, it] += temp[sss, rr, prev_cc, it]
+
+                # Add signed corners
+                if s - side >= start:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s-side, r, c, -1)
+                    if r >= side:
+                        _update_factors(temp, moving, static,
+                                        sss, rr, cc, s-side, r-side, c, 1)
+                        if c >= side:
+                            _update_factors(temp, moving, static, sss, rr,
+                                            cc, s-side, r-side, c-side, -1)
+                    if c >= side:
+                        _update_factors(temp, moving, static,
+                                        sss, rr, cc, s-side, r, c-side, 1)
+                if r >= side:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s, r-side, c, -1)
+                    if c >= side:
+                        _update_factors(temp, moving, static,
+                                        sss, rr, cc, s, r-side, c-side, 1)
+
+                if c >= side:
+                    _update_factors(temp, moving, static,
+                                    sss, rr, cc, s, r, c-side, -1)
+                # Compute final factors
+                if s >= first + radius and r >= radius and c >= radius:
+                    firstc = _int_max(0, cc - radius)
+                    lastc = _int_min(nc - 1, cc + radius)
+                    sidec = (lastc - firstc + 1)
+                    cnt = sides*sider*sidec
+                    Imean = temp[sss, rr, cc, SI] / cnt
+                    Jmean = temp[sss, rr, cc, SJ] / cnt
+                    IJprods = (temp[sss, rr, cc, SIJ] -
+                               Jmean * temp[sss, rr, cc, SI] -
+                               Imean * temp[sss, rr, cc, SJ] +
+                               cnt * Jmean * Imean)
+                    Isq = (temp[sss, rr, cc, SI2] -
+                           Imean * temp[sss, rr, cc, SI] -
+                           Imean * temp[sss, rr, cc, SI] +
+                           cnt * Imean * Imean)
+                    Jsq = (temp[sss, rr, cc, SJ2] -
+                           Jmean * temp[sss, rr, cc, SJ] -
+                           Jmean * temp[sss, rr, cc, SJ] +
+                           cnt * Jmean * Jmean)
+                    factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
+                    factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
+                    factors[ss, rr, cc, 2] = IJprods
+                    factors[ss, rr, cc, 3] = Isq
+                    factors[ss, rr, cc, 4] = Jsq
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -147,6 +302,12 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         the moving volume (notice that both images must already be in a common
         reference domain, i.e. the same S, R, C)
     radius : the radius of the neighborhood (cube of (2 * radius + 1)^3 voxels)
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -160,6 +321,12 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
             - factors[:,:,:,3] : sum of sq. values of static along the neighborhood
             - factors[:,:,:,4] : sum of sq. values of moving along the neighborhood
 
+    Notes
+    -----
+    The volume is split in slabs of 32 slices whose running sums are computed
+    independently, in parallel. The slabs do not depend on the number of
+    threads, so neither does the result.
+
     References
     ----------
     .. footbibliography::
@@ -168,118 +335,31 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         cnp.npy_intp ns = static.shape[0]
         cnp.npy_intp nr = static.shape[1]
         cnp.npy_intp nc = static.shape[2]
-        cnp.npy_intp side = 2 * radius + 1
-        cnp.npy_intp firstc, lastc, firstr, lastr, firsts, lasts
-        cnp.npy_intp s, r, c, it, sides, sider, sidec
-        double cnt
-        cnp.npy_intp ssss, sss, ss, rr, cc, prev_ss, prev_rr, prev_cc
-        double Imean, Jmean, IJprods, Isq, Jsq
-        double[:, :, :, :] temp = np.zeros((2, nr, nc, 5), dtype=np.float64)
+        cnp.npy_intp nslabs = (ns + SLAB_SLICES - 1) // SLAB_SLICES
+        cnp.npy_intp slab
+        int tid
+        int threads_to_use = -1
+        double[:, :, :, :, :] temp
         floating[:, :, :, :] factors = np.zeros((ns, nr, nc, 5),
                                                 dtype=np.asarray(static).dtype)
 
-    with nogil:
-        sss = 1
-        for s in range(ns+radius):
-            ss = _wrap(s - radius, ns)
-            sss = 1 - sss
-            firsts = _int_max(0, ss - radius)
-            lasts = _int_min(ns - 1, ss + radius)
-            sides = (lasts - firsts + 1)
-            for r in range(nr+radius):
-                rr = _wrap(r - radius, nr)
-                firstr = _int_max(0, rr - radius)
-                lastr = _int_min(nr - 1, rr + radius)
-                sider = (lastr - firstr + 1)
-                for c in range(nc+radius):
-                    cc = _wrap(c - radius, nc)
-                    # New corner
-                    _update_factors(temp, moving, static,
-                                    sss, rr, cc, s, r, c, 0)
-
-                    # Add signed sub-volumes
-                    if s > 0:
-                        prev_ss = 1 - sss
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += temp[prev_ss, rr, cc, it]
-                        if r > 0:
-                            prev_rr = _wrap(rr-1, nr)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, prev_rr, cc, it]
-                            if c > 0:
-                                prev_cc = _wrap(cc-1, nc)
-                                for it in range(5):
-                                    temp[sss, rr, cc, it] += \
-                                        temp[prev_ss, prev_rr, prev_cc, it]
-                        if c > 0:
-                            prev_cc = _wrap(cc-1, nc)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, rr, prev_cc, it]
-                    if r > 0:
-                        prev_rr = _wrap(rr-1, nr)
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += \
-                                temp[sss, prev_rr, cc, it]
-                        if c > 0:
-                            prev_cc = _wrap(cc-1, nc)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[sss, prev_rr, prev_cc, it]
-                    if c > 0:
-                        prev_cc = _wrap(cc-1, nc)
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += temp[sss, rr, prev_cc, it]
+    threads_to_use = determine_num_threads(num_threads)
+    if threads_to_use > nslabs:
+        threads_to_use = _int_max(1, nslabs)
+    set_num_threads(threads_to_use)
+    # One pair of running sum planes per thread
+    temp = np.zeros((threads_to_use, 2, nr, nc, 5), dtype=np.float64)
 
-                    # Add signed corners
-                    if s >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s-side, r, c, -1)
-                        if r >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r-side, c, 1)
-                            if c >= side:
-                                _update_factors(temp, moving, static, sss, rr,
-                                                cc, s-side, r-side, c-side, -1)
-                        if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r, c-side, 1)
-                    if r >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r-side, c, -1)
-                        if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s, r-side, c-side, 1)
-
-                    if c >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r, c-side, -1)
-                    # Compute final factors
-                    if s >= radius and r >= radius and c >= radius:
-                        firstc = _int_max(0, cc - radius)
-                        lastc = _int_min(nc - 1, cc + radius)
-                        sidec = (lastc - firstc + 1)
-                        cnt = sides*sider*sidec
-                        Imean = temp[sss, rr, cc, SI] / cnt
-                        Jmean = temp[sss, rr, cc, SJ] / cnt
-                        IJprods = (temp[sss, rr, cc, SIJ] -
-                                   Jmean * temp[sss, rr, cc, SI] -
-                                   Imean * temp[sss, rr, cc, SJ] +
-                                   cnt * Jmean * Imean)
-                        Isq = (temp[sss, rr, cc, SI2] -
-                               Imean * temp[sss, rr, cc, SI] -
-                               Imean * temp[sss, rr, cc, SI] +
-                               cnt * Imean * Imean)
-                        Jsq = (temp[sss, rr, cc, SJ2] -
-                               Jmean * temp[sss, rr, cc, SJ] -
-                               Jmean * temp[sss, rr, cc, SJ] +
-                               cnt * Jmean * Jmean)
-                        factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
-                        factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
-                        factors[ss, rr, cc, 2] = IJprods
-                        factors[ss, rr, cc, 3] = Isq
-                        factors[ss, rr, cc, 4] = Jsq
+    with nogil:
+        for slab in prange(nslabs, schedule="dynamic",
+                           num_threads=threads_to_use):
+            tid = threadid()
+            _precompute_cc_factors_slab(
+                static, moving, radius, slab * SLAB_SLICES,
+                _int_min(ns, (slab + 1) * SLAB_SLICES), temp[tid], factors)
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return factors
 
 
@@ -347,7 +427,7 @@ def precompute_cc_factors_3d_test(floating[:, :, :] static,
 @cython.cdivision(True)
 def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                                floating[:, :, :, :] factors,
-                               cnp.npy_intp radius):
+                               cnp.npy_intp radius, num_threads=None):
     """Gradient of the CC Metric w.r.t. the forward transformation.
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -366,6 +446,12 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -374,6 +460,11 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         displacement associated to the moving volume
     energy : the cross correlation energy (data term) at this iteration
 
+    Notes
+    -----
+    The energy is accumulated per slice and the slices are then added in
+    order, so the result does not depend on the number of threads.
+
     References
     ----------
     .. footbibliography::
@@ -384,11 +475,19 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         cnp.npy_intp nc = grad_static.shape[2]
         double energy = 0
         cnp.npy_intp s, r, c
-        double Ii, Ji, sfm, sff, smm, localCorrelation, temp
+        int threads_to_use = -1
+        double Ii, Ji, sfm, sff, smm, localCorrelation, temp, slice_energy
+        double[:] energies = np.zeros(ns, dtype=np.float64)
         floating[:, :, :, :] out =\
             np.zeros((ns, nr, nc, 3), dtype=np.asarray(grad_static).dtype)
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, schedule="static",
+                        num_threads=threads_to_use):
+            slice_energy = 0
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -402,11 +501,17 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                     if sff * smm > 1e-5:
                         localCorrelation = sfm * sfm / (sff * smm)
                     if localCorrelation < 1:  # avoid bad values...
-                        energy -= localCorrelation
+                        slice_energy = slice_energy - localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ji - sfm / sff * Ii)
-                    out[s, r, c, 0] -= temp * grad_static[s, r, c, 0]
-                    out[s, r, c, 1] -= temp * grad_static[s, r, c, 1]
-                    out[s, r, c, 2] -= temp * grad_static[s, r, c, 2]
+                    out[s, r, c, 0] = out[s, r, c, 0] - temp * grad_static[s, r, c, 0]
+                    out[s, r, c, 1] = out[s, r, c, 1] - temp * grad_static[s, r, c, 1]
+                    out[s, r, c, 2] = out[s, r, c, 2] - temp * grad_static[s, r, c, 2]
+            energies[s] = slice_energy
+        for s in range(radius, ns-radius):
+            energy += energies[s]
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out), energy
 
 
@@ -415,7 +520,7 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
 @cython.cdivision(True)
 def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                                 floating[:, :, :, :] factors,
-                                cnp.npy_intp radius):
+                                cnp.npy_intp radius, num_threads=None):
     """Gradient of the CC Metric w.r.t. the backward transformation.
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -434,6 +539,12 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -442,6 +553,11 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         displacement associated to the static volume
     energy : the cross correlation energy (data term) at this iteration
 
+    Notes
+    -----
+    The energy is accumulated per slice and the slices are then added in
+    order, so the result does not depend on the number of threads.
+
     References
     ----------
     .. footbibliography::
@@ -452,13 +568,20 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         cnp.npy_intp nr = grad_moving.shape[1]
         cnp.npy_intp nc = grad_moving.shape[2]
         cnp.npy_intp s, r, c
+        int threads_to_use = -1
         double energy = 0
-        double Ii, Ji, sfm, sff, smm, localCorrelation, temp
+        double Ii, Ji, sfm, sff, smm, localCorrelation, temp, slice_energy
+        double[:] energies = np.zeros(ns, dtype=np.float64)
         floating[:, :, :, :] out = np.zeros((ns, nr, nc, 3), dtype=ftype)
 
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
 
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, schedule="static",
+                        num_threads=threads_to_use):
+            slice_energy = 0
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -472,11 +595,17 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                     if sff * smm > 1e-5:
                         localCorrelation = sfm * sfm / (sff * smm)
                     if localCorrelation < 1:  # avoid bad values...
-                        energy -= localCorrelation
+                        slice_energy = slice_energy - localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ii - sfm / smm * Ji)
-                    out[s, r, c, 0] -= temp * grad_moving[s, r, c, 0]
-                    out[s, r, c, 1] -= temp * grad_moving[s, r, c, 1]
-                    out[s, r, c, 2] -= temp * grad_moving[s, r, c, 2]
+                    out[s, r, c, 0] = out[s, r, c, 0] - temp * grad_moving[s, r, c, 0]
+                    out[s, r, c, 1] = out[s, r, c, 1] - temp * grad_moving[s, r, c, 1]
+                    out[s, r, c, 2] = out[s, r, c, 2] - temp * grad_moving[s, r, c, 2]
+            energies[s] = slice_energy
+        for s in range(radius, ns-radius):
+            energy += energies[s]
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out), energy
 
 
@@ -7,7 +7,12 @@
 import numpy as np
 cimport cython
 cimport numpy as cnp
+from cython.parallel import prange
+
 from dipy.align.fused_types cimport floating
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 cdef extern from "dpy_math.h" nogil:
     int dpy_isinf(double)
     double floor(double)
@@ -450,7 +455,8 @@ def compute_em_demons_step_3d(floating[:,:,:] delta_field,
                               floating[:,:,:] sigma_sq_field,
                               floating[:,:,:,:] gradient_moving,
                               double sigma_sq_x,
-                              floating[:,:,:,:] out):
+                              floating[:,:,:,:] out,
+                              num_threads=None):
     r"""Demons step for EM metric in 3D
 
     Computes the demons step :footcite:p:`Vercauteren2009` for SSD-driven
@@ -483,6 +489,12 @@ def compute_em_demons_step_3d(floating[:,:,:] delta_field,
         $\sigma_x^2$ in algorithm 1 of footcite:p:`Vercauteren2009`.
     out : array, shape (S, R, C, 2)
         the resulting demons step will be written to this array
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -492,6 +504,11 @@ def compute_em_demons_step_3d(floating[:,:,:] delta_field,
     energy : float
         the current em energy (before applying the returned demons_step)
 
+    Notes
+    -----
+    The energy is accumulated per slice and the slices are then added in
+    order, so the result does not depend on the number of threads.
+
     References
     ----------
     .. footbibliography::
@@ -501,20 +518,25 @@ def compute_em_demons_step_3d(floating[:,:,:] delta_field,
         cnp.npy_intp nr = delta_field.shape[1]
         cnp.npy_intp nc = delta_field.shape[2]
         cnp.npy_intp i, j, k
-        double delta, sigma_sq_i, nrm2, energy, den
+        int threads_to_use = -1
+        double delta, sigma_sq_i, nrm2, energy, den, slice_energy
+        double[:] energies = np.zeros(ns, dtype=np.float64)
 
     if out is None:
         out = np.zeros((ns, nr, nc, 3), dtype=np.asarray(delta_field).dtype)
 
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
 
-        energy = 0
-        for k in range(ns):
+        for k in prange(ns, schedule="static", num_threads=threads_to_use):
+            slice_energy = 0
             for i in range(nr):
                 for j in range(nc):
                     sigma_sq_i = sigma_sq_field[k,i,j]
                     delta = delta_field[k,i,j]
-                    energy += (delta**2)
+                    slice_energy = slice_energy + delta**2
                     if dpy_isinf(sigma_sq_i) != 0:
                         out[k, i, j, 0] = 0
                         out[k, i, j, 1] = 0
@@ -543,4 +565,11 @@ def compute_em_demons_step_3d(floating[:,:,:] delta_field,
                                 gradient_moving[k, i, j, 1] / den)
                             out[k, i, j, 2] = (sigma_sq_x * delta *
                                 gradient_moving[k, i, j, 2] / den)
+            energies[k] = slice_energy
+        energy = 0
+        for k in range(ns):
+            energy += energies[k]
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out), energy
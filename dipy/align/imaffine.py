@@ -37,6 +37,10 @@ References
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import itertools
+import threading
 from warnings import warn
 
 import numpy as np
@@ -51,10 +55,12 @@ from dipy.align.parzenhist import (
     sample_domain_regular,
 )
 from dipy.align.scalespace import IsotropicScaleSpace
+from dipy.core.geometry import euler_matrix
 from dipy.core.interpolation import interpolate_scalar_2d, interpolate_scalar_3d
 from dipy.core.optimize import Optimizer
 from dipy.testing.decorators import warning_for_keywords
 from dipy.utils.logging import logger
+from dipy.utils.multiproc import determine_num_processes
 
 _interp_options = ["nearest", "linear"]
 _transform_method = {}
@@ -62,6 +68,8 @@ _transform_method[(2, "nearest")] = vf.transform_2d_affine_nn
 _transform_method[(3, "nearest")] = vf.transform_3d_affine_nn
 _transform_method[(2, "linear")] = vf.transform_2d_affine
 _transform_method[(3, "linear")] = vf.transform_3d_affine
+_transform_stack_method = {}
+_transform_stack_method[(3, "linear")] = vf.transform_3d_affine_stack
 _number_dim_affine_matrix = 2
 
 
@@ -83,6 +91,7 @@ class AffineMap:
         domain_grid2world=None,
         codomain_grid_shape=None,
         codomain_grid2world=None,
+        num_threads=None,
     ):
         """AffineMap.
 
@@ -135,6 +144,11 @@ class AffineMap:
             the grid-to-world transform associated with the co-domain grid.
             If None (the default), then the grid-to-world transform is assumed
             to be the identity.
+        num_threads : int, optional
+            Number of threads used by the 3D transform kernels. If None (the
+            default) all available threads are used. See
+            :func:`dipy.utils.omp.determine_num_threads`. 2D images are
+            always transformed with a single thread.
 
         """
         self.set_affine(affine)
@@ -142,6 +156,7 @@ class AffineMap:
         self.domain_grid2world = domain_grid2world
         self.codomain_shape = codomain_grid_shape
         self.codomain_grid2world = codomain_grid2world
+        self.num_threads = num_threads
 
     def get_affine(self):
         """Return the value of the transformation, not a reference.
@@ -266,6 +281,7 @@ class AffineMap:
         sampling_grid2world=None,
         resample_only=False,
         apply_inverse=False,
+        out_dtype=None,
     ):
         """Transform the input image applying this affine transform.
 
@@ -284,8 +300,9 @@ class AffineMap:
 
         Parameters
         ----------
-        image :  2D or 3D array
-            the image to be transformed
+        image :  array, shape (dim) or (dim + 1)
+            the image to be transformed, or a stack of images along its last
+            axis, all transformed by this same transform
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -313,11 +330,17 @@ class AffineMap:
             transform. Otherwise, the image is transformed from the domain
             of this transform to its codomain using the (inverse) affine
             transform.
+        out_dtype : data-type, optional
+            Floating point type, float32 or float64, of the linearly
+            interpolated image. If None (the default), float64 is used. It is
+            ignored for nearest neighbor interpolation, which keeps the type
+            of the input image.
 
         Returns
         -------
         transformed : array, shape `sampling_grid_shape` or `self.domain_shape`
-            the transformed image, sampled at the requested grid
+            the transformed image, sampled at the requested grid. Stacks of
+            images are returned with their last axis appended to this shape.
 
         """
         # Verify valid interpolation requested
@@ -340,9 +363,15 @@ class AffineMap:
 
         # Verify valid image dimension
         img_dim = len(image.shape)
-        if img_dim < 2 or img_dim > 3:
+        if img_dim < 2 or img_dim > 4 or img_dim not in (dim, dim + 1):
             raise ValueError(f"Undefined transform for dim: {img_dim}")
 
+        if out_dtype is None:
+            out_dtype = np.float64
+        out_dtype = np.dtype(out_dtype)
+        if out_dtype not in (np.float32, np.float64):
+            raise ValueError(f"Invalid output data type: {out_dtype}")
+
         # Obtain grid-to-world transform for sampling grid
         if sampling_grid2world is None:
             if apply_inverse:
@@ -375,9 +404,26 @@ class AffineMap:
 
         # Transform the input image
         if interpolation == "linear":
-            image = image.astype(np.float64)
-        transformed = _transform_method[(dim, interpolation)](image, shape, affine=comp)
-        return transformed
+            image = np.asarray(image, dtype=out_dtype)
+        kwargs = {"affine": comp}
+        if dim == 3:
+            kwargs["num_threads"] = self.num_threads
+        if img_dim == dim:
+            return _transform_method[(dim, interpolation)](image, shape, **kwargs)
+
+        # Transform a stack of images, computing the sampling positions and
+        # weights once for all images when a batched kernel is available
+        if (dim, interpolation) in _transform_stack_method:
+            transform_f = _transform_stack_method[(dim, interpolation)]
+            return transform_f(image, shape, **kwargs)
+        transform_f = _transform_method[(dim, interpolation)]
+        return np.stack(
+            [
+                transform_f(image[..., i], shape, **kwargs)
+                for i in range(image.shape[-1])
+            ],
+            axis=-1,
+        )
 
     @warning_for_keywords()
     def transform(
@@ -389,6 +435,7 @@ class AffineMap:
         sampling_grid_shape=None,
         sampling_grid2world=None,
         resample_only=False,
+        out_dtype=None,
     ):
         """Transform the input image from co-domain to domain space.
 
@@ -398,8 +445,9 @@ class AffineMap:
 
         Parameters
         ----------
-        image :  2D or 3D array
-            the image to be transformed
+        image :  array, shape (dim) or (dim + 1)
+            the image to be transformed, or a stack of images along its last
+            axis, all transformed by this same transform
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -421,12 +469,18 @@ class AffineMap:
             If False (the default) the affine transform is applied normally.
             If True, then the affine transform is not applied, and the input
             image is just re-sampled on the domain grid of this transform.
+        out_dtype : data-type, optional
+            Floating point type, float32 or float64, of the linearly
+            interpolated image. If None (the default), float64 is used. It is
+            ignored for nearest neighbor interpolation, which keeps the type
+            of the input image.
 
         Returns
         -------
         transformed : array
             the transformed image, sampled at the requested grid, with shape
-            `sampling_grid_shape` or `self.codomain_shape`.
+            `sampling_grid_shape` or `self.codomain_shape`. Stacks of images
+            are returned with their last axis appended to this shape.
 
         """
         transformed = self._apply_transform(
@@ -436,6 +490,7 @@ class AffineMap:
             sampling_grid_shape=sampling_grid_shape,
             sampling_grid2world=sampling_grid2world,
             resample_only=resample_only,
+            out_dtype=out_dtype,
             apply_inverse=False,
         )
         return np.array(transformed)
@@ -450,6 +505,7 @@ class AffineMap:
         sampling_grid_shape=None,
         sampling_grid2world=None,
         resample_only=False,
+        out_dtype=None,
     ):
         """Transform the input image from domain to co-domain space.
 
@@ -459,8 +515,9 @@ class AffineMap:
 
         Parameters
         ----------
-        image :  2D or 3D array
-            the image to be transformed
+        image :  array, shape (dim) or (dim + 1)
+            the image to be transformed, or a stack of images along its last
+            axis, all transformed by this same transform
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -482,12 +539,18 @@ class AffineMap:
             If False (the default) the affine transform is applied normally.
             If True, then the affine transform is not applied, and the input
             image is just re-sampled on the domain grid of this transform.
+        out_dtype : data-type, optional
+            Floating point type, float32 or float64, of the linearly
+            interpolated image. If None (the default), float64 is used. It is
+            ignored for nearest neighbor interpolation, which keeps the type
+            of the input image.
 
         Returns
         -------
         transformed : array
             the transformed image, sampled at the requested grid, with shape
-            `sampling_grid_shape` or `self.codomain_shape`.
+            `sampling_grid_shape` or `self.codomain_shape`. Stacks of images
+            are returned with their last axis appended to this shape.
 
         """
         transformed = self._apply_transform(
@@ -497,6 +560,7 @@ class AffineMap:
             sampling_grid_shape=sampling_grid_shape,
             sampling_grid2world=sampling_grid2world,
             resample_only=resample_only,
+            out_dtype=out_dtype,
             apply_inverse=True,
         )
         return np.array(transformed)
@@ -504,7 +568,9 @@ class AffineMap:
 
 class MutualInformationMetric:
     @warning_for_keywords()
-    def __init__(self, *, nbins=32, sampling_proportion=None):
+    def __init__(
+        self, *, nbins=32, sampling_proportion=None, num_threads=None, dtype=None
+    ):
         r"""Initialize an instance of the Mutual Information metric.
 
         This class implements the methods required by Optimizer to drive the
@@ -524,6 +590,21 @@ class MutualInformationMetric:
             then sparse sampling is used, where `sampling_proportion`
             specifies the proportion of voxels to be used. The default is
             None.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            histograms and gradients. If None (default) the value of
+            OMP_NUM_THREADS environment variable is used if it is set,
+            otherwise all available threads are used. If < 0 the maximal
+            number of threads minus $|num_threads + 1|$ is used (enter -1 to
+            use as many threads as possible). 0 raises an error. Note that
+            the default changed in DIPY 1.12: these kernels used to run on a
+            single thread, pass num_threads=1 for the previous behavior.
+        dtype : data-type, optional
+            floating point type (np.float32 or np.float64) of the 3D images
+            and image gradients used with dense sampling. np.float32 halves
+            their memory footprint at the cost of precision. 2D images and
+            sparse sampling always use np.float64. The default is None,
+            implying np.float64.
 
         Notes
         -----
@@ -536,8 +617,13 @@ class MutualInformationMetric:
         not applied.
 
         """
+        dtype = np.dtype(np.float64 if dtype is None else dtype)
+        if dtype not in [np.float32, np.float64]:
+            raise ValueError("dtype must be np.float32 or np.float64")
         self.histogram = ParzenJointHistogram(nbins)
         self.sampling_proportion = sampling_proportion
+        self.num_threads = num_threads
+        self.dtype = dtype
         self.metric_val = None
         self.metric_grad = None
 
@@ -600,8 +686,13 @@ class MutualInformationMetric:
         if static_grid2world is None:
             static_grid2world = np.eye(self.dim + 1)
         self.transform = transform
-        self.static = np.array(static).astype(np.float64)
-        self.moving = np.array(moving).astype(np.float64)
+        # Sparse sampling and the 2D kernels work with float64 intensities
+        if self.sampling_proportion is None and self.dim == 3:
+            ftype = self.dtype
+        else:
+            ftype = np.float64
+        self.static = np.array(static).astype(ftype)
+        self.moving = np.array(moving).astype(ftype)
         self.static_grid2world = static_grid2world
         self.static_world2grid = npl.inv(static_grid2world)
         self.moving_grid2world = moving_grid2world
@@ -612,19 +703,6 @@ class MutualInformationMetric:
         self.moving_direction, self.moving_spacing = get_direction_and_spacings(
             moving_grid2world, self.dim
         )
-        self.starting_affine = starting_affine
-
-        P = np.eye(self.dim + 1)
-        if self.starting_affine is not None:
-            P = self.starting_affine
-
-        self.affine_map = AffineMap(
-            P,
-            domain_grid_shape=static.shape,
-            domain_grid2world=static_grid2world,
-            codomain_grid_shape=moving.shape,
-            codomain_grid2world=moving_grid2world,
-        )
 
         # Masks can only be used with dense sampling
         if self.sampling_proportion in [None, 1.0]:
@@ -662,10 +740,6 @@ class MutualInformationMetric:
             self.ns = self.samples.shape[0]
             # Add a column of ones (homogeneous coordinates)
             self.samples = np.hstack((self.samples, np.ones(self.ns)[:, None]))
-            if self.starting_affine is None:
-                self.samples_prealigned = self.samples
-            else:
-                self.samples_prealigned = self.starting_affine.dot(self.samples.T).T
             # Sample the static image
             static_p = self.static_world2grid.dot(self.samples.T).T
             static_p = static_p[..., : self.dim]
@@ -674,6 +748,46 @@ class MutualInformationMetric:
         self.histogram.setup(
             self.static, self.moving, smask=self.static_mask, mmask=self.moving_mask
         )
+        self._set_starting_affine(starting_affine)
+
+    def _set_starting_affine(self, starting_affine):
+        """Set the pre-aligning matrix of a metric that has been set up"""
+        self.starting_affine = starting_affine
+
+        P = np.eye(self.dim + 1)
+        if self.starting_affine is not None:
+            P = self.starting_affine
+
+        self.affine_map = AffineMap(
+            P,
+            domain_grid_shape=self.static.shape,
+            domain_grid2world=self.static_grid2world,
+            codomain_grid_shape=self.moving.shape,
+            codomain_grid2world=self.moving_grid2world,
+            num_threads=self.num_threads,
+        )
+
+        if self.samples is not None:
+            if self.starting_affine is None:
+                self.samples_prealigned = self.samples
+            else:
+                self.samples_prealigned = self.starting_affine.dot(self.samples.T).T
+
+    def _fork(self, starting_affine, *, num_threads=None):
+        """Copy of a metric that has been set up, with another starting affine
+
+        The copy shares the images and samples prepared by `setup`, and has its
+        own histogram and buffers, so that several copies can be optimized
+        concurrently. The copy uses `num_threads` threads in its kernels, or
+        the threads of this metric if None.
+        """
+        metric = copy.copy(self)
+        metric.histogram = copy.deepcopy(self.histogram)
+        metric.metric_grad = np.zeros_like(self.metric_grad)
+        if num_threads is not None:
+            metric.num_threads = num_threads
+        metric._set_starting_affine(starting_affine)
+        return metric
 
     def _update_histogram(self):
         r"""Update the histogram according to the current affine transform.
@@ -707,6 +821,7 @@ class MutualInformationMetric:
         if self.sampling_proportion is None:  # Dense case
             static_values = self.static
             moving_values = self.affine_map.transform(self.moving)
+            moving_values = moving_values.astype(self.static.dtype, copy=False)
 
             if self.static_mask is not None:
                 static_mask_values = self.static_mask
@@ -720,6 +835,7 @@ class MutualInformationMetric:
                 moving_values,
                 smask=self.static_mask,
                 mmask=moving_mask_values,
+                num_threads=self.num_threads,
             )
         else:  # Sparse case
             sp_to_moving = self.moving_world2grid.dot(self.affine_map.affine)
@@ -729,7 +845,9 @@ class MutualInformationMetric:
             self.moving_vals = np.array(self.moving_vals)
             static_values = self.static_vals
             moving_values = self.moving_vals
-            self.histogram.update_pdfs_sparse(static_values, moving_values)
+            self.histogram.update_pdfs_sparse(
+                static_values, moving_values, num_threads=self.num_threads
+            )
         return static_values, moving_values, static_mask_values, moving_mask_values
 
     @warning_for_keywords()
@@ -785,6 +903,7 @@ class MutualInformationMetric:
                     self.moving_spacing,
                     self.static.shape,
                     grid_to_world,
+                    num_threads=self.num_threads,
                 )
                 # The Jacobian must be evaluated at the pre-aligned points
                 H.update_gradient_dense(
@@ -796,6 +915,7 @@ class MutualInformationMetric:
                     mgrad,
                     smask=static_mask_values,
                     mmask=moving_mask_values,
+                    num_threads=self.num_threads,
                 )
             else:  # Sparse case
                 # Compute the gradient of moving at the sampling points
@@ -807,7 +927,13 @@ class MutualInformationMetric:
                 # The Jacobian must be evaluated at the pre-aligned points
                 pts = self.samples_prealigned[..., : self.dim]
                 H.update_gradient_sparse(
-                    params, self.transform, static_values, moving_values, pts, mgrad
+                    params,
+                    self.transform,
+                    static_values,
+                    moving_values,
+                    pts,
+                    mgrad,
+                    num_threads=self.num_threads,
                 )
 
         # Call the cythonized MI computation with self.histogram fields
@@ -903,6 +1029,7 @@ class AffineRegistration:
         method="L-BFGS-B",
         ss_sigma_factor=None,
         options=None,
+        cache_static=False,
         verbosity=VerbosityLevels.STATUS,
     ):
         """Initialize an instance of the AffineRegistration class.
@@ -945,6 +1072,13 @@ class AffineRegistration:
         options : dict, optional
             extra optimization options. The default is None, implying
             no extra options are passed to the optimizer.
+        cache_static : bool, optional
+            If True, the scale space of the static image and its resampled
+            levels are computed once and reused by subsequent calls to
+            `optimize` with the same static image, static grid-to-world
+            transform and static mask objects. The static image and mask must
+            not be modified in place between these calls. Shallow copies of
+            this object share the cache.
 
         """
         self.metric = metric
@@ -980,6 +1114,9 @@ class AffineRegistration:
             self.sigmas = sigmas
 
         self.verbosity = verbosity
+        self.cache_static = cache_static
+        self._static_cache = {}
+        self._static_cache_lock = threading.Lock()
 
     # Separately add a string that tells about the verbosity kwarg. This needs
     # to be separate, because it is set as a module-wide option in __init__:
@@ -1122,13 +1259,7 @@ class AffineRegistration:
             moving_grid2world, self.dim
         )
 
-        # Scale the images by min and max values (where mask == 1)
-        if static_mask is not None:
-            smin = np.min(static[static_mask == 1])
-            smax = np.max(static[static_mask == 1])
-        else:
-            smin, smax = np.min(static), np.max(static)
-        static = (static.astype(np.float64) - smin) / (smax - smin)
+        # Scale the moving image by its min and max values (where mask == 1)
         if moving_mask is not None:
             mmin = np.min(moving[moving_mask == 1])
             mmax = np.max(moving[moving_mask == 1])
@@ -1136,7 +1267,7 @@ class AffineRegistration:
             mmin, mmax = np.min(moving), np.max(moving)
         moving = (moving.astype(np.float64) - mmin) / (mmax - mmin)
 
-        # Build the scale space of the input images
+        # Build the scale space of the moving image
         if self.use_isotropic:
             self.moving_ss = IsotropicScaleSpace(
                 moving,
@@ -1146,16 +1277,6 @@ class AffineRegistration:
                 input_spacing=moving_spacing,
                 mask0=False,
             )
-
-            self.static_ss = IsotropicScaleSpace(
-                static,
-                self.factors,
-                self.sigmas,
-                image_grid2world=static_grid2world,
-                input_spacing=static_spacing,
-                mask0=False,
-            )
-
         else:
             self.moving_ss = ScaleSpace(
                 moving,
@@ -1166,14 +1287,126 @@ class AffineRegistration:
                 mask0=False,
             )
 
-            self.static_ss = ScaleSpace(
+        if not self.cache_static:
+            self.static_ss = self._static_scale_space(
+                static, static_grid2world, static_spacing, static_mask
+            )
+            self._static_levels = {}
+            return
+
+        with self._static_cache_lock:
+            cache = self._static_cache
+            if not (
+                cache
+                and cache["static"] is static
+                and cache["static_mask"] is static_mask
+                and np.array_equal(cache["static_grid2world"], static_grid2world)
+            ):
+                cache.clear()
+                cache["static"] = static
+                cache["static_mask"] = static_mask
+                cache["static_grid2world"] = np.array(static_grid2world, copy=True)
+                cache["static_ss"] = self._static_scale_space(
+                    static, static_grid2world, static_spacing, static_mask
+                )
+                cache["levels"] = {}
+            self.static_ss = cache["static_ss"]
+            self._static_levels = cache["levels"]
+
+    def _static_scale_space(
+        self, static, static_grid2world, static_spacing, static_mask
+    ):
+        """Build the scale space of the static image
+
+        The static image is first scaled by its min and max values (where
+        mask == 1).
+        """
+        if static_mask is not None:
+            smin = np.min(static[static_mask == 1])
+            smax = np.max(static[static_mask == 1])
+        else:
+            smin, smax = np.min(static), np.max(static)
+        static = (static.astype(np.float64) - smin) / (smax - smin)
+
+        if self.use_isotropic:
+            return IsotropicScaleSpace(
                 static,
-                self.levels,
+                self.factors,
+                self.sigmas,
                 image_grid2world=static_grid2world,
                 input_spacing=static_spacing,
-                sigma_factor=self.ss_sigma_factor,
                 mask0=False,
             )
+        return ScaleSpace(
+            static,
+            self.levels,
+            image_grid2world=static_grid2world,
+            input_spacing=static_spacing,
+            sigma_factor=self.ss_sigma_factor,
+            mask0=False,
+        )
+
+    def _static_level(self, level):
+        """Resample the smooth static image (and mask) to the shape of a level
+
+        Results are stored in the static cache when it is enabled.
+        """
+        if level in self._static_levels:
+            return self._static_levels[level]
+
+        original_static_shape = self.static_ss.get_image(0).shape
+        original_static_grid2world = self.static_ss.get_affine(0)
+        smooth_static = self.static_ss.get_image(level)
+        current_static_shape = self.static_ss.get_domain_shape(level)
+        current_static_grid2world = self.static_ss.get_affine(level)
+        # The static image is resampled with as many threads as the metric
+        current_affine_map = AffineMap(
+            None,
+            domain_grid_shape=current_static_shape,
+            domain_grid2world=current_static_grid2world,
+            codomain_grid_shape=original_static_shape,
+            codomain_grid2world=original_static_grid2world,
+            num_threads=getattr(self.metric, "num_threads", None),
+        )
+        current_static = current_affine_map.transform(smooth_static)
+        current_static_mask = None
+        if self.static_mask is not None:
+            current_static_mask = current_affine_map.transform(
+                self.static_mask, interpolation="nearest"
+            ).astype(np.int32)
+
+        if self.cache_static:
+            with self._static_cache_lock:
+                self._static_levels[level] = (current_static, current_static_mask)
+        return current_static, current_static_mask
+
+    def _optimize_candidates(self, candidates, num_threads):
+        """Optimize the current level from each of the candidate matrices
+
+        The metric must have been set up with the first candidate as starting
+        affine. Returns the Optimizer of each candidate.
+        """
+        num_threads = min(num_threads, len(candidates))
+        # Candidates optimized concurrently use a single thread each in their
+        # kernels, to not oversubscribe the cores.
+        kernel_threads = 1 if num_threads > 1 else None
+
+        def optimize_candidate(starting_affine):
+            metric = self.metric
+            if len(candidates) > 1:
+                metric = metric._fork(starting_affine, num_threads=kernel_threads)
+            return Optimizer(
+                metric.distance_and_gradient,
+                self.params0,
+                method=self.method,
+                jac=True,
+                options=self.options,
+            )
+
+        if num_threads <= 1:
+            return [optimize_candidate(candidate) for candidate in candidates]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            return list(executor.map(optimize_candidate, candidates))
 
     @warning_for_keywords()
     def optimize(
@@ -1189,6 +1422,9 @@ class AffineRegistration:
         ret_metric=False,
         static_mask=None,
         moving_mask=None,
+        starting_grid=None,
+        keep_best=1,
+        num_threads=1,
     ):
         r"""Start the optimization process.
 
@@ -1238,6 +1474,25 @@ class AffineRegistration:
         moving_mask : array, shape (S', R', C') or (R', C'), optional
             moving image mask that defines which pixels in the moving image
             are used to calculate the mutual information.
+        starting_grid : array, shape (m, dim+1, dim+1), optional
+            affine perturbations of the starting affine (see
+            `rigid_starting_grid`) used for a multi-start optimization. The
+            m candidates ``starting_affine.dot(starting_grid[i])`` are
+            optimized at the coarsest level, the `keep_best` candidates with
+            the lowest metric value are refined at the finer levels and the
+            best one at the finest level is returned. The default is None,
+            implying a single start from the starting affine.
+        keep_best : int, optional
+            the number of candidates of the coarsest level that are refined at
+            the finer levels when `starting_grid` is given. The default is 1.
+        num_threads : int, optional
+            the number of candidates optimized concurrently by a pool of
+            threads when `starting_grid` is given. If None, all available
+            cores are used. If < 0 the maximal number of cores minus
+            ``num_threads + 1`` is used (enter -1 to use as many cores as
+            possible). 0 raises an error. The default is 1. Candidates
+            optimized concurrently use a single thread each in the metric and
+            transform kernels.
 
         Returns
         -------
@@ -1248,7 +1503,17 @@ class AffineRegistration:
         fopt : Similarity metric
             the value of the function at the optimal parameters.
 
+        Notes
+        -----
+        With `starting_grid`, the scale spaces of the images are built and
+        the metric is set up once per level for all the candidates. The
+        result does not depend on `num_threads`.
+
         """
+        if keep_best < 1:
+            raise ValueError("keep_best must be >= 1")
+        num_threads = determine_num_processes(num_threads)
+
         self._init_optimizer(
             static,
             moving,
@@ -1277,6 +1542,11 @@ class AffineRegistration:
             codomain_grid2world=original_moving_grid2world,
         )
 
+        if starting_grid is None:
+            candidates = [self.starting_affine]
+        else:
+            candidates = [self.starting_affine.dot(P) for P in starting_grid]
+
         for level in range(self.levels - 1, -1, -1):
             self.current_level = level
             max_iter = self.level_iters[-1 - level]
@@ -1284,22 +1554,8 @@ class AffineRegistration:
                 logger.info(f"Optimizing level {level} [max iter: {max_iter}]")
 
             # Resample the smooth static image to the shape of this level
-            smooth_static = self.static_ss.get_image(level)
-            current_static_shape = self.static_ss.get_domain_shape(level)
             current_static_grid2world = self.static_ss.get_affine(level)
-            current_affine_map = AffineMap(
-                None,
-                domain_grid_shape=current_static_shape,
-                domain_grid2world=current_static_grid2world,
-                codomain_grid_shape=original_static_shape,
-                codomain_grid2world=original_static_grid2world,
-            )
-            current_static = current_affine_map.transform(smooth_static)
-            current_static_mask = None
-            if self.static_mask is not None:
-                current_static_mask = current_affine_map.transform(
-                    self.static_mask, interpolation="nearest"
-                ).astype(np.int32)
+            current_static, current_static_mask = self._static_level(level)
 
             # The moving image is full resolution
             current_moving_grid2world = original_moving_grid2world
@@ -1313,7 +1569,7 @@ class AffineRegistration:
                 current_moving,
                 static_grid2world=current_static_grid2world,
                 moving_grid2world=current_moving_grid2world,
-                starting_affine=self.starting_affine,
+                starting_affine=candidates[0],
                 static_mask=current_static_mask,
                 moving_mask=self.moving_mask,
             )
@@ -1328,22 +1584,26 @@ class AffineRegistration:
             else:
                 self.options["maxiter"] = max_iter
 
-            opt = Optimizer(
-                self.metric.distance_and_gradient,
-                self.params0,
-                method=self.method,
-                jac=True,
-                options=self.options,
-            )
-            params = opt.xopt
+            opts = self._optimize_candidates(candidates, num_threads)
 
-            # Update starting_affine matrix with optimal parameters
-            T = self.transform.param_to_matrix(params)
-            self.starting_affine = T.dot(self.starting_affine)
+            # Update the candidate matrices with optimal parameters
+            candidates = [
+                self.transform.param_to_matrix(opt.xopt).dot(candidate)
+                for opt, candidate in zip(opts, candidates)
+            ]
+            if len(candidates) > keep_best:
+                best = np.argsort([opt.fopt for opt in opts], kind="stable")
+                best = best[:keep_best]
+                candidates = [candidates[i] for i in best]
+                opts = [opts[i] for i in best]
 
             # Start next iteration at identity
             self.params0 = self.transform.get_identity_parameters()
 
+        best = int(np.argmin([opt.fopt for opt in opts]))
+        opt = opts[best]
+        self.starting_affine = candidates[best]
+
         affine_map.set_affine(self.starting_affine)
         if ret_metric:
             return affine_map, opt.xopt, opt.fopt
@@ -1481,3 +1741,65 @@ def transform_origins(static, static_grid2world, moving, moving_grid2world):
         codomain_grid2world=moving_grid2world,
     )
     return affine_map
+
+
+@warning_for_keywords()
+def rigid_starting_grid(center, *, angles=(0.0,), translations=(0.0,)):
+    r"""Grid of rigid perturbations for a multi-start registration.
+
+    Each perturbation is a rotation about `center` followed by a translation,
+    for all the combinations of `angles` about each axis and `translations`
+    along each axis. It is meant to be used as the `starting_grid` of
+    `AffineRegistration.optimize`.
+
+    Parameters
+    ----------
+    center : array, shape (dim,)
+        the physical coordinates of the center of rotation, typically the
+        center of the static image.
+    angles : sequence of floats, optional
+        the rotation angles (in radians) about each axis. The default is
+        (0.0,).
+    translations : sequence of floats, optional
+        the translations (in physical units) along each axis. The default is
+        (0.0,).
+
+    Returns
+    -------
+    grid : array, shape (m, dim+1, dim+1)
+        the perturbations, with
+        ``m = len(angles) ** n_axes * len(translations) ** dim`` where
+        ``n_axes`` is 1 in 2D and 3 in 3D.
+
+    """
+    center = np.asarray(center, dtype=np.float64)
+    dim = len(center)
+    if dim not in (2, 3):
+        raise ValueError("center must be a point in 2D or 3D")
+
+    to_center = np.eye(dim + 1)
+    to_center[:dim, dim] = -center
+    from_center = np.eye(dim + 1)
+    from_center[:dim, dim] = center
+
+    rotations = []
+    if dim == 2:
+        for angle in angles:
+            R = np.eye(3)
+            R[:2, :2] = [
+                [np.cos(angle), -np.sin(angle)],
+                [np.sin(angle), np.cos(angle)],
+            ]
+            rotations.append(R)
+    else:
+        for ai, aj, ak in itertools.product(angles, repeat=3):
+            rotations.append(euler_matrix(ai, aj, ak))
+
+    grid = []
+    for R in rotations:
+        rotation = from_center.dot(R).dot(to_center)
+        for t in itertools.product(translations, repeat=dim):
+            P = rotation.copy()
+            P[:dim, dim] += t
+            grid.append(P)
+    return np.array(grid)
@@ -1,6 +1,8 @@
 """Classes and functions for Symmetric Diffeomorphic Registration"""
 
 import abc
+from functools import partial
+import threading
 
 import nibabel as nib
 from nibabel.streamlines import ArraySequence as Streamlines
@@ -112,6 +114,7 @@ class DiffeomorphicMap:
         codomain_shape=None,
         codomain_grid2world=None,
         prealign=None,
+        num_threads=None,
     ):
         """DiffeomorphicMap
 
@@ -152,10 +155,19 @@ class DiffeomorphicMap:
         prealign : array, shape (dim+1, dim+1)
             the linear transformation to be applied to align input images to
             the reference space before warping under the deformation field.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            warping and composition kernels. If None (default) the value of
+            OMP_NUM_THREADS environment variable is used if it is set,
+            otherwise all available threads are used. If < 0 the maximal
+            number of threads minus $|num_threads + 1|$ is used (enter -1 to
+            use as many threads as possible). 0 raises an error. The results
+            do not depend on the number of threads.
 
         """
 
         self.dim = dim
+        self.num_threads = num_threads
 
         if disp_shape is None:
             raise ValueError("Invalid displacement field discretization")
@@ -289,9 +301,19 @@ class DiffeomorphicMap:
             if warp_coordinates:
                 return vfu.warp_coordinates_3d
             if interpolation == "linear":
-                return vfu.warp_3d
+                return partial(vfu.warp_3d, num_threads=self.num_threads)
             else:
-                return vfu.warp_3d_nn
+                return partial(vfu.warp_3d_nn, num_threads=self.num_threads)
+
+    def _get_composition_function(self):
+        """Appropriate displacement field composition function
+
+        Returns the right composition function from vector_fields for this
+        DiffeomorphicMap dimension.
+        """
+        if self.dim == 2:
+            return vfu.compose_vector_fields_2d
+        return partial(vfu.compose_vector_fields_3d, num_threads=self.num_threads)
 
     @warning_for_keywords()
     def _warp_coordinates_forward(self, points, *, coord2world=None, world2coord=None):
@@ -345,6 +367,79 @@ class DiffeomorphicMap:
         )
         return out
 
+    def _warp(
+        self,
+        image,
+        field,
+        *,
+        interpolation,
+        affine_idx_in,
+        affine_idx_out,
+        affine_disp,
+        out_shape,
+    ):
+        """Warps an image, or a stack of images, with the given field
+
+        Parameters
+        ----------
+        image : array, shape (dim) or (dim + 1)
+            the image to be warped, or a stack of images along its last axis,
+            all warped by the same transformation
+        field : array, shape (dim + 1)
+            the displacement field driving the transformation
+        interpolation : string, either 'linear' or 'nearest'
+            the type of interpolation to be used for warping
+        affine_idx_in, affine_idx_out, affine_disp : arrays, shape (dim+1, dim+1)
+            the matrices A, B and C of the warping equation
+            warped[i] = image[C * field[A * i] + B * i]
+        out_shape : array, shape (dim,)
+            the shape of the sampling grid
+
+        Returns
+        -------
+        warped : array, shape = out_shape, or out_shape + (n,) for a stack
+            of n images
+        """
+        if image.ndim not in (self.dim, self.dim + 1):
+            raise ValueError(
+                f"Expected a {self.dim}D image or a stack of {self.dim}D "
+                f"images, got an image of dimension {image.ndim}"
+            )
+
+        # Convert the data to required types to use the cythonized functions
+        if interpolation == "nearest":
+            if image.dtype is np.dtype("float64") and floating is np.float32:
+                image = image.astype(floating)
+            elif image.dtype is np.dtype("int64"):
+                image = image.astype(np.int32)
+        else:
+            image = np.asarray(image, dtype=floating)
+
+        kwargs = {
+            "affine_idx_in": affine_idx_in,
+            "affine_idx_out": affine_idx_out,
+            "affine_disp": affine_disp,
+            "out_shape": out_shape,
+        }
+        if image.ndim == self.dim:
+            warp_f = self._get_warping_function(interpolation)
+            return warp_f(image, field, **kwargs)
+
+        # Warp a stack of images, computing the sampling positions and
+        # weights once for all images when a batched kernel is available
+        if self.dim == 3 and interpolation == "linear":
+            return vfu.warp_3d_stack(
+                image, field, num_threads=self.num_threads, **kwargs
+            )
+        warp_f = self._get_warping_function(interpolation)
+        return np.stack(
+            [
+                np.asarray(warp_f(image[..., i], field, **kwargs))
+                for i in range(image.shape[-1])
+            ],
+            axis=-1,
+        )
+
     @warning_for_keywords()
     def _warp_forward(
         self,
@@ -367,7 +462,7 @@ class DiffeomorphicMap:
         ----------
         image : array, shape (s, r, c) if dim = 3 or (r, c) if dim = 2
             the image to be warped under this transformation in the forward
-            direction
+            direction, or a stack of such images along an additional last axis
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used for warping, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -448,26 +543,15 @@ class DiffeomorphicMap:
         # prior to adding to the transformed input point
         affine_disp = W
 
-        # Convert the data to required types to use the cythonized functions
-        if interpolation == "nearest":
-            if image.dtype is np.dtype("float64") and floating is np.float32:
-                image = image.astype(floating)
-            elif image.dtype is np.dtype("int64"):
-                image = image.astype(np.int32)
-        else:
-            image = np.asarray(image, dtype=floating)
-
-        warp_f = self._get_warping_function(interpolation)
-
-        warped = warp_f(
+        return self._warp(
             image,
             self.forward,
+            interpolation=interpolation,
             affine_idx_in=affine_idx_in,
             affine_idx_out=affine_idx_out,
             affine_disp=affine_disp,
             out_shape=out_shape,
         )
-        return warped
 
     @warning_for_keywords()
     def _warp_backward(
@@ -491,7 +575,7 @@ class DiffeomorphicMap:
         ----------
         image : array, shape (s, r, c) if dim = 3 or (r, c) if dim = 2
             the image to be warped under this transformation in the backward
-            direction
+            direction, or a stack of such images along an additional last axis
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used for warping, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -572,27 +656,16 @@ class DiffeomorphicMap:
         # prior to adding to the transformed input point
         affine_disp = mult_aff(W, Pinv)
 
-        if interpolation == "nearest":
-            if image.dtype is np.dtype("float64") and floating is np.float32:
-                image = image.astype(floating)
-            elif image.dtype is np.dtype("int64"):
-                image = image.astype(np.int32)
-        else:
-            image = np.asarray(image, dtype=floating)
-
-        warp_f = self._get_warping_function(interpolation)
-
-        warped = warp_f(
+        return self._warp(
             image,
             self.backward,
+            interpolation=interpolation,
             affine_idx_in=affine_idx_in,
             affine_idx_out=affine_idx_out,
             affine_disp=affine_disp,
             out_shape=out_shape,
         )
 
-        return warped
-
     @warning_for_keywords()
     def transform(
         self,
@@ -614,7 +687,7 @@ class DiffeomorphicMap:
         ----------
         image : array, shape (s, r, c) if dim = 3 or (r, c) if dim = 2
             the image to be warped under this transformation in the forward
-            direction
+            direction, or a stack of such images along an additional last axis
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used for warping, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -629,7 +702,8 @@ class DiffeomorphicMap:
         Returns
         -------
         warped : array, shape = out_shape or self.codomain_shape if None
-            the warped image under this transformation in the forward direction
+            the warped image under this transformation in the forward
+            direction. Stacks of images keep their last axis.
 
         Notes
         -----
@@ -677,7 +751,7 @@ class DiffeomorphicMap:
         ----------
         image : array, shape (s, r, c) if dim = 3 or (r, c) if dim = 2
             the image to be warped under this transformation in the forward
-            direction
+            direction, or a stack of such images along an additional last axis
         interpolation : string, either 'linear' or 'nearest'
             the type of interpolation to be used for warping, either 'linear'
             (for k-linear interpolation) or 'nearest' for nearest neighbor
@@ -692,7 +766,8 @@ class DiffeomorphicMap:
         Returns
         -------
         warped : array, shape = out_shape or self.codomain_shape if None
-            warped image under this transformation in the backward direction
+            warped image under this transformation in the backward direction.
+            Stacks of images keep their last axis.
 
         Notes
         -----
@@ -816,6 +891,7 @@ class DiffeomorphicMap:
             codomain_shape=self.codomain_shape,
             codomain_grid2world=self.codomain_grid2world,
             prealign=self.prealign,
+            num_threads=self.num_threads,
         )
         inv.forward = self.forward
         inv.backward = self.backward
@@ -883,10 +959,7 @@ class DiffeomorphicMap:
 
         """
         Dinv = self.disp_world2grid
-        if self.dim == 2:
-            compose_f = vfu.compose_vector_fields_2d
-        else:
-            compose_f = vfu.compose_vector_fields_3d
+        compose_f = self._get_composition_function()
 
         residual, stats = compose_f(self.backward, self.forward, None, Dinv, 1.0, None)
 
@@ -913,6 +986,7 @@ class DiffeomorphicMap:
             codomain_shape=self.codomain_shape,
             codomain_grid2world=self.codomain_grid2world,
             prealign=self.prealign,
+            num_threads=self.num_threads,
         )
         new_map.forward = self.forward
         new_map.backward = self.backward
@@ -960,11 +1034,7 @@ class DiffeomorphicMap:
         d2_inv = phi.get_backward_field()
 
         premult_disp = self.disp_world2grid
-
-        if self.dim == 2:
-            compose_f = vfu.compose_vector_fields_2d
-        else:
-            compose_f = vfu.compose_vector_fields_3d
+        compose_f = self._get_composition_function()
 
         forward, stats = compose_f(d1, d2, None, premult_disp, 1.0, None)
         (
@@ -1040,6 +1110,7 @@ class DiffeomorphicMap:
             codomain_shape=self.codomain_shape,
             codomain_grid2world=None,
             prealign=None,
+            num_threads=self.num_threads,
         )
         simplified.forward = new_forward
         simplified.backward = new_backward
@@ -1117,6 +1188,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         inv_iter=20,
         inv_tol=1e-3,
         callback=None,
+        num_threads=None,
+        low_memory=False,
+        cache_static=False,
     ):
         """Symmetric Diffeomorphic Registration (SyN) Algorithm
 
@@ -1151,6 +1225,29 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             a function receiving a SymmetricDiffeomorphicRegistration object
             to be called after each iteration (this optimizer will call this
             function passing self as parameter)
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            warping, composition and inversion kernels. It is also passed to
+            the resulting DiffeomorphicMap. If None (default) the value of
+            OMP_NUM_THREADS environment variable is used if it is set,
+            otherwise all available threads are used. If < 0 the maximal
+            number of threads minus $|num_threads + 1|$ is used (enter -1 to
+            use as many threads as possible). 0 raises an error.
+        low_memory : bool, optional
+            If True, the displacement fields are updated and inverted in
+            place, the update steps computed by the metric are normalized in
+            place, and the norms of the fields are computed in single
+            precision in work buffers allocated once per pyramid level. No
+            copy of the fields nor double precision temporary is then
+            allocated at each iteration, at the cost of rounding differences
+            with the default mode.
+        cache_static : bool, optional
+            If True, the scale space of the static image is computed once and
+            reused by subsequent calls to `optimize` with the same static
+            image and static grid-to-world transform. The static image must
+            be of type float32 (other types are converted, which defeats the
+            cache) and must not be modified in place between these calls.
+            Shallow copies of this object share the cache.
         """
         super(SymmetricDiffeomorphicRegistration, self).__init__(metric=metric)
         if level_iters is None:
@@ -1170,6 +1267,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         self.full_energy_profile = []
         self.verbosity = VerbosityLevels.STATUS
         self.callback = callback
+        self.num_threads = num_threads
+        self.low_memory = low_memory
+        self._work_buffers = {}
+        self.cache_static = cache_static
+        self._static_cache = {}
+        self._static_cache_lock = threading.Lock()
         self.moving_ss = None
         self.static_ss = None
         self.static_direction = None
@@ -1209,8 +1312,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             the warped displacement field
         mean_norm : the mean norm of all vectors in current_displacement
         """
-        sq_field = np.sum((np.array(current_displacement) ** 2), -1)
-        mean_norm = np.sqrt(sq_field).mean()
+        if self.low_memory:
+            sq_field = self._squared_norms(current_displacement)
+            mean_norm = np.sqrt(sq_field, out=sq_field).mean()
+        else:
+            sq_field = np.sum((np.array(current_displacement) ** 2), -1)
+            mean_norm = np.sqrt(sq_field).mean()
         # We assume that both displacement fields have the same
         # grid2world transform, which implies premult_index=Identity
         # and premult_disp is the world2grid transform associated with
@@ -1224,8 +1331,60 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             current_displacement,
         )
 
+        if self.low_memory:
+            return current_displacement, np.array(mean_norm)
         return np.array(current_displacement), np.array(mean_norm)
 
+    def _work_buffer(self, name, shape):
+        """Single precision work array, reused while its shape is unchanged
+
+        Parameters
+        ----------
+        name : str
+            the name of the buffer
+        shape : tuple
+            the shape of the buffer
+
+        Returns
+        -------
+        buffer : array, shape `shape`
+            an uninitialized array of type `floating`
+        """
+        shape = tuple(shape)
+        buffer = self._work_buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=floating)
+            self._work_buffers[name] = buffer
+        return buffer
+
+    def _squared_norms(self, field, *, spacing=None):
+        """Squared norms of the vectors of a field, in a work buffer
+
+        Parameters
+        ----------
+        field : array, shape (R, C, 2) or (S, R, C, 3)
+            the displacement field
+        spacing : array, shape (dim,), optional
+            if given, each component of the vectors is divided by the
+            corresponding spacing (voxel size) before computing the norms
+
+        Returns
+        -------
+        sq_norms : array, shape (R, C) or (S, R, C)
+            the squared norms, valid until the next call
+        """
+        sq_norms = self._work_buffer("sq_norms", field.shape[:-1])
+        component = self._work_buffer("component", field.shape[:-1])
+        sq_norms[...] = 0
+        for i in range(self.dim):
+            if spacing is None:
+                component[...] = field[..., i]
+            else:
+                np.divide(field[..., i], floating(spacing[i]), out=component)
+            np.multiply(component, component, out=component)
+            sq_norms += component
+        return sq_norms
+
     def get_map(self):
         """Return the resulting diffeomorphic map.
 
@@ -1279,8 +1438,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             self.invert_vector_field = vfu.invert_vector_field_fixed_point_2d
             self.compose = vfu.compose_vector_fields_2d
         else:
-            self.invert_vector_field = vfu.invert_vector_field_fixed_point_3d
-            self.compose = vfu.compose_vector_fields_3d
+            self.invert_vector_field = partial(
+                vfu.invert_vector_field_fixed_point_3d, num_threads=self.num_threads
+            )
+            self.compose = partial(
+                vfu.compose_vector_fields_3d, num_threads=self.num_threads
+            )
 
     def _init_optimizer(
         self, static, moving, static_grid2world, moving_grid2world, prealign
@@ -1348,20 +1511,29 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             mask0=self.mask0,
         )
 
-        if self.verbosity >= VerbosityLevels.STATUS:
-            logger.info(
-                f"Creating scale space from the static image. Levels: {self.levels}. "
-                f"Sigma factor: {self.ss_sigma_factor:f}."
+        if not self.cache_static:
+            self.static_ss = self._static_scale_space(
+                static, static_grid2world, static_spacing
             )
-
-        self.static_ss = ScaleSpace(
-            static,
-            self.levels,
-            image_grid2world=static_grid2world,
-            input_spacing=static_spacing,
-            sigma_factor=self.ss_sigma_factor,
-            mask0=self.mask0,
-        )
+        else:
+            with self._static_cache_lock:
+                cache = self._static_cache
+                if not (
+                    cache
+                    and cache["static"] is static
+                    and np.array_equal(cache["static_grid2world"], static_grid2world)
+                ):
+                    cache.clear()
+                    cache["static"] = static
+                    cache["static_grid2world"] = (
+                        None
+                        if static_grid2world is None
+                        else np.array(static_grid2world, copy=True)
+                    )
+                    cache["static_ss"] = self._static_scale_space(
+                        static, static_grid2world, static_spacing
+                    )
+                self.static_ss = cache["static_ss"]
 
         if self.verbosity >= VerbosityLevels.DEBUG:
             logger.info("Moving scale space:")
@@ -1397,6 +1569,7 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             codomain_shape=codomain_shape,
             codomain_grid2world=codomain_grid2world,
             prealign=None,
+            num_threads=self.num_threads,
         )
         self.static_to_ref.allocate()
 
@@ -1421,13 +1594,32 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             codomain_shape=codomain_shape,
             codomain_grid2world=codomain_grid2world,
             prealign=prealign_inv,
+            num_threads=self.num_threads,
         )
         self.moving_to_ref.allocate()
 
+    def _static_scale_space(self, static, static_grid2world, static_spacing):
+        """Build the scale space of the static image"""
+        if self.verbosity >= VerbosityLevels.STATUS:
+            logger.info(
+                f"Creating scale space from the static image. Levels: {self.levels}. "
+                f"Sigma factor: {self.ss_sigma_factor:f}."
+            )
+
+        return ScaleSpace(
+            static,
+            self.levels,
+            image_grid2world=static_grid2world,
+            input_spacing=static_spacing,
+            sigma_factor=self.ss_sigma_factor,
+            mask0=self.mask0,
+        )
+
     def _end_optimizer(self):
         """Frees the resources allocated during initialization"""
         del self.moving_ss
         del self.static_ss
+        self._work_buffers = {}
 
     def _iterate(self):
         """Performs one symmetric iteration
@@ -1502,15 +1694,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             self.callback(self, RegistrationStages.ITER_START)
 
         # Compute the forward step (to be used to update the forward transform)
-        fw_step = np.array(self.metric.compute_forward())
-
-        # set zero displacements at the boundary
-        fw_step = self.__set_no_boundary_displacement(fw_step)
-
-        # Normalize the forward step
-        nrm = np.sqrt(np.sum((fw_step / current_disp_spacing) ** 2, -1)).max()
-        if nrm > 0:
-            fw_step /= nrm
+        fw_step = self.__prepare_step(
+            self.metric.compute_forward(), current_disp_spacing
+        )
 
         # Add to current total field
         self.static_to_ref.forward, md_forward = self.update(
@@ -1525,15 +1711,9 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         fw_energy = self.metric.get_energy()
 
         # Compose backward step (to be used to update the backward transform)
-        bw_step = np.array(self.metric.compute_backward())
-
-        # set zero displacements at the boundary
-        bw_step = self.__set_no_boundary_displacement(bw_step)
-
-        # Normalize the backward step
-        nrm = np.sqrt(np.sum((bw_step / current_disp_spacing) ** 2, -1)).max()
-        if nrm > 0:
-            bw_step /= nrm
+        bw_step = self.__prepare_step(
+            self.metric.compute_backward(), current_disp_spacing
+        )
 
         # Add to current total field
         self.moving_to_ref.forward, md_backward = self.update(
@@ -1570,6 +1750,32 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
 
         return der
 
+    def __prepare_step(self, step, spacing):
+        """Set zero displacements at the boundary and normalize a step
+
+        Parameters
+        ----------
+        step : array, ndim 2 or 3
+            displacements field computed by the metric. It is modified in
+            place in low memory mode, and copied otherwise.
+        spacing : array, shape (2,) or (3,)
+            the spacing between voxels (voxel size along each axis)
+
+        Returns
+        -------
+        step : array, ndim 2 or 3
+            displacements field, with maximum norm 1 (in voxel units)
+        """
+        if self.low_memory:
+            step = self.__set_no_boundary_displacement(np.asarray(step))
+            nrm = np.sqrt(self._squared_norms(step, spacing=spacing).max())
+        else:
+            step = self.__set_no_boundary_displacement(np.array(step))
+            nrm = np.sqrt(np.sum((step / spacing) ** 2, -1)).max()
+        if nrm > 0:
+            step /= nrm
+        return step
+
     def __set_no_boundary_displacement(self, step):
         """set zero displacements at the boundary
 
@@ -1605,6 +1811,30 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             the spacing between voxels (voxel size along each axis)
         """
 
+        if self.low_memory:
+            # Invert the fields in place of their current inverses
+            for model in [self.static_to_ref, self.moving_to_ref]:
+                self.invert_vector_field(
+                    model.forward,
+                    current_disp_world2grid,
+                    current_disp_spacing,
+                    self.inv_iter,
+                    self.inv_tol,
+                    start=model.backward,
+                    out=model.backward,
+                )
+            for model in [self.static_to_ref, self.moving_to_ref]:
+                self.invert_vector_field(
+                    model.backward,
+                    current_disp_world2grid,
+                    current_disp_spacing,
+                    self.inv_iter,
+                    self.inv_tol,
+                    start=model.forward,
+                    out=model.forward,
+                )
+            return
+
         # Invert the forward model's forward field
         self.static_to_ref.backward = np.array(
             self.invert_vector_field(
@@ -1818,18 +2048,17 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                 logger.info(f"Pre-align: {prealign}")
 
         self._init_optimizer(
-            static.astype(floating),
-            moving.astype(floating),
+            np.asarray(static, dtype=floating),
+            np.asarray(moving, dtype=floating),
             static_grid2world,
             moving_grid2world,
             prealign,
         )
         self._optimize()
         self._end_optimizer()
-        self.static_to_moving.forward = np.array(self.static_to_moving.forward)
-        self.static_to_moving.backward = np.array(self.static_to_moving.backward)
-        self.static_to_ref.forward = np.array(self.static_to_ref.forward)
-        self.static_to_ref.backward = np.array(self.static_to_ref.backward)
-        self.moving_to_ref.forward = np.array(self.moving_to_ref.forward)
-        self.moving_to_ref.backward = np.array(self.moving_to_ref.backward)
+        # Avoid copying the fields in low memory mode
+        as_array = np.asarray if self.low_memory else np.array
+        for model in [self.static_to_moving, self.static_to_ref, self.moving_to_ref]:
+            model.forward = as_array(model.forward)
+            model.backward = as_array(model.backward)
         return self.static_to_moving
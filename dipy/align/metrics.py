@@ -1,6 +1,7 @@
 """Metrics for Symmetric Diffeomorphic Registration"""
 
 import abc
+from functools import partial
 
 import numpy as np
 from numpy import gradient
@@ -202,7 +203,7 @@ class SimilarityMetric:
 
 class CCMetric(SimilarityMetric):
     @warning_for_keywords()
-    def __init__(self, dim, *, sigma_diff=2.0, radius=4):
+    def __init__(self, dim, *, sigma_diff=2.0, radius=4, num_threads=None):
         r"""Normalized Cross-Correlation Similarity metric.
 
         Parameters
@@ -214,10 +215,18 @@ class CCMetric(SimilarityMetric):
         radius : int
             the radius of the squared (cubic) neighborhood at each voxel to be
             considered to compute the cross correlation
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            factors and steps. If None (default) the value of OMP_NUM_THREADS
+            environment variable is used if it is set, otherwise all available
+            threads are used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
         """
         super(CCMetric, self).__init__(dim)
         self.sigma_diff = sigma_diff
         self.radius = radius
+        self.num_threads = num_threads
         self._connect_functions()
 
     def _connect_functions(self):
@@ -233,9 +242,15 @@ class CCMetric(SimilarityMetric):
             self.compute_backward_step = cc.compute_cc_backward_step_2d
             self.reorient_vector_field = vfu.reorient_vector_field_2d
         elif self.dim == 3:
-            self.precompute_factors = cc.precompute_cc_factors_3d
-            self.compute_forward_step = cc.compute_cc_forward_step_3d
-            self.compute_backward_step = cc.compute_cc_backward_step_3d
+            self.precompute_factors = partial(
+                cc.precompute_cc_factors_3d, num_threads=self.num_threads
+            )
+            self.compute_forward_step = partial(
+                cc.compute_cc_forward_step_3d, num_threads=self.num_threads
+            )
+            self.compute_backward_step = partial(
+                cc.compute_cc_backward_step_3d, num_threads=self.num_threads
+            )
             self.reorient_vector_field = vfu.reorient_vector_field_3d
         else:
             raise ValueError(f"CC Metric not defined for dim. {self.dim}")
@@ -274,7 +289,7 @@ class CCMetric(SimilarityMetric):
         self.factors = self.precompute_factors(
             self.static_image, self.moving_image, self.radius
         )
-        self.factors = np.array(self.factors)
+        self.factors = np.asarray(self.factors)
 
         self.gradient_moving = np.empty(
             shape=self.moving_image.shape + (self.dim,), dtype=floating
@@ -315,7 +330,7 @@ class CCMetric(SimilarityMetric):
         displacement, self.energy = self.compute_forward_step(
             self.gradient_static, self.factors, self.radius
         )
-        displacement = np.array(displacement)
+        displacement = np.asarray(displacement)
         for i in range(self.dim):
             displacement[..., i] = ndimage.gaussian_filter(
                 displacement[..., i], self.sigma_diff
@@ -331,7 +346,7 @@ class CCMetric(SimilarityMetric):
         displacement, energy = self.compute_backward_step(
             self.gradient_moving, self.factors, self.radius
         )
-        displacement = np.array(displacement)
+        displacement = np.asarray(displacement)
         for i in range(self.dim):
             displacement[..., i] = ndimage.gaussian_filter(
                 displacement[..., i], self.sigma_diff
@@ -358,6 +373,7 @@ class EMMetric(SimilarityMetric):
         q_levels=256,
         double_gradient=True,
         step_type="gauss_newton",
+        num_threads=None,
     ):
         r"""Expectation-Maximization Metric
 
@@ -389,6 +405,13 @@ class EMMetric(SimilarityMetric):
             the optimization schedule to be used in the multi-resolution
             Gauss-Seidel optimization algorithm (not used if Demons Step is
             selected)
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            demons step. If None (default) the value of OMP_NUM_THREADS
+            environment variable is used if it is set, otherwise all available
+            threads are used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
         """
         super(EMMetric, self).__init__(dim)
         self.smooth = smooth
@@ -396,6 +419,7 @@ class EMMetric(SimilarityMetric):
         self.q_levels = q_levels
         self.use_double_gradient = double_gradient
         self.step_type = step_type
+        self.num_threads = num_threads
         self.static_image_mask = None
         self.moving_image_mask = None
         self.staticq_means_field = None
@@ -631,7 +655,12 @@ class EMMetric(SimilarityMetric):
             )
         else:
             step, self.energy = em.compute_em_demons_step_3d(
-                delta_field, sigma_sq_field, gradient, sigma_reg_2, None
+                delta_field,
+                sigma_sq_field,
+                gradient,
+                sigma_reg_2,
+                None,
+                num_threads=self.num_threads,
             )
         for i in range(self.dim):
             step[..., i] = ndimage.gaussian_filter(step[..., i], self.smooth)
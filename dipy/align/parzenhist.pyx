@@ -17,11 +17,29 @@ from dipy.align.vector_fields cimport(_apply_affine_3d_x0,
 
 from dipy.align.transforms cimport (Transform)
 
+from cython.parallel import prange, threadid
+
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 cdef extern from "dpy_math.h" nogil:
     double cos(double)
     double sin(double)
     double log(double)
 
+
+DEF PDF_BLOCK_SLICES = 4
+DEF PDF_BLOCK_SAMPLES = 4096
+
+
+cdef inline cnp.npy_intp _intp_min(cnp.npy_intp a,
+                                   cnp.npy_intp b) noexcept nogil:
+    r"""
+    Returns the minimum of a and b
+    """
+    return a if a <= b else b
+
+
 class ParzenJointHistogram:
     def __init__(self, nbins):
         r""" Computes joint histogram and derivatives with Parzen windows
@@ -124,9 +142,30 @@ class ParzenJointHistogram:
         self.joint = np.zeros(shape=(self.nbins, self.nbins))
         self.smarginal = np.zeros(shape=(self.nbins,), dtype=np.float64)
         self.mmarginal = np.zeros(shape=(self.nbins,), dtype=np.float64)
+        # Partial histograms of the blocks of slices of 3D images, allocated
+        # once and reused by every update of the dense PDFs and gradient
+        self._joint_blocks = None
+        self._grad_blocks = None
+        if len(static.shape) == 3:
+            self._dense_blocks(static.shape[0])
 
         self.setup_called = True
 
+    def _dense_blocks(self, nslices):
+        r""" Partial histogram buffers of the blocks of `nslices` slices
+
+        The buffers are only reallocated when the number of blocks changes.
+        """
+        nblocks = (nslices + PDF_BLOCK_SLICES - 1) // PDF_BLOCK_SLICES
+        if (self._joint_blocks is None or
+                self._joint_blocks.shape[0] != nblocks):
+            self._joint_blocks = np.empty((nblocks, self.nbins, self.nbins))
+            self._smarginal_blocks = np.empty((nblocks, self.nbins))
+            self._sum_blocks = np.empty(nblocks)
+            self._valid_blocks = np.empty(nblocks, dtype=np.intp)
+            self._grad_blocks = None
+        return nblocks
+
     def bin_normalize_static(self, x):
         r""" Maps intensity x to the range covered by the static histogram
 
@@ -180,7 +219,8 @@ class ParzenJointHistogram:
         """
         return _bin_index(xnorm, self.nbins, self.padding)
 
-    def update_pdfs_dense(self, static, moving, smask=None, mmask=None):
+    def update_pdfs_dense(self, static, moving, smask=None, mmask=None,
+                          num_threads=None):
         r""" Computes the Probability Density Functions of two images
 
         The joint PDF is stored in self.joint. The marginal distributions
@@ -201,6 +241,18 @@ class ParzenJointHistogram:
             mask of moving object being registered (a binary array with 1's
             inside the object of interest and 0's along the background).
             If None, ones_like(moving) is used as mask.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            case. If None (default) the value of OMP_NUM_THREADS environment
+            variable is used if it is set, otherwise all available threads are
+            used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
+
+        Notes
+        -----
+        In the 3D case, float32 images are processed without conversion
+        when both `static` and `moving` are float32.
         """
         if static.shape != moving.shape:
             raise ValueError("Images must have the same shape")
@@ -217,13 +269,25 @@ class ParzenJointHistogram:
                                    self.sdelta, self.mmin, self.mdelta,
                                    self.nbins, self.padding, self.joint,
                                    self.smarginal, self.mmarginal)
-        elif dim == 3:
-            _compute_pdfs_dense_3d(static, moving, smask, mmask, self.smin,
-                                   self.sdelta, self.mmin, self.mdelta,
-                                   self.nbins, self.padding, self.joint,
-                                   self.smarginal, self.mmarginal)
+        else:
+            self._dense_blocks(static.shape[0])
+            if static.dtype == np.float32 and moving.dtype == np.float32:
+                _compute_pdfs_dense_3d[cython.float](
+                    static, moving, smask, mmask, self.smin, self.sdelta,
+                    self.mmin, self.mdelta, self.nbins, self.padding,
+                    self.joint, self.smarginal, self.mmarginal,
+                    self._joint_blocks, self._smarginal_blocks,
+                    self._sum_blocks, self._valid_blocks, num_threads)
+            else:
+                _compute_pdfs_dense_3d[cython.double](
+                    np.asarray(static, dtype=np.float64),
+                    np.asarray(moving, dtype=np.float64), smask, mmask,
+                    self.smin, self.sdelta, self.mmin, self.mdelta,
+                    self.nbins, self.padding, self.joint, self.smarginal,
+                    self.mmarginal, self._joint_blocks, self._smarginal_blocks,
+                    self._sum_blocks, self._valid_blocks, num_threads)
 
-    def update_pdfs_sparse(self, sval, mval):
+    def update_pdfs_sparse(self, sval, mval, num_threads=None):
         r""" Computes the Probability Density Functions from a set of samples
 
         The list of intensities `sval` and `mval` are assumed to be sampled
@@ -243,6 +307,13 @@ class ParzenJointHistogram:
             sampled intensities from the static image at sampled_points
         mval : array, shape (n,)
             sampled intensities from the moving image at sampled_points
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
         """
         if not self.setup_called:
             self.setup(sval, mval)
@@ -250,10 +321,12 @@ class ParzenJointHistogram:
         energy = _compute_pdfs_sparse(sval, mval, self.smin, self.sdelta,
                                       self.mmin, self.mdelta, self.nbins,
                                       self.padding, self.joint,
-                                      self.smarginal, self.mmarginal)
+                                      self.smarginal, self.mmarginal,
+                                      num_threads)
 
     def update_gradient_dense(self, theta, transform, static, moving,
-                              grid2world, mgradient, smask=None, mmask=None):
+                              grid2world, mgradient, smask=None, mmask=None,
+                              num_threads=None):
         r""" Computes the Gradient of the joint PDF w.r.t. transform parameters
 
         Computes the vector of partial derivatives of the joint histogram
@@ -295,6 +368,18 @@ class ParzenJointHistogram:
             mask of moving object being registered (a binary array with 1's
             inside the object of interest and 0's along the background).
             The default is None, indicating all voxels are considered.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            case. If None (default) the value of OMP_NUM_THREADS environment
+            variable is used if it is set, otherwise all available threads are
+            used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
+
+        Notes
+        -----
+        In the 3D case, float32 images and gradients are processed without
+        conversion when `static`, `moving` and `mgradient` are all float32.
         """
         if static.shape != moving.shape:
             raise ValueError("Images must have the same shape")
@@ -330,21 +415,30 @@ class ParzenJointHistogram:
                 raise ValueError('Grad. field dtype must be floating point')
 
         elif dim == 3:
-            if mgradient.dtype == np.float64:
-                _joint_pdf_gradient_dense_3d[cython.double](theta, transform,
-                    static, moving, grid2world, mgradient, smask, mmask,
-                    self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
-            elif mgradient.dtype == np.float32:
+            if mgradient.dtype not in [np.float32, np.float64]:
+                raise ValueError('Grad. field dtype must be floating point')
+            nblocks = self._dense_blocks(static.shape[0])
+            if (self._grad_blocks is None or
+                    self._grad_blocks.shape[3] != n):
+                self._grad_blocks = np.empty((nblocks, nbins, nbins, n))
+            if (static.dtype == np.float32 and moving.dtype == np.float32 and
+                    mgradient.dtype == np.float32):
                 _joint_pdf_gradient_dense_3d[cython.float](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    self._grad_blocks, self._valid_blocks, num_threads)
             else:
-                raise ValueError('Grad. field dtype must be floating point')
+                _joint_pdf_gradient_dense_3d[cython.double](theta, transform,
+                    np.asarray(static, dtype=np.float64),
+                    np.asarray(moving, dtype=np.float64), grid2world,
+                    np.asarray(mgradient, dtype=np.float64), smask, mmask,
+                    self.smin, self.sdelta, self.mmin, self.mdelta,
+                    self.nbins, self.padding, self.joint_grad,
+                    self._grad_blocks, self._valid_blocks, num_threads)
 
     def update_gradient_sparse(self, theta, transform, sval, mval,
-                               sample_points, mgradient):
+                               sample_points, mgradient, num_threads=None):
         r""" Computes the Gradient of the joint PDF w.r.t. transform parameters
 
         Computes the vector of partial derivatives of the joint histogram
@@ -375,6 +469,13 @@ class ParzenJointHistogram:
             sampled at
         mgradient : array, shape (m, 3)
             the gradient of the moving image at the sample points
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the 3D
+            case. If None (default) the value of OMP_NUM_THREADS environment
+            variable is used if it is set, otherwise all available threads are
+            used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
         """
         dim = sample_points.shape[1]
         if mgradient.shape[1] != dim:
@@ -413,12 +514,12 @@ class ParzenJointHistogram:
                 _joint_pdf_gradient_sparse_3d[cython.double](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, num_threads)
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_sparse_3d[cython.float](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, num_threads)
             else:
                 raise ValueError('Gradients dtype must be floating point')
         else:
@@ -663,12 +764,70 @@ cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
                     mmarginal[j] += joint[i, j]
 
 
-cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
+cdef void _pdfs_dense_3d_block(floating[:, :, :] static,
+                               floating[:, :, :] moving,
+                               int[:, :, :] smask, int[:, :, :] mmask,
+                               double smin, double sdelta,
+                               double mmin, double mdelta,
+                               int nbins, int padding,
+                               cnp.npy_intp first, cnp.npy_intp last,
+                               double[:, :] joint, double[:] smarginal,
+                               double* total_sum,
+                               cnp.npy_intp* valid_points) noexcept nogil:
+    r""" Unnormalized joint PDF of the slices [first, last) of two 3D images
+
+    The histograms are written to `joint` and `smarginal`, the sum of
+    the Parzen weights is written to `total_sum` and the number of points to
+    `valid_points`. See `_compute_pdfs_dense_3d` for the other parameters.
+    """
+    cdef:
+        cnp.npy_intp nrows = static.shape[1]
+        cnp.npy_intp ncols = static.shape[2]
+        cnp.npy_intp offset, k, i, j, r, c
+        cnp.npy_intp count = 0
+        double rn, cn
+        double val, spline_arg
+        double weight = 0
+
+    for r in range(nbins):
+        smarginal[r] = 0
+        for c in range(nbins):
+            joint[r, c] = 0
+    for k in range(first, last):
+        for i in range(nrows):
+            for j in range(ncols):
+                if smask is not None and smask[k, i, j] == 0:
+                    continue
+                if mmask is not None and mmask[k, i, j] == 0:
+                    continue
+                count += 1
+                rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                smarginal[r] += 1
+                for offset in range(-2, 3):
+                    val = _cubic_spline(spline_arg)
+                    joint[r, c + offset] += val
+                    weight += val
+                    spline_arg += 1.0
+    total_sum[0] = weight
+    valid_points[0] = count
+
+
+cdef _compute_pdfs_dense_3d(floating[:, :, :] static,
+                            floating[:, :, :] moving,
                             int[:, :, :] smask, int[:, :, :] mmask,
                             double smin, double sdelta,
                             double mmin, double mdelta,
                             int nbins, int padding, double[:, :] joint,
-                            double[:] smarginal, double[:] mmarginal):
+                            double[:] smarginal, double[:] mmarginal,
+                            double[:, :, :] joint_blocks,
+                            double[:, :] smarginal_blocks,
+                            double[:] sum_blocks,
+                            cnp.npy_intp[:] valid_blocks, num_threads):
     r""" Joint Probability Density Function of intensities of two 3D images
 
     Parameters
@@ -704,41 +863,59 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    joint_blocks : array, shape (nblocks, nbins, nbins)
+        buffer for the partial joint histograms of the blocks of slices
+    smarginal_blocks : array, shape (nblocks, nbins)
+        buffer for the partial static marginals of the blocks of slices
+    sum_blocks : array, shape (nblocks,)
+        buffer for the sums of the Parzen weights of the blocks of slices
+    valid_blocks : array, shape (nblocks,)
+        buffer for the numbers of points of the blocks of slices
+    num_threads : int or None
+        Number of threads to be used for OpenMP parallelization. If None
+        the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Notes
+    -----
+    The volume is split in blocks of `PDF_BLOCK_SLICES` slices whose partial
+    histograms are accumulated in parallel and added in block order, so the
+    result does not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp nslices = static.shape[0]
-        cnp.npy_intp nrows = static.shape[1]
-        cnp.npy_intp ncols = static.shape[2]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp k, i, j, r, c
-        double rn, cn
-        double val, spline_arg, total_sum
+        cnp.npy_intp nblocks = (nslices + PDF_BLOCK_SLICES - 1) // PDF_BLOCK_SLICES
+        cnp.npy_intp valid_points = 0
+        cnp.npy_intp b, i, j
+        double total_sum = 0
+        int threads_to_use = -1
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    with nogil:
+        for b in prange(nblocks, schedule="dynamic",
+                        num_threads=threads_to_use):
+            _pdfs_dense_3d_block(
+                static, moving, smask, mmask, smin, sdelta, mmin, mdelta,
+                nbins, padding, b * PDF_BLOCK_SLICES,
+                _intp_min(nslices, (b + 1) * PDF_BLOCK_SLICES),
+                joint_blocks[b], smarginal_blocks[b], &sum_blocks[b],
+                &valid_blocks[b])
+    if num_threads is not None:
+        restore_default_num_threads()
 
     joint[...] = 0
-    total_sum = 0
+    smarginal[...] = 0
     with nogil:
-        valid_points = 0
-        smarginal[:] = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
-
-                    smarginal[r] += 1
-                    for offset in range(-2, 3):
-                        val = _cubic_spline(spline_arg)
-                        joint[r, c + offset] += val
-                        total_sum += val
-                        spline_arg += 1.0
+        for b in range(nblocks):
+            for i in range(nbins):
+                smarginal[i] += smarginal_blocks[b, i]
+                for j in range(nbins):
+                    joint[i, j] += joint_blocks[b, i, j]
+            total_sum += sum_blocks[b]
+            valid_points += valid_blocks[b]
 
         if total_sum > 0:
             for i in range(nbins):
@@ -754,10 +931,45 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
                     mmarginal[j] += joint[i, j]
 
 
+cdef void _pdfs_sparse_block(double[:] sval, double[:] mval, double smin,
+                             double sdelta, double mmin, double mdelta,
+                             int nbins, int padding,
+                             cnp.npy_intp first, cnp.npy_intp last,
+                             double[:, :] joint, double[:] smarginal,
+                             double* total_sum) noexcept nogil:
+    r""" Unnormalized joint PDF of the samples [first, last)
+
+    The histograms are accumulated into `joint` and `smarginal` and the sum of
+    the Parzen weights is written to `total_sum`. See `_compute_pdfs_sparse`
+    for the other parameters.
+    """
+    cdef:
+        cnp.npy_intp offset, i, r, c
+        double rn, cn
+        double val, spline_arg
+        double weight = 0
+
+    for i in range(first, last):
+        rn = _bin_normalize(sval[i], smin, sdelta)
+        r = _bin_index(rn, nbins, padding)
+        cn = _bin_normalize(mval[i], mmin, mdelta)
+        c = _bin_index(cn, nbins, padding)
+        spline_arg = (c - 2) - cn
+
+        smarginal[r] += 1
+        for offset in range(-2, 3):
+            val = _cubic_spline(spline_arg)
+            joint[r, c + offset] += val
+            weight += val
+            spline_arg += 1.0
+    total_sum[0] = weight
+
+
 cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
                           double sdelta, double mmin, double mdelta,
                           int nbins, int padding, double[:, :] joint,
-                          double[:] smarginal, double[:] mmarginal):
+                          double[:] smarginal, double[:] mmarginal,
+                          num_threads):
     r""" Probability Density Functions of paired intensities
 
     Parameters
@@ -787,34 +999,52 @@ cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int or None
+        Number of threads to be used for OpenMP parallelization. If None
+        the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Notes
+    -----
+    The samples are split in blocks of `PDF_BLOCK_SAMPLES` samples whose
+    partial histograms are accumulated in parallel and added in block order,
+    so the result does not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp n = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp i, r, c
-        double rn, cn
-        double val, spline_arg, total_sum
+        cnp.npy_intp nblocks = (n + PDF_BLOCK_SAMPLES - 1) // PDF_BLOCK_SAMPLES
+        cnp.npy_intp valid_points = n
+        cnp.npy_intp b, i, j
+        double total_sum = 0
+        double[:, :, :] joint_blocks = np.zeros((nblocks, nbins, nbins))
+        double[:, :] smarginal_blocks = np.zeros((nblocks, nbins))
+        double[:] sum_blocks = np.zeros(nblocks)
+        int threads_to_use = -1
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    with nogil:
+        for b in prange(nblocks, schedule="dynamic",
+                        num_threads=threads_to_use):
+            _pdfs_sparse_block(
+                sval, mval, smin, sdelta, mmin, mdelta, nbins, padding,
+                b * PDF_BLOCK_SAMPLES,
+                _intp_min(n, (b + 1) * PDF_BLOCK_SAMPLES),
+                joint_blocks[b], smarginal_blocks[b], &sum_blocks[b])
+    if num_threads is not None:
+        restore_default_num_threads()
 
     joint[...] = 0
-    total_sum = 0
-
+    smarginal[...] = 0
     with nogil:
-        valid_points = 0
-        smarginal[:] = 0
-        for i in range(n):
-            valid_points += 1
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            smarginal[r] += 1
-            for offset in range(-2, 3):
-                val = _cubic_spline(spline_arg)
-                joint[r, c + offset] += val
-                total_sum += val
-                spline_arg += 1.0
+        for b in range(nblocks):
+            for i in range(nbins):
+                smarginal[i] += smarginal_blocks[b, i]
+                for j in range(nbins):
+                    joint[i, j] += joint_blocks[b, i, j]
+            total_sum += sum_blocks[b]
 
         if total_sum > 0:
             for i in range(nbins):
@@ -937,16 +1167,82 @@ cdef _joint_pdf_gradient_dense_2d(double[:] theta, Transform transform,
                         grad_pdf[i, j, k] /= norm_factor
 
 
+cdef cnp.npy_intp _joint_pdf_gradient_dense_3d_block(
+        double[:] theta, Transform transform, floating[:, :, :] static,
+        floating[:, :, :] moving, double[:, :] grid2world,
+        floating[:, :, :, :] mgradient, int[:, :, :] smask,
+        int[:, :, :] mmask, double smin, double sdelta, double mmin,
+        double mdelta, int nbins, int padding, cnp.npy_intp first,
+        cnp.npy_intp last, double[:, :] J, double[:] prod, double[:] x,
+        double[:, :, :] grad_pdf) noexcept nogil:
+    r""" Unnormalized gradient of the joint PDF of the slices [first, last)
+
+    The gradient is written to `grad_pdf`. `J`, `prod` and `x` are
+    buffers of shape (3, n), (n,) and (3,). Returns the number of points. See
+    `_joint_pdf_gradient_dense_3d` for the other parameters.
+    """
+    cdef:
+        cnp.npy_intp nrows = static.shape[1]
+        cnp.npy_intp ncols = static.shape[2]
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp offset
+        cnp.npy_intp valid_points = 0
+        int constant_jacobian = 0
+        cnp.npy_intp l, k, i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for r in range(nbins):
+        for c in range(nbins):
+            for l in range(n):
+                grad_pdf[r, c, l] = 0
+    for k in range(first, last):
+        for i in range(nrows):
+            for j in range(ncols):
+                if smask is not None and smask[k, i, j] == 0:
+                    continue
+                if mmask is not None and mmask[k, i, j] == 0:
+                    continue
+                valid_points += 1
+                x[0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
+                x[1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
+                x[2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
+
+                if constant_jacobian == 0:
+                    constant_jacobian = transform._jacobian(theta, x, J)
+
+                for l in range(n):
+                    prod[l] = (J[0, l] * mgradient[k, i, j, 0] +
+                               J[1, l] * mgradient[k, i, j, 1] +
+                               J[2, l] * mgradient[k, i, j, 2])
+
+                rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                for offset in range(-2, 3):
+                    val = _cubic_spline_derivative(spline_arg)
+                    for l in range(n):
+                        grad_pdf[r, c + offset, l] -= val * prod[l]
+                    spline_arg += 1.0
+    return valid_points
+
+
 cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
-                                  double[:, :, :] static,
-                                  double[:, :, :] moving,
+                                  floating[:, :, :] static,
+                                  floating[:, :, :] moving,
                                   double[:, :] grid2world,
                                   floating[:, :, :, :] mgradient,
                                   int[:, :, :] smask,
                                   int[:, :, :] mmask, double smin,
                                   double sdelta, double mmin, double mdelta,
                                   int nbins, int padding,
-                                  double[:, :, :] grad_pdf):
+                                  double[:, :, :] grad_pdf,
+                                  double[:, :, :, :] grad_blocks,
+                                  cnp.npy_intp[:] valid_blocks,
+                                  num_threads):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -992,55 +1288,61 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    grad_blocks : array, shape (nblocks, nbins, nbins, len(theta))
+        buffer for the partial gradients of the blocks of slices
+    valid_blocks : array, shape (nblocks,)
+        buffer for the numbers of points of the blocks of slices
+    num_threads : int or None
+        Number of threads to be used for OpenMP parallelization. If None
+        the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Notes
+    -----
+    The volume is split in blocks of `PDF_BLOCK_SLICES` slices whose partial
+    gradients are accumulated in parallel and added in block order, so the
+    result does not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp nslices = static.shape[0]
-        cnp.npy_intp nrows = static.shape[1]
-        cnp.npy_intp ncols = static.shape[2]
         cnp.npy_intp n = theta.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
-        cnp.npy_intp l, k, i, j, r, c
-        double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-        double[:] x = np.empty(shape=(3,), dtype=np.float64)
+        cnp.npy_intp nblocks = (nslices + PDF_BLOCK_SLICES - 1) // PDF_BLOCK_SLICES
+        cnp.npy_intp valid_points = 0
+        cnp.npy_intp b, k, i, j, tid
+        double norm_factor
+        double[:, :, :] J
+        double[:, :] prod
+        double[:, :] x
+        int threads_to_use = -1
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    J = np.empty((threads_to_use, 3, n), dtype=np.float64)
+    prod = np.empty((threads_to_use, n), dtype=np.float64)
+    x = np.empty((threads_to_use, 3), dtype=np.float64)
+    with nogil:
+        for b in prange(nblocks, schedule="dynamic",
+                        num_threads=threads_to_use):
+            tid = threadid()
+            valid_blocks[b] = _joint_pdf_gradient_dense_3d_block(
+                theta, transform, static, moving, grid2world, mgradient,
+                smask, mmask, smin, sdelta, mmin, mdelta, nbins, padding,
+                b * PDF_BLOCK_SLICES,
+                _intp_min(nslices, (b + 1) * PDF_BLOCK_SLICES),
+                J[tid], prod[tid], x[tid], grad_blocks[b])
+    if num_threads is not None:
+        restore_default_num_threads()
 
     grad_pdf[...] = 0
     with nogil:
-        valid_points = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    x[0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
-                    x[1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
-                    x[2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
-
-                    if constant_jacobian == 0:
-                        constant_jacobian = transform._jacobian(theta, x, J)
-
-                    for l in range(n):
-                        prod[l] = (J[0, l] * mgradient[k, i, j, 0] +
-                                   J[1, l] * mgradient[k, i, j, 1] +
-                                   J[2, l] * mgradient[k, i, j, 2])
-
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
-
-                    for offset in range(-2, 3):
-                        val = _cubic_spline_derivative(spline_arg)
-                        for l in range(n):
-                            grad_pdf[r, c + offset, l] -= val * prod[l]
-                        spline_arg += 1.0
+        for b in range(nblocks):
+            valid_points += valid_blocks[b]
+            for i in range(nbins):
+                for j in range(nbins):
+                    for k in range(n):
+                        grad_pdf[i, j, k] += grad_blocks[b, i, j, k]
 
         norm_factor = valid_points * mdelta
         if norm_factor > 0:
@@ -1140,13 +1442,57 @@ cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
                         grad_pdf[i, j, k] /= norm_factor
 
 
+cdef void _joint_pdf_gradient_sparse_3d_block(
+        double[:] theta, Transform transform, double[:] sval, double[:] mval,
+        double[:, :] sample_points, floating[:, :] mgradient, double smin,
+        double sdelta, double mmin, double mdelta, int nbins, int padding,
+        cnp.npy_intp first, cnp.npy_intp last, double[:, :] J,
+        double[:] prod, double[:, :, :] grad_pdf) noexcept nogil:
+    r""" Unnormalized gradient of the joint PDF of the samples [first, last)
+
+    The gradient is accumulated into `grad_pdf`. `J` and `prod` are buffers
+    of shape (3, n) and (n,). See `_joint_pdf_gradient_sparse_3d` for the
+    other parameters.
+    """
+    cdef:
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp offset
+        int constant_jacobian = 0
+        cnp.npy_intp i, j, r, c
+        double rn, cn
+        double val, spline_arg
+
+    for i in range(first, last):
+        if constant_jacobian == 0:
+            constant_jacobian = transform._jacobian(theta,
+                                                    sample_points[i], J)
+
+        for j in range(n):
+            prod[j] = (J[0, j] * mgradient[i, 0] +
+                       J[1, j] * mgradient[i, 1] +
+                       J[2, j] * mgradient[i, 2])
+
+        rn = _bin_normalize(sval[i], smin, sdelta)
+        r = _bin_index(rn, nbins, padding)
+        cn = _bin_normalize(mval[i], mmin, mdelta)
+        c = _bin_index(cn, nbins, padding)
+        spline_arg = (c - 2) - cn
+
+        for offset in range(-2, 3):
+            val = _cubic_spline_derivative(spline_arg)
+            for j in range(n):
+                grad_pdf[r, c + offset, j] -= val * prod[j]
+            spline_arg += 1.0
+
+
 cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
                                    double[:] sval, double[:] mval,
                                    double[:, :] sample_points,
                                    floating[:, :] mgradient, double smin,
                                    double sdelta, double mmin,
                                    double mdelta, int nbins, int padding,
-                                   double[:, :, :] grad_pdf):
+                                   double[:, :, :] grad_pdf,
+                                   num_threads):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -1185,44 +1531,54 @@ cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int or None
+        Number of threads to be used for OpenMP parallelization. If None
+        the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Notes
+    -----
+    The samples are split in blocks of `PDF_BLOCK_SAMPLES` samples whose
+    partial gradients are accumulated in parallel and added in block order,
+    so the result does not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp n = theta.shape[0]
         cnp.npy_intp m = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
-        cnp.npy_intp i, j, r, c
-        double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
+        cnp.npy_intp nblocks = (m + PDF_BLOCK_SAMPLES - 1) // PDF_BLOCK_SAMPLES
+        cnp.npy_intp valid_points = m
+        cnp.npy_intp b, i, j, k, tid
+        double norm_factor
+        double[:, :, :, :] grad_blocks = np.zeros((nblocks, nbins, nbins, n))
+        double[:, :, :] J
+        double[:, :] prod
+        int threads_to_use = -1
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    J = np.empty((threads_to_use, 3, n), dtype=np.float64)
+    prod = np.empty((threads_to_use, n), dtype=np.float64)
+    with nogil:
+        for b in prange(nblocks, schedule="dynamic",
+                        num_threads=threads_to_use):
+            tid = threadid()
+            _joint_pdf_gradient_sparse_3d_block(
+                theta, transform, sval, mval, sample_points, mgradient, smin,
+                sdelta, mmin, mdelta, nbins, padding, b * PDF_BLOCK_SAMPLES,
+                _intp_min(m, (b + 1) * PDF_BLOCK_SAMPLES), J[tid], prod[tid],
+                grad_blocks[b])
+    if num_threads is not None:
+        restore_default_num_threads()
 
     grad_pdf[...] = 0
     with nogil:
-        valid_points = 0
-        for i in range(m):
-            valid_points += 1
-
-            if constant_jacobian == 0:
-                constant_jacobian = transform._jacobian(theta,
-                                                        sample_points[i], J)
-
-            for j in range(n):
-                prod[j] = (J[0, j] * mgradient[i, 0] +
-                           J[1, j] * mgradient[i, 1] +
-                           J[2, j] * mgradient[i, 2])
-
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            for offset in range(-2, 3):
-                val = _cubic_spline_derivative(spline_arg)
-                for j in range(n):
-                    grad_pdf[r, c + offset, j] -= val * prod[j]
-                spline_arg += 1.0
+        for b in range(nblocks):
+            for i in range(nbins):
+                for j in range(nbins):
+                    for k in range(n):
+                        grad_pdf[i, j, k] += grad_blocks[b, i, j, k]
 
         norm_factor = valid_points * mdelta
         if norm_factor > 0:
@@ -1,17 +1,89 @@
-import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import math
 import warnings
 
 import numpy as np
-from scipy.ndimage import affine_transform
+from scipy.ndimage import affine_transform, spline_filter
 
 from dipy.testing.decorators import warning_for_keywords
 from dipy.utils.multiproc import determine_num_processes
 
 
-def _affine_transform(kwargs):
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", message=".*scipy.*18.*", category=UserWarning)
-        return affine_transform(**kwargs)
+def _slab_offset(zoom, start):
+    """Offset of the input coordinates of an output slab along an axis
+
+    ``affine_transform`` samples the output index ``k`` at
+    ``(k + offset / zoom) * zoom``. The offset is adjusted for
+    ``offset / zoom`` to be exactly `start`, so that a slab samples the
+    same coordinates as the whole volume.
+    """
+    offset = start * zoom
+    for _ in range(4):
+        shift = offset / zoom
+        if shift == start:
+            break
+        offset = math.nextafter(offset, math.inf if shift < start else -math.inf)
+    return offset
+
+
+def _reslice_volumes(volumes, out, zooms, *, order, mode, cval, num_threads, slab_size):
+    """Reslice each volume of a 4D array into a preallocated output
+
+    The volumes are split along their first axis in slabs of `slab_size`
+    output slices, and each (volume, slab) pair is resliced by a pool of
+    `num_threads` threads writing directly into `out`. The threads share
+    the input and output arrays, since ``affine_transform`` releases the
+    GIL.
+    """
+    n_volumes = volumes.shape[-1]
+    n_slices = out.shape[0]
+    if slab_size is None:
+        slabs_per_volume = -(-num_threads // max(n_volumes, 1))
+        slab_size = -(-n_slices // slabs_per_volume)
+    prefilter = order > 1
+    if prefilter and mode in ("nearest", "grid-constant"):
+        # scipy pads the input of these modes before the spline filter, which
+        # cannot be shared between slabs: volumes are resliced at once.
+        slab_size = n_slices
+    starts = range(0, n_slices, max(slab_size, 1))
+    split = prefilter and len(starts) > 1
+
+    def _prefilter(i):
+        return spline_filter(volumes[..., i], order, output=np.float64, mode=mode)
+
+    def _reslice_slab(task):
+        volume, i, start = task
+        affine_transform(
+            volume,
+            zooms,
+            offset=(_slab_offset(zooms[0], start), 0, 0),
+            output=out[start : start + slab_size, ..., i],
+            order=order,
+            mode=mode,
+            cval=cval,
+            prefilter=prefilter and not split,
+        )
+
+    executor = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+    run = map if executor is None else executor.map
+    try:
+        # Volumes are processed in batches of num_threads, which bounds the
+        # memory used by the spline coefficients of split volumes.
+        for first in range(0, n_volumes, num_threads):
+            batch = range(first, min(first + num_threads, n_volumes))
+            if split:
+                filtered = list(run(_prefilter, batch))
+            else:
+                filtered = [volumes[..., i] for i in batch]
+            tasks = [
+                (volume, i, start)
+                for volume, i in zip(filtered, batch)
+                for start in starts
+            ]
+            list(run(_reslice_slab, tasks))
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 
 @warning_for_keywords()
@@ -26,6 +98,7 @@ def reslice(
     cval=0,
     num_processes=1,
     new_shape=None,
+    slab_size=None,
 ):
     """Reslice data with new voxel resolution defined by ``new_zooms``.
 
@@ -50,13 +123,18 @@ def reslice(
         Value used for points outside the boundaries of the input if
         mode='constant'.
     num_processes : int, optional
-        Split the calculation to a pool of children processes. This only
-        applies to 4D `data` arrays. Default is 1. If < 0 the maximal number
-        of cores minus ``num_processes + 1`` is used (enter -1 to use as many
-        cores as possible). 0 raises an error.
+        Split the calculation to a pool of threads sharing the input and
+        output arrays. Default is 1. If None, all available cores are used.
+        If < 0 the maximal number of cores minus ``num_processes + 1`` is
+        used (enter -1 to use as many cores as possible). 0 raises an error.
     new_shape : tuple, shape (3,), optional
         Sets the shape the image should take after affine transformation.
         If None, it is calculated through the affine matrix and current shape.
+    slab_size : int, optional
+        Number of output slices along the first axis resliced by each task
+        of the pool. If None, volumes are split in as many slabs as needed
+        to give every thread a task, so that a single 3D volume is also
+        resliced in parallel. The result does not depend on the slabs.
 
 
     Returns
@@ -86,6 +164,8 @@ def reslice(
 
     """
     num_processes = determine_num_processes(num_processes)
+    if slab_size is not None and slab_size < 1:
+        raise ValueError("slab_size needs to be >= 1")
 
     # We are suppressing warnings emitted by scipy >= 0.18,
     # described in https://github.com/dipy/dipy/issues/1107.
@@ -99,35 +179,28 @@ def reslice(
         if new_shape is None:
             new_shape = zooms / new_zooms * np.array(data.shape[:3])
             new_shape = tuple(np.round(new_shape).astype("i8"))
-        kwargs = {
-            "matrix": R,
-            "output_shape": new_shape,
-            "order": order,
-            "mode": mode,
-            "cval": cval,
-        }
+        new_shape = tuple(new_shape)
         if data.ndim == 3:
-            data2 = affine_transform(input=data, **kwargs)
+            volumes = data[..., None]
         elif data.ndim == 4:
-            data2 = np.zeros(new_shape + (data.shape[-1],), data.dtype)
-            if num_processes == 1:
-                for i in range(data.shape[-1]):
-                    affine_transform(input=data[..., i], output=data2[..., i], **kwargs)
-            else:
-                params = []
-                for i in range(data.shape[-1]):
-                    _kwargs = {"input": data[..., i]}
-                    _kwargs.update(kwargs)
-                    params.append(_kwargs)
-                mp.set_start_method("spawn", force=True)
-                pool = mp.Pool(num_processes)
-                for i, res in enumerate(pool.imap(_affine_transform, params)):
-                    data2[..., i] = res
-                pool.close()
+            volumes = data
         else:
             raise ValueError(
                 f"dimension of data should be 3 or 4 but you provided {data.ndim}"
             )
+        data2 = np.zeros(new_shape + (volumes.shape[-1],), data.dtype)
+        _reslice_volumes(
+            volumes,
+            data2,
+            R,
+            order=order,
+            mode=mode,
+            cval=cval,
+            num_threads=num_processes,
+            slab_size=slab_size,
+        )
+        if data.ndim == 3:
+            data2 = data2[..., 0]
         Rx = np.eye(4)
         Rx[:3, :3] = np.diag(R)
         affine2 = np.dot(affine, Rx)
@@ -5,6 +5,7 @@ import nibabel as nib
 import numpy as np
 import numpy.testing as npt
 import pytest
+from scipy.ndimage import gaussian_filter
 
 from dipy.align import (
     affine,
@@ -20,7 +21,9 @@ from dipy.align import (
     rigid_scaling,
     streamline_registration,
     syn_registration,
+    syn_template,
     translation,
+    vector_fields as vfu,
     write_mapping,
 )
 from dipy.align.imwarp import DiffeomorphicMap
@@ -294,6 +297,89 @@ def test_register_series():
     npt.assert_(np.all(xformed[..., ref_idx] == img.get_fdata()[..., ref_idx]))
 
 
+def test_syn_template(monkeypatch):
+    shape = (24, 26, 22)
+    images = [
+        gaussian_filter(vfu.create_sphere(*shape, radius).astype(np.float64), 1.0)
+        for radius in [7, 8, 9]
+    ]
+    affines = [np.eye(4)] * len(images)
+    kwargs = {"affines": affines, "n_iterations": 2, "level_iters": [5, 5]}
+
+    template, template_affine = syn_template(images, **kwargs)
+    npt.assert_equal(template.shape, shape)
+    npt.assert_equal(template.dtype, np.float32)
+    npt.assert_array_equal(template_affine, np.eye(4))
+    # The template has the average shape of the spheres
+    sizes = [np.sum(image > 0.5) for image in images]
+    npt.assert_(sizes[0] < np.sum(template > 0.5) < sizes[2])
+
+    template_2, _ = syn_template(images, num_threads=2, **kwargs)
+    npt.assert_array_equal(template_2, template)
+
+    with TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        template_3, _ = syn_template(images, checkpoint_dir=tmpdir, **kwargs)
+        npt.assert_array_equal(template_3, template)
+        for it in range(3):
+            npt.assert_((tmpdir / f"template_{it:03d}.nii.gz").exists())
+        mapping_fname = tmpdir / "mapping_001_00002.nii.gz"
+        template_1 = nib.load(tmpdir / "template_001.nii.gz")
+        mapping = read_mapping(
+            mapping_fname, nib.Nifti1Image(images[2], np.eye(4)), template_1
+        )
+        npt.assert_equal(mapping.transform(images[2]).shape, shape)
+
+        # Resume after an interruption during the last iteration
+        (tmpdir / "template_002.nii.gz").unlink()
+        mapping_fname.unlink()
+        template_4, _ = syn_template(images, checkpoint_dir=tmpdir, **kwargs)
+        npt.assert_array_equal(template_4, template)
+        npt.assert_(mapping_fname.exists())
+
+        # Mappings read back by concurrent registrations use a single thread
+        (tmpdir / "template_002.nii.gz").unlink()
+        map_threads = []
+        transform = DiffeomorphicMap.transform
+
+        def transform_and_record(self, *args, **kwargs):
+            map_threads.append(self.num_threads)
+            return transform(self, *args, **kwargs)
+
+        monkeypatch.setattr(DiffeomorphicMap, "transform", transform_and_record)
+        template_5, _ = syn_template(
+            images, checkpoint_dir=tmpdir, num_threads=2, **kwargs
+        )
+        npt.assert_array_equal(template_5, template)
+        npt.assert_equal(map_threads, [1] * len(images))
+
+    npt.assert_raises(ValueError, syn_template, [])
+    npt.assert_raises(ValueError, syn_template, images, affines=affines[:1])
+    npt.assert_raises(ValueError, syn_template, images, affines=affines, n_iterations=0)
+
+
+def test_register_series_num_threads():
+    fdata, fbval, fbvec = dpd.get_fnames(name="small_64D")
+    img = nib.load(fdata)
+    data = img.get_fdata()[..., :4]
+    kwargs = {
+        "series_affine": img.affine,
+        "pipeline": ["center_of_mass", "rigid"],
+        "level_iters": [20, 10, 5],
+    }
+    xformed, affines = register_series(data, 0, **kwargs)
+
+    out = np.zeros(data.shape, dtype=np.float32)
+    xformed_2, affines_2 = register_series(data, 0, num_threads=2, out=out, **kwargs)
+    npt.assert_(xformed_2 is out)
+    npt.assert_array_equal(affines_2, affines)
+    npt.assert_array_equal(xformed_2, xformed.astype(np.float32))
+
+    npt.assert_raises(
+        ValueError, register_series, data, 0, out=np.zeros(data.shape[:3]), **kwargs
+    )
+
+
 def test_register_dwi_series_and_motion_correction():
     fdata, fbval, fbvec = dpd.get_fnames(name="small_64D")
     with TemporaryDirectory() as tmpdir:
@@ -0,0 +1,72 @@
+import numpy as np
+from numpy.testing import (
+    assert_allclose,
+    assert_array_equal,
+    assert_raises,
+)
+
+from dipy.align.cpd import DeformableRegistration, initialize_sigma2
+from dipy.testing.decorators import set_random_number_generator
+
+
+def _point_clouds(rng):
+    X = rng.random((120, 3)) * 20
+    Y = X[:100] + rng.normal(scale=0.5, size=(100, 3)) + 1
+    return X, Y
+
+
+@set_random_number_generator(1234)
+def test_initialize_sigma2(rng=None):
+    X, Y = _point_clouds(rng)
+    diff = X[None, :, :] - Y[:, None, :]
+    assert_allclose(initialize_sigma2(X, Y), np.sum(diff**2) / (3 * 120 * 100))
+
+
+@set_random_number_generator(1234)
+def test_chunked_expectation(rng=None):
+    X, Y = _point_clouds(rng)
+    TY = Y + rng.normal(scale=0.1, size=Y.shape)
+
+    reg = DeformableRegistration(X, Y, sigma2=4.0, w=0.1)
+    reg.TY = TY
+    reg.expectation()
+
+    results = []
+    for kwargs in [
+        {"chunk_size": 7},
+        {"chunk_size": 7, "num_threads": 3},
+        {"cutoff": 12.0, "chunk_size": 7},
+        {"cutoff": 12.0, "chunk_size": 7, "num_threads": 3},
+    ]:
+        chunked = DeformableRegistration(X, Y, sigma2=4.0, w=0.1, **kwargs)
+        assert chunked.P is None
+        chunked.TY = TY
+        chunked.expectation()
+        assert chunked.P is None
+        assert_allclose(chunked.P1, reg.P1, rtol=1e-7, atol=1e-12)
+        assert_allclose(chunked.Pt1, reg.Pt1, rtol=1e-7, atol=1e-12)
+        assert_allclose(chunked.PX, reg.PX, rtol=1e-7, atol=1e-10)
+        assert_allclose(chunked.Np, reg.Np)
+        results.append(chunked)
+
+    # The number of threads does not change the result
+    for single, multi in [(results[0], results[1]), (results[2], results[3])]:
+        assert_array_equal(single.P1, multi.P1)
+        assert_array_equal(single.Pt1, multi.Pt1)
+        assert_array_equal(single.PX, multi.PX)
+
+
+@set_random_number_generator(1234)
+def test_truncated_registration(rng=None):
+    X, Y = _point_clouds(rng)
+
+    TY, _ = DeformableRegistration(X, Y, max_iterations=30, w=0.1).register()
+    reg = DeformableRegistration(
+        X, Y, max_iterations=30, w=0.1, cutoff=6.0, num_threads=2
+    )
+    TY2, _ = reg.register()
+    assert_allclose(TY2, TY, atol=1e-2)
+
+    assert_raises(ValueError, DeformableRegistration, X, Y, chunk_size=0)
+    assert_raises(ValueError, DeformableRegistration, X, Y, chunk_size=2.5)
+    assert_raises(ValueError, DeformableRegistration, X, Y, cutoff=0)
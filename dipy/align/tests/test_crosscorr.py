@@ -1,5 +1,5 @@
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal, assert_equal
 
 from dipy.align import crosscorr as cc, floating
 from dipy.testing.decorators import set_random_number_generator
@@ -37,6 +37,38 @@ def test_cc_factors_3d():
         assert_array_almost_equal(factors, expected, decimal=5)
 
 
+@set_random_number_generator(5239911)
+def test_cc_3d_slabs_and_threads(rng):
+    # Volumes spanning several slabs of independent running sums
+    a = np.asarray(rng.random((70, 12, 11)), dtype=floating)
+    b = np.asarray(rng.random((70, 12, 11)), dtype=floating)
+    grad = np.asarray(rng.normal(size=(70, 12, 11, 3)), dtype=floating)
+    for radius in [0, 2, 5]:
+        expected = np.asarray(cc.precompute_cc_factors_3d_test(a, b, radius))
+        factors = np.asarray(cc.precompute_cc_factors_3d(a, b, radius, num_threads=1))
+        assert_array_almost_equal(factors, expected, decimal=4)
+        steps = [
+            cc.compute_cc_forward_step_3d(grad, factors, radius, num_threads=1),
+            cc.compute_cc_backward_step_3d(grad, factors, radius, num_threads=1),
+        ]
+        for num_threads in [2, 3]:
+            assert_array_equal(
+                cc.precompute_cc_factors_3d(a, b, radius, num_threads=num_threads),
+                factors,
+            )
+            actual = [
+                cc.compute_cc_forward_step_3d(
+                    grad, factors, radius, num_threads=num_threads
+                ),
+                cc.compute_cc_backward_step_3d(
+                    grad, factors, radius, num_threads=num_threads
+                ),
+            ]
+            for (exp_step, exp_energy), (step, energy) in zip(steps, actual):
+                assert_array_equal(step, exp_step)
+                assert_equal(energy, exp_energy)
+
+
 @set_random_number_generator(1147572)
 def test_compute_cc_steps_2d(rng):
     # Select arbitrary images' shape (same shape for both images)
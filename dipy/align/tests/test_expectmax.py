@@ -301,6 +301,27 @@ def test_compute_em_demons_step_3d(rng):
         raise AssertionError("Failed for sigma_i_sq != 0 and gradient != 0") from e
 
 
+@set_random_number_generator(4418230)
+def test_compute_em_demons_step_3d_num_threads(rng):
+    sh = (13, 9, 8)
+    delta_field = np.asarray(rng.normal(size=sh), dtype=floating)
+    sigma_sq_field = np.asarray(rng.random(sh), dtype=floating)
+    sigma_sq_field[0] = np.inf
+    sigma_sq_field[1, :3] = 0
+    gradient = np.asarray(rng.normal(size=sh + (3,)), dtype=floating)
+
+    expected, expected_energy = em.compute_em_demons_step_3d(
+        delta_field, sigma_sq_field, gradient, 0.5, None, num_threads=1
+    )
+    assert_array_almost_equal(expected_energy, np.sum(delta_field.astype(float) ** 2))
+    for num_threads in [2, 3]:
+        actual, energy = em.compute_em_demons_step_3d(
+            delta_field, sigma_sq_field, gradient, 0.5, None, num_threads=num_threads
+        )
+        assert_array_equal(actual, expected)
+        assert_equal(energy, expected_energy)
+
+
 @set_random_number_generator(1246592)
 def test_quantize_positive_2d(rng):
     # an arbitrary number of quantization levels
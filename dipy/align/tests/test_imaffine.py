@@ -1,11 +1,13 @@
 import numpy as np
 import numpy.linalg as npl
 from numpy.testing import (
+    assert_almost_equal,
     assert_array_almost_equal,
     assert_array_equal,
     assert_equal,
     assert_raises,
 )
+import scipy.ndimage as ndimage
 
 from dipy.align import imaffine, vector_fields as vf
 from dipy.align.imaffine import (
@@ -373,6 +375,154 @@ def test_affreg_defaults(rng):
             assert reduction > 0.89
 
 
+@set_random_number_generator(1957)
+def test_affreg_cache_static(rng):
+    transform = regtransforms[("RIGID", 3)]
+    static, moving, static_grid2world, moving_grid2world, smask, mmask, T = (
+        setup_random_transform(transform, 0.1, 20, 1.0, rng=rng)
+    )
+    moving2 = moving[::-1].copy()
+
+    results = []
+    for cache_static in [False, True]:
+        affreg = imaffine.AffineRegistration(
+            level_iters=[20, 10, 5], cache_static=cache_static, verbosity=0
+        )
+        affines = []
+        for mov in [moving, moving2]:
+            affine_map = affreg.optimize(
+                static,
+                mov,
+                transform,
+                None,
+                static_grid2world=static_grid2world,
+                moving_grid2world=moving_grid2world,
+                static_mask=smask,
+            )
+            affines.append(affine_map.affine)
+            if cache_static and mov is moving:
+                static_ss = affreg.static_ss
+        results.append(affines)
+
+    # The scale space of the static image was computed once
+    assert affreg.static_ss is static_ss
+    assert_array_equal(results[0], results[1])
+
+    # A different static image invalidates the cache
+    affreg.optimize(
+        static.copy(),
+        moving,
+        transform,
+        None,
+        static_grid2world=static_grid2world,
+        moving_grid2world=moving_grid2world,
+        static_mask=smask,
+    )
+    assert affreg.static_ss is not static_ss
+
+
+def test_affreg_starting_grid():
+    static = np.zeros((64, 64))
+    static[16:48, 20:30] = 1
+    static[16:24, 20:50] = 2
+    static[40:48, 36:44] = 0.5
+    static = ndimage.gaussian_filter(static, 1.5)
+    center = np.array([31.5, 31.5])
+    # The moving image is the static image rotated by 2 radians
+    rotation = imaffine.rigid_starting_grid(center, angles=[2.0])[0]
+    moving = AffineMap(
+        npl.inv(rotation),
+        domain_grid_shape=static.shape,
+        codomain_grid_shape=static.shape,
+    ).transform(static)
+    transform = regtransforms[("RIGID", 2)]
+    affreg = imaffine.AffineRegistration(level_iters=[100, 50, 20], verbosity=0)
+
+    affine_map = affreg.optimize(static, moving, transform, None)
+    assert np.abs(affine_map.affine - rotation).max() > 10
+
+    grid = imaffine.rigid_starting_grid(
+        center, angles=np.linspace(-np.pi, np.pi, 16, endpoint=False)
+    )
+    results = []
+    for num_threads in [1, 3]:
+        affine_map, xopt, fopt = affreg.optimize(
+            static,
+            moving,
+            transform,
+            None,
+            ret_metric=True,
+            starting_grid=grid,
+            keep_best=2,
+            num_threads=num_threads,
+        )
+        assert np.abs(affine_map.affine - rotation).max() < 2
+        results.append((affine_map.affine, fopt))
+    assert_array_equal(results[0][0], results[1][0])
+    assert_equal(results[0][1], results[1][1])
+
+    # Candidates optimized concurrently fork the metric with single-threaded
+    # kernels, the metric of the registration is left unchanged
+    fork = affreg.metric._fork(np.eye(3), num_threads=1)
+    assert_equal(fork.num_threads, 1)
+    assert_equal(fork.affine_map.num_threads, 1)
+    assert affreg.metric.num_threads is None
+    assert affreg.metric._fork(np.eye(3)).num_threads is None
+
+    assert_raises(
+        ValueError,
+        affreg.optimize,
+        static,
+        moving,
+        transform,
+        None,
+        starting_grid=grid,
+        keep_best=0,
+    )
+
+
+@set_random_number_generator(1234)
+def test_affine_map_num_threads(rng=None):
+    image = rng.random((12, 13, 14))
+    affine = np.eye(4)
+    affine[:3, 3] = [0.5, -1.2, 0.7]
+    affine[0, 1] = 0.1
+    expected = AffineMap(
+        affine, domain_grid_shape=image.shape, codomain_grid_shape=image.shape
+    ).transform(image)
+    for num_threads in [1, 2]:
+        affine_map = AffineMap(
+            affine,
+            domain_grid_shape=image.shape,
+            codomain_grid_shape=image.shape,
+            num_threads=num_threads,
+        )
+        assert_array_equal(affine_map.transform(image), expected)
+        stack = np.stack([image, 2 * image], axis=-1)
+        assert_array_equal(affine_map.transform(stack)[..., 0], expected)
+
+
+def test_rigid_starting_grid():
+    center = np.array([10.0, -5.0, 2.0])
+    grid = imaffine.rigid_starting_grid(center)
+    assert_array_almost_equal(grid, np.eye(4)[None])
+
+    grid = imaffine.rigid_starting_grid(
+        center, angles=[-0.5, 0, 0.5], translations=[-2, 2]
+    )
+    assert_equal(grid.shape, (3**3 * 2**3, 4, 4))
+    for P in grid:
+        # Rigid perturbations, rotating about the center
+        assert_array_almost_equal(P[:3, :3].dot(P[:3, :3].T), np.eye(3))
+        assert_array_almost_equal(
+            np.abs(P[:3, 3] - center + P[:3, :3].dot(center)), [2, 2, 2]
+        )
+
+    grid = imaffine.rigid_starting_grid(center[:2], angles=[0, 1, 2])
+    assert_equal(grid.shape, (3, 3, 3))
+    assert_raises(ValueError, imaffine.rigid_starting_grid, [1.0])
+
+
 @set_random_number_generator(2022966)
 def test_mi_gradient(rng):
     # Test the gradient of mutual information
@@ -682,6 +832,51 @@ def test_affine_map(rng):
             assert_raises(AffineInversionError, AffineMap, mat_large_dim)
 
 
+@set_random_number_generator(1904533)
+def test_affine_map_stack(rng):
+    # Stacks of images are transformed exactly as each image alone
+    aff = np.eye(4)
+    aff[:3, :3] += 0.05 * rng.normal(size=(3, 3))
+    aff[:3, 3] = [1.5, -2.0, 0.5]
+    for dim in [2, 3]:
+        dom_shape = (12, 13, 14)[:dim]
+        cod_shape = (10, 11, 12)[:dim]
+        affine = aff if dim == 3 else aff[1:, 1:]
+        affine_map = AffineMap(
+            affine,
+            domain_grid_shape=dom_shape,
+            codomain_grid_shape=cod_shape,
+        )
+        stack = rng.random(cod_shape + (3,))
+        for interpolation in ["linear", "nearest"]:
+            transformed = affine_map.transform(stack, interpolation=interpolation)
+            assert_equal(transformed.shape, dom_shape + (3,))
+            for i in range(stack.shape[-1]):
+                assert_array_equal(
+                    transformed[..., i],
+                    affine_map.transform(stack[..., i], interpolation=interpolation),
+                )
+            inverse = affine_map.transform_inverse(
+                transformed, interpolation=interpolation
+            )
+            assert_equal(inverse.shape, cod_shape + (3,))
+
+        # Linear interpolation in single precision
+        expected = affine_map.transform(stack)
+        actual = affine_map.transform(stack, out_dtype=np.float32)
+        assert_equal(expected.dtype, np.float64)
+        assert_equal(actual.dtype, np.float32)
+        assert_array_almost_equal(actual, expected, decimal=5)
+        labels = (10 * stack).astype(np.int32)
+        nearest = affine_map.transform(
+            labels, interpolation="nearest", out_dtype=np.float32
+        )
+        assert_equal(nearest.dtype, np.int32)
+
+        assert_raises(ValueError, affine_map.transform, stack, out_dtype=np.int32)
+        assert_raises(ValueError, affine_map.transform, stack[..., None])
+
+
 @set_random_number_generator()
 def test_MIMetric_invalid_params(rng):
     transform = regtransforms[("AFFINE", 3)]
@@ -713,3 +908,56 @@ def test_MIMetric_invalid_params(rng):
         actual_val, actual_grad = mi_metric.distance_and_gradient(theta)
         assert np.isinf(actual_val)
         assert_equal(actual_grad, expected_grad)
+
+    assert_raises(ValueError, imaffine.MutualInformationMetric, dtype=np.int32)
+
+
+@set_random_number_generator(4051)
+def test_MIMetric_dtype(rng):
+    transform = regtransforms[("RIGID", 3)]
+    static, moving, static_g2w, moving_g2w, smask, mmask, T = setup_random_transform(
+        transform, 0.1, 20, 1.0, rng=rng
+    )
+    theta = transform.get_identity_parameters() + 0.01
+    results = []
+    for dtype in [np.float64, np.float32]:
+        mi_metric = imaffine.MutualInformationMetric(dtype=dtype, num_threads=2)
+        mi_metric.setup(
+            transform,
+            static,
+            moving,
+            static_grid2world=static_g2w,
+            moving_grid2world=moving_g2w,
+        )
+        assert_equal(mi_metric.moving.dtype, dtype)
+        results.append(mi_metric.distance_and_gradient(theta))
+        # The reused histogram buffers do not leak into the next update
+        val, grad = mi_metric.distance_and_gradient(theta)
+        assert_equal(val, results[-1][0])
+        assert_array_equal(grad, results[-1][1])
+    assert_almost_equal(results[0][0], results[1][0], decimal=5)
+    assert_array_almost_equal(results[0][1], results[1][1], decimal=3)
+
+
+@set_random_number_generator(4052)
+def test_MIMetric_dtype_2d(rng):
+    # dtype only applies to 3D images, 2D images are kept in float64
+    transform = regtransforms[("RIGID", 2)]
+    static, moving, static_g2w, moving_g2w, smask, mmask, T = setup_random_transform(
+        transform, 0.1, 1, 1.0, rng=rng
+    )
+    theta = transform.get_identity_parameters() + 0.01
+    results = []
+    for dtype in [np.float64, np.float32]:
+        mi_metric = imaffine.MutualInformationMetric(dtype=dtype)
+        mi_metric.setup(
+            transform,
+            static,
+            moving,
+            static_grid2world=static_g2w,
+            moving_grid2world=moving_g2w,
+        )
+        assert_equal(mi_metric.moving.dtype, np.float64)
+        results.append(mi_metric.distance_and_gradient(theta))
+    assert_equal(results[0][0], results[1][0])
+    assert_array_equal(results[0][1], results[1][1])
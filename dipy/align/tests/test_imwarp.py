@@ -854,6 +854,69 @@ def test_cc_3d():
     assert reduced > 0.9
 
 
+def test_syn_3d_num_threads():
+    r"""Test 3D SyN gives the same map for any number of threads"""
+    moving, static = get_synthetic_warped_circle(12)
+
+    fields = []
+    for num_threads in [1, 2]:
+        similarity_metric = metrics.SSDMetric(3)
+        optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+            similarity_metric, level_iters=[5, 5], num_threads=num_threads
+        )
+        mapping = optimizer.optimize(static, moving)
+        assert_equal(mapping.num_threads, num_threads)
+        assert_equal(mapping.inverse().num_threads, num_threads)
+        fields.append((mapping.forward, mapping.backward, mapping.transform(moving)))
+
+    for expected, actual in zip(*fields):
+        assert_array_equal(expected, actual)
+
+
+def test_syn_low_memory():
+    r"""Test SyN in low memory mode is close to the default mode"""
+    for dim in [2, 3]:
+        moving, static = get_synthetic_warped_circle(12 if dim == 3 else 1)
+
+        results = []
+        for low_memory in [False, True]:
+            similarity_metric = metrics.SSDMetric(dim)
+            optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+                similarity_metric, level_iters=[5, 5], low_memory=low_memory
+            )
+            mapping = optimizer.optimize(static, moving)
+            assert_equal(optimizer._work_buffers, {})
+            for field in [mapping.forward, mapping.backward]:
+                assert_equal(type(field), np.ndarray)
+                assert_equal(field.dtype, floating)
+            results.append(mapping.transform(moving))
+
+        assert_array_almost_equal(results[0], results[1], decimal=3)
+
+
+def test_syn_cache_static():
+    r"""Test SyN reuses the scale space of the static image when cached"""
+    moving, static = get_synthetic_warped_circle(12)
+    expected = imwarp.SymmetricDiffeomorphicRegistration(
+        metrics.SSDMetric(3), level_iters=[5, 5]
+    ).optimize(static, moving)
+
+    optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+        metrics.SSDMetric(3), level_iters=[5, 5], cache_static=True
+    )
+    scale_spaces = []
+    for _ in range(2):
+        mapping = optimizer.optimize(static, moving)
+        assert_array_equal(mapping.forward, expected.forward)
+        assert_array_equal(mapping.backward, expected.backward)
+        scale_spaces.append(optimizer._static_cache["static_ss"])
+    assert scale_spaces[0] is scale_spaces[1]
+
+    # A different static image invalidates the cache
+    optimizer.optimize(static.copy(), moving)
+    assert optimizer._static_cache["static_ss"] is not scale_spaces[0]
+
+
 def test_em_3d_gauss_newton():
     r"""Test 3D SyN with EM metric, Gauss-Newton optimizer
 
@@ -1208,3 +1271,32 @@ def test_coordinate_mapping(rng):
             )
 
             assert_array_almost_equal(wpoints, wpoints_2[0])
+
+
+@set_random_number_generator(6120417)
+def test_diffeomorphic_map_stack(rng):
+    # Stacks of images are warped exactly as each image alone
+    for dim in [2, 3]:
+        shape = (10, 11, 12)[:dim]
+        prealign = np.eye(dim + 1)
+        prealign[:dim, dim] = 0.5
+        diff_map = DiffeomorphicMap(
+            dim,
+            shape,
+            domain_shape=shape,
+            codomain_shape=shape,
+            prealign=prealign,
+        )
+        diff_map.forward = np.asarray(rng.normal(size=shape + (dim,)), dtype=floating)
+        diff_map.backward = np.asarray(rng.normal(size=shape + (dim,)), dtype=floating)
+        stack = rng.random(shape + (3,))
+        for interpolation in ["linear", "nearest"]:
+            for warp_f in [diff_map.transform, diff_map.transform_inverse]:
+                warped = warp_f(stack, interpolation=interpolation)
+                assert_equal(warped.shape, shape + (3,))
+                for i in range(stack.shape[-1]):
+                    assert_array_equal(
+                        warped[..., i],
+                        warp_f(stack[..., i], interpolation=interpolation),
+                    )
+        assert_raises(ValueError, diff_map.transform, stack[..., None])
@@ -597,6 +597,49 @@ def test_sample_domain_regular():
     assert_equal((indices % k).sum(), 0)
 
 
+@set_random_number_generator(2841)
+def test_parzen_3d_num_threads_and_float32(rng):
+    transform = regtransforms[("AFFINE", 3)]
+    static, moving, static_g2w, moving_g2w, smask, mmask, M = setup_random_transform(
+        transform, 0.1, 23, 5.0, rng=rng
+    )
+    theta = transform.get_identity_parameters()
+    shape = np.array(static.shape, dtype=np.int32)
+    mgrad, inside = vf.gradient(moving, moving_g2w, np.ones(3), shape, np.eye(4))
+    nsamples = 10000
+    sval = rng.choice(static.ravel(), nsamples)
+    mval = rng.choice(moving.ravel(), nsamples)
+    points = rng.normal(size=(nsamples, 3))
+    sgrad = rng.normal(size=(nsamples, 3))
+
+    def compute(num_threads, dtype):
+        H = ParzenJointHistogram(32)
+        H.setup(static, moving, smask=smask, mmask=mmask)
+        s, m, g = static.astype(dtype), moving.astype(dtype), mgrad.astype(dtype)
+        # Updated twice, to check the reuse of the partial histogram buffers
+        for _ in range(2):
+            H.update_pdfs_dense(s, m, smask, mmask, num_threads=num_threads)
+            H.update_gradient_dense(
+                theta, transform, s, m, np.eye(4), g, smask, mmask, num_threads
+            )
+        dense = np.copy(H.joint), np.copy(H.smarginal), np.copy(H.joint_grad)
+        H.update_pdfs_sparse(sval, mval, num_threads=num_threads)
+        H.update_gradient_sparse(
+            theta, transform, sval, mval, points, sgrad, num_threads=num_threads
+        )
+        sparse = np.copy(H.joint), np.copy(H.smarginal), np.copy(H.joint_grad)
+        return dense + sparse
+
+    expected = compute(1, np.float64)
+    assert_almost_equal(expected[0].sum(), 1)
+    assert_almost_equal(expected[3].sum(), 1)
+    for num_threads in [2, 3]:
+        for actual, desired in zip(compute(num_threads, np.float64), expected):
+            assert_array_equal(actual, desired)
+    for actual, desired in zip(compute(2, np.float32), expected):
+        assert_array_almost_equal(actual, desired, decimal=5)
+
+
 def test_exceptions():
     H = ParzenJointHistogram(32)
     valid = np.empty((2, 2, 2), dtype=np.float64)
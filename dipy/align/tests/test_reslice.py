@@ -48,12 +48,12 @@ def test_resample():
         assert_almost_equal(data2[..., i], _data)
         assert_almost_equal(affine2, _affine)
 
-    # check use of multiprocessing pool of specified size
+    # check use of a pool of threads of specified size
     data3, affine3 = reslice(data, affine, zooms, new_zooms, num_processes=4)
     assert_almost_equal(data2, data3)
     assert_almost_equal(affine2, affine3)
 
-    # check use of multiprocessing pool of autoconfigured size
+    # check use of a pool of threads of autoconfigured size
     data3, affine3 = reslice(data, affine, zooms, new_zooms, num_processes=-1)
     assert_almost_equal(data2, data3)
     assert_almost_equal(affine2, affine3)
@@ -61,6 +61,22 @@ def test_resample():
     # test invalid values of num_threads
     assert_raises(ValueError, reslice, data, affine, zooms, new_zooms, num_processes=0)
 
+    # check that splitting volumes into slabs gives the same result
+    for order, mode in [(1, "constant"), (3, "reflect"), (3, "nearest")]:
+        expected, _ = reslice(data, affine, zooms, new_zooms, order=order, mode=mode)
+        for kwargs in [{"slab_size": 3}, {"num_processes": 8}]:
+            data3, _ = reslice(
+                data, affine, zooms, new_zooms, order=order, mode=mode, **kwargs
+            )
+            assert_equal(data3, expected)
+            data3, _ = reslice(
+                data[..., 0], affine, zooms, new_zooms, order=order, mode=mode, **kwargs
+            )
+            assert_equal(data3, expected[..., 0])
+
+    # test invalid slab size
+    assert_raises(ValueError, reslice, data, affine, zooms, new_zooms, slab_size=0)
+
     # test invalid volume dimension
     assert_raises(
         ValueError, reslice, np.zeros((4, 4, 4, 4, 1)), affine, zooms, new_zooms
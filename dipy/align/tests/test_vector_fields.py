@@ -1299,6 +1299,49 @@ def test_invert_vector_field_3d():
     )
 
 
+@set_random_number_generator(3347021)
+def test_invert_vector_field_out(rng):
+    # The inverse can be written to a given array, including the start field
+    for dim in [2, 3]:
+        shape = (9, 10, 11)[:dim]
+        invert_f = (
+            vfu.invert_vector_field_fixed_point_2d
+            if dim == 2
+            else vfu.invert_vector_field_fixed_point_3d
+        )
+        d = np.asarray(0.3 * rng.normal(size=shape + (dim,)), dtype=floating)
+        start = np.asarray(0.1 * rng.normal(size=shape + (dim,)), dtype=floating)
+        world2grid = np.eye(dim + 1)
+        spacing = np.ones(dim)
+
+        expected = invert_f(d, world2grid, spacing, 10, 1e-4, start=start)
+        out = np.empty_like(start)
+        actual = invert_f(d, world2grid, spacing, 10, 1e-4, start=start, out=out)
+        assert_array_equal(actual, expected)
+        assert_array_equal(out, expected)
+
+        in_place = start.copy()
+        invert_f(d, world2grid, spacing, 10, 1e-4, start=in_place, out=in_place)
+        assert_array_equal(in_place, expected)
+
+        # Without start the inversion starts from zero, whatever out contains
+        expected = invert_f(d, world2grid, spacing, 10, 1e-4)
+        out = np.full_like(start, 5)
+        invert_f(d, world2grid, spacing, 10, 1e-4, out=out)
+        assert_array_equal(out, expected)
+
+        assert_raises(
+            ValueError,
+            invert_f,
+            d,
+            world2grid,
+            spacing,
+            10,
+            1e-4,
+            out=np.empty_like(start[1:]),
+        )
+
+
 def test_resample_vector_field_2d():
     r"""
     Expand a vector field by 2, then subsample by 2, the resulting
@@ -1725,3 +1768,87 @@ def test_gradient_3d(rng):
         ValueError, vfu.gradient, img, sp_to_grid, img_spacing, shape, invalid_affine
     )
     assert_raises(ValueError, vfu.gradient, img, sp_to_grid, invalid_spacings, shape, T)
+
+
+@set_random_number_generator(5512751)
+def test_3d_kernels_num_threads(rng):
+    # The parallel 3D kernels must give the same result for any number of
+    # threads
+    shape = (9, 10, 11)
+    shape_i = np.array(shape, dtype=np.int32)
+    d1 = np.asarray(rng.normal(size=shape + (3,)), dtype=floating)
+    d2 = np.asarray(rng.normal(size=shape + (3,)), dtype=floating)
+    vol = np.asarray(rng.random(shape), dtype=floating)
+    aff = from_matvec(np.eye(3) + 0.05 * rng.normal(size=(3, 3)), [0.5, -0.3, 0.2])
+    aff_inv = np.linalg.inv(aff)
+
+    def run(num_threads):
+        comp, stats = vfu.compose_vector_fields_3d(
+            d1, d2, aff, aff_inv, 0.5, None, num_threads=num_threads
+        )
+        inv = vfu.invert_vector_field_fixed_point_3d(
+            0.2 * d1, aff_inv, np.ones(3), 10, 1e-6, num_threads=num_threads
+        )
+        warped = vfu.warp_3d(vol, d1, aff, aff, aff, shape_i, num_threads=num_threads)
+        warped_nn = vfu.warp_3d_nn(
+            (10 * vol).astype(np.int32), d1, aff, aff, aff, shape_i, num_threads
+        )
+        lin = vfu.transform_3d_affine(vol, shape_i, aff, num_threads=num_threads)
+        nn = vfu.transform_3d_affine_nn(vol, shape_i, aff, num_threads=num_threads)
+        grad, inside = vfu.gradient(
+            vol, aff_inv, np.ones(3), shape, aff, num_threads=num_threads
+        )
+        return comp, stats, inv, warped, warped_nn, lin, nn, grad, inside
+
+    expected = run(1)
+    for num_threads in [2, 3, -1]:
+        for exp, actual in zip(expected, run(num_threads)):
+            assert_array_equal(exp, actual)
+
+    # The maps carry the number of threads to the kernels
+    warped = []
+    for num_threads in [1, 2]:
+        mapping = imwarp.DiffeomorphicMap(3, shape, num_threads=num_threads)
+        mapping.forward = d1
+        mapping.backward = d2
+        assert_equal(mapping.inverse().num_threads, num_threads)
+        assert_equal(mapping.shallow_copy().num_threads, num_threads)
+        warped.append(mapping.transform(vol))
+    assert_array_equal(warped[0], warped[1])
+
+
+@set_random_number_generator(2207431)
+def test_3d_stack_kernels(rng):
+    # Stacks of volumes are transformed exactly as each volume alone
+    shape = (9, 10, 11)
+    out_shape = np.array((8, 12, 10), dtype=np.int32)
+    aff = from_matvec(np.eye(3) + 0.05 * rng.normal(size=(3, 3)), [0.5, -0.3, 0.2])
+    for dtype in [np.float32, np.float64]:
+        vols = np.asarray(rng.random(shape + (4,)), dtype=dtype)
+        d1 = np.asarray(rng.normal(size=tuple(out_shape) + (3,)), dtype=dtype)
+
+        for num_threads in [1, 2]:
+            lin = vfu.transform_3d_affine_stack(
+                vols, out_shape, aff, num_threads=num_threads
+            )
+            warped = vfu.warp_3d_stack(
+                vols, d1, aff, aff, aff, out_shape, num_threads=num_threads
+            )
+            assert_equal(lin.dtype, dtype)
+            assert_equal(warped.dtype, dtype)
+            assert_equal(lin.shape, tuple(out_shape) + (4,))
+            assert_equal(warped.shape, tuple(out_shape) + (4,))
+            for i in range(vols.shape[-1]):
+                vol = np.ascontiguousarray(vols[..., i])
+                assert_array_equal(
+                    lin[..., i], vfu.transform_3d_affine(vol, out_shape, aff)
+                )
+                assert_array_equal(
+                    warped[..., i], vfu.warp_3d(vol, d1, aff, aff, aff, out_shape)
+                )
+
+        # Empty stacks
+        empty = vfu.transform_3d_affine_stack(vols[..., :0], out_shape, aff)
+        assert_equal(empty.shape, tuple(out_shape) + (0,))
+
+    assert_raises(ValueError, vfu.transform_3d_affine_stack, vols, out_shape, np.eye(3))
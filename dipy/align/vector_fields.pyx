@@ -6,6 +6,9 @@
 import numpy as np
 cimport numpy as cnp
 
+from cython.parallel import prange, threadid
+from libc.stdlib cimport malloc, free
+
 from dipy.align.fused_types cimport floating, number
 from dipy.core.interpolation cimport (_interpolate_scalar_2d,
                                       _interpolate_scalar_3d,
@@ -13,6 +16,8 @@ from dipy.core.interpolation cimport (_interpolate_scalar_2d,
                                       _interpolate_vector_3d,
                                       _interpolate_scalar_nn_2d,
                                       _interpolate_scalar_nn_3d)
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 
 cdef extern from "dpy_math.h" nogil:
@@ -32,6 +37,15 @@ def is_valid_affine(double[:, :] M, int dim):
     return True
 
 
+def _same_buffer(a, b, int ndim):
+    r"""True if the arrays `a` and `b` view the very same memory"""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    return (a.ndim == ndim and b.ndim == ndim and a.shape == b.shape and
+            a.strides == b.strides and
+            a.__array_interface__["data"][0] == b.__array_interface__["data"][0])
+
+
 cdef void _compose_vector_fields_2d(floating[:, :, :] d1, floating[:, :, :] d2,
                                     double[:, :] premult_index,
                                     double[:, :] premult_disp,
@@ -237,7 +251,8 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                                     double[:, :] premult_disp,
                                     double t,
                                     floating[:, :, :, :] comp,
-                                    double[:] stats) noexcept nogil:
+                                    double[:] stats,
+                                    int num_threads) noexcept nogil:
     r"""Computes the composition of two 3D displacement fields
 
     Computes the composition of the two 3-D displacements d1 and d2. The
@@ -278,6 +293,8 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
     stats : array, shape (3,)
         on output, this array will contain three statistics of the vector norms
         of the composition (maximum, mean, standard_deviation)
+    num_threads : int
+        number of threads the slices are distributed over
 
     Returns
     -------
@@ -292,6 +309,9 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
     If d1[s,r,c] lies outside the domain of d2, then comp[s,r,c] will contain
     a zero vector.
 
+    The statistics are accumulated per slice and the slices are then added in
+    order, so they do not depend on the number of threads.
+
     Warning: it is possible to use the same array reference for d1 and comp to
     effectively update d1 to the composition of d1 and d2 because previously
     updated values from d1 are no longer used (this is done to save memory and
@@ -309,10 +329,19 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
         double maxNorm = 0
         double meanNorm = 0
         double stdNorm = 0
-        double nn
+        double nn, s_max, s_sum, s_sumsq
+        int s_cnt
         cnp.npy_intp i, j, k
         double di, dj, dk, dii, djj, dkk, diii, djjj, dkkk
-    for k in range(ns1):
+        double *slice_max = <double *> malloc(ns1 * sizeof(double))
+        double *slice_sum = <double *> malloc(ns1 * sizeof(double))
+        double *slice_sumsq = <double *> malloc(ns1 * sizeof(double))
+        int *slice_cnt = <int *> malloc(ns1 * sizeof(int))
+    for k in prange(ns1, schedule="static", num_threads=num_threads):
+        s_max = 0
+        s_sum = 0
+        s_sumsq = 0
+        s_cnt = 0
         for i in range(nr1):
             for j in range(nc1):
 
@@ -339,9 +368,9 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                     diii = _apply_affine_3d_x1(k, i, j, 1, premult_index)
                     djjj = _apply_affine_3d_x2(k, i, j, 1, premult_index)
 
-                dkkk += dk
-                diii += di
-                djjj += dj
+                dkkk = dkkk + dk
+                diii = diii + di
+                djjj = djjj + dj
 
                 # If d1 and comp are the same array, this will correctly update
                 # d1[k,i,j], which will never be accessed again
@@ -357,15 +386,29 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                     comp[k, i, j, 2] = t * comp[k, i, j, 2] + djj
                     nn = (comp[k, i, j, 0] ** 2 + comp[k, i, j, 1] ** 2 +
                           comp[k, i, j, 2]**2)
-                    meanNorm += nn
-                    stdNorm += nn * nn
-                    cnt += 1
-                    if maxNorm < nn:
-                        maxNorm = nn
+                    s_sum = s_sum + nn
+                    s_sumsq = s_sumsq + nn * nn
+                    s_cnt = s_cnt + 1
+                    if s_max < nn:
+                        s_max = nn
                 else:
                     comp[k, i, j, 0] = 0
                     comp[k, i, j, 1] = 0
                     comp[k, i, j, 2] = 0
+        slice_max[k] = s_max
+        slice_sum[k] = s_sum
+        slice_sumsq[k] = s_sumsq
+        slice_cnt[k] = s_cnt
+    for k in range(ns1):
+        meanNorm += slice_sum[k]
+        stdNorm += slice_sumsq[k]
+        cnt += slice_cnt[k]
+        if maxNorm < slice_max[k]:
+            maxNorm = slice_max[k]
+    free(slice_max)
+    free(slice_sum)
+    free(slice_sumsq)
+    free(slice_cnt)
     meanNorm /= cnt
     stats[0] = sqrt(maxNorm)
     stats[1] = sqrt(meanNorm)
@@ -376,7 +419,8 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
                              double[:, :] premult_index,
                              double[:, :] premult_disp,
                              double time_scaling,
-                             floating[:, :, :, :] comp):
+                             floating[:, :, :, :] comp,
+                             num_threads=None):
     r"""Computes the composition of two 3D displacement fields
 
     Computes the composition of the two 3-D displacements d1 and d2. The
@@ -415,6 +459,12 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     comp : array, shape (S, R, C, 3), same dimension as d1
         the buffer to write the composition to. If None, the buffer will be
         created internally
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -427,10 +477,11 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     Notes
     -----
     If d1[s,r,c] lies outside the domain of d2, then comp[s,r,c] will contain
-    a zero vector.
+    a zero vector. The result does not depend on the number of threads.
     """
     cdef:
         double[:] stats = np.zeros(shape=(3,), dtype=np.float64)
+        int threads_to_use = -1
 
     if comp is None:
         comp = np.zeros_like(d1)
@@ -440,8 +491,14 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     if not is_valid_affine(premult_disp, 3):
         raise ValueError("Invalid displacement pre-multiplication matrix")
 
-    _compose_vector_fields_3d[floating](d1, d2, premult_index, premult_disp,
-                                        time_scaling, comp, stats)
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    with nogil:
+        _compose_vector_fields_3d[floating](d1, d2, premult_index,
+                                            premult_disp, time_scaling, comp,
+                                            stats, threads_to_use)
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(comp), np.asarray(stats)
 
 
@@ -449,7 +506,8 @@ def invert_vector_field_fixed_point_2d(floating[:, :, :] d,
                                        double[:, :] d_world2grid,
                                        double[:] spacing,
                                        int max_iter, double tolerance,
-                                       floating[:, :, :] start=None):
+                                       floating[:, :, :] start=None,
+                                       floating[:, :, :] out=None):
     r"""Computes the inverse of a 2D displacement fields
 
     Computes the inverse of the given 2-D displacement field d using the
@@ -477,6 +535,9 @@ def invert_vector_field_fixed_point_2d(floating[:, :, :] d,
         an approximation to the inverse displacement field (if no approximation
         is available, None can be provided and the start displacement field
         will be zero)
+    out : array, shape (R, C, 2), optional
+        the array the inverse displacement field is written to, which may be
+        `start` itself. If None (default), a new array is allocated
 
     Returns
     -------
@@ -506,13 +567,24 @@ def invert_vector_field_fixed_point_2d(floating[:, :, :] d,
         double[:] stats = np.zeros(shape=(2,), dtype=np.float64)
         double[:] substats = np.empty(shape=(3,), dtype=np.float64)
         double[:, :] norms = np.zeros(shape=(nr, nc), dtype=np.float64)
-        floating[:, :, :] p = np.zeros(shape=(nr, nc, 2), dtype=ftype)
+        floating[:, :, :] p
         floating[:, :, :] q = np.zeros(shape=(nr, nc, 2), dtype=ftype)
 
     if not is_valid_affine(d_world2grid, 2):
         raise ValueError("Invalid world-to-image transform")
 
-    if start is not None:
+    if out is None:
+        p = np.zeros(shape=(nr, nc, 2), dtype=ftype)
+    elif out.shape[0] != nr or out.shape[1] != nc or out.shape[2] != 2:
+        raise ValueError("The output array must have the shape of the field")
+    else:
+        p = out
+        if start is None:
+            p[...] = 0
+
+    # Nothing to copy when the inverse is computed in place of start
+    if start is not None and not (out is not None and
+                                  _same_buffer(start, p, 3)):
         p[...] = start
 
     with nogil:
@@ -553,7 +625,9 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
                                        double[:, :] d_world2grid,
                                        double[:] spacing,
                                        int max_iter, double tol,
-                                       floating[:, :, :, :] start=None):
+                                       floating[:, :, :, :] start=None,
+                                       num_threads=None,
+                                       floating[:, :, :, :] out=None):
     r"""Computes the inverse of a 3D displacement fields
 
     Computes the inverse of the given 3-D displacement field d using the
@@ -581,6 +655,15 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         an approximation to the inverse displacement field (if no approximation
         is available, None can be provided and the start displacement field
         will be zero)
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+    out : array, shape (S, R, C, 3), optional
+        the array the inverse displacement field is written to, which may be
+        `start` itself. If None (default), a new array is allocated
 
     Returns
     -------
@@ -594,14 +677,19 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
     the same as those of the input displacement field. The 'inversion error' at
     iteration t is defined as the mean norm of the displacement vectors of the
     input displacement field composed with the inverse at iteration t.
+
+    The error is accumulated per slice and the slices are then added in order,
+    so the result does not depend on the number of threads.
     """
     cdef:
         cnp.npy_intp ns = d.shape[0]
         cnp.npy_intp nr = d.shape[1]
         cnp.npy_intp nc = d.shape[2]
+        cnp.npy_intp i, j, k
         int iter_count, current
+        int threads_to_use = -1
         double dkk, dii, djj, dk, di, dj
-        double difmag, mag, maxlen, step_factor
+        double difmag, mag, maxlen, step_factor, s_error, s_difmag
         double epsilon = 0.5
         double error = 1 + tol
         double ss = spacing[0], sr = spacing[1], sc = spacing[2]
@@ -610,16 +698,33 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
     cdef:
         double[:] stats = np.zeros(shape=(2,), dtype=np.float64)
         double[:] substats = np.zeros(shape=(3,), dtype=np.float64)
+        double[:] slice_error = np.zeros(shape=(ns,), dtype=np.float64)
+        double[:] slice_difmag = np.zeros(shape=(ns,), dtype=np.float64)
         double[:, :, :] norms = np.zeros(shape=(ns, nr, nc), dtype=np.float64)
-        floating[:, :, :, :] p = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
+        floating[:, :, :, :] p
         floating[:, :, :, :] q = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
 
     if not is_valid_affine(d_world2grid, 3):
         raise ValueError("Invalid world-to-image transform")
 
-    if start is not None:
+    if out is None:
+        p = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
+    elif (out.shape[0] != ns or out.shape[1] != nr or out.shape[2] != nc or
+          out.shape[3] != 3):
+        raise ValueError("The output array must have the shape of the field")
+    else:
+        p = out
+        if start is None:
+            p[...] = 0
+
+    # Nothing to copy when the inverse is computed in place of start
+    if start is not None and not (out is not None and
+                                  _same_buffer(start, p, 4)):
         p[...] = start
 
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
         iter_count = 0
         difmag = 1
@@ -629,21 +734,32 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
             else:
                 epsilon = 0.5
             _compose_vector_fields_3d[floating](p, d, None, d_world2grid,
-                                                1.0, q, substats)
-            difmag = 0
-            error = 0
-            for k in range(ns):
+                                                1.0, q, substats,
+                                                threads_to_use)
+            for k in prange(ns, schedule="static",
+                            num_threads=threads_to_use):
+                s_difmag = 0
+                s_error = 0
                 for i in range(nr):
                     for j in range(nc):
                         mag = sqrt((q[k, i, j, 0]/ss) ** 2 +
                                    (q[k, i, j, 1]/sr) ** 2 +
                                    (q[k, i, j, 2]/sc) ** 2)
                         norms[k, i, j] = mag
-                        error += mag
-                        if difmag < mag:
-                            difmag = mag
-            maxlen = difmag*epsilon
+                        s_error = s_error + mag
+                        if s_difmag < mag:
+                            s_difmag = mag
+                slice_error[k] = s_error
+                slice_difmag[k] = s_difmag
+            difmag = 0
+            error = 0
             for k in range(ns):
+                error += slice_error[k]
+                if difmag < slice_difmag[k]:
+                    difmag = slice_difmag[k]
+            maxlen = difmag*epsilon
+            for k in prange(ns, schedule="static",
+                            num_threads=threads_to_use):
                 for i in range(nr):
                     for j in range(nc):
                         if norms[k, i, j] > maxlen:
@@ -660,6 +776,9 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
             iter_count += 1
         stats[0] = error
         stats[1] = iter_count
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(p)
 
 
@@ -1325,7 +1444,8 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
             double[:, :] affine_idx_in=None,
             double[:, :] affine_idx_out=None,
             double[:, :] affine_disp=None,
-            int[:] out_shape=None):
+            int[:] out_shape=None,
+            num_threads=None):
     r"""Warps a 3D volume using trilinear interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -1351,6 +1471,12 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -1380,7 +1506,8 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
         cnp.npy_intp nrVol = volume.shape[1]
         cnp.npy_intp ncVol = volume.shape[2]
         cnp.npy_intp i, j, k
-        int inside
+        int inside, tid
+        int threads_to_use = -1
         double dkk, dii, djj, dk, di, dj
 
     if not is_valid_affine(affine_idx_in, 3):
@@ -1401,11 +1528,17 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef floating[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                              dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype=np.asarray(d1).dtype)
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    # One interpolation buffer per thread
+    cdef floating[:, :] tmp = np.zeros(shape=(threads_to_use, 3),
+                                       dtype=np.asarray(d1).dtype)
 
     with nogil:
 
-        for k in range(nslices):
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
+            tid = threadid()
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -1420,10 +1553,11 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
                         inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
-                        dkk = tmp[0]
-                        dii = tmp[1]
-                        djj = tmp[2]
+                                                                  dj,
+                                                                  &tmp[tid, 0])
+                        dkk = tmp[tid, 0]
+                        dii = tmp[tid, 1]
+                        djj = tmp[tid, 2]
 
                     if affine_disp is not None:
                         dk = _apply_affine_3d_x0(
@@ -1452,11 +1586,15 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
                     inside = _interpolate_scalar_3d[floating](volume, dkk,
                                                               dii, djj,
                                                               &warped[k, i, j])
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(warped)
 
 
 def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
-                        double[:, :] affine):
+                        double[:, :] affine,
+                        num_threads=None):
     r"""Transforms a 3D volume by an affine transform with trilinear interp.
 
     Deforms the input volume under the given affine transformation using
@@ -1472,6 +1610,12 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
         the shape of the resulting volume
     affine : array, shape (4, 4)
         the affine transform to be applied
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -1497,15 +1641,20 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
         int inside
         double dkk, dii, djj, tmp0, tmp1
         double alpha, beta, gamma, calpha, cbeta, cgamma
+        int threads_to_use = -1
         floating[:, :, :] out = np.zeros(shape=(nslices, nrows, ncols),
                                          dtype=np.asarray(volume).dtype)
 
     if not is_valid_affine(affine, 3):
         raise ValueError("Invalid affine transform matrix")
 
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
 
-        for k in range(nslices):
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine is not None:
@@ -1518,6 +1667,336 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
                         djj = j
                     inside = _interpolate_scalar_3d[floating](volume, dkk,
                         dii, djj, &out[k, i, j])
+
+    if num_threads is not None:
+        restore_default_num_threads()
+    return np.asarray(out)
+
+
+cdef inline int _interpolate_scalar_stack_3d(floating[:, :, :, :] volumes,
+                                             double dkk, double dii,
+                                             double djj,
+                                             floating *out) noexcept nogil:
+    r"""Trilinear interpolation of a stack of 3D scalar images
+
+    Interpolates all the volumes of the stack at (dkk, dii, djj) and stores
+    the results in out[0], ..., out[N - 1]. The interpolation weights are
+    computed once and applied to every volume, in the same order as
+    `_interpolate_scalar_3d`, so the result for each volume is identical to
+    interpolating that volume alone. If (dkk, dii, djj) is outside the
+    domain of the volumes, zero is written to out instead.
+
+    Parameters
+    ----------
+    volumes : array, shape (S, R, C, N)
+        the stack of N volumes to be interpolated
+    dkk : double
+        the first coordinate of the interpolating position
+    dii : double
+        the second coordinate of the interpolating position
+    djj : double
+        the third coordinate of the interpolating position
+    out : array, shape (N,)
+        the (contiguous) array the interpolation results will be written to
+
+    Returns
+    -------
+    inside : int
+        if (dkk, dii, djj) is inside the domain of the volumes,
+        inside == 1, otherwise inside == 0
+    """
+    cdef:
+        cnp.npy_intp ns = volumes.shape[0]
+        cnp.npy_intp nr = volumes.shape[1]
+        cnp.npy_intp nc = volumes.shape[2]
+        cnp.npy_intp nvols = volumes.shape[3]
+        cnp.npy_intp kk, ii, jj, v
+        int inside
+        double alpha, beta, calpha, cbeta, gamma, cgamma, w
+    if not (-1 < dkk < ns and -1 < dii < nr and -1 < djj < nc):
+        for v in range(nvols):
+            out[v] = 0
+        return 0
+    # find the top left index and the interpolation coefficients
+    kk = <int>floor(dkk)
+    ii = <int>floor(dii)
+    jj = <int>floor(djj)
+
+    cgamma = dkk - kk
+    calpha = dii - ii
+    cbeta = djj - jj
+    alpha = 1 - calpha
+    beta = 1 - cbeta
+    gamma = 1 - cgamma
+
+    inside = 0
+    # ---top-left
+    if ii >= 0 and jj >= 0 and kk >= 0:
+        w = alpha * beta * gamma
+        for v in range(nvols):
+            out[v] = w * volumes[kk, ii, jj, v]
+        inside += 1
+    else:
+        for v in range(nvols):
+            out[v] = 0
+    # ---top-right
+    jj += 1
+    if ii >= 0 and jj < nc and kk >= 0:
+        w = alpha * cbeta * gamma
+        for v in range(nvols):
+            out[v] += w * volumes[kk, ii, jj, v]
+        inside += 1
+    # ---bottom-right
+    ii += 1
+    if ii < nr and jj < nc and kk >= 0:
+        w = calpha * cbeta * gamma
+        for v in range(nvols):
+            out[v] += w * volumes[kk, ii, jj, v]
+        inside += 1
+    # ---bottom-left
+    jj -= 1
+    if ii < nr and jj >= 0 and kk >= 0:
+        w = calpha * beta * gamma
+        for v in range(nvols):
+            out[v] += w * volumes[kk, ii, jj, v]
+        inside += 1
+    kk += 1
+    if kk < ns:
+        ii -= 1
+        if ii >= 0 and jj >= 0:
+            w = alpha * beta * cgamma
+            for v in range(nvols):
+                out[v] += w * volumes[kk, ii, jj, v]
+            inside += 1
+        jj += 1
+        if ii >= 0 and jj < nc:
+            w = alpha * cbeta * cgamma
+            for v in range(nvols):
+                out[v] += w * volumes[kk, ii, jj, v]
+            inside += 1
+        # ---bottom-right
+        ii += 1
+        if ii < nr and jj < nc:
+            w = calpha * cbeta * cgamma
+            for v in range(nvols):
+                out[v] += w * volumes[kk, ii, jj, v]
+            inside += 1
+        # ---bottom-left
+        jj -= 1
+        if ii < nr and jj >= 0:
+            w = calpha * beta * cgamma
+            for v in range(nvols):
+                out[v] += w * volumes[kk, ii, jj, v]
+            inside += 1
+    return 1 if inside == 8 else 0
+
+
+def warp_3d_stack(floating[:, :, :, :] volumes, floating[:, :, :, :] d1,
+                  double[:, :] affine_idx_in=None,
+                  double[:, :] affine_idx_out=None,
+                  double[:, :] affine_disp=None,
+                  int[:] out_shape=None,
+                  num_threads=None):
+    r"""Warps a stack of 3D volumes using trilinear interpolation
+
+    Deforms all the volumes of the stack (along the last axis) under the same
+    transformation, given by eq. (1) of `warp_3d`. The sampling position and
+    the interpolation weights of each voxel of the sampling grid are computed
+    once and applied to all the volumes, and each warped volume is identical
+    to the result of `warp_3d` applied to it alone.
+
+    Parameters
+    ----------
+    volumes : array, shape (S, R, C, N)
+        the stack of N volumes to be transformed
+    d1 : array, shape (S', R', C', 3)
+        the displacement field driving the transformation
+    affine_idx_in : array, shape (4, 4)
+        the matrix A in eq. (1) of `warp_3d`
+    affine_idx_out : array, shape (4, 4)
+        the matrix B in eq. (1) of `warp_3d`
+    affine_disp : array, shape (4, 4)
+        the matrix C in eq. (1) of `warp_3d`
+    out_shape : array, shape (3,)
+        the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Returns
+    -------
+    warped : array, shape = out_shape + (N,)
+        the transformed volumes
+    """
+    cdef:
+        cnp.npy_intp nslices = volumes.shape[0]
+        cnp.npy_intp nrows = volumes.shape[1]
+        cnp.npy_intp ncols = volumes.shape[2]
+        cnp.npy_intp nvols = volumes.shape[3]
+        cnp.npy_intp i, j, k
+        int inside, tid
+        int threads_to_use = -1
+        double dkk, dii, djj, dk, di, dj
+
+    if not is_valid_affine(affine_idx_in, 3):
+        raise ValueError("Invalid inner index multiplication matrix")
+    if not is_valid_affine(affine_idx_out, 3):
+        raise ValueError("Invalid outer index multiplication matrix")
+    if not is_valid_affine(affine_disp, 3):
+        raise ValueError("Invalid displacement multiplication matrix")
+
+    if out_shape is not None:
+        nslices = out_shape[0]
+        nrows = out_shape[1]
+        ncols = out_shape[2]
+    elif d1 is not None:
+        nslices = d1.shape[0]
+        nrows = d1.shape[1]
+        ncols = d1.shape[2]
+
+    cdef floating[:, :, :, ::1] warped = np.zeros(
+        shape=(nslices, nrows, ncols, nvols), dtype=np.asarray(volumes).dtype)
+    if nvols == 0:
+        return np.asarray(warped)
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    # One interpolation buffer per thread
+    cdef floating[:, :] tmp = np.zeros(shape=(threads_to_use, 3),
+                                       dtype=np.asarray(d1).dtype)
+
+    with nogil:
+
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
+            tid = threadid()
+            for i in range(nrows):
+                for j in range(ncols):
+                    if affine_idx_in is None:
+                        dkk = d1[k, i, j, 0]
+                        dii = d1[k, i, j, 1]
+                        djj = d1[k, i, j, 2]
+                    else:
+                        dk = _apply_affine_3d_x0(
+                            k, i, j, 1, affine_idx_in)
+                        di = _apply_affine_3d_x1(
+                            k, i, j, 1, affine_idx_in)
+                        dj = _apply_affine_3d_x2(
+                            k, i, j, 1, affine_idx_in)
+                        inside = _interpolate_vector_3d[floating](d1, dk, di,
+                                                                  dj,
+                                                                  &tmp[tid, 0])
+                        dkk = tmp[tid, 0]
+                        dii = tmp[tid, 1]
+                        djj = tmp[tid, 2]
+
+                    if affine_disp is not None:
+                        dk = _apply_affine_3d_x0(
+                            dkk, dii, djj, 0, affine_disp)
+                        di = _apply_affine_3d_x1(
+                            dkk, dii, djj, 0, affine_disp)
+                        dj = _apply_affine_3d_x2(
+                            dkk, dii, djj, 0, affine_disp)
+                    else:
+                        dk = dkk
+                        di = dii
+                        dj = djj
+
+                    if affine_idx_out is not None:
+                        dkk = dk + _apply_affine_3d_x0(k, i, j, 1,
+                                                       affine_idx_out)
+                        dii = di + _apply_affine_3d_x1(k, i, j, 1,
+                                                       affine_idx_out)
+                        djj = dj + _apply_affine_3d_x2(k, i, j, 1,
+                                                       affine_idx_out)
+                    else:
+                        dkk = dk + k
+                        dii = di + i
+                        djj = dj + j
+
+                    inside = _interpolate_scalar_stack_3d[floating](
+                        volumes, dkk, dii, djj, &warped[k, i, j, 0])
+
+    if num_threads is not None:
+        restore_default_num_threads()
+    return np.asarray(warped)
+
+
+def transform_3d_affine_stack(floating[:, :, :, :] volumes, int[:] ref_shape,
+                              double[:, :] affine,
+                              num_threads=None):
+    r"""Transforms a stack of 3D volumes by an affine transform
+
+    Deforms all the volumes of the stack (along the last axis) under the same
+    affine transformation using tri-linear interpolation. The sampling
+    position and the interpolation weights of each voxel of the reference
+    grid are computed once and applied to all the volumes, and each
+    transformed volume is identical to the result of `transform_3d_affine`
+    applied to it alone. If the affine matrix is None, it is taken as the
+    identity.
+
+    Parameters
+    ----------
+    volumes : array, shape (S, R, C, N)
+        the stack of N volumes to be transformed
+    ref_shape : array, shape (3,)
+        the shape of each resulting volume
+    affine : array, shape (4, 4)
+        the affine transform to be applied
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
+
+    Returns
+    -------
+    out : array, shape (S', R', C', N)
+        the transformed volumes
+    """
+    cdef:
+        cnp.npy_intp nslices = ref_shape[0]
+        cnp.npy_intp nrows = ref_shape[1]
+        cnp.npy_intp ncols = ref_shape[2]
+        cnp.npy_intp nvols = volumes.shape[3]
+        cnp.npy_intp i, j, k
+        int inside
+        double dkk, dii, djj
+        int threads_to_use = -1
+        floating[:, :, :, ::1] out = np.zeros(
+            shape=(nslices, nrows, ncols, nvols),
+            dtype=np.asarray(volumes).dtype)
+
+    if not is_valid_affine(affine, 3):
+        raise ValueError("Invalid affine transform matrix")
+    if nvols == 0:
+        return np.asarray(out)
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
+    with nogil:
+
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
+            for i in range(nrows):
+                for j in range(ncols):
+                    if affine is not None:
+                        dkk = _apply_affine_3d_x0(k, i, j, 1, affine)
+                        dii = _apply_affine_3d_x1(k, i, j, 1, affine)
+                        djj = _apply_affine_3d_x2(k, i, j, 1, affine)
+                    else:
+                        dkk = k
+                        dii = i
+                        djj = j
+                    inside = _interpolate_scalar_stack_3d[floating](
+                        volumes, dkk, dii, djj, &out[k, i, j, 0])
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out)
 
 
@@ -1525,7 +2004,8 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                double[:, :] affine_idx_in=None,
                double[:, :] affine_idx_out=None,
                double[:, :] affine_disp=None,
-               int[:] out_shape=None):
+               int[:] out_shape=None,
+               num_threads=None):
     r"""Warps a 3D volume using using nearest-neighbor interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -1551,6 +2031,12 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -1580,7 +2066,8 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
         cnp.npy_intp nrVol = volume.shape[1]
         cnp.npy_intp ncVol = volume.shape[2]
         cnp.npy_intp i, j, k
-        int inside
+        int inside, tid
+        int threads_to_use = -1
         double dkk, dii, djj, dk, di, dj
 
     if not is_valid_affine(affine_idx_in, 3):
@@ -1601,11 +2088,17 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef number[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                            dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype = np.asarray(d1).dtype)
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    # One interpolation buffer per thread
+    cdef floating[:, :] tmp = np.zeros(shape=(threads_to_use, 3),
+                                       dtype=np.asarray(d1).dtype)
 
     with nogil:
 
-        for k in range(nslices):
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
+            tid = threadid()
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -1620,10 +2113,11 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
                         inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
-                        dkk = tmp[0]
-                        dii = tmp[1]
-                        djj = tmp[2]
+                                                                  dj,
+                                                                  &tmp[tid, 0])
+                        dkk = tmp[tid, 0]
+                        dii = tmp[tid, 1]
+                        djj = tmp[tid, 2]
 
                     if affine_disp is not None:
                         dk = _apply_affine_3d_x0(
@@ -1651,11 +2145,15 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
 
                     inside = _interpolate_scalar_nn_3d[number](volume,
                                         dkk, dii, djj, &warped[k, i, j])
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(warped)
 
 
 def transform_3d_affine_nn(number[:, :, :] volume, int[:] ref_shape,
-                           double[:, :] affine=None):
+                           double[:, :] affine=None,
+                           num_threads=None):
     r"""Transforms a 3D volume by an affine transform with NN interpolation
 
     Deforms the input volume under the given affine transformation using
@@ -1671,6 +2169,12 @@ def transform_3d_affine_nn(number[:, :, :] volume, int[:] ref_shape,
         the shape of the resulting volume
     affine : array, shape (4, 4)
         the affine transform to be applied
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
 
     Returns
     -------
@@ -1694,6 +2198,7 @@ def transform_3d_affine_nn(number[:, :, :] volume, int[:] ref_shape,
         cnp.npy_intp ncVol = volume.shape[2]
         double dkk, dii, djj, tmp0, tmp1
         double alpha, beta, gamma, calpha, cbeta, cgamma
+        int threads_to_use = -1
         cnp.npy_intp k, i, j, kk, ii, jj
         number[:, :, :] out = np.zeros((nslices, nrows, ncols),
                                         dtype=np.asarray(volume).dtype)
@@ -1701,9 +2206,13 @@ def transform_3d_affine_nn(number[:, :, :] volume, int[:] ref_shape,
     if not is_valid_affine(affine, 3):
         raise ValueError("Invalid affine transform matrix")
 
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+
     with nogil:
 
-        for k in range(nslices):
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine is not None:
@@ -1716,6 +2225,9 @@ def transform_3d_affine_nn(number[:, :, :] volume, int[:] ref_shape,
                         djj = j
                     _interpolate_scalar_nn_3d[number](volume, dkk, dii, djj,
                                                       &out[k, i, j])
+
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out)
 
 
@@ -2536,7 +3048,8 @@ def create_sphere(cnp.npy_intp nslices, cnp.npy_intp nrows,
 
 def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
                  double[:] img_spacing, double[:, :] out_grid2world,
-                 floating[:, :, :, :] out, int[:, :, :] inside):
+                 floating[:, :, :, :] out, int[:, :, :] inside,
+                 num_threads=None):
     r""" Gradient of a 3D image in physical space coordinates
 
     Each grid cell (i, j, k) in the sampling grid (determined by
@@ -2570,65 +3083,93 @@ def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
     inside : array, shape (S', R', C')
         the buffer in which to store the flags indicating whether the sample
         point lies inside (=1) or outside (=0) the image grid
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus $|num_threads + 1|$ is used (enter -1
+        to use as many threads as possible). 0 raises an error.
     """
     cdef:
         cnp.npy_intp nslices = out.shape[0]
         cnp.npy_intp nrows = out.shape[1]
         cnp.npy_intp ncols = out.shape[2]
-        cnp.npy_intp i, j, k, in_flag
+        cnp.npy_intp i, j, k, p, in_flag
+        int tid
+        int threads_to_use = -1
         double tmp
-        double[:] x = np.empty(shape=(3,), dtype=np.float64)
-        double[:] dx = np.empty(shape=(3,), dtype=np.float64)
         double[:] h = np.empty(shape=(3,), dtype=np.float64)
-        double[:] q = np.empty(shape=(3,), dtype=np.float64)
+        double[:, :] x
+        double[:, :] dx
+        double[:, :] q
+
+    threads_to_use = determine_num_threads(num_threads)
+    set_num_threads(threads_to_use)
+    # One set of coordinate buffers per thread
+    x = np.empty(shape=(threads_to_use, 3), dtype=np.float64)
+    dx = np.empty(shape=(threads_to_use, 3), dtype=np.float64)
+    q = np.empty(shape=(threads_to_use, 3), dtype=np.float64)
     with nogil:
         h[0] = 0.5 * img_spacing[0]
         h[1] = 0.5 * img_spacing[1]
         h[2] = 0.5 * img_spacing[2]
-        for k in range(nslices):
+        for k in prange(nslices, schedule="static",
+                        num_threads=threads_to_use):
+            tid = threadid()
             for i in range(nrows):
                 for j in range(ncols):
                     inside[k, i, j] = 1
                     # Compute coordinates of index (k, i, j) in physical space
-                    x[0] = _apply_affine_3d_x0(k, i, j, 1, out_grid2world)
-                    x[1] = _apply_affine_3d_x1(k, i, j, 1, out_grid2world)
-                    x[2] = _apply_affine_3d_x2(k, i, j, 1, out_grid2world)
-                    dx[:] = x[:]
+                    x[tid, 0] = _apply_affine_3d_x0(k, i, j, 1, out_grid2world)
+                    x[tid, 1] = _apply_affine_3d_x1(k, i, j, 1, out_grid2world)
+                    x[tid, 2] = _apply_affine_3d_x2(k, i, j, 1, out_grid2world)
+                    dx[tid, 0] = x[tid, 0]
+                    dx[tid, 1] = x[tid, 1]
+                    dx[tid, 2] = x[tid, 2]
                     for p in range(3):
                         # Compute coordinates of point dx on img's grid
-                        dx[p] = x[p] - h[p]
-                        q[0] = _apply_affine_3d_x0(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
-                        q[1] = _apply_affine_3d_x1(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
-                        q[2] = _apply_affine_3d_x2(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
+                        dx[tid, p] = x[tid, p] - h[p]
+                        q[tid, 0] = _apply_affine_3d_x0(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
+                        q[tid, 1] = _apply_affine_3d_x1(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
+                        q[tid, 2] = _apply_affine_3d_x2(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
                         # Interpolate img at q
-                        in_flag = _interpolate_scalar_3d[floating](img, q[0],
-                            q[1], q[2], &out[k, i, j, p])
+                        in_flag = _interpolate_scalar_3d[floating](img,
+                            q[tid, 0], q[tid, 1], q[tid, 2], &out[k, i, j, p])
                         if in_flag == 0:
                             out[k, i, j, p] = 0
                             inside[k, i, j] = 0
                             continue
                         tmp = out[k, i, j, p]
                         # Compute coordinates of point dx on img's grid
-                        dx[p] = x[p] + h[p]
-                        q[0] = _apply_affine_3d_x0(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
-                        q[1] = _apply_affine_3d_x1(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
-                        q[2] = _apply_affine_3d_x2(dx[0], dx[1], dx[2], 1,
-                                                   img_world2grid)
+                        dx[tid, p] = x[tid, p] + h[p]
+                        q[tid, 0] = _apply_affine_3d_x0(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
+                        q[tid, 1] = _apply_affine_3d_x1(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
+                        q[tid, 2] = _apply_affine_3d_x2(
+                            dx[tid, 0], dx[tid, 1], dx[tid, 2], 1,
+                            img_world2grid)
                         # Interpolate img at q
-                        in_flag = _interpolate_scalar_3d[floating](img, q[0],
-                                                q[1], q[2], &out[k, i, j, p])
+                        in_flag = _interpolate_scalar_3d[floating](img,
+                            q[tid, 0], q[tid, 1], q[tid, 2], &out[k, i, j, p])
                         if in_flag == 0:
                             out[k, i, j, p] = 0
                             inside[k, i, j] = 0
                             continue
                         out[k, i, j, p] = ((out[k, i, j, p] - tmp) /
                                            img_spacing[p])
-                        dx[p] = x[p]
+                        dx[tid, p] = x[tid, p]
+
+    if num_threads is not None:
+        restore_default_num_threads()
 
 
 def _sparse_gradient_3d(floating[:, :, :] img,
@@ -2876,7 +3417,7 @@ def _sparse_gradient_2d(floating[:, :] img, double[:, :] img_world2grid,
 
 
 def gradient(img, img_world2grid, img_spacing, out_shape,
-             out_grid2world):
+             out_grid2world, num_threads=None):
     r""" Gradient of an image in physical space
 
     Parameters
@@ -2892,6 +3433,13 @@ def gradient(img, img_world2grid, img_spacing, out_shape,
         the number of (slices), rows and columns of the sampling grid
     out_grid2world : array, shape (dim+1, dim+1)
         the grid-to-space transform associated to the sampling grid
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization of 3D
+        gradients. If None (default) the value of OMP_NUM_THREADS environment
+        variable is used if it is set, otherwise all available threads are
+        used. If < 0 the maximal number of threads minus $|num_threads + 1|$
+        is used (enter -1 to use as many threads as possible). 0 raises an
+        error.
 
     Returns
     -------
@@ -2922,7 +3470,11 @@ def gradient(img, img_world2grid, img_spacing, out_shape,
         img_spacing = img_spacing.astype(np.float64)
     if out_grid2world.dtype != np.float64:
         out_grid2world = out_grid2world.astype(np.float64)
-    jd_grad(img, img_world2grid, img_spacing, out_grid2world, out, inside)
+    if dim == 3:
+        jd_grad(img, img_world2grid, img_spacing, out_grid2world, out, inside,
+                num_threads=num_threads)
+    else:
+        jd_grad(img, img_world2grid, img_spacing, out_grid2world, out, inside)
     return np.asarray(out), np.asarray(inside)
 
 
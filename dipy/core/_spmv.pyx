@@ -0,0 +1,62 @@
+# cython: boundscheck=False
+# cython: cdivision=True
+# cython: initializedcheck=False
+# cython: wraparound=False
+"""Multithreaded sparse matrix-vector products."""
+
+cimport cython
+from cython.parallel import prange
+cimport numpy as cnp
+
+from cython cimport floating
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
+ctypedef fused index_t:
+    cnp.int32_t
+    cnp.int64_t
+
+
+def csr_matvec(index_t[::1] indptr,
+               index_t[::1] indices,
+               floating[::1] data,
+               double[::1] x,
+               double[::1] out,
+               num_threads=None):
+    """Compute ``out = A @ x`` for a CSR matrix ``A``, rows in parallel.
+
+    Parameters
+    ----------
+    indptr, indices, data : arrays
+        The CSR arrays of ``A``. Passing the CSR arrays of ``A.T`` computes
+        ``A.T @ x``.
+    x : array (n_cols,)
+        The dense vector.
+    out : array (n_rows,)
+        Output buffer, overwritten.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus |num_threads + 1| is used (enter -1 to
+        use as many threads as possible). 0 raises an error.
+    """
+    cdef:
+        cnp.npy_intp n_rows = out.shape[0]
+        cnp.npy_intp i
+        index_t k
+        double acc
+        int threads_to_use = determine_num_threads(num_threads)
+
+    if indptr.shape[0] != n_rows + 1:
+        raise ValueError("indptr and out have incompatible shapes")
+
+    set_num_threads(threads_to_use)
+    with nogil:
+        for i in prange(n_rows, schedule="guided", num_threads=threads_to_use):
+            acc = 0
+            for k in range(indptr[i], indptr[i + 1]):
+                acc = acc + data[k] * x[indices[k]]
+            out[i] = acc
+    if num_threads is not None:
+        restore_default_num_threads()
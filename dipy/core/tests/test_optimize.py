@@ -123,3 +123,31 @@ def test_sparse_nnls(rng):
     # We should be able to get back the right answer for this simple case
     npt.assert_array_almost_equal(beta, beta_hat, decimal=1)
     npt.assert_array_almost_equal(beta, beta_hat_sparse, decimal=1)
+
+
+@set_random_number_generator()
+def test_sparse_nnls_fista(rng):
+    beta = rng.random(50)
+    beta[::3] = 0
+    X = sps.random(2000, 50, density=0.2, random_state=rng, format="csr")
+    y = X @ beta
+    for A in [X, X.toarray(), X.tocoo(), X.astype(np.float32)]:
+        for num_threads in [1, 2]:
+            beta_hat = sparse_nnls(
+                y, A, method="fista", tol=1e-10, max_iter=5000, num_threads=num_threads
+            )
+            npt.assert_array_almost_equal(beta, beta_hat, decimal=4)
+
+    # Non-negativity
+    y = X @ (beta - 0.5)
+    beta_hat = sparse_nnls(y, X, method="fista")
+    npt.assert_(np.all(beta_hat >= 0))
+    beta_free = sparse_nnls(y, X, method="fista", non_neg=False, tol=1e-10)
+    npt.assert_array_almost_equal(beta - 0.5, beta_free, decimal=4)
+
+    # A warm start close to the solution converges immediately
+    y = X @ beta
+    beta_hat = sparse_nnls(y, X, method="fista", x0=beta, max_iter=1)
+    npt.assert_array_almost_equal(beta, beta_hat)
+    npt.assert_raises(ValueError, sparse_nnls, y, X, method="fista", x0=beta[:-1])
+    npt.assert_raises(ValueError, sparse_nnls, y, X, method="newton")
@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+import os
 from time import time
 
 from nibabel.affines import apply_affine
@@ -475,6 +477,184 @@ class RecoBundles:
 
         return pruned_streamlines, self.filtered_indices[labels]
 
+    @warning_for_keywords()
+    def recognize_atlas(
+        self,
+        model_bundles,
+        model_clust_thr,
+        *,
+        reduction_thr=10,
+        reduction_distance="mdf",
+        slr=True,
+        num_threads=None,
+        n_jobs=1,
+        slr_metric=None,
+        slr_x0=None,
+        slr_bounds=None,
+        slr_select=(400, 600),
+        slr_method="L-BFGS-B",
+        pruning_thr=5,
+        pruning_distance="mdf",
+    ):
+        """Recognize all the bundles of an atlas in self.streamlines
+
+        The model bundles are clustered once and a single distance matrix
+        between all the model centroids and the tractogram centroids is used
+        to reduce the search space of every bundle. The local SLR and pruning
+        stages are then run independently for each bundle, optionally on a
+        pool of threads sharing the (read-only) tractogram.
+
+        See :footcite:p:`Garyfallidis2018` for further details about the method.
+
+        Parameters
+        ----------
+        model_bundles : dict or sequence of Streamlines
+            Model bundles of the atlas. If a dict is given, the results are
+            keyed with the same names.
+        model_clust_thr : float or sequence of floats
+            MDF distance threshold for the model bundles. A sequence gives one
+            threshold per bundle.
+        reduction_thr : float, optional
+            Reduce search space in the target tractogram by (mm).
+        reduction_distance : string, optional
+            Reduction distance type can be mdf or mam.
+        slr : bool, optional
+            Use Streamline-based Linear Registration (SLR) locally.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization of the SLR
+            metric. If None (default) the value of OMP_NUM_THREADS environment
+            variable is used if it is set, otherwise all available threads are
+            used. If < 0 the maximal number of threads minus
+            $|num_threads + 1|$ is used (enter -1 to use as many threads as
+            possible). 0 raises an error.
+        n_jobs : int, optional
+            Number of bundles processed concurrently. If -1, one job per
+            available CPU is used. When bundles are processed concurrently,
+            the SLR metric of each bundle uses a single thread, whatever
+            `num_threads`.
+        slr_metric : BundleMinDistanceMetric
+            See :meth:`recognize`.
+        slr_x0 : array or int or str, optional
+            See :meth:`recognize`.
+        slr_bounds : array, optional
+            SLR bounds.
+        slr_select : tuple, optional
+            Select the number of streamlines from model to neighborhood of
+            model to perform the local SLR.
+        slr_method : string, optional
+            Optimization method 'L_BFGS_B' or 'Powell' optimizers can be used.
+        pruning_thr : float, optional
+            Pruning after reducing the search space.
+        pruning_distance : string, optional
+            Pruning distance type can be mdf or mam.
+
+        Returns
+        -------
+        recognized : dict or list
+            For each model bundle, a tuple ``(recognized_transf,
+            recognized_labels)`` as returned by :meth:`recognize`. A dict is
+            returned if `model_bundles` is a dict, a list otherwise.
+
+        Notes
+        -----
+        Each bundle gets its own random generator, seeded from ``self.rng``
+        before any work is dispatched, so the result does not depend on
+        `n_jobs`.
+
+        References
+        ----------
+        .. footbibliography::
+        """
+        if isinstance(model_bundles, dict):
+            names = list(model_bundles.keys())
+            bundles = [model_bundles[name] for name in names]
+        else:
+            names = None
+            bundles = list(model_bundles)
+        nb_bundles = len(bundles)
+
+        if np.ndim(model_clust_thr) == 0:
+            model_clust_thr = [model_clust_thr] * nb_bundles
+        if len(model_clust_thr) != nb_bundles:
+            raise ValueError("One model_clust_thr is needed per model bundle")
+
+        if reduction_distance.lower() == "mdf":
+            distance = bundles_distances_mdf
+        elif reduction_distance.lower() == "mam":
+            distance = bundles_distances_mam
+        else:
+            raise ValueError("Given reduction distance not known")
+
+        if self.verbose:
+            t = time()
+            logger.info(f"## Recognize {nb_bundles} atlas bundles ## \n")
+
+        seeds = self.rng.integers(np.iinfo(np.int32).max, size=nb_bundles)
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+
+        model_centroids = [
+            self._cluster_model_bundle(bundle, model_clust_thr=thr, rng=rng)
+            for bundle, thr, rng in zip(bundles, model_clust_thr, rngs)
+        ]
+        centroid_offsets = np.cumsum([0] + [len(c) for c in model_centroids])
+        centroid_matrix = distance(Streamlines(chain(*model_centroids)), self.centroids)
+        close_matrix = centroid_matrix <= reduction_thr
+
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        concurrent = n_jobs > 1 and nb_bundles > 1
+        # Bundles processed concurrently use a single thread each in the SLR
+        # metric, to not oversubscribe the cores.
+        slr_num_threads = 1 if concurrent else num_threads
+
+        def _recognize_one(i):
+            close = close_matrix[centroid_offsets[i] : centroid_offsets[i + 1]]
+            close_clusters_indices = np.where(np.any(close, axis=0))[0]
+            neighb_indices = [self.indices[j] for j in close_clusters_indices]
+            if len(neighb_indices) == 0:
+                return Streamlines([]), []
+
+            neighb_streamlines = self.streamlines[np.concatenate(neighb_indices)]
+
+            if slr:
+                transf_streamlines, _ = self._register_neighb_to_model(
+                    bundles[i],
+                    neighb_streamlines,
+                    metric=slr_metric,
+                    x0=slr_x0,
+                    bounds=slr_bounds,
+                    select_model=slr_select[0],
+                    select_target=slr_select[1],
+                    method=slr_method,
+                    num_threads=slr_num_threads,
+                    rng=rngs[i],
+                )
+            else:
+                transf_streamlines = neighb_streamlines
+
+            pruned_streamlines, labels = self._prune_what_not_in_model(
+                model_centroids[i],
+                transf_streamlines,
+                neighb_indices,
+                pruning_thr=pruning_thr,
+                pruning_distance=pruning_distance,
+                rng=rngs[i],
+            )
+            return pruned_streamlines, self.filtered_indices[labels]
+
+        if not concurrent:
+            recognized = [_recognize_one(i) for i in range(nb_bundles)]
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                recognized = list(executor.map(_recognize_one, range(nb_bundles)))
+
+        if self.verbose:
+            logger.info(f"Total duration of atlas recognition {time() - t:0.3f} s\n")
+
+        if names is not None:
+            return dict(zip(names, recognized))
+        return recognized
+
     @warning_for_keywords()
     def refine(
         self,
@@ -678,7 +858,13 @@ class RecoBundles:
 
     @warning_for_keywords()
     def _cluster_model_bundle(
-        self, model_bundle, model_clust_thr, *, nb_pts=20, select_randomly=500000
+        self,
+        model_bundle,
+        model_clust_thr,
+        *,
+        nb_pts=20,
+        select_randomly=500000,
+        rng=None,
     ):
         if self.verbose:
             t = time()
@@ -692,7 +878,7 @@ class RecoBundles:
             thresholds,
             nb_pts=nb_pts,
             select_randomly=select_randomly,
-            rng=self.rng,
+            rng=self.rng if rng is None else rng,
         )
         model_centroids = model_cluster_map.centroids
         nb_model_centroids = len(model_centroids)
@@ -759,6 +945,7 @@ class RecoBundles:
         method="L-BFGS-B",
         nb_pts=20,
         num_threads=None,
+        rng=None,
     ):
         if self.verbose:
             logger.info("# Local SLR of neighb_streamlines to model")
@@ -785,12 +972,13 @@ class RecoBundles:
                 (0.8, 1.2),
             ]
 
+        if rng is None:
+            rng = self.rng
+
         # TODO this can be speeded up by using directly the centroids
-        static = select_random_set_of_streamlines(
-            model_bundle, select_model, rng=self.rng
-        )
+        static = select_random_set_of_streamlines(model_bundle, select_model, rng=rng)
         moving = select_random_set_of_streamlines(
-            neighb_streamlines, select_target, rng=self.rng
+            neighb_streamlines, select_target, rng=rng
         )
 
         static = set_number_of_points(static, nb_points=nb_pts)
@@ -833,6 +1021,7 @@ class RecoBundles:
         mdf_thr=5,
         pruning_thr=10,
         pruning_distance="mdf",
+        rng=None,
     ):
         if self.verbose:
             if pruning_thr < 0:
@@ -849,7 +1038,7 @@ class RecoBundles:
             thresholds,
             nb_pts=20,
             select_randomly=500000,
-            rng=self.rng,
+            rng=self.rng if rng is None else rng,
         )
         if self.verbose:
             logger.info(f" QB Duration {time() - t:0.3f} s\n")
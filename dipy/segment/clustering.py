@@ -461,6 +461,22 @@ class QuickBundles(Clustering):
         automatically resampled so they have 12 points.
     max_nb_clusters : int, optional
         Limits the creation of bundles.
+    num_threads : int, optional
+        Number of threads used to compute the distances between a streamline
+        and the centroids when there are many clusters. If None (default) the
+        value of OMP_NUM_THREADS environment variable is used if it is set,
+        otherwise all available threads are used. If < 0 the maximal number of
+        threads minus $|num_threads + 1|$ is used (enter -1 to use as many
+        threads as possible). 0 raises an error. The resulting clusters do not
+        depend on the number of threads.
+    spatial_index : bool, optional
+        If True, keep a uniform grid over the centroids' barycenters and only
+        compare a streamline to the centroids whose barycenter is within
+        `threshold` of its own. The barycenter distance being a lower bound of
+        the MDF, the clusters are unchanged, but a streamline starting a new
+        cluster is always added in its original orientation, so some
+        centroids may be flipped. This makes the assignment cost sub-linear
+        in the number of clusters.
 
     Examples
     --------
@@ -500,12 +516,22 @@ class QuickBundles(Clustering):
     """
 
     @warning_for_keywords()
-    def __init__(self, threshold, *, metric="MDF_12points", max_nb_clusters=None):
+    def __init__(
+        self,
+        threshold,
+        *,
+        metric="MDF_12points",
+        max_nb_clusters=None,
+        num_threads=None,
+        spatial_index=False,
+    ):
         if max_nb_clusters is None:
             max_nb_clusters = np.iinfo("i4").max
 
         self.threshold = threshold
         self.max_nb_clusters = max_nb_clusters
+        self.num_threads = num_threads
+        self.spatial_index = spatial_index
 
         if isinstance(metric, MinimumAverageDirectFlipMetric):
             raise ValueError("Use AveragePointwiseEuclideanMetric instead")
@@ -544,6 +570,8 @@ class QuickBundles(Clustering):
             threshold=self.threshold,
             max_nb_clusters=self.max_nb_clusters,
             ordering=ordering,
+            num_threads=self.num_threads,
+            spatial_index=self.spatial_index,
         )
 
         cluster_map.refdata = streamlines
@@ -567,6 +595,13 @@ class QuickBundlesX(Clustering):
         :footcite:p:`Garyfallidis2012a` is used and streamlines are
         automatically resampled so they have 12 points.
 
+    Notes
+    -----
+    Besides `cluster`, which builds a new tree at every call, streamlines can
+    be added incrementally to a persistent tree with `partial_fit`, e.g. as
+    they are generated by a tractography algorithm. The persistent tree can
+    be queried with `query`, saved with `save` and restored with `load`.
+
     References
     ----------
     .. footbibliography::
@@ -575,6 +610,8 @@ class QuickBundlesX(Clustering):
     @warning_for_keywords()
     def __init__(self, thresholds, *, metric="MDF_12points"):
         self.thresholds = thresholds
+        self._tree = None
+        self.nb_streamlines = 0
 
         if isinstance(metric, MinimumAverageDirectFlipMetric):
             raise ValueError("Use AveragePointwiseEuclideanMetric instead")
@@ -613,6 +650,133 @@ class QuickBundlesX(Clustering):
         tree.refdata = streamlines
         return tree
 
+    @warning_for_keywords()
+    def partial_fit(self, streamlines, *, ordering=None):
+        """Adds `streamlines` to the persistent tree.
+
+        Streamlines are indexed after all the streamlines given in previous
+        calls, i.e. the first streamline of the second chunk has index
+        ``len(first_chunk)``.
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays
+            Each 2D array represents a sequence of 3D points (points, 3).
+        ordering : iterable of indices, optional
+            Specifies the order in which data points will be clustered.
+
+        Returns
+        -------
+        self : `QuickBundlesX` object
+        """
+        from dipy.segment.clusteringspeed import QuickBundlesX as QuickBundlesXTree
+
+        if ordering is None:
+            ordering = range(len(streamlines))
+
+        for idx in ordering:
+            streamline = streamlines[idx]
+            if not streamline.flags.writeable or streamline.dtype != np.float32:
+                streamline = streamline.astype(np.float32)
+
+            if self._tree is None:
+                features_shape = self.metric.feature.infer_shape(streamline)
+                self._tree = QuickBundlesXTree(
+                    features_shape, self.thresholds, self.metric
+                )
+
+            self._tree.insert(streamline, self.nb_streamlines + idx)
+
+        self.nb_streamlines += len(streamlines)
+        return self
+
+    def _check_tree(self):
+        if self._tree is None:
+            raise ValueError("No streamline has been added with partial_fit.")
+
+    def get_tree_cluster_map(self):
+        """Returns the persistent tree built with `partial_fit`.
+
+        Returns
+        -------
+        `TreeClusterMap` object
+            Snapshot of the tree. Clusters contain global streamline indices.
+        """
+        self._check_tree()
+        return self._tree.get_tree_cluster_map()
+
+    def query(self, streamlines):
+        """Finds the nearest cluster of each streamline at each level.
+
+        The persistent tree is not modified.
+
+        Parameters
+        ----------
+        streamlines : list of 2D arrays
+            Each 2D array represents a sequence of 3D points (points, 3).
+
+        Returns
+        -------
+        labels : ndarray of int, shape (N, nb_levels)
+            ``labels[i, k]`` is the index of the nearest cluster of the i-th
+            streamline in ``get_tree_cluster_map().get_clusters(k + 1)``, or
+            -1 if no cluster of that level is within the threshold.
+        dists : ndarray of float, shape (N, nb_levels)
+            Distance to the nearest cluster (inf if none).
+        """
+        self._check_tree()
+        nb_levels = len(self.thresholds)
+        labels = np.full((len(streamlines), nb_levels), -1, dtype=np.intp)
+        dists = np.full((len(streamlines), nb_levels), np.inf)
+        for i, streamline in enumerate(streamlines):
+            if not streamline.flags.writeable or streamline.dtype != np.float32:
+                streamline = streamline.astype(np.float32)
+            labels[i], dists[i] = self._tree.query(streamline)
+
+        return labels, dists
+
+    def save(self, fname):
+        """Saves the persistent tree to a file in the ``.npz`` format.
+
+        The metric is not saved and has to be given again to `load`.
+
+        Parameters
+        ----------
+        fname : str
+            Output filename, used as is (no ``.npz`` extension is added).
+        """
+        self._check_tree()
+        with open(fname, "wb") as f:
+            np.savez(f, nb_streamlines=self.nb_streamlines, **self._tree.get_state())
+
+    @classmethod
+    @warning_for_keywords()
+    def load(cls, fname, *, metric="MDF_12points"):
+        """Loads a persistent tree saved with `save`.
+
+        Parameters
+        ----------
+        fname : str
+            Filename of the saved tree.
+        metric : str or `Metric` object, optional
+            The distance metric used to build the saved tree.
+
+        Returns
+        -------
+        `QuickBundlesX` object
+            Clustering whose persistent tree can be queried and extended with
+            `partial_fit`.
+        """
+        from dipy.segment.clusteringspeed import QuickBundlesX as QuickBundlesXTree
+
+        with np.load(fname) as state:
+            state = dict(state)
+
+        qbx = cls(state["thresholds"].tolist(), metric=metric)
+        qbx._tree = QuickBundlesXTree.from_state(state, qbx.metric)
+        qbx.nb_streamlines = int(state["nb_streamlines"])
+        return qbx
+
 
 class TreeCluster(ClusterCentroid):
     @warning_for_keywords()
@@ -1,7 +1,12 @@
 # cython: wraparound=False, cdivision=True, boundscheck=False, initializedcheck=False
 
 import itertools
+from nibabel.streamlines import ArraySequence
 import numpy as np
+cimport numpy as cnp
+
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 from dipy.segment.cythonutils cimport Data2D, shape2tuple
 from dipy.segment.metricspeed cimport Metric
@@ -63,7 +68,8 @@ def peek(iterable):
 
 
 def quickbundles(streamlines, Metric metric, double threshold,
-                 long max_nb_clusters=BIGGEST_INT, ordering=None):
+                 long max_nb_clusters=BIGGEST_INT, ordering=None,
+                 num_threads=None, spatial_index=False):
     """ Clusters streamlines using QuickBundles.
 
     See :footcite:p:`Garyfallidis2012a` for further details about the method.
@@ -81,12 +87,36 @@ def quickbundles(streamlines, Metric metric, double threshold,
         Limits the creation of bundles. (Default: inf)
     ordering : iterable of indices, optional
         Iterate through `data` using the given ordering.
+    num_threads : int, optional
+        Number of threads used to compute the distances between a streamline
+        and all the centroids. If None the value of OMP_NUM_THREADS
+        environment variable is used if it is set, otherwise all available
+        threads are used. If < 0 the maximal number of threads minus
+        $|num_threads + 1|$ is used (enter -1 to use as many threads as
+        possible). 0 raises an error. The clustering does not depend on the
+        number of threads.
+    spatial_index : bool, optional
+        If True, index the centroids' barycenters in a uniform grid so that
+        only centroids within `threshold` of a streamline are evaluated. This
+        is only used with metrics derived from `SumPointwiseEuclideanMetric`
+        on 3D features, for which the barycenter distance is a lower bound of
+        the metric.
 
     Returns
     -------
     `ClusterMapCentroid` object
         Result of the clustering.
 
+    Notes
+    -----
+    When `streamlines` is an `ArraySequence`, its points buffer is read
+    directly (cast once to float32 if needed) and the whole clustering loop
+    runs without the GIL.
+
+    With `spatial_index`, the clusters are the same as without it but a
+    streamline starting a new cluster is always added in its original
+    orientation, so some centroids may be flipped.
+
     References
     ----------
     .. footbibliography::
@@ -104,16 +134,57 @@ def quickbundles(streamlines, Metric metric, double threshold,
         return ClusterMapCentroid()
 
     features_shape = shape2tuple(metric.feature.c_infer_shape(streamlines[first_idx].astype(DTYPE)))
-    cdef QuickBundles qb = QuickBundles(features_shape, metric, threshold, max_nb_clusters)
-    cdef int idx
-    for idx in ordering:
-        streamline = streamlines[idx]
-        if not streamline.flags.writeable or streamline.dtype != DTYPE:
-            streamline = streamline.astype(DTYPE)
-        cluster_id = qb.assignment_step(streamline, idx)
-        # The update step is performed right after the assignment step instead
-        # of after all streamlines have been assigned like k-means algorithm.
-        qb.update_step(cluster_id)
+    threads_to_use = determine_num_threads(num_threads)
+    cdef QuickBundles qb = QuickBundles(features_shape, metric, threshold,
+                                        max_nb_clusters, threads_to_use,
+                                        spatial_index)
+    cdef int idx, cluster_id
+    cdef cnp.npy_intp i
+    cdef float[:, ::1] points
+    cdef cnp.npy_intp[::1] offsets, lengths, order
+
+    if threads_to_use > 1:
+        set_num_threads(threads_to_use)
+
+    try:
+        if isinstance(streamlines, ArraySequence):
+            order = np.fromiter(ordering, dtype=np.intp)
+            if np.any(np.asarray(order) < 0) or \
+                    np.any(np.asarray(order) >= len(streamlines)):
+                raise IndexError("'ordering' contains out of range indices.")
+
+            data = streamlines._data
+            if not data.flags.writeable or data.dtype != DTYPE or \
+                    not data.flags.c_contiguous:
+                data = np.ascontiguousarray(data, dtype=DTYPE)
+                if not data.flags.writeable:
+                    data = data.copy()
+            points = data.reshape((len(data), -1))
+            offsets = np.asarray(streamlines._offsets, dtype=np.intp)
+            lengths = np.asarray(streamlines._lengths, dtype=np.intp)
+
+            with nogil:
+                for i in range(order.shape[0]):
+                    idx = <int> order[i]
+                    cluster_id = qb.assignment_step(
+                        points[offsets[idx]:offsets[idx] + lengths[idx]], idx)
+                    # The update step is performed right after the assignment
+                    # step instead of after all streamlines have been assigned
+                    # like k-means algorithm.
+                    qb.update_step(cluster_id)
+        else:
+            for idx in ordering:
+                streamline = streamlines[idx]
+                if not streamline.flags.writeable or streamline.dtype != DTYPE:
+                    streamline = streamline.astype(DTYPE)
+                cluster_id = qb.assignment_step(streamline, idx)
+                # The update step is performed right after the assignment step
+                # instead of after all streamlines have been assigned like
+                # k-means algorithm.
+                qb.update_step(cluster_id)
+    finally:
+        if num_threads is not None and threads_to_use > 1:
+            restore_default_num_threads()
 
     return clusters_centroid2clustermap_centroid(qb.clusters)
 
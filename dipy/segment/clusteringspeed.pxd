@@ -52,6 +52,7 @@ cdef struct CentroidNode:
     int size
     Shape centroid_shape
     int level
+    int level_index
 
 
 cdef class Clusters:
@@ -84,9 +85,30 @@ cdef class QuickBundles:
     cdef double aabb_pad
     cdef int max_nb_clusters
     cdef int bvh
+    cdef int num_threads
+    cdef double* dists
+    cdef cnp.npy_intp dists_size
     cdef QuickBundlesStats stats
+    # Uniform grid over the centroids' barycenters.
+    cdef int use_grid
+    cdef float grid_radius
+    cdef cnp.npy_intp nb_buckets
+    cdef cnp.npy_intp nb_indexed
+    cdef float* barycenters
+    cdef cnp.npy_intp* cluster_bucket
+    cdef int** buckets
+    cdef int* buckets_size
+    cdef int* buckets_capacity
+    cdef int* candidates
+    cdef cnp.npy_intp candidates_size
 
     cdef NearestCluster find_nearest_cluster(QuickBundles self, Data2D features) noexcept nogil
+    cdef cnp.npy_intp _grid_bucket(QuickBundles self, float* point, int dx, int dy, int dz) noexcept nogil
+    cdef void _grid_add(QuickBundles self, cnp.npy_intp bucket, int cluster_id) noexcept nogil
+    cdef void _grid_remove(QuickBundles self, cnp.npy_intp bucket, int cluster_id) noexcept nogil
+    cdef void _grid_resize(QuickBundles self, cnp.npy_intp nb_buckets) noexcept nogil
+    cdef void _grid_update(QuickBundles self, int cluster_id) noexcept nogil
+    cdef cnp.npy_intp _grid_candidates(QuickBundles self, Data2D features) noexcept nogil
     cdef int assignment_step(QuickBundles self, Data2D datum, int datum_id) except -1 nogil
     cdef void update_step(QuickBundles self, int cluster_id) noexcept nogil
     cdef object _build_clustermap(self)
@@ -104,6 +126,7 @@ cdef class QuickBundlesX:
     cdef object clusters
     cdef QuickBundlesXStats stats
     cdef StreamlineInfos* current_streamline
+    cdef int levels_indexed
 
     cdef int _add_child(self, CentroidNode* node) noexcept nogil
     cdef void _update_node(self, CentroidNode* node, StreamlineInfos* streamline_infos) noexcept nogil
@@ -111,4 +134,10 @@ cdef class QuickBundlesX:
     cpdef object insert(self, Data2D datum, int datum_idx)
     cdef void traverse_postorder(self, CentroidNode* node, void (*visit)(QuickBundlesX, CentroidNode*))
     cdef void _dealloc_node(self, CentroidNode* node)
-    cdef object _build_tree_clustermap(self, CentroidNode* node)
\ No newline at end of file
+    cdef object _build_tree_clustermap(self, CentroidNode* node)
+    cdef void _index_levels(self, CentroidNode* node, cnp.npy_intp* counters) noexcept nogil
+    cdef void _count_nodes(self, CentroidNode* node, cnp.npy_intp* counts) noexcept nogil
+    cdef void _fill_state(self, CentroidNode* node, cnp.npy_intp parent,
+                          cnp.npy_intp* counts, cnp.npy_intp[:] parents,
+                          cnp.npy_intp[:] sizes, float[:, :, :] centroids,
+                          int[:] indices) noexcept nogil
\ No newline at end of file
@@ -2,14 +2,16 @@
 
 import numpy as np
 cimport numpy as cnp
+from cython.parallel import prange
 
 from dipy.segment.clustering import ClusterCentroid, ClusterMapCentroid
 from dipy.segment.clustering import TreeCluster, TreeClusterMap
+from dipy.segment.metricspeed import SumPointwiseEuclideanMetric
 
 
-from libc.math cimport fabs
+from libc.math cimport fabs, floor
 from dipy.segment.cythonutils cimport Data2D, Shape,\
-    tuple2shape, same_shape, create_memview_2d, free_memview_2d
+    tuple2shape, shape2tuple, same_shape, create_memview_2d, free_memview_2d
 
 cdef extern from "math.h" nogil:
     double fabs(double x)
@@ -27,6 +29,14 @@ DEF BIGGEST_DOUBLE = 1.7976931348623157e+308  # np.finfo('f8').max
 DEF BIGGEST_INT = 2147483647  # np.iinfo('i4').max
 DEF BIGGEST_FLOAT = 3.4028235e+38  # np.finfo('f4').max
 DEF SMALLEST_FLOAT = -3.4028235e+38  # np.finfo('f4').max
+# Below this number of centroids per thread, distances are computed serially.
+DEF MIN_CENTROIDS_PER_THREAD = 32
+# Initial number of buckets of the centroid grid and average number of
+# centroids per bucket above which the number of buckets is doubled.
+DEF GRID_NB_BUCKETS = 1024
+DEF GRID_MAX_LOAD = 4
+# Clamp grid cell coordinates to avoid integer overflows.
+DEF GRID_MAX_CELL = 1e15
 
 
 cdef print_node(CentroidNode* node, prepend=""):
@@ -81,6 +91,19 @@ cdef void aabb_creation(Data2D streamline, float* aabb) noexcept nogil:
         aabb[d] = min_[d] + aabb[d + 3]  # center
 
 
+cdef void barycenter(Data2D features, float* out) noexcept nogil:
+    """ Computes the mean of the 3D points of `features`. """
+    cdef:
+        cnp.npy_intp N = features.shape[0]
+        cnp.npy_intp n, d
+
+    for d in range(3):
+        out[d] = 0
+        for n in range(N):
+            out[d] += features[n, d]
+        out[d] /= N
+
+
 cdef inline int aabb_overlap(float* aabb1, float* aabb2, float padding=0.) noexcept nogil:
     """ SIMD optimized AABB-AABB test
 
@@ -137,6 +160,7 @@ cdef class QuickBundlesX:
 
         self.level = None
         self.clusters = None
+        self.levels_indexed = 0
         self.stats.stats_per_layer = <QuickBundlesXStatsLayer*> calloc(self.nb_levels, sizeof(QuickBundlesXStatsLayer))
         # Important: because the CentroidNode structure contains an uninitialized memview,
         # we need to zero-initialize the allocated memory (calloc or via memset),
@@ -251,6 +275,7 @@ cdef class QuickBundlesX:
         aabb_creation(self.current_streamline.features[0], self.current_streamline.aabb)
         path = -1 * np.ones(self.nb_levels, dtype=np.int32)
         self._insert_in(self.root, self.current_streamline, path)
+        self.levels_indexed = 0
         return path
 
     def __str__(self):
@@ -279,7 +304,7 @@ cdef class QuickBundlesX:
         cdef Data2D centroid
         centroid = <float[:self.features_shape.dims[0],:self.features_shape.dims[1]]> &node.centroid[0][0,0]
         tree_cluster = TreeCluster(threshold=node.threshold,
-                                   centroid=np.asarray(centroid),
+                                   centroid=np.asarray(centroid).copy(),
                                    indices=np.asarray(<int[:node.size]> node.indices).copy())
         cdef cnp.npy_intp i
         for i in range(node.nb_children):
@@ -301,6 +326,225 @@ cdef class QuickBundlesX:
 
         return stats
 
+    cdef void _index_levels(self, CentroidNode* node, cnp.npy_intp* counters) noexcept nogil:
+        """ Numbers the nodes of each level in preorder, i.e. in the order
+        of `TreeClusterMap.get_clusters`. """
+        cdef cnp.npy_intp i
+        node.level_index = <int> counters[node.level]
+        counters[node.level] += 1
+        for i in range(node.nb_children):
+            self._index_levels(node.children[i], counters)
+
+    def query(self, Data2D datum):
+        """ Finds the nearest cluster of `datum` at each level of the tree.
+
+        The tree is descended as when inserting `datum`, but it is not
+        modified.
+
+        Parameters
+        ----------
+        datum : 2D array
+            The datum to look for.
+
+        Returns
+        -------
+        labels : ndarray of int, shape (nb_levels,)
+            Index of the nearest cluster among the clusters of each level
+            (see `TreeClusterMap.get_clusters`), or -1 if no cluster is within
+            the threshold, i.e. `datum` would start a new cluster at that
+            level.
+        dists : ndarray of float, shape (nb_levels,)
+            Distance to the nearest cluster at each level (inf if none).
+        """
+        cdef:
+            Data2D features = np.empty(shape2tuple(self.features_shape), dtype=DTYPE)
+            Data2D features_flip = np.empty(shape2tuple(self.features_shape), dtype=DTYPE)
+            float[6] aabb
+            CentroidNode* node = self.root
+            CentroidNode* child
+            cnp.npy_intp* counters
+            cnp.npy_intp level, k
+            double dist
+            NearestCluster nearest_cluster
+
+        labels = -np.ones(self.nb_levels, dtype=np.intp)
+        dists = np.full(self.nb_levels, np.inf)
+        cdef cnp.npy_intp[:] labels_view = labels
+        cdef double[:] dists_view = dists
+
+        self.metric.feature.c_extract(datum, features)
+        self.metric.feature.c_extract(datum[::-1], features_flip)
+        aabb_creation(features, &aabb[0])
+
+        with nogil:
+            if not self.levels_indexed:
+                counters = <cnp.npy_intp*> calloc(self.nb_levels + 1, sizeof(cnp.npy_intp))
+                self._index_levels(self.root, counters)
+                free(counters)
+                self.levels_indexed = 1
+
+            for level in range(self.nb_levels):
+                nearest_cluster.id = -1
+                nearest_cluster.dist = BIGGEST_DOUBLE
+                for k in range(node.nb_children):
+                    child = node.children[k]
+                    if not aabb_overlap(child.aabb, &aabb[0], node.threshold):
+                        continue
+                    dist = min(self.metric.c_dist(child.centroid[0], features),
+                               self.metric.c_dist(child.centroid[0], features_flip))
+                    if dist < nearest_cluster.dist:
+                        nearest_cluster.dist = dist
+                        nearest_cluster.id = k
+
+                if nearest_cluster.id == -1 or nearest_cluster.dist > node.threshold:
+                    break
+
+                node = node.children[nearest_cluster.id]
+                labels_view[level] = node.level_index
+                dists_view[level] = nearest_cluster.dist
+
+        return labels, dists
+
+    cdef void _count_nodes(self, CentroidNode* node, cnp.npy_intp* counts) noexcept nogil:
+        cdef cnp.npy_intp i
+        counts[0] += 1
+        counts[1] += node.size
+        for i in range(node.nb_children):
+            self._count_nodes(node.children[i], counts)
+
+    cdef void _fill_state(self, CentroidNode* node, cnp.npy_intp parent,
+                          cnp.npy_intp* counts, cnp.npy_intp[:] parents,
+                          cnp.npy_intp[:] sizes, float[:, :, :] centroids,
+                          int[:] indices) noexcept nogil:
+        cdef:
+            cnp.npy_intp i, n, d
+            cnp.npy_intp node_id = counts[0]
+            Data2D centroid = node.centroid[0]
+
+        parents[node_id] = parent
+        sizes[node_id] = node.size
+        for n in range(centroid.shape[0]):
+            for d in range(centroid.shape[1]):
+                centroids[node_id, n, d] = centroid[n, d]
+        for i in range(node.size):
+            indices[counts[1] + i] = node.indices[i]
+
+        counts[0] += 1
+        counts[1] += node.size
+        for i in range(node.nb_children):
+            self._fill_state(node.children[i], node_id, counts, parents, sizes,
+                             centroids, indices)
+
+    def get_state(self):
+        """ Returns the tree as a dictionary of arrays.
+
+        The nodes are listed in preorder, the root first. The state can be
+        saved with `np.savez` and restored with `QuickBundlesX.from_state`.
+
+        Returns
+        -------
+        dict
+            With keys 'thresholds', 'features_shape', 'parents' (index of the
+            parent of each node, -1 for the root), 'sizes' (number of
+            elements of each node), 'centroids' and 'indices' (the elements
+            of all nodes, concatenated).
+        """
+        cdef cnp.npy_intp counts[2]
+        counts[0] = 0
+        counts[1] = 0
+        self._count_nodes(self.root, counts)
+
+        shape = shape2tuple(self.features_shape)
+        parents = np.empty(counts[0], dtype=np.intp)
+        sizes = np.empty(counts[0], dtype=np.intp)
+        centroids = np.empty((counts[0],) + shape, dtype=DTYPE)
+        indices = np.empty(counts[1], dtype=np.int32)
+
+        counts[0] = 0
+        counts[1] = 0
+        self._fill_state(self.root, -1, counts, parents, sizes, centroids,
+                         indices)
+
+        return {'thresholds': np.array([self.thresholds[i]
+                                        for i in range(self.nb_levels)]),
+                'features_shape': np.array(shape, dtype=np.intp),
+                'parents': parents,
+                'sizes': sizes,
+                'centroids': centroids,
+                'indices': indices}
+
+    @staticmethod
+    def from_state(state, Metric metric):
+        """ Rebuilds a tree from the output of `get_state`.
+
+        Parameters
+        ----------
+        state : dict
+            Tree as returned by `get_state`.
+        metric : `Metric` object
+            Tells how to compute the distance between two streamlines. It has
+            to produce features of the saved shape.
+
+        Returns
+        -------
+        `QuickBundlesX` object
+            Tree to which new data can be inserted.
+        """
+        shape = tuple(int(dim) for dim in state['features_shape'])
+        cdef:
+            QuickBundlesX qbx = QuickBundlesX(shape, list(state['thresholds']), metric)
+            cnp.npy_intp[:] parents = np.asarray(state['parents'], dtype=np.intp)
+            cnp.npy_intp[:] sizes = np.asarray(state['sizes'], dtype=np.intp)
+            float[:, :, :] centroids = np.asarray(state['centroids'], dtype=DTYPE)
+            int[:] indices = np.asarray(state['indices'], dtype=np.int32)
+            cnp.npy_intp nb_nodes = parents.shape[0]
+            cnp.npy_intp i, j, n, d, offset = 0
+            CentroidNode** nodes
+            CentroidNode* node
+            Data2D centroid
+
+        if (nb_nodes == 0 or parents[0] != -1 or sizes.shape[0] != nb_nodes
+                or centroids.shape[0] != nb_nodes
+                or centroids.shape[1] != shape[0]
+                or centroids.shape[2] != shape[1]
+                or indices.shape[0] != np.sum(sizes)):
+            raise ValueError("Invalid QuickBundlesX state.")
+
+        levels = np.zeros(nb_nodes, dtype=np.intp)
+        for i in range(1, nb_nodes):
+            if not 0 <= parents[i] < i:
+                raise ValueError("Invalid QuickBundlesX state: nodes must be"
+                                 " in preorder.")
+            levels[i] = levels[parents[i]] + 1
+        if np.any(levels > qbx.nb_levels):
+            raise ValueError("Invalid QuickBundlesX state: the tree is deeper"
+                             " than the number of thresholds.")
+
+        nodes = <CentroidNode**> malloc(nb_nodes * sizeof(CentroidNode*))
+        nodes[0] = qbx.root
+        for i in range(1, nb_nodes):
+            j = qbx._add_child(nodes[parents[i]])
+            nodes[i] = nodes[parents[i]].children[j]
+
+        for i in range(nb_nodes):
+            node = nodes[i]
+            centroid = node.centroid[0]
+            for n in range(centroid.shape[0]):
+                for d in range(centroid.shape[1]):
+                    centroid[n, d] = centroids[i, n, d]
+
+            node.size = <int> sizes[i]
+            node.indices = <int*> malloc(max(node.size, 1) * sizeof(int))
+            for j in range(node.size):
+                node.indices[j] = indices[offset + j]
+            offset += node.size
+
+            if node.size > 0:
+                aabb_creation(centroid, node.aabb)
+
+        free(nodes)
+        return qbx
+
 
 cdef class Clusters:
     """ Provides Cython functionalities to interact with clustering outputs.
@@ -492,7 +736,8 @@ cdef class ClustersCentroid(Clusters):
 
 cdef class QuickBundles:
     def __init__(QuickBundles self, features_shape, Metric metric, double threshold,
-                 int max_nb_clusters=BIGGEST_INT):
+                 int max_nb_clusters=BIGGEST_INT, int num_threads=1,
+                 int spatial_index=0):
         self.metric = metric
         self.features_shape = tuple2shape(features_shape)
         self.threshold = threshold
@@ -500,10 +745,195 @@ cdef class QuickBundles:
         self.clusters = ClustersCentroid(features_shape)
         self.features = np.empty(features_shape, dtype=DTYPE)
         self.features_flip = np.empty(features_shape, dtype=DTYPE)
+        self.num_threads = max(num_threads, 1)
+        self.dists = NULL
+        self.dists_size = 0
 
         self.stats.nb_mdf_calls = 0
         self.stats.nb_aabb_calls = 0
 
+        self.use_grid = 0
+        self.nb_buckets = 0
+        self.nb_indexed = 0
+        self.barycenters = NULL
+        self.cluster_bucket = NULL
+        self.buckets = NULL
+        self.buckets_size = NULL
+        self.buckets_capacity = NULL
+        self.candidates = NULL
+        self.candidates_size = 0
+
+        # The distance between the barycenters of two sequences of points is
+        # a lower bound of their average (or sum of) pointwise distance, so
+        # centroids whose barycenter is farther than `threshold` can be
+        # skipped without changing the clustering.
+        if (spatial_index and self.features_shape.ndim == 2 and
+                self.features_shape.dims[1] == 3 and
+                isinstance(metric, SumPointwiseEuclideanMetric) and
+                0 < threshold < BIGGEST_FLOAT):
+            self.use_grid = 1
+            # Slightly enlarged to be robust to rounding errors.
+            self.grid_radius = threshold * (1 + 1e-5)
+            self._grid_resize(GRID_NB_BUCKETS)
+
+    def __dealloc__(QuickBundles self):
+        cdef cnp.npy_intp i
+        free(self.dists)
+        self.dists = NULL
+        if self.buckets != NULL:
+            for i in range(self.nb_buckets):
+                free(self.buckets[i])
+        free(self.buckets)
+        self.buckets = NULL
+        free(self.buckets_size)
+        self.buckets_size = NULL
+        free(self.buckets_capacity)
+        self.buckets_capacity = NULL
+        free(self.barycenters)
+        self.barycenters = NULL
+        free(self.cluster_bucket)
+        self.cluster_bucket = NULL
+        free(self.candidates)
+        self.candidates = NULL
+
+    cdef cnp.npy_intp _grid_bucket(QuickBundles self, float* point, int dx,
+                                   int dy, int dz) noexcept nogil:
+        """ Hashes the grid cell containing `point`, shifted by (dx, dy, dz),
+        into a bucket index. """
+        cdef:
+            double c
+            long long cell[3]
+            int shift[3]
+            unsigned long long h
+            cnp.npy_intp d
+
+        shift[0] = dx
+        shift[1] = dy
+        shift[2] = dz
+        for d in range(3):
+            c = floor(point[d] / self.grid_radius)
+            c = min(max(c, -GRID_MAX_CELL), GRID_MAX_CELL)
+            cell[d] = <long long> c + shift[d]
+
+        h = ((<unsigned long long> cell[0] * 73856093ULL) ^
+             (<unsigned long long> cell[1] * 19349663ULL) ^
+             (<unsigned long long> cell[2] * 83492791ULL))
+        return <cnp.npy_intp> (h & <unsigned long long> (self.nb_buckets - 1))
+
+    cdef void _grid_add(QuickBundles self, cnp.npy_intp bucket,
+                        int cluster_id) noexcept nogil:
+        cdef int size = self.buckets_size[bucket]
+        if size == self.buckets_capacity[bucket]:
+            self.buckets_capacity[bucket] = max(2 * size, 4)
+            self.buckets[bucket] = <int*> realloc(
+                self.buckets[bucket],
+                self.buckets_capacity[bucket] * sizeof(int))
+
+        self.buckets[bucket][size] = cluster_id
+        self.buckets_size[bucket] += 1
+        self.cluster_bucket[cluster_id] = bucket
+
+    cdef void _grid_remove(QuickBundles self, cnp.npy_intp bucket,
+                           int cluster_id) noexcept nogil:
+        cdef int i, last = self.buckets_size[bucket] - 1
+        for i in range(last + 1):
+            if self.buckets[bucket][i] == cluster_id:
+                self.buckets[bucket][i] = self.buckets[bucket][last]
+                self.buckets_size[bucket] -= 1
+                return
+
+    cdef void _grid_resize(QuickBundles self, cnp.npy_intp nb_buckets) noexcept nogil:
+        """ Reallocates the grid with `nb_buckets` (a power of two) buckets
+        and reinserts the indexed centroids. """
+        cdef cnp.npy_intp i
+        if self.buckets != NULL:
+            for i in range(self.nb_buckets):
+                free(self.buckets[i])
+        free(self.buckets)
+        free(self.buckets_size)
+        free(self.buckets_capacity)
+
+        self.nb_buckets = nb_buckets
+        self.buckets = <int**> calloc(nb_buckets, sizeof(int*))
+        self.buckets_size = <int*> calloc(nb_buckets, sizeof(int))
+        self.buckets_capacity = <int*> calloc(nb_buckets, sizeof(int))
+
+        for i in range(self.nb_indexed):
+            self._grid_add(self._grid_bucket(&self.barycenters[3 * i], 0, 0, 0),
+                           <int> i)
+
+    cdef void _grid_update(QuickBundles self, int cluster_id) noexcept nogil:
+        """ Moves a centroid in the grid after it has been updated, or
+        inserts it if it is a new one. """
+        cdef:
+            cnp.npy_intp bucket
+            float* center
+
+        if cluster_id >= self.nb_indexed:
+            self.nb_indexed = cluster_id + 1
+            self.barycenters = <float*> realloc(
+                self.barycenters, 3 * self.nb_indexed * sizeof(float))
+            self.cluster_bucket = <cnp.npy_intp*> realloc(
+                self.cluster_bucket, self.nb_indexed * sizeof(cnp.npy_intp))
+            center = &self.barycenters[3 * cluster_id]
+            barycenter(self.clusters.centroids[cluster_id].features[0], center)
+            if self.nb_indexed > GRID_MAX_LOAD * self.nb_buckets:
+                self._grid_resize(2 * self.nb_buckets)
+            else:
+                self._grid_add(self._grid_bucket(center, 0, 0, 0), cluster_id)
+            return
+
+        center = &self.barycenters[3 * cluster_id]
+        barycenter(self.clusters.centroids[cluster_id].features[0], center)
+        bucket = self._grid_bucket(center, 0, 0, 0)
+        if bucket != self.cluster_bucket[cluster_id]:
+            self._grid_remove(self.cluster_bucket[cluster_id], cluster_id)
+            self._grid_add(bucket, cluster_id)
+
+    cdef cnp.npy_intp _grid_candidates(QuickBundles self, Data2D features) noexcept nogil:
+        """ Gathers in `self.candidates` the clusters whose barycenter is
+        within `threshold` of the barycenter of `features`. """
+        cdef:
+            float center[3]
+            float dd, dist2, radius2 = self.grid_radius * self.grid_radius
+            cnp.npy_intp visited[27]
+            cnp.npy_intp nb_visited = 0, nb_candidates = 0
+            cnp.npy_intp bucket, i, j
+            int dx, dy, dz, d, k, seen
+
+        if self.candidates_size < self.nb_indexed:
+            self.candidates_size = 2 * self.nb_indexed
+            self.candidates = <int*> realloc(self.candidates,
+                                             self.candidates_size * sizeof(int))
+
+        barycenter(features, center)
+        for dx in range(-1, 2):
+            for dy in range(-1, 2):
+                for dz in range(-1, 2):
+                    bucket = self._grid_bucket(center, dx, dy, dz)
+                    # Neighboring cells can be hashed to the same bucket.
+                    seen = 0
+                    for j in range(nb_visited):
+                        if visited[j] == bucket:
+                            seen = 1
+                            break
+                    if seen:
+                        continue
+                    visited[nb_visited] = bucket
+                    nb_visited += 1
+
+                    for i in range(self.buckets_size[bucket]):
+                        k = self.buckets[bucket][i]
+                        dist2 = 0
+                        for d in range(3):
+                            dd = self.barycenters[3 * k + d] - center[d]
+                            dist2 += dd * dd
+                        if dist2 <= radius2:
+                            self.candidates[nb_candidates] = k
+                            nb_candidates += 1
+
+        return nb_candidates
+
     cdef NearestCluster find_nearest_cluster(QuickBundles self, Data2D features) noexcept nogil:
         """ Finds the nearest cluster of a datum given its `features` vector.
 
@@ -516,28 +946,65 @@ cdef class QuickBundles:
         -------
         `NearestCluster` object
             Nearest cluster to `features` according to the given metric.
+
+        Notes
+        -----
+        When the centroid grid is used, only the clusters whose barycenter is
+        within the threshold are evaluated. If none of them is, the returned
+        cluster has an id of -1.
+
+        When there are enough clusters, the distances to all centroids are
+        computed in parallel and the nearest one is then searched serially,
+        so the result does not depend on the number of threads.
         """
         cdef:
-            cnp.npy_intp k
+            cnp.npy_intp i, k
+            cnp.npy_intp nb_clusters = self.clusters.c_size()
+            cnp.npy_intp nb_candidates = nb_clusters
+            int* candidates = NULL
+            int parallel
             double dist
             NearestCluster nearest_cluster
-            float aabb[6]
 
         nearest_cluster.id = -1
         nearest_cluster.dist = BIGGEST_DOUBLE
         nearest_cluster.flip = 0
 
-        for k in range(self.clusters.c_size()):
-
-            self.stats.nb_mdf_calls += 1
-            dist = self.metric.c_dist(self.clusters.centroids[k].features[0], features)
-
-            # Keep track of the nearest cluster
-            if dist < nearest_cluster.dist:
+        # Once the maximum number of clusters is reached, a datum is assigned
+        # to its nearest cluster even if it is farther than the threshold.
+        if self.use_grid and nb_clusters < self.max_nb_clusters:
+            nb_candidates = self._grid_candidates(features)
+            candidates = self.candidates
+
+        self.stats.nb_mdf_calls += nb_candidates
+        parallel = (self.num_threads > 1 and
+                    nb_candidates >= MIN_CENTROIDS_PER_THREAD * self.num_threads)
+        if parallel:
+            if self.dists_size < nb_candidates:
+                self.dists_size = 2 * nb_candidates
+                self.dists = <double*> realloc(self.dists,
+                                               self.dists_size * sizeof(double))
+
+            for i in prange(nb_candidates, schedule="static",
+                            num_threads=self.num_threads):
+                k = i if candidates == NULL else candidates[i]
+                self.dists[i] = self.metric.c_dist(
+                    self.clusters.centroids[k].features[0], features)
+
+        for i in range(nb_candidates):
+            k = i if candidates == NULL else candidates[i]
+            if parallel:
+                dist = self.dists[i]
+            else:
+                dist = self.metric.c_dist(self.clusters.centroids[k].features[0], features)
+
+            # Keep track of the nearest cluster, ties are resolved in favor
+            # of the oldest cluster.
+            if dist < nearest_cluster.dist or \
+                    (dist == nearest_cluster.dist and k < nearest_cluster.id):
                 nearest_cluster.dist = dist
                 nearest_cluster.id = k
 
-
         return nearest_cluster
 
     cdef int assignment_step(QuickBundles self, Data2D datum, int datum_id) except -1 nogil:
@@ -613,6 +1080,8 @@ cdef class QuickBundles:
 
         """
         self.clusters.c_update(cluster_id)
+        if self.use_grid:
+            self._grid_update(cluster_id)
 
     def get_stats(self):
         stats = {'nb_mdf_calls': self.stats.nb_mdf_calls,
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
 import warnings
 
 import numpy as np
@@ -108,17 +110,46 @@ class FastStreamlineSearch:
         baryc_bins = baryc_tree.query_ball_point(bins_center, center_dist, p=np.inf)
 
         # Compute streamlines mean-points
-        meanpts = self._slines_mean_points(self.ref_slines)
+        self.ref_meanpts = self._slines_mean_points(self.ref_slines)
 
         # Compute bin indices, streamlines + mean-points tree
         self.bin_dict = {}
         for i, baryc_b in enumerate(baryc_bins):
             if baryc_b:
                 slines_id = np.asarray(baryc_b)
-                self.bin_dict[i] = (slines_id, cKDTree(meanpts[slines_id]))
+                self.bin_dict[i] = (slines_id, cKDTree(self.ref_meanpts[slines_id]))
+
+    def __getstate__(self):
+        """Pickle the index without its k-d trees.
+
+        Bins are stored as flat arrays so the index can be saved once, e.g.
+        with ``joblib.dump``, and reloaded (optionally memory-mapped with
+        ``joblib.load(fname, mmap_mode="r")``) for every subject.
+        """
+        state = self.__dict__.copy()
+        bin_ids = np.fromiter(self.bin_dict.keys(), dtype=np.intp)
+        bin_slines = [self.bin_dict[i][0] for i in bin_ids]
+        state["bin_dict"] = (
+            bin_ids,
+            np.cumsum([0] + [len(ids) for ids in bin_slines]),
+            np.concatenate(bin_slines) if bin_slines else np.zeros(0, np.intp),
+        )
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled index and rebuild the k-d tree of each bin."""
+        bin_ids, bin_offsets, bin_slines = state.pop("bin_dict")
+        self.__dict__.update(state)
+        self.bin_dict = {}
+        for i, bin_id in enumerate(bin_ids):
+            slines_id = np.asarray(bin_slines[bin_offsets[i] : bin_offsets[i + 1]])
+            self.bin_dict[int(bin_id)] = (
+                slines_id,
+                cKDTree(self.ref_meanpts[slines_id]),
+            )
 
     @warning_for_keywords()
-    def radius_search(self, streamlines, radius, *, use_negative=True):
+    def radius_search(self, streamlines, radius, *, use_negative=True, n_jobs=1):
         """Radius Search using Fast Streamline Search
 
         For each given streamlines, return all reference streamlines
@@ -135,7 +166,9 @@ class FastStreamlineSearch:
         use_negative : bool, optional
             When used with bidirectional,
             negative values are returned for reversed order neighbors.
-
+        n_jobs : int, optional
+            Number of threads used to search the bins concurrently. If -1,
+            all available CPUs are used. The result does not depend on it.
 
         Returns
         -------
@@ -174,37 +207,38 @@ class FastStreamlineSearch:
         # Rounded up for float32 precision to avoid error / false negative
         l1_sum_dist = 1.73205081 * radius * self.nb_mpts
 
-        # Search for all similar streamlines
-        list_id = []
-        list_id_ref = []
-        list_dist = []
-        for i, bin_id in enumerate(u_bin):
-            if bin_id in self.bin_dict:
-                slines_id_ref, ref_tree = self.bin_dict[bin_id]
-                slines_id = binned_slines_ids[i]
-
-                mpts = self._slines_mean_points(q_slines[slines_id])
-
-                # Compute Tree L1 Query with mean-points
-                res = ref_tree.query_ball_point(mpts, l1_sum_dist, p=1)
-
-                # Refine distance with the complete
-                for s, ref_ids in enumerate(res):
-                    if ref_ids:
-                        s_id = slines_id[s]
-                        rs_ids = slines_id_ref[ref_ids]
-                        d = mean_euclidean_distance(
-                            q_slines[s_id], self.ref_slines[rs_ids]
-                        )
-
-                        # Return all pairs within the radius
-                        in_dist_max = d < radius
-                        id_ref = rs_ids[in_dist_max]
-                        id_s = np.full_like(id_ref, s_id)
-
-                        list_id.append(id_s)
-                        list_id_ref.append(id_ref)
-                        list_dist.append(d[in_dist_max])
+        # Search for all similar streamlines, bins are searched concurrently
+        # and a single bin uses the threads of the k-d tree query.
+        searched = [
+            (bin_id, binned_slines_ids[i])
+            for i, bin_id in enumerate(u_bin)
+            if bin_id in self.bin_dict
+        ]
+        if len(searched) < 2:
+            results = [
+                self._bin_radius_search(
+                    *args, q_slines, radius, l1_sum_dist, workers=n_jobs
+                )
+                for args in searched
+            ]
+        elif n_jobs == 1:
+            results = [
+                self._bin_radius_search(*args, q_slines, radius, l1_sum_dist)
+                for args in searched
+            ]
+        else:
+            if n_jobs == -1:
+                n_jobs = os.cpu_count() or 1
+
+            def _search(args):
+                return self._bin_radius_search(*args, q_slines, radius, l1_sum_dist)
+
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(_search, searched))
+
+        list_id = [res[0] for res in results if len(res[0]) > 0]
+        list_id_ref = [res[1] for res in results if len(res[0]) > 0]
+        list_dist = [res[2] for res in results if len(res[0]) > 0]
 
         # Combine all results in a coup sparse matrix
         if len(list_id) > 0:
@@ -225,6 +259,37 @@ class FastStreamlineSearch:
         # No results, return an empty sparse matrix
         return coo_array((q_nb_slines, self.ref_nb_slines))
 
+    def _bin_radius_search(
+        self, bin_id, slines_id, q_slines, radius, l1_sum_dist, *, workers=1
+    ):
+        """Search the reference streamlines of a bin within the radius"""
+        slines_id_ref, ref_tree = self.bin_dict[bin_id]
+        mpts = self._slines_mean_points(q_slines[slines_id])
+
+        # Compute Tree L1 Query with mean-points
+        res = ref_tree.query_ball_point(mpts, l1_sum_dist, p=1, workers=workers)
+
+        # Refine distance with the complete streamlines
+        list_id = []
+        list_id_ref = []
+        list_dist = []
+        for s, ref_ids in enumerate(res):
+            if ref_ids:
+                s_id = slines_id[s]
+                rs_ids = slines_id_ref[ref_ids]
+                d = mean_euclidean_distance(q_slines[s_id], self.ref_slines[rs_ids])
+
+                # Return all pairs within the radius
+                in_dist_max = d < radius
+                id_ref = rs_ids[in_dist_max]
+                list_id.append(np.full_like(id_ref, s_id))
+                list_id_ref.append(id_ref)
+                list_dist.append(d[in_dist_max])
+
+        if len(list_id) == 0:
+            return np.zeros(0, np.intp), np.zeros(0, np.intp), np.zeros(0)
+        return np.hstack(list_id), np.hstack(list_id_ref), np.hstack(list_dist)
+
     def _resample(self, streamlines):
         """Resample streamlines"""
         s = np.zeros([len(streamlines), self.resampling, 3], dtype=np.float32)
@@ -0,0 +1,276 @@
+"""Approximate nearest streamline search with locality-sensitive hashing."""
+
+import numpy as np
+from scipy.sparse import coo_array
+
+from dipy.io.stateful_tractogram import StatefulTractogram
+from dipy.testing.decorators import warning_for_keywords
+from dipy.tracking.streamline import Streamlines, set_number_of_points
+
+
+def _resample(streamlines, nb_points):
+    """Resample streamlines into a (N, nb_points, 3) float32 array"""
+    if isinstance(streamlines, StatefulTractogram):
+        streamlines = streamlines.streamlines
+
+    if len(streamlines) == 0:
+        return np.zeros((0, nb_points, 3), dtype=np.float32)
+
+    resampled = set_number_of_points(Streamlines(streamlines), nb_points=nb_points)
+    return resampled.get_data().astype(np.float32).reshape((-1, nb_points, 3))
+
+
+def _embed(slines_arr):
+    """Flip-invariant embedding of resampled streamlines"""
+    half = (slines_arr.shape[1] + 1) // 2
+    midpoints = (slines_arr[:, :half] + slines_arr[:, ::-1][:, :half]) / 2.0
+    return midpoints.reshape((len(slines_arr), -1)).astype(np.float64) / np.sqrt(half)
+
+
+@warning_for_keywords()
+def flip_invariant_embedding(streamlines, *, nb_points=12):
+    """Embed streamlines as flip-invariant fixed-length vectors
+
+    Each streamline is resampled to `nb_points` points and represented by the
+    midpoints of its symmetric pairs of points, ``(s[i] + s[-1 - i]) / 2``,
+    which do not depend on the orientation of the streamline. The embedding
+    is scaled so that the Euclidean distance between two embeddings is the
+    root mean square distance between their midpoints.
+
+    Parameters
+    ----------
+    streamlines : Streamlines
+        Streamlines to embed, with at least 2 points each.
+    nb_points : int, optional
+        Number of points used to resample each streamline.
+
+    Returns
+    -------
+    embedding : ndarray, shape (N, 3 * ceil(nb_points / 2))
+        One vector per streamline.
+
+    Notes
+    -----
+    By the triangle inequality, the mean distance between the midpoints of
+    two streamlines is a lower bound of their MDF distance.
+    """
+    return _embed(_resample(streamlines, nb_points))
+
+
+class StreamlineLSH:
+    @warning_for_keywords()
+    def __init__(
+        self,
+        ref_streamlines,
+        *,
+        nb_points=12,
+        bucket_width=8.0,
+        nb_tables=8,
+        nb_projections=4,
+        rng=None,
+    ):
+        """Approximate nearest streamline index
+
+        Reference streamlines are embedded with
+        :func:`flip_invariant_embedding` and hashed in `nb_tables` tables
+        using random projections quantized in buckets of `bucket_width`
+        :footcite:p:`Datar2004`. Streamlines sharing a bucket with a query
+        in any table are candidates, and candidates are ranked with the exact
+        MDF distance.
+
+        Parameters
+        ----------
+        ref_streamlines : Streamlines
+            Reference streamlines to index, with at least 2 points each.
+        nb_points : int, optional
+            Number of points used to resample each streamline, also used
+            for the exact MDF distance.
+        bucket_width : float, optional
+            Width of the buckets, in the units of the streamlines. Larger
+            buckets increase recall and the number of candidates. It should
+            be a few times the distances searched for.
+        nb_tables : int, optional
+            Number of hash tables. More tables increase recall.
+        nb_projections : int, optional
+            Number of random projections per table. More projections reduce
+            the number of candidates and recall.
+        rng : numpy.random.Generator, optional
+            Generator of the random projections.
+
+        Notes
+        -----
+        Searches are approximate: neighbors that never share a bucket with
+        the query are missed. The distances returned are exact MDF distances
+        between the resampled streamlines.
+
+        References
+        ----------
+        .. footbibliography::
+        """
+        if bucket_width <= 0:
+            raise ValueError("bucket_width needs to be a positive value")
+        if nb_tables < 1 or nb_projections < 1:
+            raise ValueError("nb_tables and nb_projections need to be >= 1")
+        if nb_points < 2:
+            raise ValueError("nb_points needs to be >= 2")
+
+        if rng is None:
+            rng = np.random.default_rng()
+
+        self.nb_points = nb_points
+        self.bucket_width = bucket_width
+        self.nb_tables = nb_tables
+        self.nb_projections = nb_projections
+
+        self.ref_slines = _resample(ref_streamlines, nb_points)
+        self.ref_nb_slines = len(self.ref_slines)
+
+        dim = 3 * ((nb_points + 1) // 2)
+        self.projections = rng.normal(size=(nb_tables, nb_projections, dim))
+        self.projection_offsets = rng.uniform(
+            0, bucket_width, size=(nb_tables, nb_projections)
+        )
+        # Odd multipliers combining the quantized projections of a table
+        # into a single (wrapping) 64-bit key.
+        self.key_multipliers = (
+            rng.integers(1, 2**62, size=nb_projections, dtype=np.int64) | 1
+        ).astype(np.uint64)
+
+        keys = self._hash(_embed(self.ref_slines))
+        self.order = np.argsort(keys, axis=1, kind="stable")
+        self.keys = np.take_along_axis(keys, self.order, axis=1)
+
+    def _hash(self, embedding):
+        """Compute the key of each embedding in every table"""
+        keys = np.empty((self.nb_tables, len(embedding)), dtype=np.uint64)
+        for t in range(self.nb_tables):
+            proj = embedding @ self.projections[t].T + self.projection_offsets[t]
+            cells = np.floor(proj / self.bucket_width).astype(np.int64)
+            keys[t] = (cells.astype(np.uint64) * self.key_multipliers).sum(axis=1)
+        return keys
+
+    def _candidates(self, q_slines):
+        """Return unique (query, reference) pairs sharing a bucket"""
+        q_keys = self._hash(_embed(q_slines))
+        q_nb = len(q_slines)
+        pairs = []
+        for t in range(self.nb_tables):
+            lo = np.searchsorted(self.keys[t], q_keys[t], side="left")
+            hi = np.searchsorted(self.keys[t], q_keys[t], side="right")
+            counts = hi - lo
+            total = np.sum(counts)
+            if total == 0:
+                continue
+            q_ids = np.repeat(np.arange(q_nb), counts)
+            starts = np.cumsum(counts) - counts
+            pos = np.arange(total) - np.repeat(starts - lo, counts)
+            pairs.append(q_ids * self.ref_nb_slines + self.order[t][pos])
+
+        if len(pairs) == 0:
+            return np.zeros(0, np.intp), np.zeros(0, np.intp)
+
+        pairs = np.unique(np.concatenate(pairs))
+        return pairs // self.ref_nb_slines, pairs % self.ref_nb_slines
+
+    def _mdf(self, q_slines, q_ids, ref_ids, chunk_size=100000):
+        """Exact MDF distance between pairs of resampled streamlines"""
+        dist = np.empty(len(q_ids), dtype=np.float64)
+        for start in range(0, len(q_ids), chunk_size):
+            end = start + chunk_size
+            a = q_slines[q_ids[start:end]]
+            b = self.ref_slines[ref_ids[start:end]]
+            direct = np.mean(np.linalg.norm(a - b, axis=-1), axis=-1)
+            flipped = np.mean(np.linalg.norm(a - b[:, ::-1], axis=-1), axis=-1)
+            dist[start:end] = np.minimum(direct, flipped)
+        return dist
+
+    def _search(self, streamlines, chunk_size):
+        """Yield candidate pairs and their distances, per chunk of queries"""
+        q_slines = _resample(streamlines, self.nb_points)
+        for start in range(0, len(q_slines), chunk_size):
+            chunk = q_slines[start : start + chunk_size]
+            q_ids, ref_ids = self._candidates(chunk)
+            dist = self._mdf(chunk, q_ids, ref_ids)
+            yield start, len(chunk), q_ids + start, ref_ids, dist
+
+    @warning_for_keywords()
+    def radius_search(self, streamlines, radius, *, chunk_size=10000):
+        """Approximate radius search
+
+        Parameters
+        ----------
+        streamlines : Streamlines
+            Query streamlines.
+        radius : float
+            Search radius (MDF distance).
+        chunk_size : int, optional
+            Number of query streamlines processed at once.
+
+        Returns
+        -------
+        res : scipy COOrdinates sparse array (nb_slines x nb_slines_ref)
+            MDF distance of the neighbors found within the radius.
+        """
+        list_id = []
+        list_id_ref = []
+        list_dist = []
+        q_nb_slines = 0
+        for _, nb, q_ids, ref_ids, dist in self._search(streamlines, chunk_size):
+            q_nb_slines += nb
+            in_radius = dist < radius
+            list_id.append(q_ids[in_radius])
+            list_id_ref.append(ref_ids[in_radius])
+            list_dist.append(dist[in_radius])
+
+        if len(list_id) == 0:
+            return coo_array((q_nb_slines, self.ref_nb_slines))
+
+        return coo_array(
+            (
+                np.concatenate(list_dist),
+                (np.concatenate(list_id), np.concatenate(list_id_ref)),
+            ),
+            shape=(q_nb_slines, self.ref_nb_slines),
+        )
+
+    @warning_for_keywords()
+    def knn_search(self, streamlines, *, k=1, chunk_size=10000):
+        """Approximate k-nearest neighbors search
+
+        Parameters
+        ----------
+        streamlines : Streamlines
+            Query streamlines.
+        k : int, optional
+            Number of neighbors.
+        chunk_size : int, optional
+            Number of query streamlines processed at once.
+
+        Returns
+        -------
+        ids : ndarray of int, shape (nb_slines, k)
+            Indices of the nearest reference streamlines, sorted by distance,
+            -1 when fewer than `k` candidates were found.
+        dist : ndarray, shape (nb_slines, k)
+            MDF distance to the neighbors, inf when not found.
+        """
+        list_ids = []
+        list_dist = []
+        for start, nb, q_ids, ref_ids, dist in self._search(streamlines, chunk_size):
+            ids = np.full((nb, k), -1, dtype=np.intp)
+            knn_dist = np.full((nb, k), np.inf)
+            if len(q_ids) > 0:
+                q_local = q_ids - start
+                order = np.lexsort((dist, q_local))
+                q_sorted = q_local[order]
+                first = np.searchsorted(q_sorted, q_sorted, side="left")
+                rank = np.arange(len(order)) - first
+                keep = rank < k
+                ids[q_sorted[keep], rank[keep]] = ref_ids[order][keep]
+                knn_dist[q_sorted[keep], rank[keep]] = dist[order][keep]
+            list_ids.append(ids)
+            list_dist.append(knn_dist)
+
+        if len(list_ids) == 0:
+            return np.zeros((0, k), dtype=np.intp), np.zeros((0, k))
+        return np.concatenate(list_ids), np.concatenate(list_dist)
@@ -2,9 +2,14 @@
 #cython: boundscheck=False
 #cython: wraparound=False
 #cython: cdivision=True
+from cython.parallel import prange
 import numpy as np
 
 cimport numpy as cnp
+
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 cdef extern from "dpy_math.h" nogil:
     cdef double NPY_PI
     cdef double NPY_INFINITY
@@ -123,7 +128,8 @@ class ConstantObservationModel:
         return mu, var
 
 
-    def negloglikelihood(self, image, mu, sigmasq, cnp.npy_intp nclasses):
+    def negloglikelihood(self, image, mu, sigmasq, cnp.npy_intp nclasses, *,
+                         num_threads=None):
         r""" Computes the gaussian negative log-likelihood of each class at
         each voxel of `image` assuming a gaussian distribution with means and
         variances given by `mu` and `sigmasq`, respectively (constant models
@@ -140,22 +146,34 @@ class ConstantObservationModel:
             variance of each class
         nclasses : int
             number of classes
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
         nloglike : ndarray
             4D negloglikelihood for each class in each volume
         """
-        cdef int l
+        cdef int l, threads_to_use
         nloglike = np.zeros(image.shape + (nclasses,), dtype=np.float64)
 
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
         for l in range(nclasses):
-            _negloglikelihood(image, mu, sigmasq, l, nloglike)
+            _negloglikelihood(image, mu, sigmasq, l, nloglike, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
 
         return nloglike
 
 
-    def prob_image(self, img, cnp.npy_intp nclasses, mu, sigmasq, P_L_N):
+    def prob_image(self, img, cnp.npy_intp nclasses, mu, sigmasq, P_L_N, *,
+                   num_threads=None):
         r""" Conditional probability of the label given the image
 
         Parameters
@@ -171,23 +189,33 @@ class ConstantObservationModel:
             tissue class
         P_L_N : ndarray
             4D probability map of the label given the neighborhood.
-
-        Previously computed by function prob_neighborhood
+            Previously computed by function prob_neighborhood
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
         P_L_Y : ndarray
             4D probability of the label given the input image
         """
-        cdef int l
+        cdef int l, threads_to_use
         P_L_Y = np.zeros_like(P_L_N)
         P_L_Y_norm = np.zeros_like(img)
 
         g = np.empty_like(img)
 
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
         for l in range(nclasses):
-            _prob_image(img, g, mu, sigmasq, l, P_L_N, P_L_Y)
+            _prob_image(img, g, mu, sigmasq, l, P_L_N, P_L_Y, threads_to_use)
             P_L_Y_norm[:, :, :] += P_L_Y[:, :, :, l]
+        if num_threads is not None:
+            restore_default_num_threads()
 
         for l in range(nclasses):
             P_L_Y[:, :, :, l] = P_L_Y[:, :, :, l] / P_L_Y_norm
@@ -283,7 +311,8 @@ cdef void _initialize_param_uniform(double[:, :, :] image, double[:] mu,
 
 cdef void _negloglikelihood(double[:, :, :] image, double[:] mu,
                             double[:] sigmasq, int classid,
-                            double[:, :, :, :] neglogl) noexcept nogil:
+                            double[:, :, :, :] neglogl,
+                            int num_threads) noexcept nogil:
     r""" Computes the gaussian negative log-likelihood of each class at
     each voxel of `image` assuming a gaussian distribution with means and
     variances given by `mu` and `sigmasq`, respectively (constant models
@@ -301,6 +330,8 @@ cdef void _negloglikelihood(double[:, :, :] image, double[:] mu,
     classid : int
         class identifier
     neglogl : buffer for the neg-loglikelihood
+    num_threads : int
+        number of threads sharing the slices of `image`
 
     Returns
     -------
@@ -316,7 +347,7 @@ cdef void _negloglikelihood(double[:, :, :] image, double[:] mu,
         double eps = 1e-8      # We assume images normalized to 0-1
         double eps_sq = 1e-16  # Maximum precision for double.
 
-    for x in range(nx):
+    for x in prange(nx, schedule="static", num_threads=num_threads):
         for y in range(ny):
             for z in range(nz):
 
@@ -338,7 +369,8 @@ cdef void _negloglikelihood(double[:, :, :] image, double[:] mu,
 cdef void _prob_image(double[:, :, :] image, double[:, :, :] gaussian,
                       double[:] mu, double[:] sigmasq, int classid,
                       double[:, :, :, :] P_L_N,
-                      double[:, :, :, :] P_L_Y) noexcept nogil:
+                      double[:, :, :, :] P_L_Y,
+                      int num_threads) noexcept nogil:
     r""" Conditional probability of the label given the image
 
     Parameters
@@ -360,6 +392,8 @@ cdef void _prob_image(double[:, :, :] image, double[:, :, :] gaussian,
         Previously computed by function prob_neighborhood
     P_L_Y : array
         4D buffer to hold P(L|Y)
+    num_threads : int
+        number of threads sharing the slices of `image`
 
     Returns
     -------
@@ -376,7 +410,7 @@ cdef void _prob_image(double[:, :, :] image, double[:, :, :] gaussian,
         double eps = 1e-8
         double eps_sq = 1e-16
 
-    for x in range(nx):
+    for x in prange(nx, schedule="static", num_threads=num_threads):
         for y in range(ny):
             for z in range(nz):
 
@@ -397,7 +431,7 @@ class IteratedConditionalModes:
     def __init__(self):
         pass
 
-    def initialize_maximum_likelihood(self, nloglike):
+    def initialize_maximum_likelihood(self, nloglike, *, num_threads=None):
         r""" Initializes the segmentation of an image with given
             neg-loglikelihood
 
@@ -411,20 +445,33 @@ class IteratedConditionalModes:
         nloglike : ndarray
             4D shape, nloglike[x, y, z, k] is the likelihhood of class k
             for voxel (x, y, z)
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
         seg : ndarray
             3D initial segmentation
         """
+        cdef int threads_to_use
         seg = np.zeros(nloglike.shape[:3]).astype(np.int16)
 
-        _initialize_maximum_likelihood(nloglike, seg)
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
+        _initialize_maximum_likelihood(nloglike, seg, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
 
         return seg
 
 
-    def icm_ising(self, nloglike, beta, seg):
+    def icm_ising(self, nloglike, beta, seg, *, red_black=False,
+                  num_threads=None):
         r""" Executes one iteration of the ICM algorithm for MRF MAP
         estimation. The prior distribution of the MRF is a Gibbs
         distribution with the Potts/Ising model with parameter `beta`:
@@ -442,6 +489,20 @@ class IteratedConditionalModes:
         seg : ndarray
             3D initial segmentation. This segmentation will change by one
             iteration of the ICM algorithm
+        red_black : bool, optional
+            If False (default), all the voxels are updated from the
+            neighborhood in `seg`. If True, the voxels are split in a
+            checkerboard: the voxels with an even ``x + y + z`` are updated
+            first, then the odd voxels are updated using the new labels of
+            their (even) neighbors, which is closer to the sequential ICM
+            updates.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
@@ -450,16 +511,64 @@ class IteratedConditionalModes:
         energy : ndarray
             3D final energy
         """
+        cdef int threads_to_use
         energy = np.zeros(nloglike.shape[:3]).astype(np.float64)
 
-        new_seg = np.zeros_like(seg)
-
-        _icm_ising(nloglike, beta, seg, energy, new_seg)
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
+        if red_black:
+            new_seg = np.array(seg, dtype=np.int16)
+            _icm_ising_red_black(nloglike, beta, new_seg, energy,
+                                 threads_to_use)
+        else:
+            new_seg = np.zeros_like(seg)
+            _icm_ising(nloglike, beta, seg, energy, new_seg, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
 
         return new_seg, energy
 
 
-    def prob_neighborhood(self, seg, beta, cnp.npy_intp nclasses):
+    def total_energy(self, energy, *, num_threads=None):
+        r""" Sum of the energy of all the voxels, ignoring -inf values
+
+        The sum of each slice is computed in parallel, and the slices are
+        added in order, so the result does not depend on the number of
+        threads.
+
+        Parameters
+        ----------
+        energy : ndarray
+            3D energy returned by `icm_ising`
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
+
+        Returns
+        -------
+        energy_sum : float
+            Total energy of the segmentation.
+        """
+        cdef:
+            int threads_to_use
+            double[:, :, :] energy_view = np.asarray(energy, dtype=np.float64)
+            double[:] slice_sums = np.zeros(energy.shape[0])
+
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
+        _slice_energy(energy_view, slice_sums, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
+
+        return float(np.sum(slice_sums))
+
+
+    def prob_neighborhood(self, seg, beta, cnp.npy_intp nclasses, *,
+                          num_threads=None):
         r""" Conditional probability of the label given the neighborhood
         Equation 2.18 of the Stan Z. Li book (Stan Z. Li, Markov Random Field
         Modeling in Image Analysis, 3rd ed., Advances in Pattern Recognition
@@ -475,6 +584,13 @@ class IteratedConditionalModes:
             Usually between 0 to 0.5
         nclasses : int
             number of tissue classes
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
@@ -485,18 +601,24 @@ class IteratedConditionalModes:
         cdef:
             double[:, :, :] P_L_N = np.zeros(seg.shape, dtype=np.float64)
             cnp.npy_intp classid = 0
+            int threads_to_use
 
         PLN_norm = np.zeros(seg.shape, dtype=np.float64)
         PLN = np.zeros(seg.shape + (nclasses,), dtype=np.float64)
 
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
         for classid in range(nclasses):
 
             P_L_N = np.zeros(seg.shape, dtype=np.float64)
-            _prob_class_given_neighb(seg, beta, classid, P_L_N)
+            _prob_class_given_neighb(seg, beta, classid, P_L_N,
+                                     threads_to_use)
 
             PLN[:, :, :, classid] = np.array(P_L_N)
             PLN[:, :, :, classid] = np.exp(- PLN[:, :, :, classid])
             PLN_norm += PLN[:, :, :, classid]
+        if num_threads is not None:
+            restore_default_num_threads()
 
         for l in range(nclasses):
             PLN[:, :, :, l] = PLN[:, :, :, l] / PLN_norm
@@ -505,7 +627,8 @@ class IteratedConditionalModes:
 
 
 cdef void _initialize_maximum_likelihood(double[:,:,:,:] nloglike,
-                                         cnp.npy_short[:,:,:] seg) noexcept nogil:
+                                         cnp.npy_short[:,:,:] seg,
+                                         int num_threads) noexcept nogil:
     r""" Initializes the segmentation of an image with given
     neg-log-likelihood.
 
@@ -521,6 +644,8 @@ cdef void _initialize_maximum_likelihood(double[:,:,:,:] nloglike,
         (x, y, z)
     seg : array
         3D buffer for the initial segmentation
+    num_threads : int
+        number of threads sharing the slices of `seg`
 
     Returns
     -------
@@ -532,14 +657,16 @@ cdef void _initialize_maximum_likelihood(double[:,:,:,:] nloglike,
         cnp.npy_intp ny = nloglike.shape[1]
         cnp.npy_intp nz = nloglike.shape[2]
         cnp.npy_intp nclasses = nloglike.shape[3]
+        cnp.npy_intp x, y, z, k
         double min_energy
         cnp.npy_short best_class
 
-    for x in range(nx):
+    for x in prange(nx, schedule="static", num_threads=num_threads):
         for y in range(ny):
             for z in range(nz):
 
                 best_class = -1
+                min_energy = NPY_INFINITY
                 for k in range(nclasses):
                     if (best_class == -1) or (nloglike[x, y, z, k] <
                                               min_energy):
@@ -548,9 +675,61 @@ cdef void _initialize_maximum_likelihood(double[:,:,:,:] nloglike,
                 seg[x, y, z] = best_class
 
 
+cdef inline cnp.npy_short _icm_voxel(double[:,:,:,:] nloglike, double beta,
+                                     cnp.npy_short[:,:,:] seg,
+                                     cnp.npy_intp x, cnp.npy_intp y,
+                                     cnp.npy_intp z,
+                                     double *energy) noexcept nogil:
+    r""" ICM update of voxel (x, y, z) given the labels of its neighbors
+
+    Returns the class of minimum energy and writes its energy to `energy`.
+    """
+    cdef:
+        cnp.npy_intp nneigh = 6
+        cnp.npy_intp* dX = [-1, 0, 0, 0,  0, 1]
+        cnp.npy_intp* dY = [0, -1, 0, 1,  0, 0]
+        cnp.npy_intp* dZ = [0,  0, 1, 0, -1, 0]
+        cnp.npy_intp nx = nloglike.shape[0]
+        cnp.npy_intp ny = nloglike.shape[1]
+        cnp.npy_intp nz = nloglike.shape[2]
+        cnp.npy_intp nclasses = nloglike.shape[3]
+        cnp.npy_intp xx, yy, zz, i, k
+        double min_energy = NPY_INFINITY
+        double this_energy = NPY_INFINITY
+        cnp.npy_short best_class = -1
+
+    for k in range(nclasses):
+        this_energy = nloglike[x, y, z, k]
+
+        for i in range(nneigh):
+            xx = x + dX[i]
+            if xx < 0 or xx >= nx:
+                continue
+            yy = y + dY[i]
+            if yy < 0 or yy >= ny:
+                continue
+            zz = z + dZ[i]
+            if zz < 0 or zz >= nz:
+                continue
+
+            if seg[xx, yy, zz] == k:
+                this_energy -= beta
+            else:
+                this_energy += beta
+
+        if this_energy < min_energy:
+
+            min_energy = this_energy
+            best_class = k
+
+    energy[0] = min_energy
+    return best_class
+
+
 cdef void _icm_ising(double[:,:,:,:] nloglike, double beta,
                      cnp.npy_short[:,:,:] seg, double[:,:,:] energy,
-                     cnp.npy_short[:,:,:] new_seg) noexcept nogil:
+                     cnp.npy_short[:,:,:] new_seg,
+                     int num_threads) noexcept nogil:
     r""" Executes one iteration of the ICM algorithm for MRF MAP estimation
     The prior distribution of the MRF is a Gibbs distribution with the
     Potts/Ising model with parameter `beta`:
@@ -572,6 +751,8 @@ cdef void _icm_ising(double[:,:,:,:] nloglike, double beta,
         3D buffer for the energy
     new_seg : array
         3D buffer for the final segmentation
+    num_threads : int
+        number of threads sharing the slices of `seg`
 
     Returns
     -------
@@ -582,56 +763,77 @@ cdef void _icm_ising(double[:,:,:,:] nloglike, double beta,
         iteration).
     """
     cdef:
-        cnp.npy_intp nneigh = 6
-        cnp.npy_intp* dX = [-1, 0, 0, 0,  0, 1]
-        cnp.npy_intp* dY = [0, -1, 0, 1,  0, 0]
-        cnp.npy_intp* dZ = [0,  0, 1, 0, -1, 0]
         cnp.npy_intp nx = nloglike.shape[0]
         cnp.npy_intp ny = nloglike.shape[1]
         cnp.npy_intp nz = nloglike.shape[2]
-        cnp.npy_intp nclasses = nloglike.shape[3]
-        cnp.npy_intp x, y, z, xx, yy, zz, i, j, k
-        double min_energy = NPY_INFINITY
-        double this_energy = NPY_INFINITY
-        cnp.npy_short best_class
+        cnp.npy_intp x, y, z
 
-    for x in range(nx):
+    for x in prange(nx, schedule="static", num_threads=num_threads):
         for y in range(ny):
             for z in range(nz):
+                new_seg[x, y, z] = _icm_voxel(nloglike, beta, seg, x, y, z,
+                                              &energy[x, y, z])
 
-                best_class = -1
-                min_energy = NPY_INFINITY
 
-                for k in range(nclasses):
-                    this_energy = nloglike[x, y, z, k]
-
-                    for i in range(nneigh):
-                        xx = x + dX[i]
-                        if xx < 0 or xx >= nx:
-                            continue
-                        yy = y + dY[i]
-                        if yy < 0 or yy >= ny:
-                            continue
-                        zz = z + dZ[i]
-                        if zz < 0 or zz >= nz:
-                            continue
-
-                        if seg[xx, yy, zz] == k:
-                            this_energy -= beta
-                        else:
-                            this_energy += beta
-
-                    if this_energy < min_energy:
-
-                        min_energy = this_energy
-                        best_class = k
+cdef void _icm_ising_red_black(double[:,:,:,:] nloglike, double beta,
+                               cnp.npy_short[:,:,:] seg, double[:,:,:] energy,
+                               int num_threads) noexcept nogil:
+    r""" One red-black (checkerboard) iteration of the ICM algorithm
+
+    The six neighbors of a voxel have the opposite parity of ``x + y + z``,
+    so all the voxels of one parity can be updated in place and in parallel.
+    The even voxels are updated first, then the odd voxels.
+
+    Parameters
+    ----------
+    nloglike : array
+        4D nloglike[x, y, z, k] is the negative log likelihood of class k
+        at voxel (x, y, z)
+    beta : float
+        positive scalar, it is the parameter of the Potts/Ising model.
+    seg : array
+        3D segmentation, updated in place
+    energy : array
+        3D buffer for the energy
+    num_threads : int
+        number of threads sharing the slices of `seg`
+    """
+    cdef:
+        cnp.npy_intp nx = nloglike.shape[0]
+        cnp.npy_intp ny = nloglike.shape[1]
+        cnp.npy_intp nz = nloglike.shape[2]
+        cnp.npy_intp x, y, z, color
+
+    for color in range(2):
+        for x in prange(nx, schedule="static", num_threads=num_threads):
+            for y in range(ny):
+                for z in range((x + y + color) % 2, nz, 2):
+                    seg[x, y, z] = _icm_voxel(nloglike, beta, seg, x, y, z,
+                                              &energy[x, y, z])
+
+
+cdef void _slice_energy(double[:, :, :] energy, double[:] slice_sums,
+                        int num_threads) noexcept nogil:
+    r""" Sum of the energy of each slice, ignoring -inf values """
+    cdef:
+        cnp.npy_intp nx = energy.shape[0]
+        cnp.npy_intp ny = energy.shape[1]
+        cnp.npy_intp nz = energy.shape[2]
+        cnp.npy_intp x, y, z
+        double acc
 
-                new_seg[x, y, z] = best_class
-                energy[x, y, z] = min_energy
+    for x in prange(nx, schedule="static", num_threads=num_threads):
+        acc = 0
+        for y in range(ny):
+            for z in range(nz):
+                if energy[x, y, z] > -NPY_INFINITY:
+                    acc = acc + energy[x, y, z]
+        slice_sums[x] = acc
 
 
 cdef void _prob_class_given_neighb(cnp.npy_short[:, :, :] seg, double beta,
-                                   int classid, double[:, :, :] P_L_N) noexcept nogil:
+                                   int classid, double[:, :, :] P_L_N,
+                                   int num_threads) noexcept nogil:
     r""" Conditional probability of the label given the neighborhood
     Equation 2.18 of the Stan Z. Li book.
 
@@ -648,6 +850,8 @@ cdef void _prob_class_given_neighb(cnp.npy_short[:, :, :] seg, double beta,
         tissue class identifier
     P_L_N : array
         buffer array for P(L|N)
+    num_threads : int
+        number of threads sharing the slices of `seg`
 
     Returns
     -------
@@ -661,13 +865,13 @@ cdef void _prob_class_given_neighb(cnp.npy_short[:, :, :] seg, double beta,
         cnp.npy_intp nz = seg.shape[2]
         cnp.npy_intp nneigh = 6
         cnp.npy_intp l = classid
-        cnp.npy_intp x, y, z, xx, yy, zz
+        cnp.npy_intp x, y, z, xx, yy, zz, i
         double vox_prob
         cnp.npy_intp* dX = [-1, 0, 0, 0,  0, 1]
         cnp.npy_intp* dY = [0, -1, 0, 1,  0, 0]
         cnp.npy_intp* dZ = [0,  0, 1, 0, -1, 0]
 
-    for x in range(nx):
+    for x in prange(nx, schedule="static", num_threads=num_threads):
         for y in range(ny):
             for z in range(nz):
 
@@ -685,8 +889,8 @@ cdef void _prob_class_given_neighb(cnp.npy_short[:, :, :] seg, double beta,
                         continue
 
                     if seg[xx, yy, zz] == l:
-                        vox_prob -= beta
+                        vox_prob = vox_prob - beta
                     else:
-                        vox_prob += beta
+                        vox_prob = vox_prob + beta
 
                 P_L_N[x, y, z] = vox_prob
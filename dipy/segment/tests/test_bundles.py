@@ -1,6 +1,7 @@
 import warnings
 
 import numpy as np
+import numpy.testing as npt
 from numpy.testing import assert_almost_equal, assert_equal
 
 from dipy.data import get_fnames
@@ -272,3 +273,59 @@ def test_rb_reduction_mam():
     # check if the bundle is recognized correctly
     for row in D:
         assert_equal(row.min(), 0)
+
+
+@set_random_number_generator(42)
+def test_rb_recognize_atlas(rng):
+    rb = RecoBundles(f, greater_than=0, clust_thr=10, rng=rng)
+    atlas = {"f2": f2, "f3": f3}
+
+    recognized = rb.recognize_atlas(
+        atlas, model_clust_thr=5.0, reduction_thr=10, slr=False
+    )
+    assert_equal(sorted(recognized.keys()), ["f2", "f3"])
+
+    # f2 and f3 were appended to the fornix in this order
+    expected = {
+        "f2": np.arange(len(f1), len(f1) + len(f2)),
+        "f3": np.arange(len(f1) + len(f2), len(f)),
+    }
+    for name, model in atlas.items():
+        rec_trans, rec_labels = recognized[name]
+        assert_equal(len(rec_trans), len(rec_labels))
+        npt.assert_(np.all(np.isin(rec_labels, expected[name])))
+        npt.assert_(len(rec_labels) >= 0.9 * len(model))
+
+    # The result does not depend on the number of concurrent jobs
+    rb_seq = RecoBundles(f, greater_than=0, clust_thr=10, rng=np.random.default_rng(7))
+    rb_par = RecoBundles(f, greater_than=0, clust_thr=10, rng=np.random.default_rng(7))
+    rec_seq = rb_seq.recognize_atlas([f2, f3], model_clust_thr=[5.0, 5.0], n_jobs=1)
+    slr_num_threads = []
+    register = rb_par._register_neighb_to_model
+
+    def register_and_record(*args, **kwargs):
+        slr_num_threads.append(kwargs["num_threads"])
+        return register(*args, **kwargs)
+
+    rb_par._register_neighb_to_model = register_and_record
+    rec_par = rb_par.recognize_atlas([f2, f3], model_clust_thr=5.0, n_jobs=2)
+    for (_, labels_seq), (_, labels_par) in zip(rec_seq, rec_par):
+        assert_equal(np.sort(labels_seq), np.sort(labels_par))
+    # Concurrent jobs run the SLR metric on a single thread
+    assert_equal(slr_num_threads, [1, 1])
+
+    # Bundle far from the tractogram is not found
+    far = f2.copy()
+    far._data += np.array([1000, 0, 0])
+    ((rec_trans, rec_labels),) = rb.recognize_atlas([far], model_clust_thr=5.0)
+    assert_equal(len(rec_trans), 0)
+    assert_equal(len(rec_labels), 0)
+
+    npt.assert_raises(ValueError, rb.recognize_atlas, [f2, f3], model_clust_thr=[5.0])
+    npt.assert_raises(
+        ValueError,
+        rb.recognize_atlas,
+        [f2],
+        model_clust_thr=5.0,
+        reduction_distance="xyz",
+    )
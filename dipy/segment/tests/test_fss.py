@@ -1,5 +1,7 @@
+import pickle
+
 import numpy as np
-from numpy.testing import assert_almost_equal, assert_raises
+from numpy.testing import assert_almost_equal, assert_equal, assert_raises
 
 from dipy.data import get_fnames
 from dipy.io.streamline import load_tractogram
@@ -167,3 +169,28 @@ def test_fss_invalid_mpts():
         nb_mpts=0,
         resampling=24,
     )
+
+
+def test_fss_threads_and_pickle(tmp_path):
+    r = 4.0
+    fss = FastStreamlineSearch(f1, max_radius=r, nb_mpts=4, bin_size=10.0)
+    res = fss.radius_search(f2, radius=r)
+
+    for n_jobs in [2, -1]:
+        res_threads = fss.radius_search(f2, radius=r, n_jobs=n_jobs)
+        assert_arrays_equal(res_threads.row, res.row)
+        assert_arrays_equal(res_threads.col, res.col)
+        assert_arrays_equal(res_threads.data, res.data)
+
+    # The index can be built once, saved and reused
+    fname = tmp_path / "fss.pkl"
+    with open(fname, "wb") as f:
+        pickle.dump(fss, f)
+    with open(fname, "rb") as f:
+        fss_loaded = pickle.load(f)
+
+    assert_equal(sorted(fss_loaded.bin_dict.keys()), sorted(fss.bin_dict.keys()))
+    res_loaded = fss_loaded.radius_search(f2, radius=r, n_jobs=2)
+    assert_arrays_equal(res_loaded.row, res.row)
+    assert_arrays_equal(res_loaded.col, res.col)
+    assert_arrays_equal(res_loaded.data, res.data)
@@ -0,0 +1,75 @@
+import numpy as np
+from numpy.testing import (
+    assert_array_almost_equal,
+    assert_array_equal,
+    assert_equal,
+    assert_raises,
+)
+
+from dipy.data import get_fnames
+from dipy.io.streamline import load_tractogram
+from dipy.segment.lsh import StreamlineLSH, flip_invariant_embedding
+from dipy.tracking.distances import bundles_distances_mdf
+from dipy.tracking.streamline import Streamlines, set_number_of_points
+
+
+def setup_module():
+    global fornix
+    fname = get_fnames(name="fornix")
+    fornix = Streamlines(
+        load_tractogram(fname, "same", bbox_valid_check=False).streamlines
+    )
+
+
+def test_flip_invariant_embedding():
+    emb = flip_invariant_embedding(fornix, nb_points=12)
+    emb_flip = flip_invariant_embedding([s[::-1] for s in fornix], nb_points=12)
+    assert_equal(emb.shape, (len(fornix), 18))
+    assert_array_almost_equal(emb, emb_flip, decimal=4)
+
+    # The mean distance between midpoints is a lower bound of the MDF
+    resampled = set_number_of_points(fornix[:50], nb_points=12)
+    mdf = bundles_distances_mdf(resampled, resampled)
+    mid = emb[:50].reshape((50, 6, 3)) * np.sqrt(6)
+    mean_dist = np.mean(np.linalg.norm(mid[:, None] - mid[None, :], axis=-1), axis=-1)
+    assert_equal(np.all(mean_dist <= mdf + 1e-4), True)
+
+
+def test_streamline_lsh():
+    rng = np.random.default_rng(42)
+    index = StreamlineLSH(fornix, bucket_width=12.0, nb_tables=16, rng=rng)
+    resampled = set_number_of_points(fornix, nb_points=12)
+    mdf = bundles_distances_mdf(resampled, resampled)
+
+    # Each streamline is its own nearest neighbor, even when flipped
+    ids, dist = index.knn_search(fornix, k=3)
+    assert_array_equal(ids[:, 0], np.arange(len(fornix)))
+    assert_array_almost_equal(dist[:, 0], 0, decimal=4)
+    ids_flip, _ = index.knn_search([s[::-1] for s in fornix], k=1)
+    assert_array_equal(ids_flip[:, 0], np.arange(len(fornix)))
+
+    # Distances are exact and sorted, recall is high
+    found = ids >= 0
+    rows = np.repeat(np.arange(len(fornix))[:, None], 3, axis=1)
+    assert_array_almost_equal(dist[found], mdf[rows[found], ids[found]], decimal=4)
+    assert_equal(np.all(np.diff(dist, axis=1) >= 0), True)
+    exact = np.argsort(mdf, axis=1)[:, :3]
+    recall = np.mean([len(set(a) & set(b)) / 3 for a, b in zip(ids, exact)])
+    assert_equal(recall > 0.8, True)
+
+    # Radius search returns a subset of the exact neighbors
+    res = index.radius_search(fornix, 5.0, chunk_size=100)
+    assert_equal(res.shape, (len(fornix), len(fornix)))
+    assert_array_almost_equal(res.data, mdf[res.row, res.col], decimal=4)
+    assert_equal(np.all(res.data < 5.0), True)
+    assert_equal(res.nnz > 0.8 * np.sum(mdf < 5.0), True)
+
+    # Far away queries have no neighbors
+    far = [s + 1000 for s in fornix[:5]]
+    assert_equal(index.radius_search(far, 5.0).nnz, 0)
+    ids, dist = index.knn_search(far, k=2)
+    assert_array_equal(ids, -1)
+    assert_equal(np.all(np.isinf(dist)), True)
+
+    assert_raises(ValueError, StreamlineLSH, fornix, bucket_width=0)
+    assert_raises(ValueError, StreamlineLSH, fornix, nb_tables=0)
@@ -421,3 +421,55 @@ def test_classify():
     npt.assert_(seg_final.min() == 0.0)
 
     npt.assert_(imgseg.energies_sum[0] > imgseg.energies_sum[-1])
+
+
+@set_random_number_generator()
+def test_icm_red_black_and_threads(rng):
+    nclasses = 4
+    beta = 0.5
+
+    com = ConstantObservationModel()
+    icm = IteratedConditionalModes()
+
+    square_seg = create_square()
+    square_1 = create_square_uniform(rng)
+    mu, sigma = com.seg_stats(square_1, square_seg, nclasses)
+    negll = com.negloglikelihood(square_1, mu, sigma**2, nclasses)
+    seg_init = icm.initialize_maximum_likelihood(negll)
+
+    # Results do not depend on the number of threads
+    seg_1, energy_1 = icm.icm_ising(negll, beta, seg_init, num_threads=1)
+    seg_2, energy_2 = icm.icm_ising(negll, beta, seg_init, num_threads=2)
+    npt.assert_array_equal(seg_1, seg_2)
+    npt.assert_array_equal(energy_1, energy_2)
+    npt.assert_equal(
+        icm.total_energy(energy_1, num_threads=1),
+        icm.total_energy(energy_1, num_threads=2),
+    )
+    npt.assert_almost_equal(icm.total_energy(energy_1), np.sum(energy_1))
+    for num_threads in [1, 2]:
+        npt.assert_array_equal(
+            com.negloglikelihood(
+                square_1, mu, sigma**2, nclasses, num_threads=num_threads
+            ),
+            negll,
+        )
+
+    # The even voxels are updated as in a regular ICM step, then the odd
+    # voxels see their updated neighbors
+    seg_rb, energy_rb = icm.icm_ising(negll, beta, seg_init, red_black=True)
+    even = np.indices(seg_init.shape).sum(axis=0) % 2 == 0
+    npt.assert_array_equal(seg_rb[even], seg_1[even])
+    npt.assert_array_equal(energy_rb[even], energy_1[even])
+    seg_odd, energy_odd = icm.icm_ising(negll, beta, np.where(even, seg_1, seg_init))
+    npt.assert_array_equal(seg_rb[~even], seg_odd[~even])
+    npt.assert_array_equal(energy_rb[~even], energy_odd[~even])
+    # The initial segmentation is not modified
+    npt.assert_array_equal(seg_init, icm.initialize_maximum_likelihood(negll))
+
+    imgseg = TissueClassifierHMRF(verbose=False)
+    _, seg_final, _ = imgseg.classify(
+        create_image(), 3, 0.1, max_iter=5, red_black=True, num_threads=2
+    )
+    npt.assert_equal(seg_final.min(), 0)
+    npt.assert_equal(seg_final.max(), 3)
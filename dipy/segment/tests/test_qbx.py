@@ -233,3 +233,69 @@ def test_qbx_and_merge(rng):
     # check that refdata clusters return streamlines in qbx_and_merge
     streamline_idx = qbxm_clusters[0].indices[0]
     assert_array_equal(qbxm_clusters[0][0], streamlines[streamline_idx])
+
+
+def test_qbx_partial_fit_save_load(tmp_path):
+    streamlines = Streamlines()
+    for bundle in bearing_bundles(4, 2):
+        bundle += (10, 0, 0)
+        streamlines.extend(bundle)
+    streamlines = list(streamlines)
+    thresholds = [10, 2, 1]
+
+    qbx = QuickBundlesX(thresholds)
+    tree = qbx.cluster(streamlines)
+
+    # Adding the streamlines in chunks gives the same tree.
+    qbx_online = QuickBundlesX(thresholds)
+    qbx_online.partial_fit(streamlines[:150]).partial_fit(streamlines[150:250])
+    assert_equal(qbx_online.nb_streamlines, 250)
+
+    # Saving and reloading does not change the tree and it can be extended.
+    fname = tmp_path / "qbx.npz"
+    qbx_online.save(fname)
+    qbx_loaded = QuickBundlesX.load(fname)
+    assert_equal(qbx_loaded.nb_streamlines, 250)
+    assert_equal(qbx_loaded.thresholds, thresholds)
+    qbx_loaded.partial_fit(streamlines[250:])
+    qbx_online.partial_fit(streamlines[250:])
+
+    for online in [qbx_online, qbx_loaded]:
+        online_tree = online.get_tree_cluster_map()
+        for level in range(len(thresholds) + 1):
+            clusters = tree.get_clusters(level)
+            online_clusters = online_tree.get_clusters(level)
+            assert_equal(len(online_clusters), len(clusters))
+            for cluster, online_cluster in zip(clusters, online_clusters):
+                assert_array_equal(online_cluster.indices, cluster.indices)
+                assert_array_equal(online_cluster.centroid, cluster.centroid)
+
+    # Each streamline is closest to the clusters it belongs to.
+    labels, dists = qbx_loaded.query(streamlines)
+    assert_equal(labels.shape, (len(streamlines), len(thresholds)))
+    for level in range(1, len(thresholds) + 1):
+        clusters = tree.get_clusters(level)
+        for i in range(0, len(streamlines), 37):
+            if labels[i, level - 1] >= 0:
+                assert_equal(dists[i, level - 1] <= thresholds[level - 1], True)
+        members = [set(cluster.indices) for cluster in clusters]
+        found = [i in members[labels[i, level - 1]] for i in range(len(streamlines))]
+        assert_equal(np.mean(found) > 0.9, True)
+
+    labels_loaded = labels
+
+    far = [streamlines[0] + 1000]
+    labels, dists = qbx_loaded.query(far)
+    assert_array_equal(labels, -np.ones((1, len(thresholds))))
+    assert_equal(np.all(np.isinf(dists)), True)
+
+    assert_raises(ValueError, QuickBundlesX(thresholds).query, streamlines)
+    assert_raises(ValueError, QuickBundlesX(thresholds).save, fname)
+
+    # The filename is used as is, even without the .npz extension.
+    fname = tmp_path / "qbx_tree"
+    qbx_loaded.save(fname)
+    assert_equal(fname.exists(), True)
+    qbx_reloaded = QuickBundlesX.load(fname)
+    assert_equal(qbx_reloaded.nb_streamlines, qbx_loaded.nb_streamlines)
+    assert_array_equal(qbx_reloaded.query(streamlines)[0], labels_loaded)
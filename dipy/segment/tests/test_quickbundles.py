@@ -202,3 +202,79 @@ def test_quickbundles_memory_leaks():
     qb.cluster(data)
     # At this point, all memoryviews created during clustering should be freed.
     assert_equal(get_type_refcount(type_name_pattern), initial_types_refcount)
+
+
+@set_random_number_generator(42)
+def test_quickbundles_arraysequence_and_threads(rng):
+    # Many small clusters so the parallel assignment step is used.
+    nb_streamlines = 2000
+    streamlines = streamline_utils.Streamlines(
+        [
+            rng.uniform(-100, 100, size=(1, 3)) + rng.normal(size=(n, 3))
+            for n in rng.integers(5, 20, size=nb_streamlines)
+        ]
+    )
+    ordering = rng.permutation(nb_streamlines)
+
+    qb = QuickBundles(threshold=5.0, num_threads=1)
+    clusters_list = qb.cluster(list(streamlines), ordering=ordering)
+    expected_indices = [cluster.indices for cluster in clusters_list]
+    assert_equal(len(clusters_list) > 200, True)
+
+    for num_threads in [1, 2, 4]:
+        qb = QuickBundles(threshold=5.0, num_threads=num_threads)
+        clusters = qb.cluster(streamlines, ordering=ordering)
+        assert_equal(len(clusters), len(clusters_list))
+        assert_equal([cluster.indices for cluster in clusters], expected_indices)
+        assert_arrays_equal(clusters.centroids, clusters_list.centroids)
+
+    # float64 and read-only buffers are cast once
+    streamlines64 = streamline_utils.Streamlines(streamlines)
+    streamlines64._data = streamlines64._data.astype(np.float64)
+    streamlines64._data.setflags(write=False)
+    clusters = QuickBundles(threshold=5.0).cluster(streamlines64, ordering=ordering)
+    assert_equal([cluster.indices for cluster in clusters], expected_indices)
+
+    assert_raises(
+        IndexError,
+        QuickBundles(threshold=5.0).cluster,
+        streamlines,
+        ordering=[0, nb_streamlines],
+    )
+
+
+@set_random_number_generator(3)
+def test_quickbundles_spatial_index(rng):
+    streamlines = streamline_utils.Streamlines(
+        [
+            rng.uniform(-100, 100, size=(1, 3))
+            + np.cumsum(rng.normal(size=(20, 3)), axis=0)
+            for _ in range(2000)
+        ]
+    )
+
+    for max_nb_clusters in [None, 50]:
+        clusters = QuickBundles(
+            threshold=10.0, max_nb_clusters=max_nb_clusters
+        ).cluster(streamlines)
+        clusters_grid = QuickBundles(
+            threshold=10.0, max_nb_clusters=max_nb_clusters, spatial_index=True
+        ).cluster(streamlines)
+
+        assert_equal(len(clusters_grid), len(clusters))
+        for cluster, cluster_grid in zip(clusters, clusters_grid):
+            assert_array_equal(cluster_grid.indices, cluster.indices)
+            # Centroids are the same up to their orientation.
+            dist = min(
+                np.abs(cluster_grid.centroid - cluster.centroid).max(),
+                np.abs(cluster_grid.centroid[::-1] - cluster.centroid).max(),
+            )
+            assert_equal(dist < 1e-4, True)
+
+    # The grid is not used for metrics without a barycenter lower bound.
+    metric = dipysmetric.CosineMetric(dipysfeature.VectorOfEndpointsFeature())
+    clusters = QuickBundles(threshold=0.1, metric=metric).cluster(streamlines)
+    clusters_grid = QuickBundles(
+        threshold=0.1, metric=metric, spatial_index=True
+    ).cluster(streamlines)
+    assert_equal([c.indices for c in clusters_grid], [c.indices for c in clusters])
@@ -26,7 +26,17 @@ class TissueClassifierHMRF:
         self.verbose = verbose
 
     @warning_for_keywords()
-    def classify(self, image, nclasses, beta, *, tolerance=1e-05, max_iter=100):
+    def classify(
+        self,
+        image,
+        nclasses,
+        beta,
+        *,
+        tolerance=1e-05,
+        max_iter=100,
+        red_black=False,
+        num_threads=None,
+    ):
         """
         This method uses the Maximum a posteriori - Markov Random Field
         approach for segmentation by using the Iterative Conditional Modes
@@ -54,6 +64,18 @@ class TissueClassifierHMRF:
             explicitly set to 0, this early stopping mechanism is disabled,
             and the algorithm will run for the specified number of
             iterations unless another stopping criterion is met.
+        red_black : bool, optional
+            Whether the ICM step updates the voxels in two checkerboard
+            passes, each voxel seeing the labels already updated in its
+            neighborhood. See
+            :meth:`dipy.segment.mrf.IteratedConditionalModes.icm_ising`.
+        num_threads : int, optional
+            Number of threads to be used for OpenMP parallelization. If None
+            (default) the value of OMP_NUM_THREADS environment variable is
+            used if it is set, otherwise all available threads are used. If
+            < 0 the maximal number of threads minus $|num_threads + 1|$ is
+            used (enter -1 to use as many threads as possible). 0 raises an
+            error.
 
         Returns
         -------
@@ -66,6 +88,7 @@ class TissueClassifierHMRF:
         """
         nclasses += 1  # One extra class for the background
         energy_sum = [1e-05]
+        e_min = e_max = energy_sum[0]
 
         com = ConstantObservationModel()
         icm = IteratedConditionalModes()
@@ -78,8 +101,10 @@ class TissueClassifierHMRF:
         mu = mu[p]
         sigmasq = sigmasq[p]
 
-        neglogl = com.negloglikelihood(image, mu, sigmasq, nclasses)
-        seg_init = icm.initialize_maximum_likelihood(neglogl)
+        neglogl = com.negloglikelihood(
+            image, mu, sigmasq, nclasses, num_threads=num_threads
+        )
+        seg_init = icm.initialize_maximum_likelihood(neglogl, num_threads=num_threads)
 
         mu, sigmasq = com.seg_stats(image, seg_init, nclasses)
 
@@ -94,18 +119,26 @@ class TissueClassifierHMRF:
             if self.verbose:
                 logger.info(f">> Iteration: {i}")
 
-            PLN = icm.prob_neighborhood(seg_init, beta, nclasses)
-            PVE = com.prob_image(image_gauss, nclasses, mu, sigmasq, PLN)
+            PLN = icm.prob_neighborhood(
+                seg_init, beta, nclasses, num_threads=num_threads
+            )
+            PVE = com.prob_image(
+                image_gauss, nclasses, mu, sigmasq, PLN, num_threads=num_threads
+            )
 
             mu_upd, sigmasq_upd = com.update_param(image_gauss, PVE, mu, nclasses)
             ind = np.argsort(mu_upd)
             mu_upd = mu_upd[ind]
             sigmasq_upd = sigmasq_upd[ind]
 
-            negll = com.negloglikelihood(image_gauss, mu_upd, sigmasq_upd, nclasses)
-            final_segmentation, energy = icm.icm_ising(negll, beta, seg_init)
+            negll = com.negloglikelihood(
+                image_gauss, mu_upd, sigmasq_upd, nclasses, num_threads=num_threads
+            )
+            final_segmentation, energy = icm.icm_ising(
+                negll, beta, seg_init, red_black=red_black, num_threads=num_threads
+            )
 
-            energy_sum.append(energy[energy > -np.inf].sum())
+            energy_sum.append(icm.total_energy(energy, num_threads=num_threads))
 
             if self.save_history:
                 self.segmentations.append(final_segmentation)
@@ -113,12 +146,14 @@ class TissueClassifierHMRF:
                 self.energies.append(energy)
                 self.energies_sum.append(energy_sum[-1])
 
+            # The range of the history is updated in O(1) per iteration
+            e_min = min(e_min, energy_sum[-1])
+            e_max = max(e_max, energy_sum[-1])
             if tolerance > 0 and i > 5:
-                e_sum = np.asarray(energy_sum)
-                tol = tolerance * (np.amax(e_sum) - np.amin(e_sum))
+                tol = tolerance * (e_max - e_min)
 
-                e_end = e_sum[-5:]
-                test_dist = np.abs(np.amax(e_end) - np.amin(e_end))
+                e_end = energy_sum[-5:]
+                test_dist = abs(max(e_end) - min(e_end))
 
                 if test_dist < tol:
                     break
@@ -1,9 +1,8 @@
 from pathlib import Path
 
+from nibabel.affines import apply_affine
 import numpy as np
-from scipy.ndimage import map_coordinates
 from scipy.spatial import cKDTree
-from scipy.spatial.distance import mahalanobis
 
 from dipy.io.utils import save_buan_profiles_hdf5
 from dipy.segment.clustering import QuickBundles
@@ -17,6 +16,126 @@ from dipy.tracking.streamline import (
 )
 
 
+def _trilinear_sampler(points, shape, *, pad=False):
+    """Corners and weights of the trilinear interpolation of `points`
+
+    By default, follows ``scipy.ndimage.map_coordinates(..., order=1)``:
+    points outside of the volume get a value of 0. With `pad`, follows
+    :func:`dipy.core.interpolation.interpolate_scalar_3d`, where the volume
+    is padded with zeros, so points less than one voxel away from the
+    volume get partial values.
+
+    Returns
+    -------
+    indices : array (8, N)
+        Linear index of the 8 voxels surrounding each point.
+    weights : array (8, N)
+        Interpolation weight of each voxel, 0 for voxels outside the volume.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+    shape = np.asarray(shape[:3])
+    if pad:
+        inside = np.all((points > -1) & (points < shape), axis=1)
+        low = np.floor(np.where(inside[:, None], points, 0)).astype(np.intp)
+        high = low + 1
+    else:
+        inside = np.all((points >= 0) & (points <= shape - 1), axis=1)
+        low = np.where(inside[:, None], np.floor(points), 0)
+        low = np.clip(low, 0, np.maximum(shape - 2, 0)).astype(np.intp)
+        high = np.minimum(low + 1, shape - 1)
+    frac = points - low
+
+    indices = np.empty((8, len(points)), dtype=np.intp)
+    weights = np.empty((8, len(points)))
+    for corner in range(8):
+        upper = [(corner >> axis) & 1 for axis in range(3)]
+        idx = np.where(upper, high, low)
+        valid = inside & np.all((idx >= 0) & (idx < shape), axis=1)
+        indices[corner] = np.ravel_multi_index(idx.T, tuple(shape), mode="clip")
+        weights[corner] = np.prod(np.where(upper, frac, 1 - frac), axis=1)
+        weights[corner, ~valid] = 0
+    return indices, weights
+
+
+def buan_profiles(bundle, metrics, ind, subject, group_id):
+    """Samples several metrics on every point of a bundle.
+
+    The assignment of the points to the disks and the interpolation weights
+    are computed once and shared by all the metrics.
+
+    See :footcite:p:`Chandio2020a` for further details about the method.
+
+    Parameters
+    ----------
+    bundle : Streamlines
+        Bundle in the voxel space of the metrics.
+    metrics : dict
+        3D volume of each metric, e.g. ``{"fa": fa, "md": md}``.
+    ind : integer list
+        ind tells which disk number a point belong, see
+        :func:`assignment_map`.
+    subject : string
+        subject number as a string (e.g. 10001)
+    group_id : integer
+        which group subject belongs to 1 for patient and 0 control
+
+    Returns
+    -------
+    profiles : dict
+        Columns of the profile table, one row per point: ``streamline``,
+        ``disk``, ``subject``, ``group`` and one column per metric.
+
+    References
+    ----------
+    .. footbibliography::
+
+    """
+    points = bundle.get_data()
+    nb_points = len(points)
+    profiles = {
+        "streamline": np.repeat(np.arange(len(bundle)), bundle._lengths),
+        "disk": np.asarray(ind)[:nb_points] + 1,
+        "subject": np.full(nb_points, subject),
+        "group": np.full(nb_points, group_id),
+    }
+
+    if len(metrics) > 0:
+        shape = next(iter(metrics.values())).shape
+        indices, weights = _trilinear_sampler(points, shape)
+
+    for pname, metric in metrics.items():
+        if metric.shape[:3] != shape[:3]:
+            raise ValueError("All metrics need to have the same shape")
+        dtype = metric.dtype if np.issubdtype(metric.dtype, np.floating) else float
+        values = np.sum(weights * metric.ravel()[indices], axis=0)
+        profiles[pname] = values.astype(dtype)
+
+    return profiles
+
+
+def save_buan_profiles(profiles, bname, dir_name):
+    """Saves each metric of a profile table in its own hd5 file.
+
+    Parameters
+    ----------
+    profiles : dict
+        Profile table, see :func:`buan_profiles`.
+    bname : string
+        Name of bundle being analyzed.
+    dir_name : string
+        path of output directory
+
+    """
+    columns = ["streamline", "disk", "subject", "group"]
+    common = {col: profiles[col] for col in columns}
+    for pname in profiles:
+        if pname in columns:
+            continue
+        dt = dict(common)
+        dt[pname] = profiles[pname]
+        save_buan_profiles_hdf5(Path(dir_name) / f"{bname}_{pname}", dt)
+
+
 def peak_values(bundle, peaks, dt, pname, bname, subject, group_id, ind, dir_name):
     """Peak_values function finds the generalized fractional anisotropy (gfa)
         and quantitative anisotropy (qa) values from peaks object (eg: csa) for
@@ -46,15 +165,10 @@ def peak_values(bundle, peaks, dt, pname, bname, subject, group_id, ind, dir_nam
 
     """
 
-    gfa = peaks.gfa
-    anatomical_measures(
-        bundle, gfa, dt, pname + "_gfa", bname, subject, group_id, ind, dir_name
-    )
-
-    qa = peaks.qa[..., 0]
-    anatomical_measures(
-        bundle, qa, dt, pname + "_qa", bname, subject, group_id, ind, dir_name
-    )
+    metrics = {pname + "_gfa": peaks.gfa, pname + "_qa": peaks.qa[..., 0]}
+    profiles = buan_profiles(bundle, metrics, ind, subject, group_id)
+    dt.update(profiles)
+    save_buan_profiles(profiles, bname, dir_name)
 
 
 def anatomical_measures(
@@ -84,27 +198,14 @@ def anatomical_measures(
     dir_name : string
         path of output directory
 
-    """
-    dt["streamline"] = []
-    dt["disk"] = []
-    dt["subject"] = []
-    dt[pname] = []
-    dt["group"] = []
-
-    values = map_coordinates(metric, bundle._data.T, order=1)
-
-    dt["disk"].extend(ind[list(range(len(values)))] + 1)
-    dt["subject"].extend([subject] * len(values))
-    dt["group"].extend([group_id] * len(values))
-    dt[pname].extend(values)
-
-    for st_i in range(len(bundle)):
-        st = bundle[st_i]
-        dt["streamline"].extend([st_i] * len(st))
-
-    file_name = f"{bname}_{pname}"
+    See Also
+    --------
+    buan_profiles : Samples several metrics at once.
 
-    save_buan_profiles_hdf5(Path(dir_name) / file_name, dt)
+    """
+    profiles = buan_profiles(bundle, {pname: metric}, ind, subject, group_id)
+    dt.update(profiles)
+    save_buan_profiles(profiles, bname, dir_name)
 
 
 def assignment_map(target_bundle, model_bundle, no_disks):
@@ -205,19 +306,18 @@ def gaussian_weights(bundle, *, n_points=100, return_mahalnobis=False, stat=np.m
         # Calculate the mean or median of this node as well
         # delta = node_coords - np.mean(node_coords, 0)
         m = stat(node_coords, 0)
-        # Weights are the inverse of the Mahalanobis distance
-        for fn in range(len(bundle)):
-            # In the special case where all the streamlines have the exact same
-            # coordinate in this node, the covariance matrix is all zeros, so
-            # we can't calculate the Mahalanobis distance, we will instead give
-            # each streamline an identical weight, equal to the number of
-            # streamlines:
-            if np.allclose(c, 0):
-                w[:, node] = len(bundle)
-                break
-            # Otherwise, go ahead and calculate Mahalanobis for node on
-            # fiber[fn]:
-            w[fn, node] = mahalanobis(node_coords[fn], m, np.linalg.inv(c))
+        # In the special case where all the streamlines have the exact same
+        # coordinate in this node, the covariance matrix is all zeros, so
+        # we can't calculate the Mahalanobis distance, we will instead give
+        # each streamline an identical weight, equal to the number of
+        # streamlines:
+        if np.allclose(c, 0):
+            w[:, node] = len(bundle)
+            continue
+        # Otherwise, go ahead and calculate Mahalanobis for node on every
+        # fiber at once. Weights are the inverse of the Mahalanobis distance
+        delta = node_coords - m
+        w[:, node] = np.sqrt(np.sum((delta @ np.linalg.inv(c)) * delta, axis=1))
     if return_mahalnobis:
         return w
     # weighting is inverse to the distance (the further you are, the less you
@@ -317,3 +417,115 @@ def afq_profile(
         return profile_stat(values, weights=weights, axis=0)
     else:
         return profile_stat(values, axis=0)
+
+
+@warning_for_keywords()
+def afq_profiles(
+    data,
+    bundles,
+    affine,
+    *,
+    n_points=100,
+    profile_stat=np.average,
+    orient_by=None,
+    weights=None,
+    **weights_kwarg,
+):
+    """
+    Calculates the profiles of several scalar maps along several bundles.
+
+    Equivalent to calling :func:`afq_profile` for every bundle and every
+    scalar map, but the orientation, resampling and weights of a bundle are
+    computed once, and all the scalar maps are sampled in a single
+    interpolation pass.
+
+    Parameters
+    ----------
+    data : 4D volume or sequence of 3D volumes
+        The statistics to sample with the streamlines, stacked along the last
+        dimension.
+    bundles : sequence of Streamlines
+        The bundles to profile. See Note in :func:`afq_profile` about
+        orienting the streamlines.
+    affine : array_like (4, 4)
+        The mapping from voxel coordinates to streamline points.
+        The voxel_to_rasmm matrix, typically from a NIFTI file.
+    n_points: int, optional
+        The number of points to sample along the bundles.
+    profile_stat : callable, optional
+        The statistic used to average the profile across streamlines.
+        If weights is not None, this must take weights as a keyword argument.
+    orient_by: streamline or sequence of streamlines, optional
+        A streamline to use as a standard to orient all of the streamlines in
+        the bundles according to, or one streamline (or None) per bundle.
+    weights : callable or sequence of arrays, optional
+        A function that calculates the weights of a bundle, or the 1D or 2D
+        weights of each bundle (see :func:`afq_profile`).
+    weights_kwarg : key-word arguments
+        Additional key-word arguments to pass to the weight-calculating
+        function. Only to be used if weights is a callable.
+
+    Returns
+    -------
+    profiles : ndarray (n_bundles, n_metrics, n_points)
+        The profile of every scalar map along every bundle.
+
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 3:
+        data = data[..., None]
+    elif not isinstance(data, np.ndarray):
+        data = np.stack(data, axis=-1)
+    if data.ndim != 4:
+        raise ValueError("Data needs to have 3 or 4 dimensions")
+    if affine is None:
+        affine = np.eye(4)
+    if orient_by is None or (isinstance(orient_by, np.ndarray) and orient_by.ndim == 2):
+        orient_by = [orient_by] * len(bundles)
+    if weights is None or callable(weights):
+        weights = [weights] * len(bundles)
+    if len(orient_by) != len(bundles) or len(weights) != len(bundles):
+        raise ValueError("orient_by and weights need one entry per bundle")
+
+    n_metrics = data.shape[-1]
+    # Only the sampled values are converted to float64, not the whole stack
+    stack = data.reshape((-1, n_metrics))
+    inv_affine = np.linalg.inv(affine)
+
+    profiles = np.zeros((len(bundles), n_metrics, n_points))
+    for i, bundle in enumerate(bundles):
+        if orient_by[i] is not None:
+            bundle = orient_by_streamline(bundle, orient_by[i])
+        if len(bundle) == 0:
+            raise ValueError(f"The bundle {i} contains no streamlines")
+
+        # Resample each streamline to the same number of points:
+        fgarray = set_number_of_points(bundle, nb_points=n_points)
+        if isinstance(fgarray, Streamlines):
+            points = fgarray.get_data()
+        else:
+            points = np.concatenate(fgarray)
+
+        # Sample every scalar map at once
+        points = apply_affine(inv_affine, points)
+        indices, corner_weights = _trilinear_sampler(points, data.shape, pad=True)
+        values = np.zeros((len(points), n_metrics))
+        for corner in range(8):
+            corner_values = np.asarray(stack[indices[corner]], dtype=np.float64)
+            values += corner_weights[corner][:, None] * corner_values
+        values = values.reshape((len(bundle), n_points, n_metrics))
+
+        bundle_weights = weights[i]
+        if bundle_weights is None:
+            for m in range(n_metrics):
+                profiles[i, m] = profile_stat(values[..., m], axis=0)
+            continue
+        if callable(bundle_weights):
+            bundle_weights = bundle_weights(bundle, **weights_kwarg)
+        elif not np.allclose(np.sum(bundle_weights, 0), np.ones(n_points)):
+            raise ValueError("The sum of weights across streamlines must be equal to 1")
+        for m in range(n_metrics):
+            profiles[i, m] = profile_stat(
+                values[..., m], weights=bundle_weights, axis=0
+            )
+
+    return profiles
@@ -1,7 +1,14 @@
 import numpy as np
 import numpy.testing as npt
-
-from dipy.stats.analysis import afq_profile, gaussian_weights
+from scipy.ndimage import map_coordinates
+
+from dipy.stats.analysis import (
+    afq_profile,
+    afq_profiles,
+    buan_profiles,
+    gaussian_weights,
+)
+from dipy.testing.decorators import set_random_number_generator
 from dipy.tracking.streamline import Streamlines
 
 
@@ -135,3 +142,79 @@ def test_afq_profile():
     # Test for error-handling:
     empty_bundle = Streamlines([])
     npt.assert_raises(ValueError, afq_profile, data, empty_bundle, np.eye(4))
+
+
+@set_random_number_generator()
+def test_buan_profiles(rng):
+    fa = rng.random((10, 12, 8))
+    md = rng.random((10, 12, 8)).astype(np.float32)
+    bundle = Streamlines(
+        [rng.uniform(-1, 12, size=(rng.integers(2, 20), 3)) for _ in range(15)]
+    )
+    ind = rng.integers(0, 5, size=len(bundle.get_data()))
+
+    profiles = buan_profiles(bundle, {"fa": fa, "md": md}, ind, "10001", 1)
+    nb_points = len(bundle.get_data())
+    for col in ["streamline", "disk", "subject", "group", "fa", "md"]:
+        npt.assert_equal(len(profiles[col]), nb_points)
+
+    npt.assert_array_equal(profiles["disk"], ind + 1)
+    npt.assert_array_equal(profiles["subject"], ["10001"] * nb_points)
+    npt.assert_array_equal(profiles["group"], np.ones(nb_points))
+    expected = np.concatenate([[i] * len(s) for i, s in enumerate(bundle)])
+    npt.assert_array_equal(profiles["streamline"], expected)
+
+    # Same values as interpolating each metric on its own
+    for pname, metric in [("fa", fa), ("md", md)]:
+        values = map_coordinates(metric, bundle.get_data().T, order=1)
+        npt.assert_equal(profiles[pname].dtype, metric.dtype)
+        npt.assert_allclose(profiles[pname], values, rtol=1e-6)
+
+    npt.assert_raises(
+        ValueError, buan_profiles, bundle, {"fa": fa, "b": fa[1:]}, ind, "1", 0
+    )
+
+
+@set_random_number_generator()
+def test_afq_profiles(rng):
+    fa = rng.random((10, 12, 8))
+    md = rng.random((10, 12, 8))
+    affine = np.eye(4)
+    affine[:3, 3] = [-1, 2, 0.5]
+    bundles = [
+        Streamlines(
+            [
+                np.linspace(rng.uniform(-1, 2, 3), rng.uniform(6, 9, 3), 15)
+                for _ in range(n)
+            ]
+        )
+        for n in [5, 8]
+    ]
+    orient_by = [bundles[0][0], None]
+
+    for weights in [None, gaussian_weights]:
+        profiles = afq_profiles(
+            [fa, md], bundles, affine, orient_by=orient_by, weights=weights
+        )
+        npt.assert_equal(profiles.shape, (2, 2, 100))
+        for i, bundle in enumerate(bundles):
+            for m, metric in enumerate([fa, md]):
+                expected = afq_profile(
+                    metric, bundle, affine, orient_by=orient_by[i], weights=weights
+                )
+                npt.assert_allclose(profiles[i, m], expected, rtol=1e-10)
+
+    # Per bundle weights and a single 3D volume
+    weights = [np.ones((5, 10)) / 5, np.ones(8) / 8]
+    profiles = afq_profiles(fa, bundles, affine, n_points=10, weights=weights)
+    npt.assert_equal(profiles.shape, (2, 1, 10))
+    for i, bundle in enumerate(bundles):
+        expected = afq_profile(fa, bundle, affine, n_points=10, weights=weights[i])
+        npt.assert_allclose(profiles[i, 0], expected, rtol=1e-10)
+
+    bad_weights = [np.ones((5, 10)) * 0.6, None]
+    npt.assert_raises(
+        ValueError, afq_profiles, fa, bundles, affine, n_points=10, weights=bad_weights
+    )
+    npt.assert_raises(ValueError, afq_profiles, fa, [Streamlines([])], affine)
+    npt.assert_raises(ValueError, afq_profiles, fa, bundles, affine, weights=[None])
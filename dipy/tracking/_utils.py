@@ -1,5 +1,6 @@
 """This is a helper module for dipy.tracking.utils."""
 
+from nibabel.streamlines import ArraySequence
 import numpy as np
 
 
@@ -49,3 +50,63 @@ def _to_voxel_coordinates(streamline, lin_T, offset):
     if inds.min().round(decimals=6) < 0:
         raise IndexError("streamline has points that map to negative voxel indices")
     return inds.astype(np.intp)
+
+
+def _iter_streamline_chunks(streamlines, chunk_size):
+    """Yields streamlines in flat chunks, without loading all of them at once.
+
+    This function is an implementation detail of the streaming kernels in
+    ``vox2track``. ArraySequence inputs are sliced directly, any other
+    iterable (lists, generators, lazily loaded tractograms) is consumed
+    ``chunk_size`` streamlines at a time.
+
+    Parameters
+    ----------
+    streamlines : iterable
+        A sequence or generator of streamlines, each of shape (N, 3).
+    chunk_size : int
+        Maximum number of streamlines per chunk.
+
+    Yields
+    ------
+    points : array (P, 3)
+        C-contiguous float64 array with the points of every streamline in the
+        chunk.
+    offsets : array (S,)
+        Offset of the first point of each streamline in ``points``.
+    lengths : array (S,)
+        Number of points of each streamline.
+
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+
+    if isinstance(streamlines, ArraySequence):
+        for start in range(0, len(streamlines), chunk_size):
+            chunk = streamlines[start : start + chunk_size]
+            lengths = np.asarray(chunk._lengths, dtype=np.intp)
+            offsets = np.zeros_like(lengths)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+            points = np.ascontiguousarray(chunk.get_data(), dtype=np.float64)
+            yield points.reshape(-1, 3), offsets, lengths
+        return
+
+    buffer = []
+    for sl in streamlines:
+        buffer.append(sl)
+        if len(buffer) == chunk_size:
+            yield _flatten_streamlines(buffer)
+            buffer = []
+    if buffer:
+        yield _flatten_streamlines(buffer)
+
+
+def _flatten_streamlines(streamlines):
+    """Concatenates a list of streamlines into flat points/offsets/lengths."""
+    lengths = np.array([len(sl) for sl in streamlines], dtype=np.intp)
+    offsets = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    points = np.empty((lengths.sum(), 3), dtype=np.float64)
+    for sl, start, n in zip(streamlines, offsets, lengths):
+        points[start : start + n] = sl
+    return points, offsets, lengths
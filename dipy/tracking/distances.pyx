@@ -7,12 +7,18 @@
 
 cimport cython
 
+from cython.parallel import prange, threadid
 from libc.stdlib cimport calloc, realloc, free
 
+from nibabel.streamlines import ArraySequence
 import numpy as np
+from scipy.sparse import coo_array
 from warnings import warn
 cimport numpy as cnp
 
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
@@ -470,9 +476,198 @@ def most_similar_track_mam(tracks,metric='avg'):
         track2others[j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
     return si, track2others
 
+DEF MDF_METRIC = 3  # metric type of the MDF distance, 0-2 are MAM metrics
+DEF TILE_POINTS = 16384  # points of tracksB processed by a tile
+DEF BLOCK_ENTRIES = 4194304  # distances of a row block (32 MB)
+
+
+def _mam_metric_type(metric):
+    if metric == 'avg':
+        return 0
+    elif metric == 'min':
+        return 1
+    elif metric == 'max':
+        return 2
+    raise ValueError('Metric should be one of avg, min, max')
+
+
+def _pack_tracks(tracks):
+    """ Concatenate tracks in a contiguous float32 array of points
+
+    Returns the points (P, 3), the offset and the number of points of each
+    track. ArraySequence and (N, M, 3) arrays are not copied when already in
+    float32. Only the points of the tracks of an ArraySequence view (e.g.
+    ``streamlines[idx]``) are converted, not its whole buffer.
+    """
+    if isinstance(tracks, ArraySequence):
+        data = tracks._data.reshape((-1, 3))
+        offsets = np.ascontiguousarray(tracks._offsets, dtype=np.intp)
+        lengths = np.ascontiguousarray(tracks._lengths, dtype=np.intp)
+        if data.dtype == f32_dt and data.flags.c_contiguous:
+            return data, offsets, lengths
+        covers_data = np.sum(lengths) == len(data)
+        if covers_data and len(lengths) > 0:
+            covers_data = offsets[0] == 0 and np.array_equal(
+                offsets[1:], np.cumsum(lengths[:-1]))
+        if not covers_data:
+            data = tracks.get_data()
+            offsets = np.zeros(len(lengths), dtype=np.intp)
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        points = np.ascontiguousarray(data, dtype=f32_dt)
+        return points.reshape((-1, 3)), offsets, lengths
+
+    if isinstance(tracks, np.ndarray) and tracks.ndim == 3:
+        nb_tracks, nb_points = tracks.shape[0], tracks.shape[1]
+        points = np.ascontiguousarray(tracks, dtype=f32_dt).reshape((-1, 3))
+        lengths = np.full(nb_tracks, nb_points, dtype=np.intp)
+        offsets = np.arange(nb_tracks, dtype=np.intp) * nb_points
+        return points, offsets, lengths
+
+    lengths = np.array([len(t) for t in tracks], dtype=np.intp)
+    offsets = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    if np.sum(lengths) == 0:
+        return np.zeros((0, 3), dtype=f32_dt), offsets, lengths
+    points = np.concatenate([np.asarray(t, dtype=f32_dt).reshape((-1, 3))
+                             for t in tracks])
+    return np.ascontiguousarray(points), offsets, lengths
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def bundles_distances_mam(tracksA, tracksB, metric='avg'):
+def _bundles_distances_rows(float[:, ::1] pointsA,
+                            cnp.npy_intp[::1] offsetsA,
+                            cnp.npy_intp[::1] lengthsA,
+                            float[:, ::1] pointsB,
+                            cnp.npy_intp[::1] offsetsB,
+                            cnp.npy_intp[::1] lengthsB,
+                            cnp.npy_intp start,
+                            double[:, ::1] out,
+                            int metric_type,
+                            cnp.npy_intp mdf_len,
+                            float[:, ::1] buffers,
+                            cnp.npy_intp tile_size,
+                            int num_threads):
+    """ Distances between rows ``start:start + len(out)`` of A and all of B
+
+    Tracks of B are processed in tiles of `tile_size` tracks which stay in
+    cache while the rows are distributed across threads. Each thread uses
+    its own row of `buffers` as scratch memory.
+    """
+    cdef:
+        cnp.npy_intp nb_rows = out.shape[0]
+        cnp.npy_intp nb_cols = out.shape[1]
+        cnp.npy_intp nb_tiles = (nb_cols + tile_size - 1) // tile_size
+        cnp.npy_intp ii, i, j, tid, tile, tile_start, tile_end
+        float *scratch
+
+    with nogil:
+        for tile in range(nb_tiles):
+            tile_start = tile * tile_size
+            tile_end = min(tile_start + tile_size, nb_cols)
+            for ii in prange(nb_rows, schedule="static",
+                             num_threads=num_threads):
+                i = start + ii
+                tid = threadid()
+                scratch = &buffers[tid, 0]
+                for j in range(tile_start, tile_end):
+                    if metric_type == MDF_METRIC:
+                        track_direct_flip_dist(&pointsA[offsetsA[i], 0],
+                                               &pointsB[offsetsB[j], 0],
+                                               mdf_len, scratch)
+                        if scratch[0] < scratch[1]:
+                            out[ii, j] = scratch[0]
+                        else:
+                            out[ii, j] = scratch[1]
+                    else:
+                        out[ii, j] = czhang(lengthsA[i],
+                                            &pointsA[offsetsA[i], 0],
+                                            lengthsB[j],
+                                            &pointsB[offsetsB[j], 0],
+                                            scratch, metric_type)
+
+
+class _BundlesDistances:
+    """ Packed tracks and settings shared by the bundle distance functions """
+
+    def __init__(self, tracksA, tracksB, metric_type, num_threads):
+        self.packedA = _pack_tracks(tracksA)
+        self.packedB = _pack_tracks(tracksB)
+        self.metric_type = metric_type
+        self.num_threads = num_threads
+        self.shape = (len(self.packedA[2]), len(self.packedB[2]))
+        if self.shape[0] == 0 or self.shape[1] == 0:
+            return
+
+        lengthsA, lengthsB = self.packedA[2], self.packedB[2]
+        # for performance issue, we just check the first streamline
+        if lengthsA[0] != lengthsB[0]:
+            w_s = "Streamlines do not have the same number of points. "
+            w_s += "All streamlines need to have the same number of points. "
+            w_s += "Use dipy.tracking.streamline.set_number_of_points to adjust "
+            w_s += "your streamlines"
+            warn(w_s)
+
+        # the MDF distance uses the number of points of the first track of A
+        self.mdf_len = lengthsA[0]
+        if metric_type == MDF_METRIC and (np.min(lengthsA) < self.mdf_len or
+                                          np.min(lengthsB) < self.mdf_len):
+            raise ValueError("All streamlines need at least as many points "
+                             "as the first streamline of tracksA")
+
+        longest = max(np.max(lengthsA), np.max(lengthsB))
+        self.threads = determine_num_threads(num_threads)
+        self.buffers = np.zeros((self.threads, max(2 * longest, 2)),
+                                dtype=np.float32)
+        self.tile_size = max(1, (TILE_POINTS * self.shape[1]) //
+                             max(len(self.packedB[0]), 1))
+
+    def fill(self, start, out):
+        """ Fill `out` with the distances of the rows of A from `start` """
+        if out.size == 0:
+            return out
+        set_num_threads(self.threads)
+        try:
+            _bundles_distances_rows(*self.packedA, *self.packedB, start, out,
+                                    self.metric_type, self.mdf_len,
+                                    self.buffers, self.tile_size,
+                                    self.threads)
+        finally:
+            if self.num_threads is not None:
+                restore_default_num_threads()
+        return out
+
+    def blocks(self, block_size=None):
+        """ Yield the distances by blocks of `block_size` rows """
+        nb_rows, nb_cols = self.shape
+        if block_size is None:
+            block_size = max(1, BLOCK_ENTRIES // max(nb_cols, 1))
+        elif block_size < 1:
+            raise ValueError("block_size needs to be >= 1")
+        for start in range(0, nb_rows, block_size):
+            end = min(start + block_size, nb_rows)
+            out = np.zeros((end - start, nb_cols), dtype=np.double)
+            yield start, self.fill(start, out)
+
+    def dense(self):
+        return self.fill(0, np.zeros(self.shape, dtype=np.double))
+
+    def sparse(self, threshold):
+        rows, cols, vals = [], [], []
+        for start, block in self.blocks():
+            block_rows, block_cols = np.nonzero(block < threshold)
+            rows.append(block_rows + start)
+            cols.append(block_cols)
+            vals.append(block[block_rows, block_cols])
+        if len(rows) == 0:
+            return coo_array(self.shape, dtype=np.double)
+        return coo_array((np.concatenate(vals),
+                          (np.concatenate(rows), np.concatenate(cols))),
+                         shape=self.shape)
+
+
+def bundles_distances_mam(tracksA, tracksB, metric='avg', *, threshold=None,
+                          num_threads=1):
     """ Calculate distances between list of tracks A and list of tracks B
 
     Parameters
@@ -483,88 +678,40 @@ def bundles_distances_mam(tracksA, tracksB, metric='avg'):
        of tracks as arrays, shape (N1,3) .. (Nm,3)
     metric : str
        'avg', 'min', 'max'
+    threshold : float, optional
+        If given, only the pairs of tracks closer than `threshold` are
+        returned, as a sparse array. The full distance matrix is never
+        allocated.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. By default
+        (1) the distances are computed serially. If None the value of
+        OMP_NUM_THREADS environment variable is used if it is set, otherwise
+        all available threads are used. If < 0 the maximal number of threads
+        minus $|num_threads + 1|$ is used (enter -1 to use as many threads as
+        possible). 0 raises an error.
 
     Returns
     -------
     DM : array, shape (len(tracksA), len(tracksB))
-        distances between tracksA and tracksB according to metric
+        distances between tracksA and tracksB according to metric. A scipy
+        COOrdinates sparse array if `threshold` is given, where identical
+        tracks are stored as explicit zeros.
 
     See Also
     --------
     dipy.tracking.streamline.set_number_of_points
+    bundles_distances_blocks
 
     """
-    cdef:
-        cnp.npy_intp i, j, lentA, lentB
-        int metric_type
-    if metric=='avg':
-        metric_type = 0
-    elif metric == 'min':
-        metric_type = 1
-    elif metric == 'max':
-        metric_type = 2
-    else:
-        raise ValueError('Metric should be one of avg, min, max')
-    # preprocess tracks
-    cdef:
-        cnp.npy_intp longest_track_len = 0, track_len
-        cnp.npy_intp longest_track_lenA = 0, longest_track_lenB = 0
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    # for performance issue, we just check the first streamline
-    if len(tracksA[0]) != len(tracksB[0]):
-        w_s = "Streamlines do not have the same number of points. "
-        w_s += "All streamlines need to have the same number of points. "
-        w_s += "Use dipy.tracking.streamline.set_number_of_points to adjust "
-        w_s += "your streamlines"
-        warn(w_s)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout, find longest track
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-        track_len = tracksA32[i].shape[0]
-        if track_len > longest_track_lenA:
-            longest_track_lenA = track_len
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-        track_len = tracksB32[i].shape[0]
-        if track_len > longest_track_lenB:
-            longest_track_lenB = track_len
-    if longest_track_lenB > longest_track_lenA:
-        longest_track_lenA = longest_track_lenB
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=1] distances_buffer
-        cnp.float32_t *t1_ptr
-        cnp.float32_t *t2_ptr
-        cnp.float32_t *min_buffer
-    distances_buffer = np.zeros((longest_track_lenA*2,), dtype=np.float32)
-    min_buffer = <cnp.float32_t *> cnp.PyArray_DATA(distances_buffer)
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        cnp.npy_intp t1_len, t2_len
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        t1_len = cnp.PyArray_DIM(t1, 0)
-        t1_ptr = <cnp.float32_t *> cnp.PyArray_DATA(t1)
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            t2_len = cnp.PyArray_DIM(t2, 0)
-            t2_ptr = <cnp.float32_t *> cnp.PyArray_DATA(t2)
-            DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
-
-    return DM
+    dist = _BundlesDistances(tracksA, tracksB, _mam_metric_type(metric),
+                             num_threads)
+    if threshold is None:
+        return dist.dense()
+    return dist.sparse(threshold)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def bundles_distances_mdf(tracksA, tracksB):
+def bundles_distances_mdf(tracksA, tracksB, *, threshold=None,
+                          num_threads=1):
     """ Calculate distances between list of tracks A and list of tracks B
 
     All tracks need to have the same number of points
@@ -575,72 +722,83 @@ def bundles_distances_mdf(tracksA, tracksB):
        of tracks as arrays, [(N,3) .. (N,3)]
     tracksB : sequence
        of tracks as arrays, [(N,3) .. (N,3)]
+    threshold : float, optional
+        If given, only the pairs of tracks closer than `threshold` are
+        returned, as a sparse array. The full distance matrix is never
+        allocated.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. By default
+        (1) the distances are computed serially. If None the value of
+        OMP_NUM_THREADS environment variable is used if it is set, otherwise
+        all available threads are used. If < 0 the maximal number of threads
+        minus $|num_threads + 1|$ is used (enter -1 to use as many threads as
+        possible). 0 raises an error.
 
     Returns
     -------
     DM : array, shape (len(tracksA), len(tracksB))
-        distances between tracksA and tracksB according to metric
+        distances between tracksA and tracksB according to metric. A scipy
+        COOrdinates sparse array if `threshold` is given, where identical
+        tracks are stored as explicit zeros.
 
     See Also
     --------
     dipy.tracking.streamline.set_number_of_points
+    bundles_distances_blocks
 
     """
-    cdef:
-        cnp.npy_intp i, j, lentA, lentB
-    # preprocess tracks
-    cdef:
-        cnp.npy_intp longest_track_len = 0, track_len
-        longest_track_lenA, longest_track_lenB
-        cnp.ndarray[object, ndim=1] tracksA32
-        cnp.ndarray[object, ndim=1] tracksB32
-        cnp.ndarray[cnp.double_t, ndim=2] DM
-    lentA = len(tracksA)
-    lentB = len(tracksB)
-    # for performance issue, we just check the first streamline
-    if len(tracksA[0]) != len(tracksB[0]):
-        w_s = "Streamlines do not have the same number of points. "
-        w_s += "All streamlines need to have the same number of points. "
-        w_s += "Use dipy.tracking.streamline.set_number_of_points to adjust "
-        w_s += "your streamlines"
-        warn(w_s)
-    tracksA32 = np.zeros((lentA,), dtype=object)
-    tracksB32 = np.zeros((lentB,), dtype=object)
-    DM = np.zeros((lentA,lentB), dtype=np.double)
-    # process tracks to predictable memory layout
-    for i in range(lentA):
-        tracksA32[i] = np.ascontiguousarray(tracksA[i], dtype=f32_dt)
-    for i in range(lentB):
-        tracksB32[i] = np.ascontiguousarray(tracksB[i], dtype=f32_dt)
-    # preallocate buffer array for track distance calculations
-    cdef:
-        cnp.float32_t *t1_ptr
-        cnp.float32_t *t2_ptr
-        cnp.float32_t *min_buffer
-    # cycle over tracks
-    cdef:
-        cnp.ndarray [cnp.float32_t, ndim=2] t1, t2
-        cnp.npy_intp t1_len, t2_len
-        float d[2]
-    t_len = tracksA32[0].shape[0]
+    dist = _BundlesDistances(tracksA, tracksB, MDF_METRIC, num_threads)
+    if threshold is None:
+        return dist.dense()
+    return dist.sparse(threshold)
 
-    for i from 0 <= i < lentA:
-        t1 = tracksA32[i]
-        #t1_len = t1.shape[0]
-        t1_ptr = <cnp.float32_t *> cnp.PyArray_DATA(t1)
-        for j from 0 <= j < lentB:
-            t2 = tracksB32[j]
-            #t2_len = t2.shape[0]
-            t2_ptr = <cnp.float32_t *> cnp.PyArray_DATA(t2)
-            #DM[i,j] = czhang(t1_len, t1_ptr, t2_len, t2_ptr, min_buffer, metric_type)
-            track_direct_flip_dist(t1_ptr, t2_ptr,t_len,<float *>d)
-            if d[0]<d[1]:
-                DM[i,j]=d[0]
-            else:
-                DM[i,j]=d[1]
-    return DM
 
+def bundles_distances_blocks(tracksA, tracksB, *, distance='mdf',
+                             metric='avg', block_size=None, num_threads=1):
+    """ Iterate over the distance matrix of two bundles by blocks of rows
+
+    Only one block of rows is in memory at a time, which allows computing
+    distances between bundles whose full distance matrix does not fit in
+    memory.
 
+    Parameters
+    ----------
+    tracksA : sequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    tracksB : sequence
+       of tracks as arrays, shape (N1,3) .. (Nm,3)
+    distance : str, optional
+        'mdf' (see :func:`bundles_distances_mdf`) or 'mam' (see
+        :func:`bundles_distances_mam`).
+    metric : str, optional
+        'avg', 'min', 'max', metric of the 'mam' distance.
+    block_size : int, optional
+        Number of rows of each block. By default, blocks hold about 4
+        million distances.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. By default
+        (1) the distances are computed serially. If None the value of
+        OMP_NUM_THREADS environment variable is used if it is set, otherwise
+        all available threads are used. If < 0 the maximal number of threads
+        minus $|num_threads + 1|$ is used (enter -1 to use as many threads as
+        possible). 0 raises an error.
+
+    Yields
+    ------
+    start : int
+        Index in `tracksA` of the first row of the block.
+    block : array, shape (nb_rows, len(tracksB))
+        Distances between ``tracksA[start:start + nb_rows]`` and tracksB.
+
+    """
+    if distance == 'mdf':
+        metric_type = MDF_METRIC
+    elif distance == 'mam':
+        metric_type = _mam_metric_type(metric)
+    else:
+        raise ValueError('Distance should be one of mdf, mam')
+    dist = _BundlesDistances(tracksA, tracksB, metric_type, num_threads)
+    yield from dist.blocks(block_size)
 
 
 cdef cnp.float32_t inf = np.inf
@@ -7,15 +7,19 @@ References
 .. footbibliography::
 """
 
+import os
+
 import numpy as np
 import scipy.linalg as la
 import scipy.sparse as sps
+from scipy.spatial import cKDTree
 
 import dipy.core.optimize as opt
+from dipy.core.sphere import HemiSphere
 import dipy.data as dpd
 from dipy.reconst.base import ReconstFit, ReconstModel
 from dipy.testing.decorators import warning_for_keywords
-from dipy.tracking.streamline import transform_streamlines
+from dipy.tracking.streamline import Streamlines, transform_streamlines
 from dipy.tracking.utils import unique_rows
 from dipy.tracking.vox2track import _voxel2streamline
 
@@ -256,6 +260,39 @@ class LifeSignalMaker:
 
         return self.signal[idx]
 
+    def calc_signals(self, xyz):
+        """
+        Find the sphere vertices closest to many directions at once and make
+        sure their signal is cached
+
+        Parameters
+        ----------
+        xyz : array of shape (n, 3)
+            Directions, e.g. the gradients at every node of many streamlines.
+
+        Returns
+        -------
+        idx : array of shape (n,)
+            Index of the closest vertex to each direction. The corresponding
+            signals are ``self.signal[idx]``.
+        """
+        xyz = np.asarray(xyz, dtype=float)
+        norm = np.linalg.norm(xyz, axis=-1)
+        nonzero = norm > 0
+        # For unit vectors, the largest cosine similarity is the smallest
+        # euclidean distance:
+        vertices = self.sphere.vertices
+        if isinstance(self.sphere, HemiSphere):
+            vertices = np.concatenate([vertices, -vertices])
+        idx = np.zeros(len(xyz), dtype=np.intp)
+        _, idx[nonzero] = cKDTree(vertices).query(xyz[nonzero] / norm[nonzero, None])
+        idx %= len(self.sphere.vertices)
+
+        # Each vertex signal is only computed once:
+        for vertex in np.setdiff1d(idx, self._calculated):
+            self.calc_signal(self.sphere.vertices[vertex])
+        return idx
+
     def streamline_signal(self, streamline):
         """
         Approximate the signal for a given streamline
@@ -304,6 +341,41 @@ def voxel2streamline(streamline, affine, *, unique_idx=None):
     return _voxel2streamline(transformed_streamline, unique_idx.astype(np.intp))
 
 
+def _node_gradients(points, offsets, lengths):
+    """
+    Spatial gradients of all the nodes of many streamlines at once
+
+    Equivalent to calling :func:`streamline_gradients` on every streamline and
+    concatenating the results. Every streamline must have at least 2 nodes.
+    """
+    grad = np.empty_like(points)
+    grad[1:-1] = (points[2:] - points[:-2]) / 2.0
+    first = offsets
+    last = offsets + lengths - 1
+    grad[first] = points[first + 1] - points[first]
+    grad[last] = points[last] - points[last - 1]
+    return grad
+
+
+def _unique_rows_inverse(in_array):
+    """
+    Same as :func:`dipy.tracking.utils.unique_rows`, also returning for each
+    row of `in_array` the index of the corresponding unique row.
+    """
+    order = np.lexsort(in_array.T)
+    x = in_array[order]
+    diff_x = np.ones(len(x), dtype=bool)
+    diff_x[1:] = (x[1:] != x[:-1]).any(-1)
+    group = np.cumsum(diff_x) - 1
+    # Unique rows are kept in order of first appearance:
+    first = order[diff_x]
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    inverse = np.empty(len(in_array), dtype=np.intp)
+    inverse[order] = rank[group]
+    return in_array[np.sort(first)], inverse
+
+
 class FiberModel(ReconstModel):
     """
     A class for representing and solving predictive models based on
@@ -330,7 +402,17 @@ class FiberModel(ReconstModel):
         ReconstModel.__init__(self, gtab)
 
     @warning_for_keywords()
-    def setup(self, streamline, affine, *, evals=(0.001, 0, 0), sphere=None):
+    def setup(
+        self,
+        streamline,
+        affine,
+        *,
+        evals=(0.001, 0, 0),
+        sphere=None,
+        dtype=np.float64,
+        mmap_dir=None,
+        chunk_size=100000,
+    ):
         """
         Set up the necessary components for the LiFE model: the matrix of
         fiber-contributions to the DWI signal, and the coordinates of voxels
@@ -353,62 +435,140 @@ class FiberModel(ReconstModel):
             gradients along the streamlines to calculate the matrix, instead of
             an approximation. Defaults to use the 724-vertex symmetric sphere
             from :mod:`dipy.data`
+        dtype : data-type, optional
+            Data type of the matrix values. Use ``np.float32`` to halve the
+            memory used by the matrix.
+        mmap_dir : str, optional
+            If given, the arrays of the matrix are stored as memory-mapped
+            ``.npy`` files in this directory instead of in memory.
+        chunk_size : int, optional
+            Number of streamline nodes whose signal is computed at once.
+
+        Returns
+        -------
+        life_matrix : csr_array
+            The matrix of shape (n_voxels * n_bvecs, n_streamlines).
+        vox_coords : array of shape (n_voxels, 3)
+            The coordinates of the voxels the streamlines go through.
         """
-        if sphere is not False:
-            SignalMaker = LifeSignalMaker(self.gtab, evals=evals, sphere=sphere)
+        streamline = Streamlines(transform_streamlines(streamline, affine))
+        lengths = np.asarray(streamline._lengths, dtype=np.intp)
+        if np.any(lengths < 2):
+            raise IndexError(
+                "Input contains streamlines with only one node, their gradient"
+                " is not defined."
+            )
+        n_streamlines = len(lengths)
+        offsets = np.zeros_like(lengths)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        all_coords = streamline.get_data()
+        del streamline
 
-        streamline = transform_streamlines(streamline, affine)
-        # Assign some local variables, for shorthand:
-        all_coords = np.concatenate(streamline)
-        vox_coords = unique_rows(np.round(all_coords).astype(np.intp))
-        del all_coords
-        # We only consider the diffusion-weighted signals:
-        n_bvecs = self.gtab.bvals[~self.gtab.b0s_mask].shape[0]
-        v2f, v2fn = voxel2streamline(streamline, np.eye(4), unique_idx=vox_coords)
+        # Voxel of every node, and (voxel, fiber) pair of every node, sorted by
+        # voxel then fiber. This is the order of the entries of the matrix:
+        vox_coords, node_vox = _unique_rows_inverse(
+            np.round(all_coords).astype(np.intp)
+        )
+        n_vox = vox_coords.shape[0]
+        node_fiber = np.repeat(np.arange(n_streamlines, dtype=np.intp), lengths)
+        pair_key, node_pair = np.unique(
+            node_vox * n_streamlines + node_fiber, return_inverse=True
+        )
+        node_pair = node_pair.ravel()
+        pair_vox = pair_key // n_streamlines
+        pair_fiber = pair_key % n_streamlines
+        del pair_key, node_fiber
         # How many fibers in each voxel (this will determine how many
         # components are in the matrix):
-        n_unique_f = len(np.hstack(list(v2f.values())))
-        # Preallocate these, which will be used to generate the sparse
-        # matrix:
-        f_matrix_sig = np.zeros(n_unique_f * n_bvecs, dtype=float)
-        f_matrix_row = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-        f_matrix_col = np.zeros(n_unique_f * n_bvecs, dtype=np.intp)
-
-        fiber_signal = []
-        for _, s in enumerate(streamline):
+        vox_n_fibers = np.bincount(pair_vox, minlength=n_vox)
+        vox_start = np.zeros(n_vox + 1, dtype=np.intp)
+        np.cumsum(vox_n_fibers, out=vox_start[1:])
+
+        # We only consider the diffusion-weighted signals:
+        n_bvecs = self.gtab.bvals[~self.gtab.b0s_mask].shape[0]
+        nnz = len(pair_vox) * n_bvecs
+        index_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+
+        # In CSR order, row ``v * n_bvecs + b`` holds the fibers of voxel v,
+        # so the value for (pair p, bvec b) goes to ``pair_base[p] + b *
+        # vox_n_fibers[v]``:
+        pair_base = vox_start[pair_vox] * n_bvecs + (
+            np.arange(len(pair_vox)) - vox_start[pair_vox]
+        )
+        pair_stride = vox_n_fibers[pair_vox]
+        indptr = (
+            vox_start[:-1, None] * n_bvecs + np.arange(n_bvecs) * vox_n_fibers[:, None]
+        ).ravel()
+        indptr = np.append(indptr, nnz).astype(index_dtype)
+
+        def _alloc(name, size, alloc_dtype):
+            if mmap_dir is None:
+                return np.zeros(size, dtype=alloc_dtype)
+            return np.lib.format.open_memmap(
+                os.path.join(mmap_dir, f"life_matrix_{name}.npy"),
+                mode="w+",
+                dtype=alloc_dtype,
+                shape=(size,),
+            )
+
+        f_matrix_sig = _alloc("data", nnz, dtype)
+        f_matrix_col = _alloc("indices", nnz, index_dtype)
+
+        # Column indices, repeated for each bvec of a voxel:
+        pair_chunk = max(1, chunk_size // n_bvecs)
+        for p_start in range(0, len(pair_vox), pair_chunk):
+            pairs = np.arange(p_start, min(p_start + pair_chunk, len(pair_vox)))
+            pos = pair_base[pairs] + np.arange(n_bvecs)[:, None] * pair_stride[pairs]
+            f_matrix_col[pos] = pair_fiber[pairs]
+        del pair_fiber
+
+        if sphere is not False:
+            SignalMaker = LifeSignalMaker(self.gtab, evals=evals, sphere=sphere)
+            node_grad = _node_gradients(all_coords, offsets, lengths)
+            del all_coords
+            node_vertex = SignalMaker.calc_signals(node_grad)
+            del node_grad
+            signal = SignalMaker.signal.astype(dtype, copy=False)
+
+        range_bvecs = np.arange(n_bvecs)
+        sl_chunk = max(1, chunk_size // lengths.max())
+        for sl_start in range(0, n_streamlines, sl_chunk):
+            sl_end = min(sl_start + sl_chunk, n_streamlines)
+            n_start = offsets[sl_start]
+            n_end = offsets[sl_end - 1] + lengths[sl_end - 1]
+            # All the nodes of a (voxel, fiber) pair belong to the same
+            # streamline, so each pair is complete within a chunk:
+            pairs, local_pair = np.unique(node_pair[n_start:n_end], return_inverse=True)
             if sphere is not False:
-                fiber_signal.append(SignalMaker.streamline_signal(s))
+                # Count how many nodes of each pair point to each vertex:
+                node_col = node_vertex[n_start:n_end]
+                node_sig = signal
             else:
-                fiber_signal.append(streamline_signal(s, self.gtab, evals=evals))
+                node_col = np.arange(n_end - n_start)
+                node_sig = np.concatenate(
+                    [
+                        streamline_signal(
+                            all_coords[offsets[ii] : offsets[ii] + lengths[ii]],
+                            self.gtab,
+                            evals=evals,
+                        )
+                        for ii in range(sl_start, sl_end)
+                    ]
+                )
+            node_to_pair = sps.csr_array(
+                (np.ones(n_end - n_start), (local_pair.ravel(), node_col)),
+                shape=(len(pairs), len(node_sig)),
+            )
+            pos = pair_base[pairs][:, None] + range_bvecs * pair_stride[pairs][:, None]
+            # Sum the signal from each node of the fiber in that voxel:
+            f_matrix_sig[pos] = node_to_pair @ node_sig
 
-        del streamline
-        if sphere is not False:
-            del SignalMaker
-
-        keep_ct = 0
-        range_bvecs = np.arange(n_bvecs).astype(int)
-        # In each voxel:
-        for v_idx in range(vox_coords.shape[0]):
-            mat_row_idx = (range_bvecs + v_idx * n_bvecs).astype(np.intp)
-            # For each fiber in that voxel:
-            for f_idx in v2f[v_idx]:
-                # For each fiber-voxel combination, store the row/column
-                # indices in the pre-allocated linear arrays
-                f_matrix_row[keep_ct : keep_ct + n_bvecs] = mat_row_idx
-                f_matrix_col[keep_ct : keep_ct + n_bvecs] = f_idx
-
-                vox_fiber_sig = np.zeros(n_bvecs)
-                for node_idx in v2fn[f_idx][v_idx]:
-                    # Sum the signal from each node of the fiber in that voxel:
-                    vox_fiber_sig += fiber_signal[f_idx][node_idx]
-                # And add the summed thing into the corresponding rows:
-                f_matrix_sig[keep_ct : keep_ct + n_bvecs] += vox_fiber_sig
-                keep_ct = keep_ct + n_bvecs
-
-        del v2f, v2fn
         # Allocate the sparse matrix, using the more memory-efficient 'csr'
         # format:
-        life_matrix = sps.csr_array((f_matrix_sig, [f_matrix_row, f_matrix_col]))
+        life_matrix = sps.csr_array(
+            (f_matrix_sig, f_matrix_col, indptr),
+            shape=(n_vox * n_bvecs, n_streamlines),
+        )
 
         return life_matrix, vox_coords
 
@@ -440,7 +600,18 @@ class FiberModel(ReconstModel):
         return (to_fit, weighted_signal, b0_signal, relative_signal, mean_sig, vox_data)
 
     @warning_for_keywords()
-    def fit(self, data, streamline, affine, *, evals=(0.001, 0, 0), sphere=None):
+    def fit(
+        self,
+        data,
+        streamline,
+        affine,
+        *,
+        evals=(0.001, 0, 0),
+        sphere=None,
+        solver="gradient",
+        beta0=None,
+        num_threads=None,
+    ):
         """
         Fit the LiFE FiberModel for data and a set of streamlines associated
         with this data
@@ -463,6 +634,19 @@ class FiberModel(ReconstModel):
             problem, but is not as accurate. If `False`, we use the exact
             gradients along the streamlines to calculate the matrix, instead of
             an approximation.
+        solver : str, optional
+            The `method` of :func:`dipy.core.optimize.sparse_nnls`, 'gradient'
+            or 'fista'.
+        beta0 : array, optional
+            Initial streamline weights, e.g. from a previous fit on a superset
+            of these streamlines.
+        num_threads : int, optional
+            Number of threads used for the sparse matrix-vector products of
+            the 'fista' solver. If None (default) the value of
+            OMP_NUM_THREADS environment variable is used if it is set,
+            otherwise all available threads are used. If < 0 the maximal
+            number of threads minus |num_threads + 1| is used (enter -1 to
+            use as many threads as possible). 0 raises an error.
 
         Returns
         -------
@@ -482,7 +666,9 @@ class FiberModel(ReconstModel):
         (to_fit, weighted_signal, b0_signal, relative_signal, mean_sig, vox_data) = (
             self._signals(data, vox_coords)
         )
-        beta = opt.sparse_nnls(to_fit, life_matrix)
+        beta = opt.sparse_nnls(
+            to_fit, life_matrix, method=solver, x0=beta0, num_threads=num_threads
+        )
         return FiberFit(
             self,
             life_matrix,
@@ -1,6 +1,9 @@
 # cython: wraparound=False, cdivision=True, boundscheck=False
 
+import weakref
+
 import numpy as np
+from cython.parallel import prange
 from libc.math cimport sqrt
 from libc.stdlib cimport malloc, free
 
@@ -8,6 +11,8 @@ cimport numpy as cnp
 
 from dipy.tracking import Streamlines
 from dipy.utils.arrfuncs import as_native_array
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 cdef extern from "dpy_math.h" nogil:
     bint dpy_isnan(double x)
@@ -33,26 +38,29 @@ cdef double c_length(Streamline streamline) noexcept nogil:
 cdef void c_arclengths_from_arraysequence(Streamline points,
                                           cnp.npy_intp[:] offsets,
                                           cnp.npy_intp[:] lengths,
-                                          double[:] arclengths) noexcept nogil:
+                                          double[:] arclengths,
+                                          int num_threads) noexcept nogil:
     cdef:
         cnp.npy_intp i, j, k
         cnp.npy_intp offset
-        double dn, sum_dn_sqr
+        double dn, sum_dn_sqr, total
 
-    for i in range(offsets.shape[0]):
+    for i in prange(offsets.shape[0], schedule="guided",
+                    num_threads=num_threads):
         offset = offsets[i]
 
-        arclengths[i] = 0
+        total = 0
         for j in range(1, lengths[i]):
             sum_dn_sqr = 0.0
             for k in range(points.shape[1]):
                 dn = points[offset+j, k] - points[offset+j-1, k]
-                sum_dn_sqr += dn*dn
+                sum_dn_sqr = sum_dn_sqr + dn*dn
 
-            arclengths[i] += sqrt(sum_dn_sqr)
+            total = total + sqrt(sum_dn_sqr)
+        arclengths[i] = total
 
 
-def length(streamlines):
+def length(streamlines, out=None, num_threads=1):
     """ Euclidean length of streamlines
 
     Length is in mm only if streamlines are expressed in world coordinates.
@@ -65,6 +73,16 @@ def length(streamlines):
         If list, each item must be ndarray shape (Ni,3) where Ni is the number
         of points of streamline i.
         If :class:`dipy.tracking.Streamlines`, its `common_shape` must be 3.
+    out : ndarray shape (N,) of float64, optional
+        Preallocated output, only used when `streamlines` is a
+        :class:`dipy.tracking.Streamlines`.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization when
+        `streamlines` is a :class:`dipy.tracking.Streamlines`. If None the
+        value of OMP_NUM_THREADS environment variable is used if it is set,
+        otherwise all available threads are used. If < 0 the maximal number
+        of threads minus |num_threads + 1| is used (enter -1 to use as many
+        threads as possible). 0 raises an error. Default: 1.
 
     Returns
     -------
@@ -97,27 +115,33 @@ def length(streamlines):
         if len(streamlines) == 0:
             return 0.0
 
-        arclengths = np.zeros(len(streamlines), dtype=np.float64)
+        if out is None:
+            arclengths = np.zeros(len(streamlines), dtype=np.float64)
+        elif out.shape != (len(streamlines),) or out.dtype != np.float64:
+            raise ValueError("out must be a float64 array with one value per "
+                             "streamline")
+        else:
+            arclengths = out
         streamlines_data = as_native_array(streamlines._data)
+        offsets = streamlines._offsets.astype(np.intp, copy=False)
+        lengths = streamlines._lengths.astype(np.intp, copy=False)
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
         if streamlines_data.dtype == np.float32:
             c_arclengths_from_arraysequence[float2d](
-                                    streamlines_data,
-                                    streamlines._offsets.astype(np.intp),
-                                    streamlines._lengths.astype(np.intp),
-                                    arclengths)
+                                    streamlines_data, offsets, lengths,
+                                    arclengths, threads_to_use)
         elif streamlines_data.dtype == np.float64:
             c_arclengths_from_arraysequence[double2d](
-                                      streamlines_data,
-                                      streamlines._offsets.astype(np.intp),
-                                      streamlines._lengths.astype(np.intp),
-                                      arclengths)
+                                      streamlines_data, offsets, lengths,
+                                      arclengths, threads_to_use)
         else:
             streamlines_data = streamlines_data.astype(np.float64)
             c_arclengths_from_arraysequence[double2d](
-                                      streamlines_data,
-                                      streamlines._offsets.astype(np.intp),
-                                      streamlines._lengths.astype(np.intp),
-                                      arclengths)
+                                      streamlines_data, offsets, lengths,
+                                      arclengths, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
 
         return arclengths
 
@@ -245,24 +269,33 @@ cdef void c_set_number_of_points_from_arraysequence(Streamline points,
                                                     cnp.npy_intp[:] offsets,
                                                     cnp.npy_intp[:] lengths,
                                                     long nb_points,
-                                                    Streamline out) noexcept nogil:
+                                                    Streamline out,
+                                                    int num_threads) noexcept nogil:
     cdef:
-        cnp.npy_intp i, j, k
-        cnp.npy_intp offset, length
-        cnp.npy_intp offset_out = 0
-        double dn, sum_dn_sqr
+        cnp.npy_intp i
+        cnp.npy_intp offset, length, offset_out
 
-    for i in range(offsets.shape[0]):
+    for i in prange(offsets.shape[0], schedule="guided",
+                    num_threads=num_threads):
         offset = offsets[i]
         length = lengths[i]
+        offset_out = i * nb_points
 
         c_set_number_of_points(points[offset:offset+length, :],
                                out[offset_out:offset_out+nb_points, :])
 
-        offset_out += nb_points
+
+# Resampled versions of ArraySequence objects, see `set_number_of_points`
+_resampled_cache = weakref.WeakKeyDictionary()
 
 
-def set_number_of_points(streamlines, nb_points=3):
+def clear_resampled_cache():
+    """Forget the streamlines memoized by ``set_number_of_points``."""
+    _resampled_cache.clear()
+
+
+def set_number_of_points(streamlines, nb_points=3, out=None, num_threads=1,
+                         cache=False):
     """ Change the number of points of streamlines
         (either by downsampling or upsampling)
 
@@ -282,6 +315,29 @@ def set_number_of_points(streamlines, nb_points=3):
     nb_points : int
         integer representing number of points wanted along the curve.
 
+    out : ndarray, optional
+        Preallocated C-contiguous buffer of shape (N, nb_points, 3) or
+        (N * nb_points, 3), with the dtype of the streamlines data, holding
+        the result. Only used when `streamlines` is a
+        :class:`dipy.tracking.Streamlines`.
+
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization when
+        `streamlines` is a :class:`dipy.tracking.Streamlines`. If None the
+        value of OMP_NUM_THREADS environment variable is used if it is set,
+        otherwise all available threads are used. If < 0 the maximal number
+        of threads minus |num_threads + 1| is used (enter -1 to use as many
+        threads as possible). 0 raises an error. Default: 1.
+
+    cache : bool, optional
+        If True and `streamlines` is a :class:`dipy.tracking.Streamlines`,
+        the result is memoized for this (streamlines, nb_points) pair and
+        returned directly by later calls with ``cache=True``, as long as the
+        streamlines data is not replaced. Memoized results are read-only and
+        released together with `streamlines` or by calling
+        :func:`clear_resampled_cache`. The streamlines must not be modified
+        in place while they are cached.
+
     Returns
     -------
     new_streamlines : ndarray or a list or :class:`dipy.tracking.Streamlines`
@@ -317,27 +373,50 @@ def set_number_of_points(streamlines, nb_points=3):
         if len(streamlines) == 0:
             return Streamlines()
 
+        if cache:
+            cached = _resampled_cache.get(streamlines, {}).get(nb_points)
+            if cached is not None and cached[0] is streamlines._data:
+                return cached[1]
+
         nb_streamlines = len(streamlines)
         dtype = as_native_array(streamlines._data).dtype
+        if dtype != np.float32 and dtype != np.float64:
+            raise ValueError("Streamlines data must be float32 or float64.")
+        if out is None:
+            data = np.zeros((nb_streamlines * nb_points, 3), dtype=dtype)
+        else:
+            if (out.dtype != dtype or out.size != nb_streamlines * nb_points * 3
+                    or not out.flags.c_contiguous):
+                raise ValueError(
+                    "out must be a C-contiguous array of shape "
+                    f"({nb_streamlines}, {nb_points}, 3) and dtype {dtype}")
+            data = out.reshape((nb_streamlines * nb_points, 3))
         new_streamlines = Streamlines()
-        new_streamlines._data = np.zeros((nb_streamlines * nb_points, 3),
-                                         dtype=dtype)
+        new_streamlines._data = data
         new_streamlines._offsets = nb_points * np.arange(nb_streamlines,
                                                          dtype=np.intp)
         new_streamlines._lengths = nb_points * np.ones(nb_streamlines,
                                                        dtype=np.intp)
 
+        offsets = streamlines._offsets.astype(np.intp, copy=False)
+        lengths = streamlines._lengths.astype(np.intp, copy=False)
+        threads_to_use = determine_num_threads(num_threads)
+        set_num_threads(threads_to_use)
         if dtype == np.float32:
             c_set_number_of_points_from_arraysequence[float2d](
-                as_native_array(streamlines._data), streamlines._offsets.astype(np.intp),
-                streamlines._lengths.astype(np.intp), nb_points,
-                new_streamlines._data)
+                as_native_array(streamlines._data), offsets, lengths,
+                nb_points, new_streamlines._data, threads_to_use)
         else:
             c_set_number_of_points_from_arraysequence[double2d](
-                as_native_array(streamlines._data), streamlines._offsets.astype(np.intp),
-                streamlines._lengths.astype(np.intp), nb_points,
-                new_streamlines._data)
-
+                as_native_array(streamlines._data), offsets, lengths,
+                nb_points, new_streamlines._data, threads_to_use)
+        if num_threads is not None:
+            restore_default_num_threads()
+
+        if cache:
+            new_streamlines._data.flags.writeable = False
+            _resampled_cache.setdefault(streamlines, {})[nb_points] = (
+                streamlines._data, new_streamlines)
         return new_streamlines
 
     only_one_streamlines = False
@@ -6,6 +6,7 @@ from numpy.testing import (
     assert_array_almost_equal,
     assert_array_equal,
     assert_equal,
+    assert_raises,
 )
 
 from dipy.data import get_fnames
@@ -13,7 +14,7 @@ from dipy.io.streamline import load_tractogram
 from dipy.testing import assert_true
 from dipy.testing.decorators import set_random_number_generator
 from dipy.tracking import distances as pf
-from dipy.tracking.streamline import set_number_of_points
+from dipy.tracking.streamline import Streamlines, set_number_of_points
 
 
 @set_random_number_generator()
@@ -196,6 +197,60 @@ def test_bundles_distances_mdf(verbose=False):
         assert_true("not have the same number of points" in str(w[0].message))
 
 
+@set_random_number_generator()
+def test_bundles_distances_threshold_and_blocks(rng=None):
+    tracksA = [rng.normal(size=(12, 3)).astype("f4") for _ in range(40)]
+    tracksB = Streamlines(
+        [rng.normal(size=(rng.integers(4, 20), 3)) for _ in range(30)]
+    )
+    tracksB12 = set_number_of_points(tracksB, nb_points=12)
+
+    for distance, func, other in [
+        ("mdf", pf.bundles_distances_mdf, tracksB12),
+        ("mam", pf.bundles_distances_mam, tracksB),
+    ]:
+        dense = func(tracksA, other)
+        assert_equal(dense.shape, (40, 30))
+        for num_threads in [1, 2]:
+            assert_array_equal(func(tracksA, other, num_threads=num_threads), dense)
+
+        thr = np.median(dense)
+        sparse = func(tracksA, other, threshold=thr).toarray()
+        assert_array_equal(sparse, np.where(dense < thr, dense, 0))
+
+        blocks = list(
+            pf.bundles_distances_blocks(
+                tracksA, other, distance=distance, block_size=7, num_threads=2
+            )
+        )
+        assert_equal([start for start, _ in blocks], list(range(0, 40, 7)))
+        assert_array_equal(np.vstack([b for _, b in blocks]), dense)
+
+    # Views of a float64 ArraySequence only convert the points of their tracks
+    idx = [17, 3, 25, 8]
+    view = tracksB[idx]
+    points, offsets, lengths = pf._pack_tracks(view)
+    assert_equal(points.dtype, np.float32)
+    assert_equal(len(points), sum(len(t) for t in view))
+    for t, offset, length in zip(view, offsets, lengths):
+        assert_array_equal(points[offset : offset + length], t.astype("f4"))
+    assert_array_equal(
+        pf.bundles_distances_mam(tracksA, view),
+        pf.bundles_distances_mam(tracksA, list(view)),
+    )
+
+    # (N, M, 3) arrays are supported and identical tracks are kept
+    arr = np.array(tracksA)
+    sparse = pf.bundles_distances_mdf(arr, arr, threshold=1e-6)
+    assert_array_equal(sparse.row, sparse.col)
+    assert_equal(sparse.nnz, 40)
+    assert_equal(pf.bundles_distances_mdf(arr, []).shape, (40, 0))
+
+    assert_raises(ValueError, pf.bundles_distances_mdf, tracksA, [arr[0, :3]])
+    blocks = pf.bundles_distances_blocks(tracksA, tracksA, distance="mdl")
+    assert_raises(ValueError, list, blocks)
+
+
 def test_mam_distances():
     xyz1 = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 0, 0]])
     xyz2 = np.array([[0, 1, 1], [1, 0, 1], [2, 3, -2]])
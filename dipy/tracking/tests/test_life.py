@@ -125,6 +125,45 @@ def test_FiberModel_init():
         )
 
 
+def test_FiberModel_setup_storage(tmp_path):
+    data_file, bval_file, bvec_file = dpd.get_fnames(name="small_64D")
+    bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
+    gtab = grad.gradient_table(bvals, bvecs=bvecs)
+    FM = life.FiberModel(gtab)
+    streamline = [
+        np.array([[1, 2, 3], [1.2, 2.1, 3], [4, 5, 3], [5, 6, 3], [6, 7, 3]]),
+        np.array([[6, 7, 3], [5, 6, 3], [4, 5, 3.2], [4, 5, 3]]),
+        np.array([[1, 2, 3], [4, 5, 3], [5, 6, 3]]),
+    ]
+    for sphere in [None, False]:
+        ref_matrix, ref_coords = FM.setup(streamline, np.eye(4), sphere=sphere)
+        # Dense reference, one fiber at a time:
+        expected = np.zeros(ref_matrix.shape)
+        for f_idx, sl in enumerate(streamline):
+            if sphere is False:
+                sig = life.streamline_signal(sl, gtab)
+            else:
+                sig = life.LifeSignalMaker(gtab).streamline_signal(sl)
+            for node, node_sig in zip(np.round(sl).astype(int), sig):
+                v_idx = np.where((ref_coords == node).all(-1))[0][0]
+                expected[v_idx * 64 : (v_idx + 1) * 64, f_idx] += node_sig
+        npt.assert_almost_equal(ref_matrix.toarray(), expected)
+
+        for chunk_size in [1, 100]:
+            matrix, vox_coords = FM.setup(
+                streamline,
+                np.eye(4),
+                sphere=sphere,
+                dtype=np.float32,
+                mmap_dir=tmp_path,
+                chunk_size=chunk_size,
+            )
+            npt.assert_array_equal(vox_coords, ref_coords)
+            npt.assert_equal(matrix.dtype, np.float32)
+            npt.assert_almost_equal(matrix.toarray(), ref_matrix.toarray(), decimal=6)
+    npt.assert_(op.exists(tmp_path / "life_matrix_data.npy"))
+
+
 def test_FiberFit():
     data_file, bval_file, bvec_file = dpd.get_fnames(name="small_64D")
     data = load_nifti_data(data_file)
@@ -183,3 +222,24 @@ def test_fit_data():
     npt.assert_(np.median(model_rmse) < np.median(matlab_rmse))
     # And a moderate correlation with the Matlab implementation weights:
     npt.assert_(np.corrcoef(matlab_weights, life_fit.beta)[0, 1] > 0.6)
+
+    # The accelerated solver, warm-started from the previous solution:
+    fista_fit = life_model.fit(
+        data, tensor_streamlines_vox, np.eye(4), solver="fista", beta0=life_fit.beta
+    )
+
+    def sse(fit):
+        return np.sum((opt.spdot(fit.life_matrix, fit.beta) - fit.fit_data) ** 2)
+
+    npt.assert_(sse(fista_fit) <= sse(life_fit))
+
+    # The fit does not depend on the number of threads
+    fista_fit_2 = life_model.fit(
+        data,
+        tensor_streamlines_vox,
+        np.eye(4),
+        solver="fista",
+        beta0=life_fit.beta,
+        num_threads=2,
+    )
+    npt.assert_array_almost_equal(fista_fit_2.beta, fista_fit.beta)
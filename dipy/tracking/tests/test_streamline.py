@@ -31,6 +31,7 @@ from dipy.tracking.streamline import (
     values_from_volume,
 )
 from dipy.tracking.streamlinespeed import (
+    clear_resampled_cache,
     compress_streamlines,
     length,
     set_number_of_points,
@@ -346,6 +347,45 @@ def test_set_number_of_points():
     )
 
 
+@set_random_number_generator(42)
+def test_set_number_of_points_threads_and_out(rng):
+    for dtype in [np.float32, np.float64]:
+        streamlines = Streamlines(
+            [
+                np.cumsum(rng.standard_normal((rng.integers(2, 50), 3)), axis=0)
+                for _ in range(200)
+            ]
+        )
+        streamlines._data = streamlines._data.astype(dtype)
+        expected = [set_number_of_points(s, nb_points=12) for s in streamlines]
+
+        for num_threads in [1, 2, None]:
+            new = set_number_of_points(streamlines, 12, num_threads=num_threads)
+            assert_array_equal(new.get_data(), np.concatenate(expected))
+
+        out = np.zeros((len(streamlines), 12, 3), dtype=dtype)
+        new = set_number_of_points(streamlines, 12, out=out, num_threads=2)
+        npt.assert_(np.shares_memory(new._data, out))
+        assert_array_equal(out, np.array(expected))
+        assert_raises(ValueError, set_number_of_points, streamlines, 12, out=out[:-1])
+        assert_raises(
+            ValueError, set_number_of_points, streamlines, 12, out=out.astype("f2")
+        )
+
+        # Memoization
+        cached = set_number_of_points(streamlines, 12, cache=True)
+        assert_array_equal(cached.get_data(), np.concatenate(expected))
+        npt.assert_(not cached._data.flags.writeable)
+        npt.assert_(set_number_of_points(streamlines, 12, cache=True) is cached)
+        npt.assert_(set_number_of_points(streamlines, 12) is not cached)
+        npt.assert_(set_number_of_points(streamlines, 13, cache=True) is not cached)
+        streamlines._data = streamlines._data.copy()
+        npt.assert_(set_number_of_points(streamlines, 12, cache=True) is not cached)
+        cached = set_number_of_points(streamlines, 12, cache=True)
+        clear_resampled_cache()
+        npt.assert_(set_number_of_points(streamlines, 12, cache=True) is not cached)
+
+
 @set_random_number_generator(1234)
 def test_set_number_of_points_memory_leaks(rng):
     # Test some dtypes
@@ -498,6 +538,23 @@ def test_length():
     )
 
 
+@set_random_number_generator(42)
+def test_length_threads_and_out(rng):
+    streamlines = Streamlines(
+        [rng.standard_normal((rng.integers(1, 50), 3)) for _ in range(200)]
+    )
+    expected = [length(s) for s in streamlines]
+    for num_threads in [1, 2, None]:
+        assert_array_almost_equal(
+            length(streamlines, num_threads=num_threads), expected
+        )
+    out = np.empty(len(streamlines))
+    npt.assert_(length(streamlines, out=out, num_threads=2) is out)
+    assert_array_almost_equal(out, expected)
+    assert_raises(ValueError, length, streamlines, out=out[:-1])
+    assert_raises(ValueError, length, streamlines, out=out.astype(np.float32))
+
+
 @set_random_number_generator(1234)
 def test_length_memory_leaks(rng):
     # Test some dtypes
@@ -8,7 +8,7 @@ from dipy.testing import assert_true, assert_warns
 from dipy.testing.decorators import set_random_number_generator
 from dipy.tracking import metrics
 from dipy.tracking._utils import _to_voxel_coordinates
-from dipy.tracking.streamline import transform_streamlines
+from dipy.tracking.streamline import Streamlines, transform_streamlines
 from dipy.tracking.utils import (
     _min_at,
     clip_streamlines_to_target,
@@ -27,9 +27,10 @@ from dipy.tracking.utils import (
     seeds_from_mask,
     target,
     target_line_based,
+    track_density_map,
     unique_rows,
 )
-from dipy.tracking.vox2track import streamline_mapping
+from dipy.tracking.vox2track import streamline_mapping, streamline_mapping_csr
 
 
 def make_streamlines(return_seeds=False):
@@ -86,6 +87,79 @@ def test_density_map():
     npt.assert_array_equal(dm, expected)
 
 
+@set_random_number_generator(42)
+def test_density_map_streaming(rng):
+    streamlines = [rng.uniform(0, 9.4, (rng.integers(1, 20), 3)) for _ in range(200)]
+    streamlines.append(np.zeros((0, 3)))
+    shape = (10, 10, 10)
+    expected = np.zeros(shape, dtype=int)
+    weighted = np.zeros(shape)
+    weights = rng.random(len(streamlines))
+    for sl, w in zip(streamlines[:-1], weights):
+        i, j, k = _to_voxel_coordinates(sl, np.eye(3), 0.5).T
+        expected[i, j, k] += 1
+        weighted[i, j, k] += w
+
+    weighted_maps = []
+    for num_threads in (1, 3):
+        for chunk_size in (1, 17, 10000):
+            for sls in (streamlines, iter(streamlines), Streamlines(streamlines)):
+                dm = density_map(
+                    sls,
+                    np.eye(4),
+                    shape,
+                    chunk_size=chunk_size,
+                    num_threads=num_threads,
+                )
+                npt.assert_array_equal(dm, expected)
+                npt.assert_equal(dm.dtype.kind, "i")
+        dm = density_map(
+            streamlines,
+            np.eye(4),
+            shape,
+            weights=weights,
+            chunk_size=17,
+            num_threads=num_threads,
+        )
+        npt.assert_array_almost_equal(dm, weighted)
+        weighted_maps.append(dm)
+    # The weights are added in the order of the streamlines for any number of
+    # threads
+    npt.assert_array_equal(weighted_maps[0], weighted_maps[1])
+
+    npt.assert_raises(
+        ValueError, density_map, streamlines, np.eye(4), shape, weights=weights[:-1]
+    )
+    npt.assert_raises(IndexError, density_map, streamlines, np.eye(4), (9, 10, 10))
+    npt.assert_raises(
+        IndexError, density_map, [np.array([[-1.0, 0, 0]])], np.eye(4), shape
+    )
+
+
+def test_track_density_map():
+    streamlines = [np.array([[-0.5, -0.5, -0.5], [0.5, -0.5, -0.5], [1.5, 1.5, 1.5]])]
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    tdi, tdi_affine = track_density_map(streamlines, affine, (2, 2, 2))
+    npt.assert_array_equal(tdi, density_map(streamlines, affine, (2, 2, 2)))
+    npt.assert_array_equal(tdi_affine, affine)
+
+    tdi, tdi_affine = track_density_map(streamlines, affine, (2, 2, 2), upsample=2)
+    npt.assert_equal(tdi.shape, (4, 4, 4))
+    npt.assert_array_almost_equal(tdi_affine[:3, :3], np.eye(3))
+    npt.assert_array_almost_equal(tdi_affine[:3, 3], [-0.5, -0.5, -0.5])
+    expected = np.zeros((4, 4, 4), dtype=int)
+    expected[0, 0, 0] = 1
+    expected[1, 0, 0] = 1
+    expected[2, 2, 2] = 1
+    npt.assert_array_equal(tdi, expected)
+
+    tdi, _ = track_density_map(streamlines, affine, (2, 2, 2), upsample=(1, 2, 1))
+    npt.assert_equal(tdi.shape, (2, 4, 2))
+    npt.assert_raises(
+        ValueError, track_density_map, streamlines, affine, (2, 2, 2), upsample=0
+    )
+
+
 def test_to_voxel_coordinates_precision():
     # To simplify tests, use an identity affine. This would be the result of
     # a call to _mapping_to_voxel with another identity affine.
@@ -641,6 +715,38 @@ def test_streamline_mapping():
     npt.assert_equal(mapping, expected)
 
 
+@set_random_number_generator(7)
+def test_streamline_mapping_csr(rng):
+    shape = (10, 10, 10)
+    streamlines = [rng.uniform(0, 9.4, (rng.integers(1, 20), 3)) for _ in range(300)]
+    expected = streamline_mapping(streamlines, affine=np.eye(4))
+
+    for num_threads in (1, 3):
+        for chunk_size in (13, 100000):
+            voxels, offsets, indices = streamline_mapping_csr(
+                Streamlines(streamlines),
+                np.eye(4),
+                shape,
+                chunk_size=chunk_size,
+                num_threads=num_threads,
+            )
+            npt.assert_equal(indices.dtype, np.int32)
+            npt.assert_equal(len(offsets), len(voxels) + 1)
+            npt.assert_(np.all(np.diff(voxels) > 0))
+            coords = np.array(np.unravel_index(voxels, shape)).T
+            mapping = {
+                tuple(int(c) for c in coord): indices[offsets[i] : offsets[i + 1]]
+                for i, coord in enumerate(coords)
+            }
+            npt.assert_equal(mapping, expected)
+
+    voxels, offsets, indices = streamline_mapping_csr([], np.eye(4), shape)
+    npt.assert_equal((len(voxels), len(offsets), len(indices)), (0, 1, 0))
+    npt.assert_raises(
+        IndexError, streamline_mapping_csr, streamlines, np.eye(4), (5, 5, 5)
+    )
+
+
 @set_random_number_generator()
 def test_length(rng):
     # Generate a simulated bundle of fibers:
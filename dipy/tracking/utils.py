@@ -62,28 +62,48 @@ from dipy.testing.decorators import warning_for_keywords
 from dipy.tracking import metrics
 
 # Import helper functions shared with vox2track
-from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
-from dipy.tracking.vox2track import _streamlines_in_mask
+from dipy.tracking._utils import (
+    _iter_streamline_chunks,
+    _mapping_to_voxel,
+    _to_voxel_coordinates,
+)
+from dipy.tracking.vox2track import _accumulate_density, _streamlines_in_mask
+from dipy.utils.omp import determine_num_threads
 
 
-def density_map(streamlines, affine, vol_dims):
+def density_map(
+    streamlines, affine, vol_dims, *, weights=None, chunk_size=10000, num_threads=None
+):
     """Count the number of unique streamlines that pass through each voxel.
 
     Parameters
     ----------
     streamlines : iterable
-        A sequence of streamlines.
+        A sequence of streamlines. Generators and lazily loaded tractograms
+        are consumed in chunks and never held in memory all at once.
     affine : array_like (4, 4)
         The mapping from voxel coordinates to streamline points.
         The voxel_to_rasmm matrix, typically from a NIFTI file.
     vol_dims : 3 ints
         The shape of the volume to be returned containing the streamlines
         counts
+    weights : array_like (N,), optional
+        One weight per streamline, added (instead of 1) to every voxel that
+        the streamline passes through.
+    chunk_size : int, optional
+        Number of streamlines processed at once.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus |num_threads + 1| is used (enter -1 to
+        use as many threads as possible). 0 raises an error.
 
     Returns
     -------
     image_volume : ndarray, shape=vol_dims
-        The number of streamline points in each voxel of volume.
+        The number of streamline points in each voxel of volume. Integer
+        counts if `weights` is None, the sum of the weights otherwise.
 
     Raises
     ------
@@ -98,15 +118,110 @@ def density_map(streamlines, affine, vol_dims):
     the edges of the voxels are smaller than the steps of the streamlines.
 
     """
+    vol_dims = tuple(int(d) for d in vol_dims)
     lin_T, offset = _mapping_to_voxel(affine)
-    counts = np.zeros(vol_dims, "int")
-    for sl in streamlines:
-        inds = _to_voxel_coordinates(sl, lin_T, offset)
-        i, j, k = inds.T
-        # this takes advantage of the fact that numpy's += operator only
-        # acts once even if there are repeats in inds
-        counts[i, j, k] += 1
-    return counts
+    threads_to_use = determine_num_threads(num_threads)
+    dims = np.array(vol_dims, dtype=np.intp)
+    if weights is None:
+        density = np.zeros(np.prod(vol_dims), dtype=np.int64)
+    else:
+        weights = np.asarray(weights, dtype=np.float64)
+        density = np.zeros(np.prod(vol_dims))
+
+    n_seen = 0
+    for points, offsets, lengths in _iter_streamline_chunks(streamlines, chunk_size):
+        n = len(lengths)
+        if weights is None:
+            chunk_weights = np.ones(n, dtype=np.int64)
+        else:
+            chunk_weights = np.ascontiguousarray(weights[n_seen : n_seen + n])
+            if len(chunk_weights) != n:
+                raise ValueError("weights must have one value per streamline")
+        status = _accumulate_density(
+            points,
+            offsets,
+            lengths,
+            chunk_weights,
+            density,
+            dims,
+            lin_T,
+            offset,
+            num_threads=threads_to_use,
+        )
+        if status.any():
+            raise IndexError(
+                "streamline has points that map outside of the volume "
+                f"(streamline {n_seen + np.flatnonzero(status)[0]})"
+            )
+        n_seen += n
+
+    if weights is not None and len(weights) != n_seen:
+        raise ValueError("weights must have one value per streamline")
+
+    return density.reshape(vol_dims)
+
+
+def track_density_map(
+    streamlines,
+    affine,
+    vol_dims,
+    *,
+    upsample=1,
+    weights=None,
+    chunk_size=10000,
+    num_threads=None,
+):
+    """Track density imaging (TDI) on a grid finer than the reference image.
+
+    Each voxel of the reference grid is split in ``upsample`` voxels along
+    every axis and :func:`density_map` is computed on the resulting grid.
+
+    Parameters
+    ----------
+    streamlines : iterable
+        A sequence of streamlines, possibly a generator or lazily loaded
+        tractogram.
+    affine : array_like (4, 4)
+        The voxel_to_rasmm matrix of the reference image.
+    vol_dims : 3 ints
+        The shape of the reference image.
+    upsample : int or 3 ints, optional
+        Super-resolution factor along each axis.
+    weights : array_like (N,), optional
+        One weight per streamline. See :func:`density_map`.
+    chunk_size : int, optional
+        Number of streamlines processed at once.
+    num_threads : int, optional
+        Number of threads. See :func:`density_map`.
+
+    Returns
+    -------
+    tdi : ndarray
+        The density map, of shape ``vol_dims * upsample``.
+    tdi_affine : ndarray (4, 4)
+        The voxel_to_rasmm matrix of the super-resolution grid.
+
+    """
+    factor = np.broadcast_to(np.asarray(upsample, dtype=int), (3,))
+    if np.any(factor < 1):
+        raise ValueError("upsample must be a positive integer")
+    # Voxel i of the fine grid has its center at (i + .5) / f - .5 in the
+    # reference grid
+    scaling = np.eye(4)
+    scaling[:3, :3] = np.diag(1.0 / factor)
+    scaling[:3, 3] = 0.5 / factor - 0.5
+    tdi_affine = np.dot(np.asarray(affine, dtype=float), scaling)
+    tdi_dims = tuple(int(d) * int(f) for d, f in zip(vol_dims, factor))
+
+    tdi = density_map(
+        streamlines,
+        tdi_affine,
+        tdi_dims,
+        weights=weights,
+        chunk_size=chunk_size,
+        num_threads=num_threads,
+    )
+    return tdi, tdi_affine
 
 
 @warning_for_keywords()
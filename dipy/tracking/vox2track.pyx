@@ -7,10 +7,15 @@ import cython
 cdef extern from "dpy_math.h" nogil:
     double fmin(double x, double y)
 from libc.math cimport ceil, floor, fabs, sqrt
+from libc.stdlib cimport qsort
+from cython.parallel import prange
 
 import numpy as np
 cimport numpy as cnp
-from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
+from dipy.tracking._utils import (_iter_streamline_chunks, _mapping_to_voxel,
+                                  _to_voxel_coordinates)
+from dipy.utils.omp import determine_num_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 
 @cython.boundscheck(False)
@@ -156,6 +161,91 @@ def streamline_mapping(streamlines, affine=None,
     return mapping
 
 
+def streamline_mapping_csr(streamlines, affine, vol_dims, chunk_size=100000,
+                           num_threads=None):
+    """Creates a compact mapping from voxels to streamlines.
+
+    Equivalent to :func:`streamline_mapping` but, instead of a dictionary of
+    lists, the mapping is returned in compressed sparse row (CSR) form: the
+    streamlines passing through voxel ``voxels[i]`` are
+    ``indices[offsets[i]:offsets[i + 1]]``, in increasing order.
+
+    Parameters
+    ----------
+    streamlines : sequence
+        A sequence of streamlines. ArraySequence data is read chunk by chunk,
+        without copying the whole tractogram.
+    affine : array_like (4, 4)
+        The mapping from voxel coordinates to streamline coordinates.
+    vol_dims : 3 ints
+        The shape of the volume, used to linearize the voxel indices.
+    chunk_size : int, optional
+        Number of streamlines processed at once.
+    num_threads : int, optional
+        Number of threads to be used for OpenMP parallelization. If None
+        (default) the value of OMP_NUM_THREADS environment variable is used
+        if it is set, otherwise all available threads are used. If < 0 the
+        maximal number of threads minus |num_threads + 1| is used (enter -1 to
+        use as many threads as possible). 0 raises an error.
+
+    Returns
+    -------
+    voxels : array (V,) of intp
+        Sorted linear (C order) indices of the voxels crossed by at least one
+        streamline. Use ``np.unravel_index(voxels, vol_dims)`` to get the 3d
+        indices.
+    offsets : array (V + 1,) of intp
+        Start of the streamlines of each voxel in `indices`.
+    indices : array of int32
+        Streamline indices, grouped by voxel.
+
+    Raises
+    ------
+    IndexError
+        When the points of the streamlines lie outside of the volume.
+
+    Examples
+    --------
+    >>> streamlines = [np.array([[0., 0., 0.],
+    ...                          [1., 1., 1.],
+    ...                          [2., 3., 4.]]),
+    ...                np.array([[0., 0., 0.],
+    ...                          [1., 2., 3.]])]
+    >>> voxels, offsets, indices = streamline_mapping_csr(
+    ...     streamlines, np.eye(4), (5, 5, 5))
+    >>> voxels
+    array([ 0, 31, 38, 69])
+    >>> [indices[offsets[i]:offsets[i + 1]].tolist() for i in range(4)]
+    [[0, 1], [0], [1], [0]]
+
+    """
+    vol_dims = tuple(int(d) for d in vol_dims)
+    lin_T, offset = _mapping_to_voxel(affine)
+    dims = np.array(vol_dims, dtype=np.intp)
+
+    chunk_voxels = []
+    chunk_counts = []
+    n_seen = 0
+    for points, offsets, lengths in _iter_streamline_chunks(streamlines,
+                                                            chunk_size):
+        voxels, counts = _unique_voxels(points, offsets, lengths, dims,
+                                        lin_T, offset, num_threads)
+        if np.any(counts < 0):
+            raise IndexError(
+                "streamline has points that map outside of the volume "
+                f"(streamline {n_seen + np.flatnonzero(counts < 0)[0]})")
+        chunk_voxels.append(voxels)
+        chunk_counts.append(counts)
+        n_seen += len(lengths)
+
+    if not n_seen:
+        return (np.zeros(0, dtype=np.intp), np.zeros(1, dtype=np.intp),
+                np.zeros(0, dtype=np.int32))
+    return _pairs_to_csr(np.concatenate(chunk_voxels),
+                         np.concatenate(chunk_counts),
+                         np.prod(vol_dims))
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cdef inline cnp.double_t norm(cnp.double_t x,
@@ -458,3 +548,220 @@ def track_counts(tracks, vol_dims, vox_sizes=(1,1,1), return_elements=True):
     if ret_elf:
         return tcs.reshape(vol_dims), el_inds
     return tcs.reshape(vol_dims)
+
+
+cdef int _compare_intp(const void *a, const void *b) noexcept nogil:
+    cdef cnp.npy_intp va = (<cnp.npy_intp*>a)[0]
+    cdef cnp.npy_intp vb = (<cnp.npy_intp*>b)[0]
+    return (va > vb) - (va < vb)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef cnp.npy_intp _streamline_linear_voxels(
+        double[:, ::1] points,
+        cnp.npy_intp start,
+        cnp.npy_intp n_points,
+        double[:, ::1] lin_T,
+        double[::1] offset,
+        cnp.npy_intp[::1] dims,
+        cnp.npy_intp *out) noexcept nogil:
+    """Sorted unique linear voxel indices visited by one streamline.
+
+    Applies the same voxel mapping and rounding as ``_to_voxel_coordinates``.
+    Returns the number of unique voxels written to ``out``, or -1 if a point
+    of the streamline falls outside of the volume.
+    """
+    cdef:
+        cnp.npy_intp i, j, d, n_unique
+        cnp.npy_intp idx[3]
+        double v
+
+    for i in range(n_points):
+        for d in range(3):
+            v = (points[start + i, 0] * lin_T[0, d] +
+                 points[start + i, 1] * lin_T[1, d] +
+                 points[start + i, 2] * lin_T[2, d] + offset[d])
+            # Same tolerance as rounding to 6 decimals before the check
+            if v < -5e-7:
+                return -1
+            idx[d] = <cnp.npy_intp>v if v > 0 else 0
+            if idx[d] >= dims[d]:
+                return -1
+        out[i] = (idx[0] * dims[1] + idx[1]) * dims[2] + idx[2]
+
+    if n_points == 0:
+        return 0
+    qsort(out, n_points, sizeof(cnp.npy_intp), _compare_intp)
+    n_unique = 1
+    for j in range(1, n_points):
+        if out[j] != out[n_unique - 1]:
+            out[n_unique] = out[j]
+            n_unique += 1
+    return n_unique
+
+
+ctypedef fused density_t:
+    cnp.int64_t
+    double
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _accumulate_density(double[:, ::1] points,
+                        cnp.npy_intp[::1] offsets,
+                        cnp.npy_intp[::1] lengths,
+                        density_t[::1] weights,
+                        density_t[::1] density,
+                        cnp.npy_intp[::1] dims,
+                        double[:, ::1] lin_T,
+                        double[::1] offset,
+                        num_threads=None):
+    """Adds one chunk of streamlines to a density map.
+
+    This function is private because it's supposed to be called only by
+    ``tracking.utils.density_map`` and ``tracking.utils.track_density_map``.
+
+    Parameters
+    ----------
+    points : array (P, 3)
+        Points of all the streamlines of the chunk.
+    offsets, lengths : arrays (S,)
+        Position and number of points of each streamline in ``points``.
+    weights : array (S,)
+        Value added to every voxel visited by each streamline.
+    density : array (prod(dims),)
+        Flattened density map, updated in place.
+    dims : array (3,)
+        Shape of the density map.
+    lin_T, offset : arrays (3, 3) and (3,)
+        Mapping to voxel space obtained with `_mapping_to_voxel`.
+    num_threads : int, optional
+        Number of threads. See :func:`dipy.utils.omp.determine_num_threads`.
+
+    Returns
+    -------
+    status : array (S,) of uint8
+        1 for the streamlines with points outside of the volume (they are
+        not accumulated), 0 otherwise.
+
+    Notes
+    -----
+    The voxels of the streamlines are found in parallel with
+    `_unique_voxels`, and then added to the shared map sequentially, in the
+    order of the streamlines. The extra memory is proportional to the number
+    of points of the chunk, whatever the number of threads.
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = lengths.shape[0]
+        cnp.npy_intp s, j, pos = 0
+        cnp.npy_intp[::1] voxels
+        cnp.npy_intp[::1] counts
+        cnp.uint8_t[::1] status = np.zeros(nb_streamlines, dtype=np.uint8)
+
+    voxels, counts = _unique_voxels(points, offsets, lengths, dims, lin_T,
+                                    offset, num_threads=num_threads)
+    with nogil:
+        for s in range(nb_streamlines):
+            if counts[s] < 0:
+                status[s] = 1
+                continue
+            for j in range(counts[s]):
+                density[voxels[pos + j]] += weights[s]
+            pos += counts[s]
+
+    return np.asarray(status)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _unique_voxels(double[:, ::1] points,
+                   cnp.npy_intp[::1] offsets,
+                   cnp.npy_intp[::1] lengths,
+                   cnp.npy_intp[::1] dims,
+                   double[:, ::1] lin_T,
+                   double[::1] offset,
+                   num_threads=None):
+    """Unique voxels crossed by each streamline of a chunk.
+
+    Returns the concatenated sorted linear voxel indices of every streamline
+    and the number of voxels of each streamline (-1 if the streamline leaves
+    the volume, in which case it contributes no voxel).
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = lengths.shape[0]
+        cnp.npy_intp s, i, pos = 0
+        int threads_to_use
+        cnp.npy_intp[::1] buffer = np.empty(points.shape[0], dtype=np.intp)
+        cnp.npy_intp[::1] counts = np.empty(nb_streamlines, dtype=np.intp)
+
+    threads_to_use = determine_num_threads(num_threads)
+    # Each streamline has at most as many voxels as points, so it can use
+    # its own slice of the points buffer without synchronization.
+    set_num_threads(threads_to_use)
+    with nogil:
+        for s in prange(nb_streamlines, schedule="guided",
+                        num_threads=threads_to_use):
+            counts[s] = _streamline_linear_voxels(points, offsets[s],
+                                                  lengths[s], lin_T, offset,
+                                                  dims, &buffer[offsets[s]])
+        # Compact the slices
+        for s in range(nb_streamlines):
+            for i in range(counts[s]):
+                buffer[pos + i] = buffer[offsets[s] + i]
+            pos += max(counts[s], 0)
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    return np.asarray(buffer[:pos]), np.asarray(counts)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _pairs_to_csr(cnp.npy_intp[::1] voxels,
+                  cnp.npy_intp[::1] counts,
+                  cnp.npy_intp n_voxels):
+    """Counting sort of (voxel, streamline) pairs ordered by streamline.
+
+    ``voxels`` holds, for each streamline in turn, the ``counts[s]`` voxels
+    it crosses. Returns the CSR arrays described in
+    :func:`streamline_mapping_csr`.
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = counts.shape[0]
+        cnp.npy_intp s, i, v, k = 0, n_occupied = 0
+        cnp.npy_intp[::1] starts = np.zeros(n_voxels + 1, dtype=np.intp)
+        cnp.npy_intp[::1] occupied
+        cnp.npy_intp[::1] csr_offsets
+        cnp.int32_t[::1] indices = np.empty(voxels.shape[0], dtype=np.int32)
+
+    with nogil:
+        # Count pass
+        for i in range(voxels.shape[0]):
+            starts[voxels[i] + 1] += 1
+        for v in range(n_voxels):
+            if starts[v + 1]:
+                n_occupied += 1
+            starts[v + 1] += starts[v]
+
+    occupied = np.empty(n_occupied, dtype=np.intp)
+    csr_offsets = np.empty(n_occupied + 1, dtype=np.intp)
+
+    with nogil:
+        for v in range(n_voxels):
+            if starts[v + 1] > starts[v]:
+                occupied[k] = v
+                csr_offsets[k] = starts[v]
+                k += 1
+        csr_offsets[n_occupied] = voxels.shape[0]
+        # Fill pass, streamlines are visited in order so each voxel gets
+        # sorted streamline indices
+        k = 0
+        for s in range(nb_streamlines):
+            for i in range(counts[s] if counts[s] > 0 else 0):
+                v = voxels[k]
+                indices[starts[v]] = <cnp.int32_t>s
+                starts[v] += 1
+                k += 1
+
+    return np.asarray(occupied), np.asarray(csr_offsets), np.asarray(indices)
@@ -102,10 +102,9 @@ class ResliceFlow(Workflow):
             Fill value for points outside the input boundaries when
             mode='constant'.
         num_processes : int, optional
-            Split the calculation to a pool of children processes. This only
-            applies to 4D `data` arrays. Default is 1. If < 0 the maximal
-            number of cores minus ``num_processes + 1`` is used (enter -1 to
-            use as many cores as possible). 0 raises an error.
+            Split the calculation to a pool of threads. Default is 1. If < 0
+            the maximal number of cores minus ``num_processes + 1`` is used
+            (enter -1 to use as many cores as possible). 0 raises an error.
         vox_factor : float, optional
             Interpolation factor for automatic voxel size calculation,
             ranging from 0.0 to 1.0. Controls the trade-off between the
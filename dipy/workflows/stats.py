@@ -15,7 +15,7 @@ from dipy.io.streamline import load_tractogram
 from dipy.reconst.dti import TensorModel
 from dipy.segment.bundles import bundle_shape_similarity
 from dipy.segment.mask import bounding_box, segment_from_cfa
-from dipy.stats.analysis import anatomical_measures, assignment_map, peak_values
+from dipy.stats.analysis import assignment_map, buan_profiles, save_buan_profiles
 from dipy.testing.decorators import warning_for_keywords
 from dipy.tracking.streamline import transform_streamlines
 from dipy.utils.logging import logger
@@ -239,6 +239,25 @@ def buan_bundle_profiles(
     logger.info(org_bd)
     n = len(mb)
 
+    # Load every metric once, they are shared by all the bundles
+    metrics = {}
+    metric_files_names_dti = sorted(Path(metric_folder).glob("*.nii.gz"))
+    metric_files_names_csa = sorted(Path(metric_folder).glob("*.pam5"))
+    if n > 0:
+        _, affine = load_nifti(metric_files_names_dti[0])
+        affine_r = np.linalg.inv(affine)
+
+    for metric_file in metric_files_names_dti:
+        logger.info(f"metric = {metric_file}")
+        metrics[Path(metric_file).name[:-7]], _ = load_nifti(metric_file)
+
+    for metric_file in metric_files_names_csa:
+        logger.info(f"metric = {metric_file}")
+        peaks = load_peaks(metric_file)
+        fm = Path(metric_file).name[:-5]
+        metrics[fm + "_gfa"] = peaks.gfa
+        metrics[fm + "_qa"] = peaks.qa[..., 0]
+
     for io in range(n):
         mbundles = load_tractogram(
             mb[io], reference="same", bbox_valid_check=False
@@ -254,63 +273,15 @@ def buan_bundle_profiles(
             indx = assignment_map(bundles, mbundles, no_disks)
             ind = np.array(indx)
 
-            metric_files_names_dti = list(Path(metric_folder).glob("*.nii.gz"))
-
-            metric_files_names_csa = list(Path(metric_folder).glob("*.pam5"))
-
-            _, affine = load_nifti(metric_files_names_dti[0])
-
-            affine_r = np.linalg.inv(affine)
             transformed_orig_bundles = transform_streamlines(orig_bundles, affine_r)
 
-            for mn in range(len(metric_files_names_dti)):
-                metric_name = Path(metric_files_names_dti[mn]).name
-
-                fm = metric_name[:-7]
-                bm = Path(mb[io]).name[:-4]
-
-                logger.info(f"bm = {bm}")
-
-                dt = {}
-
-                logger.info(f"metric = {metric_files_names_dti[mn]}")
-
-                metric, _ = load_nifti(metric_files_names_dti[mn])
+            bm = Path(mb[io]).name[:-4]
+            logger.info(f"bm = {bm}")
 
-                anatomical_measures(
-                    transformed_orig_bundles,
-                    metric,
-                    dt,
-                    fm,
-                    bm,
-                    subject,
-                    group_id,
-                    ind,
-                    out_dir,
-                )
-
-            for mn in range(len(metric_files_names_csa)):
-                metric_name = Path(metric_files_names_csa[mn]).name
-
-                fm = metric_name[:-5]
-                bm = Path(mb[io]).name[:-4]
-
-                logger.info(f"bm = {bm}")
-                logger.info(f"metric = {metric_files_names_csa[mn]}")
-                dt = {}
-                metric = load_peaks(metric_files_names_csa[mn])
-
-                peak_values(
-                    transformed_orig_bundles,
-                    metric,
-                    dt,
-                    fm,
-                    bm,
-                    subject,
-                    group_id,
-                    ind,
-                    out_dir,
-                )
+            profiles = buan_profiles(
+                transformed_orig_bundles, metrics, ind, subject, group_id
+            )
+            save_buan_profiles(profiles, bm, out_dir)
 
     logger.info(f"total time taken in minutes = {(-t + time()) / 60}")
 